@@ -0,0 +1,195 @@
+"""
+Write-behind buffer for Supabase upserts
+Accumulates rows and flushes them as multi-row upserts on size or age thresholds
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+from app.metrics import UPSERT_PENDING
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+# Every live buffer, so shutdown hooks can flush whatever is still pending
+_LIVE_BUFFERS: "weakref.WeakSet[BatchUpserter]" = weakref.WeakSet()
+
+
+class BatchUpserter:
+    """
+    Collect rows for one table and write them with a single upsert per flush.
+
+    A flush happens when `max_rows` rows are pending, when the oldest pending
+    row is older than `max_age_secs` (a timer thread enforces this when no
+    further rows arrive), or when `flush()`/`close()` is called.
+    PostgREST sends one column list per bulk payload and fills missing keys
+    with NULL, so rows are grouped by their key set and each group is its
+    own upsert; a row never overwrites a column it did not carry.
+    If a multi-row upsert fails, the group is bisected until the failing rows
+    are isolated, so each error is attributed to the row key that caused it.
+    `on_flush` receives the rows written by each flush, e.g. to maintain
+    derived aggregates.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        table: str,
+        on_conflict: str = "response_id",
+        max_rows: int = 250,
+        max_age_secs: float = 5.0,
+        on_flush: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+    ) -> None:
+        self.client = client
+        self.table = table
+        self.on_conflict = on_conflict
+        self.max_rows = max_rows
+        self.max_age_secs = max_age_secs
+        self.on_flush = on_flush
+
+        self._pending: List[Dict[str, Any]] = []
+        self._oldest: Optional[float] = None
+        self._lock = threading.Lock()
+        # Serializes flushes from callers and the age timer
+        self._flush_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+        self.written = 0
+        self.round_trips = 0
+        self.failures: List[Tuple[Any, str]] = []
+
+        _LIVE_BUFFERS.add(self)
+
+    # -------------------------------------------------------------------------
+    # Public API
+    # -------------------------------------------------------------------------
+    def add(self, row: Dict[str, Any]) -> None:
+        """Queue a row; flushes automatically when a threshold is reached."""
+        with self._lock:
+            self._pending.append(row)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._schedule(self.max_age_secs)
+            UPSERT_PENDING.set(len(self._pending), table=self.table)
+        if self._should_flush():
+            self.flush()
+
+    def flush(self) -> int:
+        """Write all pending rows. Returns the number of rows written."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+            self._oldest = None
+            self._cancel_timer()
+            UPSERT_PENDING.set(0, table=self.table)
+        if not batch:
+            return 0
+        groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for row in batch:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        written = sum(self._write(group) for group in groups.values())
+        if self.on_flush and written:
+            failed = {key for key, _ in self.failures}
+            try:
+                self.on_flush([r for r in batch if r.get(self.on_conflict) not in failed])
+            except Exception as e:
+                logging.error(f"on_flush hook for {self.table} failed: {e}")
+        return written
+
+    def close(self) -> None:
+        self.flush()
+        _LIVE_BUFFERS.discard(self)
+
+    def take_failures(self) -> List[Tuple[Any, str]]:
+        """Return and clear the (row key, error) pairs collected so far."""
+        with self._lock:
+            failures, self.failures = self.failures, []
+        return failures
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def __enter__(self) -> "BatchUpserter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    # -------------------------------------------------------------------------
+    # Internals
+    # -------------------------------------------------------------------------
+    def _schedule(self, delay: float) -> None:
+        # Caller holds self._lock
+        self._cancel_timer()
+        timer = threading.Timer(max(delay, 0.0), self._on_timer)
+        timer.daemon = True
+        self._timer = timer
+        timer.start()
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timer(self) -> None:
+        """Age-based flush when no add() came along to trigger it."""
+        with self._lock:
+            if self._oldest is None:
+                return
+            remaining = self.max_age_secs - (time.monotonic() - self._oldest)
+            if remaining > 0:
+                self._schedule(remaining)
+                return
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error(f"Timed flush for {self.table} failed: {e}")
+
+    def _should_flush(self) -> bool:
+        if len(self._pending) >= self.max_rows:
+            return True
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.max_age_secs
+
+    def _write(self, batch: List[Dict[str, Any]]) -> int:
+        try:
+            self._upsert(batch)
+            self.written += len(batch)
+            return len(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                key = batch[0].get(self.on_conflict)
+                logging.error(f"Upsert into {self.table} failed for {key}: {e}")
+                with self._lock:
+                    self.failures.append((key, str(e)))
+                return 0
+            # Bisect to isolate the offending rows
+            mid = len(batch) // 2
+            return self._write(batch[:mid]) + self._write(batch[mid:])
+
+    def _upsert(self, batch: List[Dict[str, Any]]) -> None:
+        # Every row of a batch has the same keys (see flush)
+        self.round_trips += 1
+        self.client.table(self.table).upsert(batch, on_conflict=self.on_conflict).execute()
+
+
+def flush_all() -> None:
+    """Flush every live buffer; used on application shutdown."""
+    for buf in list(_LIVE_BUFFERS):
+        try:
+            buf.flush()
+        except Exception as e:
+            logging.error(f"Flush on shutdown failed for {buf.table}: {e}")
+
+
+atexit.register(flush_all)
@@ -0,0 +1,101 @@
+"""
+Shared API clients
+One Supabase client per key (service role / anon) and one OpenAI client per
+flavour (async / sync) per process, built on first use. Importing this module
+is cheap: supabase and openai are only imported when a client is requested,
+and missing environment variables raise then instead of at import time.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict
+
+from app.metrics import instrument_supabase
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+    from supabase import Client
+
+_clients: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+SUPABASE_KEYS = {
+    "service": "SUPABASE_SERVICE_ROLE_KEY",
+    "anon": "SUPABASE_ANON_KEY",
+}
+
+
+def require_env(*names: str) -> Dict[str, str]:
+    values = {n: os.getenv(n) for n in names}
+    missing = [n for n, v in values.items() if not v]
+    if missing:
+        raise RuntimeError(f"Missing {' or '.join(missing)}")
+    return values  # type: ignore[return-value]
+
+
+def _get(name: str, build: Any) -> Any:
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = build()
+    return client
+
+
+def supabase(role: str = "service") -> "Client":
+    """Shared Supabase client for `role` ('service' or 'anon'), instrumented for /metrics."""
+
+    def build() -> "Client":
+        from supabase import create_client
+
+        env = require_env("SUPABASE_URL", SUPABASE_KEYS[role])
+        return instrument_supabase(create_client(env["SUPABASE_URL"], env[SUPABASE_KEYS[role]]))
+
+    return _get(f"supabase:{role}", build)
+
+
+def openai_async() -> "AsyncOpenAI":
+    def build() -> "AsyncOpenAI":
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(api_key=require_env("OPENAI_API_KEY")["OPENAI_API_KEY"])
+
+    return _get("openai:async", build)
+
+
+def openai_sync() -> "OpenAI":
+    def build() -> "OpenAI":
+        from openai import OpenAI
+
+        return OpenAI(api_key=require_env("OPENAI_API_KEY")["OPENAI_API_KEY"])
+
+    return _get("openai:sync", build)
+
+
+def preload() -> None:
+    """Build the clients up front, e.g. from a startup hook before taking traffic."""
+    supabase("service")
+    if os.getenv("SUPABASE_ANON_KEY"):
+        supabase("anon")
+    if os.getenv("OPENAI_API_KEY"):
+        openai_async()
+
+
+async def close_all() -> None:
+    """Close pooled HTTP connections on shutdown."""
+    with _lock:
+        clients = list(_clients.items())
+        _clients.clear()
+    for name, client in clients:
+        try:
+            if name.startswith("supabase:"):
+                client.postgrest.session.close()
+            elif name == "openai:async":
+                await client.close()
+            else:
+                client.close()
+        except Exception:
+            pass
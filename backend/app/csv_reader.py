@@ -0,0 +1,269 @@
+"""
+CSV upload reading
+Uploads are decoded with a detected encoding instead of UTF-8 with dropped
+bytes: a BOM wins, then strict UTF-8, then cp1252 (Excel's "CSV" on Dutch
+Windows), then latin-1, which accepts every byte. The delimiter is chosen by
+parsing a sample with each candidate and keeping the one that gives the most
+rows with the header's field count.
+
+Parsing is pluggable (CSV_READER): "arrow" reads with pyarrow.csv on all
+cores straight into Arrow string columns, "stdlib" with the csv module into
+column lists (no pyarrow needed). Either way the result is a ParsedColumns:
+columns by header, handed to normalization in record batches, with original
+rows only materialized for the slices that need them (legacy nps_raw).
+Every cell is read as text, so leading zeros and codes survive unchanged.
+
+read_csv_file does the same for an upload spooled to disk without loading it:
+detection streams the file once and both readers read from the path.
+"""
+
+from __future__ import annotations
+
+import codecs
+import csv
+import io
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+CSV_READER = os.getenv("CSV_READER", "arrow")  # arrow | stdlib
+# Rows per batch handed to normalization
+BATCH_ROWS = int(os.getenv("CSV_BATCH_ROWS", "65536"))
+SAMPLE_BYTES = 64 * 1024
+# Read size when streaming a spooled upload through detection
+SCAN_CHUNK = 1024 * 1024
+SAMPLE_ROWS = 200
+DELIMITERS = (",", ";", "\t", "|")
+BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+
+# -----------------------------------------------------------------------------
+# Detection
+# -----------------------------------------------------------------------------
+def detect_encoding(data: bytes) -> str:
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    for encoding in ("utf-8", "cp1252"):
+        try:
+            data.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin-1"
+
+
+def scan_file(path: str) -> Tuple[str, bytes, bool]:
+    """
+    detect_encoding for a file in one streamed pass: the encoding, the head
+    _sample needs and whether the file contains any quote.
+    """
+    decoders = {encoding: codecs.getincrementaldecoder(encoding)() for encoding in ("utf-8", "cp1252")}
+    head = b""
+    quoted = False
+    with open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(SCAN_CHUNK)
+            if len(head) <= SAMPLE_BYTES:
+                head += chunk[: SAMPLE_BYTES + 1 - len(head)]
+            quoted = quoted or b'"' in chunk
+            for encoding, decoder in list(decoders.items()):
+                try:
+                    decoder.decode(chunk, final=not chunk)
+                except UnicodeDecodeError:
+                    del decoders[encoding]
+            if not chunk:
+                break
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding, head, quoted
+    return next(iter(decoders), "latin-1"), head, quoted
+
+
+def _sample(data: bytes, encoding: str) -> str:
+    head = data[:SAMPLE_BYTES]
+    if len(data) > SAMPLE_BYTES:
+        # Whole lines only; utf-16 needs an even cut
+        cut = head.rfind(b"\n")
+        head = head[: cut + 1] if cut > 0 else head
+        if encoding == "utf-16" and len(head) % 2:
+            head = head + data[len(head): len(head) + 1]
+    return head.decode(encoding, errors="replace")
+
+
+def detect_delimiter(sample: str) -> str:
+    """Candidate whose sample rows most often match the header's field count."""
+    best: Tuple[float, int, str] = (0.0, 0, "")
+    for delimiter in DELIMITERS:
+        rows = [r for _, r in zip(range(SAMPLE_ROWS), csv.reader(io.StringIO(sample), delimiter=delimiter)) if r]
+        if len(rows) < 1 or len(rows[0]) < 2:
+            continue
+        width = len(rows[0])
+        # The last sampled row may be cut off
+        body = rows[1:-1] if len(rows) > 2 else rows[1:]
+        consistent = sum(len(r) == width for r in body) / len(body) if body else 1.0
+        best = max(best, (consistent, width, delimiter))
+    if best[2]:
+        return best[2]
+    try:
+        return csv.Sniffer().sniff(sample, delimiters="".join(DELIMITERS)).delimiter
+    except csv.Error:
+        return ";" if sample.count(";") > sample.count(",") else ","
+
+
+# -----------------------------------------------------------------------------
+# Parsed uploads
+# -----------------------------------------------------------------------------
+@dataclass
+class ParsedColumns:
+    """
+    An upload as columns. `columns` holds (header, column) pairs in file
+    order, duplicates included; a column is an Arrow array or a list.
+    """
+
+    columns: List[Tuple[str, Sequence[Any]]]
+    num_rows: int
+    encoding: str = ""
+    delimiter: str = ""
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.columns]
+
+    def batches(self, size: int = BATCH_ROWS) -> Iterator[Tuple[int, List[Tuple[str, Sequence[Any]]]]]:
+        """(offset, column slices) per record batch."""
+        for start in range(0, self.num_rows, size):
+            yield start, [(name, col[start: start + size]) for name, col in self.columns]
+
+    def rows(self, start: int = 0, stop: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Original rows [start, stop) as dicts (later duplicate headers win, like csv.DictReader)."""
+        stop = self.num_rows if stop is None else min(stop, self.num_rows)
+        values = [(name, to_list(col[start:stop])) for name, col in self.columns]
+        return [{name: col[i] for name, col in values} for i in range(stop - start)]
+
+    def to_arrow(self) -> Any:
+        """Columns as an Arrow table of strings, with the names rows() uses, for archiving."""
+        import pyarrow as pa
+
+        # Excel headers may be non-string; everything is archived as text
+        latest = {str(name): col for name, col in self.columns}
+        arrays = {}
+        for name, col in latest.items():
+            if isinstance(col, (pa.Array, pa.ChunkedArray)):
+                arrays[name] = col.cast(pa.string())
+            else:
+                arrays[name] = pa.array([_text(v) for v in col], type=pa.string())
+        return pa.table(arrays)
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Dict[str, Any]]) -> "ParsedColumns":
+        names: Dict[Any, None] = {}
+        for r in rows:
+            for k in r:
+                names.setdefault(k, None)
+        return cls([(k, [r.get(k) for r in rows]) for k in names], len(rows))
+
+
+def _text(value: Any) -> Optional[str]:
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    return str(value)
+
+
+def to_list(col: Sequence[Any]) -> List[Any]:
+    return col.to_pylist() if hasattr(col, "to_pylist") else list(col)
+
+
+# -----------------------------------------------------------------------------
+# Readers
+# -----------------------------------------------------------------------------
+# A source is the upload's bytes or the path of the file it was spooled to
+Source = Union[bytes, str]
+
+
+def _open_text(source: Source, encoding: str) -> Any:
+    if isinstance(source, bytes):
+        return io.StringIO(source.decode(encoding), newline="")
+    return open(source, encoding=encoding, newline="")
+
+
+def read_arrow(source: Source, encoding: str, delimiter: str, header: Sequence[str], quoted: bool) -> ParsedColumns:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    ragged = 0
+
+    def on_ragged(row: Any) -> str:
+        nonlocal ragged
+        ragged += 1
+        return "skip"
+
+    table = pacsv.read_csv(
+        io.BytesIO(source) if isinstance(source, bytes) else source,
+        read_options=pacsv.ReadOptions(use_threads=True, encoding=encoding),
+        parse_options=pacsv.ParseOptions(
+            delimiter=delimiter,
+            # Quoted multi-line comments need the (slower) quote-aware chunker
+            newlines_in_values=quoted,
+            invalid_row_handler=on_ragged,
+        ),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in header},
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+    if ragged:
+        # Rows with a different field count are kept (padded/cut, like
+        # csv.DictReader did), which Arrow cannot do; re-read them all in order
+        logging.info(f"{ragged} rows with a different field count, re-reading with the stdlib reader")
+        return read_stdlib(source, encoding, delimiter)
+    columns = [(name, table.column(i)) for i, name in enumerate(table.column_names)]
+    return ParsedColumns(columns, table.num_rows, encoding, delimiter)
+
+
+def read_stdlib(source: Source, encoding: str, delimiter: str) -> ParsedColumns:
+    with _open_text(source, encoding) as fh:
+        reader = csv.reader(fh, delimiter=delimiter)
+        header = next(reader, [])
+        width = len(header)
+        cols: List[List[Any]] = [[] for _ in header]
+        num_rows = 0
+        for row in reader:
+            if not row:
+                continue
+            # Missing fields are None and extra fields dropped, like csv.DictReader
+            if len(row) != width:
+                row = row[:width] + [None] * (width - len(row))
+            for col, value in zip(cols, row):
+                col.append(value)
+            num_rows += 1
+    return ParsedColumns(list(zip(header, cols)), num_rows, encoding, delimiter)
+
+
+def _read(source: Source, reader: str, encoding: str, head: bytes, quoted: bool) -> ParsedColumns:
+    sample = _sample(head, encoding)
+    delimiter = detect_delimiter(sample)
+    if reader == "arrow":
+        try:
+            import pyarrow.csv  # noqa: F401
+        except ImportError:
+            reader = "stdlib"
+    if reader == "arrow":
+        header = next(csv.reader(io.StringIO(sample), delimiter=delimiter), [])
+        return read_arrow(source, encoding, delimiter, header, quoted)
+    return read_stdlib(source, encoding, delimiter)
+
+
+def read_csv(data: bytes, reader: str = CSV_READER) -> ParsedColumns:
+    return _read(data, reader, detect_encoding(data), data[: SAMPLE_BYTES + 1], b'"' in data)
+
+
+def read_csv_file(path: str, reader: str = CSV_READER) -> ParsedColumns:
+    """read_csv for an upload on disk; the file is never read into memory whole."""
+    encoding, head, quoted = scan_file(path)
+    return _read(path, reader, encoding, head, quoted)
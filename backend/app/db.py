@@ -0,0 +1,108 @@
+"""
+Shared Supabase helpers
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional
+
+from app import clients
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+PAGE_SIZE = 1000
+
+
+def service_client() -> Client:
+    """Service-role client for backend jobs that read or write whole tables (shared per process)."""
+    return clients.supabase("service")
+
+
+def iter_pages(
+    client: Client,
+    table: str,
+    columns: str,
+    page_size: int = PAGE_SIZE,
+    where: Optional[Callable[[Any], Any]] = None,
+    key: str = "id",
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yield a table in pages ordered by its unique `key`; `where` adds filters to
+    each page query. Keyset paging (key > last key seen) instead of offsets, so
+    rows inserted or deleted during the scan cannot shift rows between pages.
+    """
+    if columns.strip() != "*" and key not in (c.strip() for c in columns.split(",")):
+        columns = f"{columns}, {key}"
+    last: Optional[Any] = None
+    while True:
+        query = client.table(table).select(columns)
+        if where is not None:
+            query = where(query)
+        if last is not None:
+            query = query.gt(key, last)
+        # Short pages are not the end (the server's max-rows cap can return
+        # fewer rows than asked); stop on an empty page
+        page = query.order(key).limit(page_size).execute().data or []
+        if not page:
+            break
+        yield page
+        last = page[-1][key]
+
+
+class CreatedWatermark:
+    """
+    created_at watermark for in-memory counters that are fed both by ingest
+    hooks and by catching up from the table (trend counters, segment cube).
+
+    A catch-up re-reads REFRESH_OVERLAP seconds before the watermark for
+    inserts that commit late. Counters cannot be upserted, so the ids counted
+    inside that window are remembered and a re-read row is not counted
+    twice. Not thread-safe: callers hold their own lock.
+    """
+
+    def __init__(self, overlap_secs: float) -> None:
+        self.overlap_secs = overlap_secs
+        self.watermark = ""
+        # id -> created_at of counted rows that a catch-up may read again
+        self.recent: Dict[str, str] = {}
+
+    def horizon(self) -> str:
+        """created_at from which rows may be read again by the next catch-up."""
+        if not self.watermark:
+            return ""
+        try:
+            return (datetime.fromisoformat(self.watermark) - timedelta(seconds=self.overlap_secs)).isoformat()
+        except ValueError:
+            return ""
+
+    def where(self) -> Optional[Callable[[Any], Any]]:
+        """iter_pages filter for the next catch-up; None reads the whole table."""
+        since = self.horizon()
+        return (lambda q: q.gte("created_at", since)) if since else None
+
+    def first_time(self, row: Dict[str, Any], horizon: str) -> bool:
+        """False when this row (by id) was counted already; rows without an id always count."""
+        rid = row.get("id")
+        if rid is None:
+            return True
+        rid = str(rid)
+        if rid in self.recent:
+            return False
+        created = str(row.get("created_at") or "")
+        if created >= horizon:
+            self.recent[rid] = created
+        return True
+
+    def advance(self, rows: List[Dict[str, Any]]) -> None:
+        """Move the watermark past rows read from the table (never past ingested rows)."""
+        latest = max((str(r.get("created_at") or "") for r in rows), default="")
+        self.watermark = max(self.watermark, latest)
+        horizon = self.horizon()
+        if horizon:
+            self.recent = {rid: c for rid, c in self.recent.items() if c >= horizon}
+
+    def reset(self) -> None:
+        self.watermark = ""
+        self.recent = {}
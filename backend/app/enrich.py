@@ -6,35 +6,32 @@ Uses OpenAI GPT-4o-mini for Dutch taxonomy analysis and embeddings
 import asyncio
 import json
 import logging
+import os
+from functools import lru_cache
 from typing import Dict, List, Optional, Any
 from fastapi import APIRouter, HTTPException, BackgroundTasks
 from pydantic import BaseModel
-import openai
-from openai import AsyncOpenAI
 import time
-import os
 from dotenv import load_dotenv
-from supabase import create_client, Client
+
+from app import clients, keywords, prompts, response_cache, response_store, sentiment
+from app.batch_writer import BatchUpserter
+from app.db import iter_pages
+from app.metrics import ENRICH_QUEUE, openai_call
+from app.theme_aggregates import refresh_hook
 
 load_dotenv()
 
 router = APIRouter(prefix="/enrich", tags=["ai-enrichment"])
 
-# Initialize OpenAI client
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-# Initialize Supabase client
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
-    raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY")
-sb: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+# OpenAI and Supabase clients come from app.clients and are created on first use
 
 class EnrichmentResponse(BaseModel):
     processed: int
     retried: int
     failed: int
     skipped_no_comment: int
+    collapsed_duplicates: int = 0
     error_details: List[str] = []
 
 class EnrichmentRequest(BaseModel):
@@ -63,26 +60,41 @@ Geef een JSON response met:
   "themes": ["lijst van relevante thema's"],
   "theme_scores": {"thema": score_0_1},
   "sentiment": -1.0 tot 1.0 (null als onduidelijk),
-  "keywords": ["belangrijke woorden"],
   "language": "nl"
 }
 """
 
+ANALYSIS_MODEL = "gpt-4o-mini"
+# Comments per embeddings request
+EMBED_BATCH = 256
+# Responses picked up by one /enrich call
+ENRICH_REQUEST_LIMIT = int(os.getenv("ENRICH_REQUEST_LIMIT", "500"))
+# Response ids per enrichment lookup
+LOOKUP_CHUNK = 200
+
+@lru_cache(maxsize=1)
+def analysis_prefix() -> prompts.PromptPrefix:
+    """System instructions plus taxonomy: the cacheable prefix; only the comment follows"""
+    return prompts.build_prefix(
+        "analyze",
+        "Je bent een expert in Nederlandse NPS analyse. Geef altijd een geldige JSON response.\n" + DUTCH_TAXONOMY,
+        ANALYSIS_MODEL,
+    )
+
 async def analyze_comment_with_ai(comment: str) -> Dict[str, Any]:
     """Analyze comment using OpenAI with Dutch taxonomy"""
     try:
-        prompt = f"{DUTCH_TAXONOMY}\n\nCommentaar: \"{comment}\""
+        fitted = prompts.fit_comment(comment, ANALYSIS_MODEL)
         
-        response = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Je bent een expert in Nederlandse NPS analyse. Geef altijd een geldige JSON response."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500,
-            temperature=0.3,
-            response_format={"type": "json_object"}
-        )
+        with openai_call(fitted.model) as call:
+            response = await clients.openai_async().chat.completions.create(
+                model=fitted.model,
+                messages=analysis_prefix().messages(f"Commentaar: \"{fitted.text}\""),
+                max_tokens=500,
+                temperature=0.3,
+                response_format={"type": "json_object"}
+            )
+            call.usage(response)
         
         result = json.loads(response.choices[0].message.content)
         return result
@@ -93,22 +105,41 @@ async def analyze_comment_with_ai(comment: str) -> Dict[str, Any]:
             "themes": [],
             "theme_scores": {},
             "sentiment": None,
-            "keywords": [],
             "language": "nl"
         }
 
 async def create_embedding(text: str) -> Optional[List[float]]:
     """Create embedding using OpenAI text-embedding-3-large"""
     try:
-        response = await client.embeddings.create(
-            model="text-embedding-3-large",
-            input=text
-        )
+        with openai_call("text-embedding-3-large", "embeddings") as call:
+            response = await clients.openai_async().embeddings.create(
+                model="text-embedding-3-large",
+                input=text
+            )
+            call.usage(response)
         return response.data[0].embedding
     except Exception as e:
         logging.error(f"Embedding creation failed: {str(e)}")
         return None
 
+async def create_embeddings(texts: List[str], chunk: int = EMBED_BATCH) -> List[Optional[List[float]]]:
+    """create_embedding for many texts, one request per `chunk` inputs; None where a request failed."""
+    out: List[Optional[List[float]]] = []
+    for i in range(0, len(texts), chunk):
+        part = texts[i:i + chunk]
+        try:
+            with openai_call("text-embedding-3-large", "embeddings") as call:
+                response = await clients.openai_async().embeddings.create(
+                    model="text-embedding-3-large",
+                    input=part
+                )
+                call.usage(response)
+            out.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        except Exception as e:
+            logging.error(f"Embedding creation failed for {len(part)} texts: {str(e)}")
+            out.extend([None] * len(part))
+    return out
+
 def categorize_nps_score(score: int) -> str:
     """Categorize NPS score into promoter/passive/detractor"""
     if score >= 9:
@@ -118,78 +149,109 @@ def categorize_nps_score(score: int) -> str:
     else:
         return "detractor"
 
-async def process_batch(responses: List[Dict], batch_id: int) -> Dict[str, int]:
-    """Process a batch of responses for AI enrichment"""
+async def process_batch(responses: List[Dict], batch_id: int, writer: BatchUpserter) -> Dict[str, int]:
+    """
+    Process a batch of responses for AI enrichment, queueing results on the writer.
+    Near-duplicate comments are analyzed once and the result is shared by the group.
+    """
+    from app import near_dupes
+
     processed = 0
     retried = 0
     failed = 0
     skipped = 0
-    
+
+    commented = []
     for response in responses:
+        comment = response.get('nps_explanation')
+        if not comment or comment.strip() in ['', 'n.v.t.', 'nvt']:
+            skipped += 1
+        else:
+            commented.append(response)
+
+    groups = near_dupes.collapse([r['nps_explanation'] for r in commented])
+    near_dupes.log_collapse(groups, f"Batch {batch_id}")
+    # Near-duplicates share the LLM analysis, but every comment gets its own embedding
+    embeddings = await create_embeddings([r['nps_explanation'] for r in commented])
+
+    for rep, members in zip(groups.representatives, groups.members()):
+        response = commented[rep]
         try:
-            comment = response.get('nps_explanation')
-            if not comment or comment.strip() in ['', 'n.v.t.', 'nvt']:
-                skipped += 1
-                continue
+            comment = response['nps_explanation']
             
             # AI analysis
             ai_result = await analyze_comment_with_ai(comment)
             
-            # Create embedding
-            embedding = await create_embedding(comment)
-            
-            # Prepare enrichment data
-            enrichment_data = {
-                "response_id": response['id'],
-                "themes": ai_result.get('themes', []),
-                "theme_scores": ai_result.get('theme_scores', {}),
-                "sentiment_score": ai_result.get('sentiment'),
-                "sentiment_label": "positive" if ai_result.get('sentiment', 0) > 0.1 else "negative" if ai_result.get('sentiment', 0) < -0.1 else "neutral",
-                "keywords": ai_result.get('keywords', []),
-                "summary": f"Analyse van {len(ai_result.get('themes', []))} thema's",
-                "embedded_vector": embedding,
-                "ai_model": "gpt-4o-mini",
-                "processing_status": "completed",
-                "language": ai_result.get('language', 'nl')
-            }
+            # The local scorer fills in when the LLM gave no sentiment
+            score = ai_result.get('sentiment')
+            source = sentiment.SOURCE_LLM
+            if score is None:
+                score = round(float(sentiment.score([comment])[0]), 2)
+                source = sentiment.SOURCE_LOCAL
             
-            # Here you would insert into nps_ai_enrichment table
-            # For now, we'll just count as processed
-            processed += 1
+            # Prepare enrichment data; every group member gets the representative's analysis
+            # and its own embedding.
+            # Keywords come from the corpus TF-IDF engine, not the LLM.
+            for member in members:
+                enrichment_data = {
+                    "response_id": commented[member]['id'],
+                    "themes": ai_result.get('themes', []),
+                    "theme_scores": ai_result.get('theme_scores', {}),
+                    "sentiment_score": score,
+                    "sentiment_label": sentiment.label(score),
+                    "sentiment_source": source,
+                    "keywords": keywords.extract(commented[member]['nps_explanation']),
+                    "summary": f"Analyse van {len(ai_result.get('themes', []))} thema's",
+                    "embedded_vector": embeddings[member],
+                    "ai_model": "gpt-4o-mini",
+                    "processing_status": "completed",
+                    "language": ai_result.get('language', 'nl')
+                }
+                
+                # Buffered; written as one multi-row upsert per flush
+                writer.add(enrichment_data)
+                processed += 1
             
             # Add small delay to avoid rate limiting
             await asyncio.sleep(0.1)
             
         except Exception as e:
             logging.error(f"Error processing response {response.get('id')}: {str(e)}")
-            failed += 1
+            failed += len(members)
             continue
     
     return {
         "processed": processed,
         "retried": retried,
         "failed": failed,
-        "skipped": skipped
+        "skipped": skipped,
+        "collapsed": len(commented) - len(groups.representatives)
     }
 
-async def get_unprocessed_responses(batch_size: int, force_reprocess: bool = False) -> List[Dict]:
+def fetch_unprocessed_responses(limit: int, force_reprocess: bool = False) -> List[Dict]:
+    """
+    Up to `limit` nps_response rows with a comment that have no enrichment
+    yet (or any rows with a comment when force_reprocess), in id order.
+    """
+    sb = clients.supabase()
+    out: List[Dict] = []
+    for page in iter_pages(sb, "nps_response", "id, nps_score, nps_explanation, survey_name",
+                           where=lambda q: q.filter("nps_explanation", "not.is", "null")):
+        if not force_reprocess:
+            ids = [r["id"] for r in page]
+            done = set()
+            for i in range(0, len(ids), LOOKUP_CHUNK):
+                res = sb.table("nps_ai_enrichment").select("response_id").in_("response_id", ids[i:i + LOOKUP_CHUNK]).execute()
+                done.update(r["response_id"] for r in res.data or [])
+            page = [r for r in page if r["id"] not in done]
+        out.extend(page)
+        if len(out) >= limit:
+            break
+    return out[:limit]
+
+async def get_unprocessed_responses(limit: int, force_reprocess: bool = False) -> List[Dict]:
     """Get responses that need AI enrichment"""
-    # This would query your database for unprocessed responses
-    # For now, return mock data
-    return [
-        {
-            "id": "mock-id-1",
-            "nps_score": 9,
-            "nps_explanation": "Geweldige service, zeer tevreden!",
-            "survey_name": "LLT_Nieuws"
-        },
-        {
-            "id": "mock-id-2", 
-            "nps_score": 4,
-            "nps_explanation": "Slechte klantenservice, lang wachten",
-            "survey_name": "LLT_Nieuws"
-        }
-    ]
+    return await asyncio.to_thread(fetch_unprocessed_responses, limit, force_reprocess)
 
 @router.post("/", response_model=EnrichmentResponse)
 async def enrich_responses(
@@ -203,7 +265,7 @@ async def enrich_responses(
     try:
         # Get unprocessed responses
         responses = await get_unprocessed_responses(
-            request.batch_size, 
+            ENRICH_REQUEST_LIMIT,
             request.force_reprocess
         )
         
@@ -220,23 +282,35 @@ async def enrich_responses(
         total_retried = 0
         total_failed = 0
         total_skipped = 0
+        total_collapsed = 0
         error_details = []
+        sb = clients.supabase()
+        refresh = refresh_hook(sb)
+
+        def on_flush(rows: List[Dict]) -> None:
+            refresh(rows)
+            keywords.record_enriched(rows)
+            response_cache.invalidate_enrichment(rows)
+
+        writer = BatchUpserter(sb, "nps_ai_enrichment", on_conflict="response_id", on_flush=on_flush)
         
         # Split into batches
         for i in range(0, len(responses), request.batch_size):
             batch = responses[i:i + request.batch_size]
             batch_id = i // request.batch_size + 1
+            ENRICH_QUEUE.set(len(responses) - i, source="api")
             
             try:
                 # Process batch with retry logic
                 retry_count = 0
                 while retry_count < request.max_retries:
                     try:
-                        batch_result = await process_batch(batch, batch_id)
+                        batch_result = await process_batch(batch, batch_id, writer)
                         total_processed += batch_result['processed']
                         total_retried += batch_result['retried']
                         total_failed += batch_result['failed']
                         total_skipped += batch_result['skipped']
+                        total_collapsed += batch_result['collapsed']
                         break
                         
                     except Exception as e:
@@ -256,11 +330,20 @@ async def enrich_responses(
                 error_details.append(f"Batch {batch_id} error: {str(e)}")
                 total_failed += len(batch)
         
+        # Write whatever is still buffered and attribute failed rows
+        ENRICH_QUEUE.set(0, source="api")
+        writer.close()
+        for response_id, err in writer.take_failures():
+            total_processed -= 1
+            total_failed += 1
+            error_details.append(f"Response {response_id} upsert failed: {err}")
+        
         return EnrichmentResponse(
             processed=total_processed,
             retried=total_retried,
             failed=total_failed,
             skipped_no_comment=total_skipped,
+            collapsed_duplicates=total_collapsed,
             error_details=error_details
         )
         
@@ -312,49 +395,62 @@ async def get_enrichment_status():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting status: {str(e)}")
 
-@router.get("/stats")
-async def get_enrichment_stats():
-    """Get enrichment statistics"""
-    try:
+def load_enrichment_stats() -> Dict[str, Any]:
+    """Enrichment statistics computed from nps_response and nps_ai_enrichment"""
+    sb = clients.supabase()
+    # Get enriched responses
+    enriched_response = sb.table("nps_ai_enrichment").select("*").execute()
+    enriched_responses = len(enriched_response.data) if enriched_response.data else 0
+
+    if response_store.enabled():
+        # Counted from the in-process columns instead of fetching every response
+        counts = response_store.current().counts()
+        total_responses = counts["responses"]
+        pending_responses = max(0, counts["with_explanation"] - enriched_responses)
+    else:
         # Get total responses
         total_response = sb.table("nps_response").select("*").execute()
         total_responses = len(total_response.data) if total_response.data else 0
-        
-        # Get enriched responses
-        enriched_response = sb.table("nps_ai_enrichment").select("*").execute()
-        enriched_responses = len(enriched_response.data) if enriched_response.data else 0
-        
+
         # Get pending responses (responses with comments but no enrichment)
         pending_response = sb.table("nps_response").select("*").neq("nps_explanation", "").execute()
         pending_responses = max(0, (len(pending_response.data) if pending_response.data else 0) - enriched_responses)
-        
-        # Get unique themes count
-        themes_response = sb.table("nps_ai_enrichment").select("*").execute()
-        all_themes = set()
-        if themes_response.data:
-            for row in themes_response.data:
-                if row.get("themes"):
-                    all_themes.update(row["themes"])
-        themes_found = len(all_themes)
-        
-        # Get average sentiment
-        sentiment_response = sb.table("nps_ai_enrichment").select("*").execute()
-        avg_sentiment = 0
-        if sentiment_response.data:
-            scores = [row["sentiment_score"] for row in sentiment_response.data if row.get("sentiment_score") is not None]
-            avg_sentiment = sum(scores) / len(scores) if scores else 0
-        
-        # Get last enrichment date
-        last_enrichment_response = sb.table("nps_ai_enrichment").select("*").order("created_at", desc=True).limit(1).execute()
-        last_enrichment = last_enrichment_response.data[0]["created_at"] if last_enrichment_response.data else None
-        
-        return {
-            "total_responses": total_responses,
-            "enriched_responses": enriched_responses,
-            "pending_responses": max(0, pending_responses),
-            "last_enrichment": last_enrichment,
-            "themes_found": themes_found,
-            "avg_sentiment": round(avg_sentiment, 3)
-        }
+    
+    # Get unique themes count
+    themes_response = sb.table("nps_ai_enrichment").select("*").execute()
+    all_themes = set()
+    if themes_response.data:
+        for row in themes_response.data:
+            if row.get("themes"):
+                all_themes.update(row["themes"])
+    themes_found = len(all_themes)
+    
+    # Get average sentiment
+    sentiment_response = sb.table("nps_ai_enrichment").select("*").execute()
+    avg_sentiment = 0
+    if sentiment_response.data:
+        scores = [row["sentiment_score"] for row in sentiment_response.data if row.get("sentiment_score") is not None]
+        avg_sentiment = sum(scores) / len(scores) if scores else 0
+    
+    # Get last enrichment date
+    last_enrichment_response = sb.table("nps_ai_enrichment").select("*").order("created_at", desc=True).limit(1).execute()
+    last_enrichment = last_enrichment_response.data[0]["created_at"] if last_enrichment_response.data else None
+    
+    return {
+        "total_responses": total_responses,
+        "enriched_responses": enriched_responses,
+        "pending_responses": max(0, pending_responses),
+        "last_enrichment": last_enrichment,
+        "themes_found": themes_found,
+        "avg_sentiment": round(avg_sentiment, 3)
+    }
+
+@router.get("/stats")
+async def get_enrichment_stats():
+    """Get enrichment statistics"""
+    try:
+        return response_cache.get_or_compute(
+            "enrichment_stats", [response_cache.ALL_SURVEYS, response_cache.ENRICHMENT], {}, load_enrichment_stats
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting stats: {str(e)}")
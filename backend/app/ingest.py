@@ -1,30 +1,22 @@
 from __future__ import annotations
 
-import csv
 import io
-import os
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+import logging
+import math
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-import pandas as pd
 from fastapi import APIRouter, File, HTTPException, UploadFile
 from pydantic import BaseModel
-from supabase import Client, create_client
 from dotenv import load_dotenv
 
+from app import clients, csv_reader, keywords, raw_archive, response_cache, response_store, search, segments, trends
+from app.csv_reader import ParsedColumns
+from app.metrics import INGEST_ROWS, INGEST_STAGE
+
 # Load environment variables
 load_dotenv()
 
-# -----------------------------------------------------------------------------
-# Supabase
-# -----------------------------------------------------------------------------
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
-    raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY")
-
-sb: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-
 router = APIRouter(prefix="/ingest", tags=["ingest"])
 
 # -----------------------------------------------------------------------------
@@ -69,11 +61,11 @@ def normalize_headers(row: Dict[str, Any]) -> Dict[str, Any]:
 
 def try_parse_date(val: Any) -> Optional[datetime.date]:
     """Parse dates like dd/mm/yyyy, d/m/yyyy, m/d/yyyy, yyyy-mm-dd, mm/dd/yyyy, excel serials."""
-    if val is None or (isinstance(val, float) and pd.isna(val)):
+    if val is None or (isinstance(val, float) and math.isnan(val)):
         return None
 
-    # Already a pandas/py datetime?
-    if isinstance(val, (datetime, pd.Timestamp)):
+    # Already a pandas/py datetime? (pd.Timestamp subclasses datetime)
+    if isinstance(val, datetime):
         return val.date()
 
     s = str(val).strip()
@@ -83,7 +75,7 @@ def try_parse_date(val: Any) -> Optional[datetime.date]:
     # Excel serial date
     if isinstance(val, (int, float)) and not isinstance(val, bool):
         try:
-            return (pd.Timestamp("1899-12-30") + pd.to_timedelta(int(val), unit="D")).date()
+            return date(1899, 12, 30) + timedelta(days=int(val))
         except Exception:
             pass
 
@@ -101,8 +93,10 @@ def try_parse_date(val: Any) -> Optional[datetime.date]:
         except Exception:
             continue
 
-    # Pandas fallback
+    # Pandas fallback (imported lazily; most dates match a format above)
     try:
+        import pandas as pd
+
         return pd.to_datetime(s, dayfirst=True, errors="coerce").date()
     except Exception:
         return None
@@ -146,22 +140,20 @@ def detect_filetype(filename: str) -> str:
     # Best-effort default
     return "csv"
 
-def read_csv_bytes(file_bytes: bytes) -> List[Dict[str, Any]]:
-    sample = file_bytes[:4096].decode("utf-8", errors="ignore")
-    try:
-        dialect = csv.Sniffer().sniff(sample)
-        delimiter = dialect.delimiter
-    except Exception:
-        # common fallbacks
-        delimiter = ";" if sample.count(";") > sample.count(",") else ","
-    text = file_bytes.decode("utf-8", errors="ignore")
-    reader = csv.DictReader(io.StringIO(text), delimiter=delimiter)
-    return [dict(row) for row in reader]
+def read_csv_bytes(file_bytes: bytes) -> ParsedColumns:
+    """Columns of a CSV upload (encoding and delimiter detected, see app/csv_reader.py)."""
+    return csv_reader.read_csv(file_bytes)
+
+def read_xlsx_bytes(file_bytes: bytes) -> ParsedColumns:
+    return read_xlsx(io.BytesIO(file_bytes))
 
-def read_xlsx_bytes(file_bytes: bytes) -> List[Dict[str, Any]]:
-    df = pd.read_excel(io.BytesIO(file_bytes))
-    df.columns = [str(c).strip() for c in df.columns]
-    return df.to_dict(orient="records")
+def read_xlsx(source: Any) -> ParsedColumns:
+    """Columns of an Excel workbook given as a path or file object."""
+    import pandas as pd  # heavy; only needed for Excel uploads
+
+    df = pd.read_excel(source)
+    columns = [(str(c).strip(), df.iloc[:, i].tolist()) for i, c in enumerate(df.columns)]
+    return ParsedColumns(columns, len(df))
 
 def normalize_row(row: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
     """
@@ -200,92 +192,233 @@ def normalize_row(row: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Option
     }
     return normalized, None
 
+def map_distinct(values: Sequence[Any], fn: Callable[[Any], Any]) -> List[Any]:
+    """fn over a column, called once per distinct value (dates and scores repeat a lot)."""
+    if hasattr(values, "dictionary_encode"):
+        if hasattr(values, "combine_chunks"):
+            values = values.combine_chunks()
+        encoded = values.dictionary_encode()
+        mapped = [fn(v) for v in encoded.dictionary.to_pylist()]
+        return [fn(None) if i is None else mapped[i] for i in encoded.indices.to_pylist()]
+    memo: Dict[Any, Any] = {}
+    out = []
+    for v in values:
+        try:
+            if v not in memo:
+                memo[v] = fn(v)
+            out.append(memo[v])
+        except TypeError:  # unhashable cell
+            out.append(fn(v))
+    return out
+
+def normalize_batch(
+    columns: List[Tuple[Any, Sequence[Any]]],
+) -> Tuple[List[Tuple[int, Dict[str, Any]]], List[Tuple[int, str]]]:
+    """
+    normalize_row for a record batch of columns: headers are mapped once and
+    values converted column by column. Returns ([(row, normalized)], [(row, error)])
+    with row offsets into the batch.
+    """
+    size = len(columns[0][1]) if columns else 0
+    # Same header rules as normalize_headers: later duplicates win
+    cols: Dict[str, Sequence[Any]] = {}
+    for name, col in columns:
+        if name is not None:
+            cols[str(name).strip().upper()] = col
+
+    def column(name: str) -> List[Any]:
+        return csv_reader.to_list(cols[name]) if name in cols else [None] * size
+
+    survey, nps, created_raw = column("SURVEY"), column("NPS"), column("CREATIE_DT")
+    scores = map_distinct(cols["NPS"], nps_int) if "NPS" in cols else [None] * size
+    created = map_distinct(cols["CREATIE_DT"], try_parse_date) if "CREATIE_DT" in cols else [None] * size
+    comments = map_distinct(cols["NPS_TOELICHTING"], clean_comment) if "NPS_TOELICHTING" in cols else [None] * size
+    gender, age, years = column("GESLACHT"), column("LEEFTIJD"), column("ABOJAREN")
+    title_text, title = column("TITEL_TEKST"), column("TITEL")
+
+    valid: List[Tuple[int, Dict[str, Any]]] = []
+    errors: List[Tuple[int, str]] = []
+    for i in range(size):
+        score, day = scores[i], created[i]
+        if not survey[i]:
+            errors.append((i, "Missing SURVEY"))
+        elif score is None:
+            errors.append((i, f"Invalid NPS: {nps[i]}"))
+        elif day is None:
+            errors.append((i, f"Invalid CREATIE_DT: {created_raw[i]}"))
+        else:
+            valid.append((i, {
+                "survey_name": str(survey[i]).strip(),
+                "nps_score": score,
+                "nps_explanation": comments[i],
+                "gender": (gender[i] or None),
+                "age_range": (age[i] or None),
+                "years_employed": (years[i] or None),
+                "creation_date": day.isoformat(),
+                "title_text": (title_text[i] or title[i] or None),
+                "nps_category": "promoter" if score >= 9 else ("passive" if score >= 7 else "detractor"),
+            }))
+    return valid, errors
+
 def chunked(seq: List[Dict[str, Any]], size: int) -> List[List[Dict[str, Any]]]:
     return [seq[i : i + size] for i in range(0, len(seq), size)]
 
 # -----------------------------------------------------------------------------
-# Endpoint
+# Pipeline
 # -----------------------------------------------------------------------------
-@router.post("", response_model=IngestResult)
-async def ingest_data(file: UploadFile = File(...)) -> IngestResult:
+BATCH = 500
+ProgressFn = Callable[[Dict[str, int]], None]
+
+def parse_upload(filename: str, raw_bytes: bytes) -> ParsedColumns:
+    with INGEST_STAGE.time(stage="parse"):
+        if detect_filetype(filename) == "xlsx":
+            return read_xlsx_bytes(raw_bytes)
+        return read_csv_bytes(raw_bytes)
+
+def parse_upload_file(filename: str, path: str) -> ParsedColumns:
+    """parse_upload for an upload spooled to disk, without reading it into memory first."""
+    with INGEST_STAGE.time(stage="parse"):
+        if detect_filetype(filename) == "xlsx":
+            return read_xlsx(path)
+        return csv_reader.read_csv_file(path)
+
+def insert_raw(sb: Any, batch: List[Dict[str, Any]], errors: List[str]) -> int:
+    """Legacy raw storage: one nps_raw row per response. Returns rows saved."""
+    raw_payload = []
+    for r in batch:
+        norm = r["_norm"]
+        raw_payload.append({
+            "survey_name": norm["survey_name"],
+            "nps_score": norm["nps_score"],
+            "nps_explanation": norm["nps_explanation"],
+            "gender": norm["gender"],
+            "age_range": norm["age_range"],
+            "years_employed": norm["years_employed"],
+            "creation_date": norm["creation_date"],
+            "title_text": norm["title_text"],
+            "raw_data": r["_raw"]
+        })
+    with INGEST_STAGE.time(stage="raw_insert"):
+        resp_raw = sb.table("nps_raw").insert(raw_payload).execute()
+    if not resp_raw.data:
+        errors.append(f"nps_raw insert failed: {resp_raw}")
+        return 0
+    return len(batch)
+
+def run_ingest(
+    rows: Union[ParsedColumns, List[Dict[str, Any]]],
+    progress: Optional[ProgressFn] = None,
+    filename: Optional[str] = None,
+) -> IngestResult:
     """
-    Accept CSV/XLSX upload, parse, normalize, and batch-insert into:
-      - nps_raw (original row as JSON)
+    Normalize and batch-insert parsed rows into:
+      - nps_raw (original row as JSON), or with RAW_ARCHIVE=parquet one
+        compressed archive per upload referenced by (upload_id, row_index)
       - nps_response (normalized)
-    Returns counts and errors.
+    `progress` is called with running counts after normalization and after every batch.
     """
-    try:
-        filename = file.filename or "upload.csv"
-        filetype = detect_filetype(filename)
-        raw_bytes = await file.read()
-
-        # Read rows
-        if filetype == "xlsx":
-            rows = read_xlsx_bytes(raw_bytes)
-        else:
-            rows = read_csv_bytes(raw_bytes)
-
-        if not rows:
-            raise HTTPException(status_code=400, detail="No rows found in file")
-
-        normalized_rows: List[Dict[str, Any]] = []
-        errors: List[str] = []
-        for idx, row in enumerate(rows, start=1):
-            norm, err = normalize_row(row)
-            if err:
-                errors.append(f"Row {idx}: {err}")
-                continue
-            # Keep a copy of the original for nps_raw
-            normalized_rows.append({"_norm": norm, "_raw": normalize_headers(row)})
-
-        if not normalized_rows:
-            return IngestResult(inserted=0, skipped=len(rows), raw_saved=0, errors=errors)
-
-        # Batch insert
-        BATCH = 500
-        inserted = 0
-        raw_saved = 0
-        skipped = len(rows) - len(normalized_rows)
+    if not isinstance(rows, ParsedColumns):
+        rows = ParsedColumns.from_rows(rows)
+    normalized_rows: List[Dict[str, Any]] = []
+    errors: List[str] = []
+    archived = raw_archive.enabled()
+    with INGEST_STAGE.time(stage="normalize"):
+        for offset, columns in rows.batches():
+            valid, invalid = normalize_batch(columns)
+            errors.extend(f"Row {offset + i + 1}: {err}" for i, err in invalid)
+            normalized_rows.extend({"_norm": norm, "_raw": None, "_index": offset + i} for i, norm in valid)
+
+    inserted = 0
+    raw_saved = 0
+    skipped = len(rows) - len(normalized_rows)
+    INGEST_ROWS.inc(skipped, outcome="invalid")
+    if progress:
+        progress({"parsed": len(rows), "valid": len(normalized_rows), "inserted": 0, "raw_saved": 0, "skipped": skipped})
+
+    if not normalized_rows:
+        return IngestResult(inserted=0, skipped=len(rows), raw_saved=0, errors=errors)
+
+    sb = clients.supabase()
+    upload_id = None
+    if archived:
+        # Original rows (valid or not) are stored once; responses point into the archive,
+        # so it is written first (nps_response.upload_id references it)
+        with INGEST_STAGE.time(stage="raw_archive"):
+            upload_id = raw_archive.archive_table(rows.to_arrow(), filename)
+        for r in normalized_rows:
+            r["_norm"]["upload_id"] = upload_id
+            r["_norm"]["row_index"] = r["_index"]
 
+    try:
         # Insert raw first, then normalized (matching counts by order)
         for batch in chunked(normalized_rows, BATCH):
-            raw_payload = []
-            for r in batch:
-                norm = r["_norm"]
-                raw_payload.append({
-                    "survey_name": norm["survey_name"],
-                    "nps_score": norm["nps_score"],
-                    "nps_explanation": norm["nps_explanation"],
-                    "gender": norm["gender"],
-                    "age_range": norm["age_range"],
-                    "years_employed": norm["years_employed"],
-                    "creation_date": norm["creation_date"],
-                    "title_text": norm["title_text"],
-                    "raw_data": r["_raw"]
-                })
-            resp_raw = sb.table("nps_raw").insert(raw_payload).execute()
-            if not resp_raw.data:
-                errors.append(f"nps_raw insert failed: {resp_raw}")
-            else:
-                raw_saved += len(batch)
+            if not archived:
+                # Original rows for nps_raw, only for this batch's span of the file
+                first, last = batch[0]["_index"], batch[-1]["_index"]
+                originals = rows.rows(first, last + 1)
+                for r in batch:
+                    r["_raw"] = normalize_headers(originals[r["_index"] - first])
+                raw_saved += insert_raw(sb, batch, errors)
 
             norm_payload = [r["_norm"] for r in batch]
-            resp_norm = sb.table("nps_response").insert(norm_payload).execute()
+            with INGEST_STAGE.time(stage="response_insert"):
+                resp_norm = sb.table("nps_response").insert(norm_payload).execute()
             if not resp_norm.data:
                 errors.append(f"nps_response insert failed: {resp_norm}")
+                INGEST_ROWS.inc(len(batch), outcome="failed")
             else:
                 inserted += len(batch)
+                if archived:
+                    raw_saved += len(batch)
+                INGEST_ROWS.inc(len(batch), outcome="inserted")
+                with INGEST_STAGE.time(stage="index_update"):
+                    # Inserted rows carry the generated ids (and created_at) the indexes need
+                    segments.record_ingested(resp_norm.data)
+                    trends.record_ingested(resp_norm.data)
+                    search.record_ingested(resp_norm.data)
+                    response_store.record_ingested(resp_norm.data)
+                    keywords.record_ingested(resp_norm.data)
+                # Every worker's cached survey results now miss
+                response_cache.invalidate_surveys(norm_payload)
+
+            if progress:
+                progress({"parsed": len(rows), "valid": len(normalized_rows), "inserted": inserted, "raw_saved": raw_saved, "skipped": skipped})
+    finally:
+        if upload_id is not None and not inserted:
+            # No response points into the archive; don't leave it orphaned
+            try:
+                raw_archive.delete_upload(upload_id)
+            except Exception as e:
+                logging.error(f"Could not delete unused archive {upload_id}: {e}")
+
+    return IngestResult(
+        inserted=inserted,
+        skipped=skipped,
+        raw_saved=raw_saved,
+        errors=errors,
+    )
+
+# -----------------------------------------------------------------------------
+# Endpoint
+# -----------------------------------------------------------------------------
+@router.post("", response_model=IngestResult)
+async def ingest_data(file: UploadFile = File(...)) -> IngestResult:
+    """
+    Accept CSV/XLSX upload, parse, normalize, and batch-insert it within the request.
+    For large files use POST /ingest/jobs, which returns immediately.
+    Returns counts and errors.
+    """
+    try:
+        filename = file.filename or "upload.csv"
+        raw_bytes = await file.read()
+
+        rows = parse_upload(filename, raw_bytes)
+        if not rows:
+            raise HTTPException(status_code=400, detail="No rows found in file")
 
-        # Final progress update (kept simple & clearly indented)
-        result = IngestResult(
-            inserted=inserted,
-            skipped=skipped,
-            raw_saved=raw_saved,
-            errors=errors,
-        )
-        return result
+        return run_ingest(rows, filename=filename)
 
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ingest failed: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Ingest failed: {e}")
@@ -0,0 +1,322 @@
+"""
+Asynchronous ingest jobs
+The upload is spooled to a local temp file and a job id is returned at once;
+a background worker runs the batched ingest pipeline while clients poll
+/ingest/jobs/{job_id} or follow /ingest/jobs/{job_id}/events (SSE).
+
+Job status is written to nps_ingest_job (sql/021_ingest_job.sql) on every
+state change and at most every JOB_SYNC_SECS while rows go in, so any worker
+can answer for a job and finished jobs survive a restart. A running job whose
+row has not been touched for JOB_STALE_SECS lost its worker and reads as failed.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import APIRouter, File, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from app import clients
+from app.ingest import parse_upload_file, run_ingest
+
+router = APIRouter(prefix="/ingest/jobs", tags=["ingest"])
+
+SPOOL_CHUNK = 1024 * 1024
+# Finished jobs kept in memory (and listed) for status lookups
+MAX_FINISHED_JOBS = 200
+SSE_INTERVAL_SECS = 1.0
+JOB_TABLE = "nps_ingest_job"
+JOB_SYNC_SECS = float(os.getenv("INGEST_JOB_SYNC_SECS", "1.0"))
+JOB_STALE_SECS = float(os.getenv("INGEST_JOB_STALE_SECS", "600"))
+JOB_RETENTION_DAYS = int(os.getenv("INGEST_JOB_RETENTION_DAYS", "7"))
+DONE = {"completed", "failed"}
+
+
+class IngestJobStatus(BaseModel):
+    job_id: str
+    filename: str
+    status: str  # queued | parsing | inserting | completed | failed
+    bytes: int
+    rows_parsed: int
+    rows_valid: int
+    inserted: int
+    raw_saved: int
+    skipped: int
+    rows_per_sec: float
+    eta_secs: Optional[float] = None
+    elapsed_secs: float
+    errors: List[str] = []
+
+
+class IngestJob:
+    def __init__(self, filename: str, path: str, size: int) -> None:
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.status = "queued"
+        self.counts: Dict[str, int] = {"parsed": 0, "valid": 0, "inserted": 0, "raw_saved": 0, "skipped": 0}
+        self.errors: List[str] = []
+        self.created = time.monotonic()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self._synced = 0.0
+        self._lock = threading.Lock()
+
+    def set_status(self, status: str) -> None:
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            self.status = status
+            if status == "parsing":
+                self.started = time.monotonic()
+                self.started_at = now
+            elif status in DONE:
+                self.finished = time.monotonic()
+                self.finished_at = now
+        self.save()
+
+    def update(self, counts: Dict[str, int]) -> None:
+        with self._lock:
+            self.counts.update(counts)
+            if self.status == "parsing":
+                self.status = "inserting"
+        self.save(force=False)
+
+    def save(self, force: bool = True) -> None:
+        """Write the status row; progress updates are throttled to JOB_SYNC_SECS."""
+        now = time.monotonic()
+        if not force and now - self._synced < JOB_SYNC_SECS:
+            return
+        self._synced = now
+        with self._lock:
+            row = {
+                "id": self.id,
+                "filename": self.filename,
+                "status": self.status,
+                "bytes": self.size,
+                "counts": dict(self.counts),
+                "errors": self.errors[:50],
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
+        try:
+            clients.supabase().table(JOB_TABLE).upsert(row, on_conflict="id").execute()
+        except Exception as e:
+            logging.warning(f"Could not save ingest job {self.id}: {e}")
+
+    def snapshot(self) -> IngestJobStatus:
+        with self._lock:
+            c = dict(self.counts)
+            status = self.status
+        end = self.finished or time.monotonic()
+        return _status(self.id, self.filename, status, self.size, c, self.errors, end - (self.started or end))
+
+    @property
+    def done(self) -> bool:
+        return self.status in DONE
+
+
+def _status(
+    job_id: str, filename: str, status: str, size: int, counts: Dict[str, int], errors: List[str], elapsed: float
+) -> IngestJobStatus:
+    c = {"parsed": 0, "valid": 0, "inserted": 0, "raw_saved": 0, "skipped": 0, **counts}
+    done = c["inserted"] + c["skipped"]
+    rate = done / elapsed if elapsed > 0 else 0.0
+    remaining = max(c["parsed"] - done, 0)
+    eta = None
+    if status == "inserting" and rate > 0:
+        eta = round(remaining / rate, 1)
+    return IngestJobStatus(
+        job_id=job_id,
+        filename=filename,
+        status=status,
+        bytes=size,
+        rows_parsed=c["parsed"],
+        rows_valid=c["valid"],
+        inserted=c["inserted"],
+        raw_saved=c["raw_saved"],
+        skipped=c["skipped"],
+        rows_per_sec=round(rate, 1),
+        eta_secs=eta,
+        elapsed_secs=round(elapsed, 2),
+        errors=list(errors)[:50],
+    )
+
+
+def _parse_ts(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _from_row(row: Dict[str, Any]) -> IngestJobStatus:
+    """Status of a job as stored by whichever worker ran it."""
+    now = datetime.now(timezone.utc)
+    started = _parse_ts(row.get("started_at"))
+    finished = _parse_ts(row.get("finished_at"))
+    updated = _parse_ts(row.get("updated_at"))
+    status = row["status"]
+    errors = list(row.get("errors") or [])
+    if status not in DONE and updated is not None and (now - updated).total_seconds() > JOB_STALE_SECS:
+        status = "failed"
+        errors.append("Ingest worker stopped before the job finished")
+    end = finished or updated or now
+    elapsed = (end - started).total_seconds() if started else 0.0
+    return _status(row["id"], row.get("filename") or "", status, row.get("bytes") or 0, row.get("counts") or {}, errors, elapsed)
+
+
+def load_job(job_id: str) -> Optional[IngestJobStatus]:
+    found = clients.supabase().table(JOB_TABLE).select("*").eq("id", job_id).limit(1).execute().data
+    return _from_row(found[0]) if found else None
+
+
+_jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+
+
+def _remember(job: IngestJob) -> None:
+    _jobs[job.id] = job
+    finished = [j for j in _jobs.values() if j.done]
+    for old in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        _jobs.pop(old.id, None)
+
+
+def run_job(job: IngestJob) -> None:
+    """Worker body; runs in a thread because the Supabase client is synchronous."""
+    try:
+        job.set_status("parsing")
+        rows = parse_upload_file(job.filename, job.path)
+        if not rows:
+            raise ValueError("No rows found in file")
+        job.update({"parsed": len(rows)})
+        result = run_ingest(rows, progress=job.update, filename=job.filename)
+        job.errors = result.errors
+        job.set_status("completed")
+    except Exception as e:
+        logging.error(f"Ingest job {job.id} failed: {e}")
+        job.errors.append(str(e))
+        job.set_status("failed")
+    finally:
+        try:
+            os.unlink(job.path)
+        except OSError:
+            pass
+        prune_jobs()
+
+
+async def spool_upload(file: UploadFile) -> IngestJob:
+    """Stream the upload to a temp file without holding it all in memory."""
+    filename = file.filename or "upload.csv"
+    suffix = os.path.splitext(filename)[1] or ".csv"
+    fd, path = tempfile.mkstemp(prefix="nps-ingest-", suffix=suffix)
+    size = 0
+    with os.fdopen(fd, "wb") as out:
+        while True:
+            chunk = await file.read(SPOOL_CHUNK)
+            if not chunk:
+                break
+            out.write(chunk)
+            size += len(chunk)
+    return IngestJob(filename, path, size)
+
+
+async def start_job(file: UploadFile) -> IngestJobStatus:
+    job = await spool_upload(file)
+    _remember(job)
+    await asyncio.to_thread(job.save)
+    asyncio.get_running_loop().run_in_executor(None, run_job, job)
+    return job.snapshot()
+
+
+def prune_jobs() -> None:
+    """Drop stored jobs older than JOB_RETENTION_DAYS."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=JOB_RETENTION_DAYS)
+    try:
+        clients.supabase().table(JOB_TABLE).delete().lt("updated_at", cutoff.isoformat()).execute()
+    except Exception as e:
+        logging.warning(f"Could not prune ingest jobs: {e}")
+
+
+def job_status(job_id: str) -> IngestJobStatus:
+    """
+    A job's status: live when this worker runs it, otherwise from the
+    stored row. 404 when neither knows the job.
+    """
+    job = _jobs.get(job_id)
+    if job is not None:
+        return job.snapshot()
+    try:
+        stored = load_job(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error loading ingest job: {str(e)}")
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Ingest job not found")
+    return stored
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.post("", response_model=IngestJobStatus, status_code=202)
+async def create_ingest_job(file: UploadFile = File(...)) -> IngestJobStatus:
+    """Spool the upload and ingest it in the background; returns the job id immediately"""
+    try:
+        return await start_job(file)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not start ingest job: {e}")
+
+
+@router.get("", response_model=List[IngestJobStatus])
+async def list_ingest_jobs() -> List[IngestJobStatus]:
+    """Recent jobs of all workers, newest first"""
+    try:
+        rows = await asyncio.to_thread(
+            lambda: clients.supabase().table(JOB_TABLE).select("*").order("created_at", desc=True).limit(MAX_FINISHED_JOBS).execute().data
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error listing ingest jobs: {str(e)}")
+    # This worker's own jobs are more current than their last saved row
+    return [_jobs[r["id"]].snapshot() if r["id"] in _jobs else _from_row(r) for r in rows or []]
+
+
+@router.get("/{job_id}", response_model=IngestJobStatus)
+async def get_ingest_job(job_id: str) -> IngestJobStatus:
+    return await asyncio.to_thread(job_status, job_id)
+
+
+@router.get("/{job_id}/events")
+async def stream_ingest_job(job_id: str):
+    """Server-sent events with the job status until it completes or fails"""
+    first = await asyncio.to_thread(job_status, job_id)
+
+    async def events():
+        last = None
+        snap = first
+        while True:
+            payload = json.dumps(snap.model_dump())
+            if payload != last:
+                yield f"event: progress\ndata: {payload}\n\n"
+                last = payload
+            if snap.status in DONE:
+                yield f"event: {snap.status}\ndata: {payload}\n\n"
+                return
+            await asyncio.sleep(SSE_INTERVAL_SECS)
+            snap = await asyncio.to_thread(job_status, job_id)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
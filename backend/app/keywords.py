@@ -0,0 +1,525 @@
+"""
+Corpus-level keyword engine
+Replaces per-comment LLM keywords with TF-IDF over all comments: unigrams and
+adjacent-word bigrams of stemmed Dutch tokens (same tokenizer as app.search),
+stored as an append-only sparse document-term matrix that ingest batches
+extend incrementally.
+
+- per-comment keywords: top (1 + log tf) * idf terms, shown in their most
+  common surface form ("kranten" and "krant" both display as "krant" if that
+  is how most people wrote it)
+- distinctive keywords per title/survey/month/category/theme: log-odds ratio
+  with an informative Dirichlet prior of each group against the rest of the
+  corpus, computed for all groups at once on a groups x terms count matrix
+
+Run from backend/:
+    python -m app.keywords --by title --top 10
+    python -m app.keywords --backfill          # rewrite nps_ai_enrichment.keywords
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import re
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+
+from app import response_cache
+from app.db import iter_pages, service_client
+from app.metrics import cache_lookup
+from app.search import STOPWORDS, fold, stem
+from app.trends import month_key, month_label
+
+router = APIRouter(prefix="/keywords", tags=["keywords"])
+
+LOAD_COLUMNS = "id, survey_name, title_text, creation_date, nps_score, nps_explanation"
+TOP_K = 5
+# Bigrams must occur in this many comments before they can be a keyword
+BIGRAM_MIN_DF = 3
+# Strength of the corpus prior in the log-odds contrast
+PRIOR_WEIGHT = 500.0
+GROUPINGS = ("title", "survey", "month", "category", "theme")
+CATEGORIES = ("detractor", "passive", "promoter")
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def analyze(text: Optional[str]) -> List[Tuple[str, str]]:
+    """(term, surface) pairs: stemmed unigrams, plus bigrams of words adjacent in the text."""
+    if not text:
+        return []
+    out: List[Tuple[str, str]] = []
+    prev: Optional[Tuple[int, str, str]] = None
+    for pos, word in enumerate(_TOKEN.findall(fold(text))):
+        if len(word) < 2 or word in STOPWORDS or word.isdigit():
+            continue
+        term = stem(word)
+        out.append((term, word))
+        if prev is not None and prev[0] == pos - 1:
+            out.append((f"{prev[1]} {term}", f"{prev[2]} {word}"))
+        prev = (pos, term, word)
+    return out
+
+
+def _category(score: Any) -> int:
+    if score is None:
+        return -1
+    score = int(score)
+    return 2 if score >= 9 else 1 if score >= 7 else 0
+
+
+def pick_distinct(ranked: Iterable[Tuple[str, Callable[[], str]]], k: int) -> List[str]:
+    """
+    Labels of the first k ranked (term, label) pairs without overlap: a unigram
+    already covered by a chosen bigram is skipped, and so is a bigram with a
+    part already chosen (as a unigram or in another bigram).
+    """
+    chosen: List[str] = []
+    covered: set = set()
+    for term, label in ranked:
+        parts = term.split(" ")
+        if term in covered or (len(parts) > 1 and any(p in covered for p in parts)):
+            continue
+        chosen.append(label())
+        covered.update(parts)
+        if len(chosen) == k:
+            break
+    return chosen
+
+
+class KeywordEngine:
+    """
+    Documents are rows of a CSR matrix held in growable typed arrays
+    (indptr/indices/counts), so appends never copy the corpus. Document
+    frequencies and per-term surface forms are maintained as rows arrive;
+    theme membership comes from nps_ai_enrichment and is updated on enrichment
+    writes.
+    """
+
+    def __init__(self) -> None:
+        self._reset()
+        self._lock = threading.Lock()
+
+    def _reset(self) -> None:
+        self.vocab: Dict[str, int] = {}
+        self.terms: List[str] = []
+        self.surfaces: List[Counter] = []
+        self.df = array("I")
+        self.indptr = array("Q", [0])
+        self.indices = array("I")
+        self.counts = array("H")
+        self.ids: List[str] = []
+        self.doc_of: Dict[str, int] = {}
+        self.dims: Dict[str, Dict[str, int]] = {"title": {}, "survey": {}, "theme": {}}
+        self.title = array("i")
+        self.survey = array("i")
+        self.month = array("i")
+        self.category = array("b")
+        self.themes: Dict[int, List[int]] = {}
+        self.loaded = False
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    # -------------------------------------------------------------------------
+    # Updates
+    # -------------------------------------------------------------------------
+    def _term(self, term: str) -> int:
+        tid = self.vocab.get(term)
+        if tid is None:
+            tid = self.vocab[term] = len(self.terms)
+            self.terms.append(term)
+            self.surfaces.append(Counter())
+            self.df.append(0)
+        return tid
+
+    def _code(self, dim: str, value: Any) -> int:
+        table = self.dims[dim]
+        return table.setdefault(str(value or ""), len(table))
+
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Add nps_response rows (with ids) that have a comment; known ids are ignored."""
+        added = 0
+        with self._lock:
+            for r in rows:
+                rid = r.get("id")
+                if not rid or rid in self.doc_of:
+                    continue
+                pairs = analyze(r.get("nps_explanation"))
+                if not pairs:
+                    continue
+                tf: Counter = Counter()
+                for term, surface in pairs:
+                    tid = self._term(term)
+                    tf[tid] += 1
+                    self.surfaces[tid][surface] += 1
+                for tid in sorted(tf):
+                    self.indices.append(tid)
+                    self.counts.append(min(tf[tid], 65535))
+                    self.df[tid] += 1
+                self.indptr.append(len(self.indices))
+                self.doc_of[rid] = len(self.ids)
+                self.ids.append(rid)
+                self.title.append(self._code("title", r.get("title_text")))
+                self.survey.append(self._code("survey", r.get("survey_name")))
+                m = month_key(r.get("creation_date"))
+                self.month.append(-1 if m is None else m)
+                self.category.append(_category(r.get("nps_score")))
+                added += 1
+        return added
+
+    def set_themes(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """Record themes from nps_ai_enrichment rows (response_id, themes)."""
+        with self._lock:
+            for r in rows:
+                doc = self.doc_of.get(r.get("response_id"))
+                if doc is None:
+                    continue
+                t = r.get("themes") or []
+                names = json.loads(t) if isinstance(t, str) else t
+                self.themes[doc] = [self._code("theme", n) for n in names if isinstance(n, str) and n]
+
+    # -------------------------------------------------------------------------
+    # Scoring
+    # -------------------------------------------------------------------------
+    def _idf(self, df: np.ndarray) -> np.ndarray:
+        return np.log((1 + self.size) / (1 + df)) + 1
+
+    def _pick(self, ranked: Iterable[int], k: int, labels: Optional[List[str]] = None) -> List[str]:
+        """First k of the ranked term ids, without overlap (see pick_distinct)."""
+        return pick_distinct(
+            ((self.terms[tid], lambda tid=tid: labels[tid] if labels is not None else self.display(tid)) for tid in ranked), k
+        )
+
+    def display(self, tid: int) -> str:
+        surfaces = self.surfaces[tid]
+        return surfaces.most_common(1)[0][0] if surfaces else self.terms[tid]
+
+    def extract(self, text: Optional[str], k: int = TOP_K) -> List[str]:
+        """Keywords for a comment, weighted by the corpus idf (new words count as rare)."""
+        with self._lock:
+            tf: Counter = Counter()
+            surface: Dict[str, str] = {}
+            for term, word in analyze(text):
+                tid = self.vocab.get(term)
+                df = self.df[tid] if tid is not None else 0
+                if " " in term and df < BIGRAM_MIN_DF:
+                    continue
+                tf[term] += 1
+                surface.setdefault(term, word)
+            if not tf:
+                return []
+            terms = list(tf)
+            df = np.array([self.df[self.vocab[t]] if t in self.vocab else 0 for t in terms], dtype=np.float64)
+            weights = (1 + np.log(np.array([tf[t] for t in terms], dtype=np.float64))) * self._idf(df)
+            return pick_distinct(
+                (
+                    (terms[i], lambda t=terms[i]: self.display(self.vocab[t]) if t in self.vocab else surface[t])
+                    for i in np.argsort(-weights, kind="stable")
+                ),
+                k,
+            )
+
+    def doc_keywords(self, response_id: str, k: int = TOP_K) -> Optional[List[str]]:
+        with self._lock:
+            doc = self.doc_of.get(response_id)
+            if doc is None:
+                return None
+            lo, hi = self.indptr[doc], self.indptr[doc + 1]
+            tids = np.array(self.indices[lo:hi], dtype=np.int64)
+            tf = np.array(self.counts[lo:hi], dtype=np.float64)
+            df = np.array(self.df, dtype=np.float64)[tids]
+            weights = (1 + np.log(tf)) * self._idf(df)
+            allowed = np.array([" " not in self.terms[t] or self.df[t] >= BIGRAM_MIN_DF for t in tids], dtype=bool)
+            order = np.argsort(-weights, kind="stable")
+            return self._pick(tids[order][allowed[order]].tolist(), k)
+
+    def all_keywords(self, k: int = TOP_K) -> Dict[str, List[str]]:
+        """Keywords for every document, vectorized over the whole matrix."""
+        with self._lock:
+            indptr = np.array(self.indptr, dtype=np.int64)
+            tids = np.array(self.indices, dtype=np.int64)
+            tf = np.array(self.counts, dtype=np.float64)
+            df = np.array(self.df, dtype=np.float64)
+            is_bigram = np.array([" " in t for t in self.terms], dtype=bool)
+            ids = list(self.ids)
+            labels = [self.display(t) for t in range(len(self.terms))]
+        weights = (1 + np.log(tf)) * self._idf(df)[tids]
+        weights[is_bigram[tids] & (df[tids] < BIGRAM_MIN_DF)] = -np.inf
+        # Order every row's entries by weight in one sort: row ascending, weight descending
+        rows = np.repeat(np.arange(len(ids)), np.diff(indptr))
+        order = np.lexsort((-weights, rows))
+        ranked = np.where(np.isfinite(weights[order]), tids[order], -1)
+        out: Dict[str, List[str]] = {}
+        for doc, rid in enumerate(ids):
+            # k * 3 entries leave room for unigrams dropped under a chosen bigram
+            row = ranked[indptr[doc] : min(indptr[doc + 1], indptr[doc] + k * 3)]
+            out[rid] = self._pick(row[row >= 0].tolist(), k, labels)
+        return out
+
+    def distinctive(
+        self,
+        by: str,
+        top: int = 10,
+        min_count: int = 5,
+        groups: Optional[Sequence[str]] = None,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Most over-represented terms per group versus the rest of the corpus.
+
+        Counts are documents containing the term. The score is the z-score of
+        the log-odds ratio with an informative Dirichlet prior (Monroe et al.
+        2008), which keeps rare terms in small groups from dominating.
+        """
+        with self._lock:
+            indptr = np.array(self.indptr, dtype=np.int64)
+            tids = np.array(self.indices, dtype=np.int64)
+            df = np.array(self.df, dtype=np.int64)
+            n = self.size
+            if by == "theme":
+                names = sorted(self.dims["theme"], key=self.dims["theme"].get)
+                pairs = [(d, t) for d, ts in self.themes.items() for t in ts]
+                docs = np.array([p[0] for p in pairs], dtype=np.int64)
+                labels = np.array([p[1] for p in pairs], dtype=np.int64)
+            else:
+                if by == "month":
+                    raw = np.array(self.month, dtype=np.int64)
+                    keys = sorted(set(raw[raw >= 0].tolist()))
+                    names = [month_label(m)[:7] for m in keys]
+                    labels = np.searchsorted(keys, raw) if keys else np.zeros(n, dtype=np.int64)
+                    labels[raw < 0] = -1
+                elif by == "category":
+                    names = list(CATEGORIES)
+                    labels = np.array(self.category, dtype=np.int64)
+                else:
+                    names = sorted(self.dims[by], key=self.dims[by].get)
+                    labels = np.array(getattr(self, by), dtype=np.int64)
+                docs = np.arange(n)[labels >= 0]
+                labels = labels[labels >= 0]
+
+        if not len(docs) or not names:
+            return {}
+        # Restrict to terms frequent enough to matter, with compact ids
+        vocab = np.nonzero(df >= min_count)[0]
+        V = len(vocab)
+        if not V:
+            return {}
+        remap = np.full(len(df), -1, dtype=np.int64)
+        remap[vocab] = np.arange(V)
+
+        # Gather the CSR rows of every (doc, group) pair
+        lengths = indptr[docs + 1] - indptr[docs]
+        starts = np.repeat(indptr[docs], lengths)
+        pos = starts + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        term = remap[tids[pos]]
+        group = np.repeat(labels, lengths)
+        ok = term >= 0
+        G = len(names)
+        if G < 2:
+            # Nothing to contrast a single group against
+            return {}
+        y = np.bincount(group[ok] * V + term[ok], minlength=G * V).reshape(G, V).astype(np.float64)
+
+        total = y.sum(axis=0)
+        alpha = PRIOR_WEIGHT * total / total.sum()
+        alpha0 = alpha.sum()
+        n_g = y.sum(axis=1, keepdims=True)
+        y_r = total[None, :] - y
+        n_r = total.sum() - n_g
+        delta = (
+            np.log((y + alpha) / (n_g + alpha0 - y - alpha))
+            - np.log((y_r + alpha) / (n_r + alpha0 - y_r - alpha))
+        )
+        z = delta / np.sqrt(1 / (y + alpha) + 1 / (y_r + alpha))
+        z[y < min_count] = -np.inf
+
+        wanted = set(groups) if groups else None
+        out: Dict[str, List[Dict[str, Any]]] = {}
+        for g, name in enumerate(names):
+            if wanted is not None and name not in wanted:
+                continue
+            row = z[g]
+            k = min(top, int(np.isfinite(row).sum()))
+            if k <= 0:
+                continue
+            best = np.argpartition(-row, k - 1)[:k]
+            best = best[np.argsort(-row[best], kind="stable")]
+            out[name] = [
+                {
+                    "keyword": self.display(int(vocab[i])),
+                    "score": round(float(row[i]), 2),
+                    "count": int(y[g, i]),
+                    "share": round(float(y[g, i] / max(n_g[g, 0], 1)), 4),
+                }
+                for i in best
+            ]
+        return out
+
+
+# -----------------------------------------------------------------------------
+# Shared engine
+# -----------------------------------------------------------------------------
+engine = KeywordEngine()
+_load_lock = threading.Lock()
+_warm_lock = threading.Lock()
+_warming: Optional[threading.Thread] = None
+
+
+def ensure_loaded() -> KeywordEngine:
+    """Build the matrix from nps_response (and themes from nps_ai_enrichment) on first use."""
+    cache_lookup("keyword_engine", engine.loaded)
+    if engine.loaded:
+        return engine
+    with _load_lock:
+        if engine.loaded:
+            return engine
+        client = service_client()
+        for page in iter_pages(client, "nps_response", LOAD_COLUMNS,
+                               where=lambda q: q.filter("nps_explanation", "not.is", "null")):
+            engine.add_rows(page)
+        for page in iter_pages(client, "nps_ai_enrichment", "response_id, themes", key="response_id"):
+            engine.set_themes(page)
+        engine.loaded = True
+        logging.info(f"Keyword engine loaded: {engine.size} comments, {len(engine.terms)} terms")
+    return engine
+
+
+def warm() -> None:
+    """Load the engine in a background thread (startup, first extract) unless loaded or loading."""
+    global _warming
+    with _warm_lock:
+        if engine.loaded or (_warming is not None and _warming.is_alive()):
+            return
+
+        def run() -> None:
+            try:
+                ensure_loaded()
+            except Exception as e:
+                logging.error(f"Keyword engine load failed: {e}")
+
+        _warming = threading.Thread(target=run, name="keyword-engine-load", daemon=True)
+        _warming.start()
+
+
+def record_ingested(rows: Iterable[Dict[str, Any]]) -> None:
+    """Ingest hook: add inserted responses if the engine is live."""
+    if engine.loaded:
+        engine.add_rows(rows)
+
+
+def record_enriched(rows: Iterable[Dict[str, Any]]) -> None:
+    """Enrichment hook (BatchUpserter on_flush): keep theme membership current."""
+    if engine.loaded:
+        engine.set_themes(rows)
+
+
+def extract(text: Optional[str], k: int = TOP_K) -> List[str]:
+    """
+    Keywords for a comment; [] while the engine is still loading, so enrichment
+    never waits on (or fails with) the corpus load. `--backfill` fills those in.
+    """
+    if not engine.loaded:
+        warm()
+        return []
+    return engine.extract(text, k)
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.get("/distinctive")
+async def get_distinctive_keywords(
+    by: str = "title",
+    group: Optional[List[str]] = Query(None),
+    top: int = Query(10, ge=1, le=100),
+    min_count: int = Query(5, ge=1),
+):
+    """Keywords that set each title/survey/month/category/theme apart from the rest"""
+    if by not in GROUPINGS:
+        raise HTTPException(status_code=400, detail=f"Unknown grouping: {by}")
+    try:
+        return ensure_loaded().distinctive(by, top, min_count, group)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error computing keywords: {str(e)}")
+
+
+@router.get("/responses/{response_id}")
+async def get_response_keywords(response_id: str, k: int = Query(TOP_K, ge=1, le=25)):
+    """TF-IDF keywords of one comment"""
+    try:
+        found = ensure_loaded().doc_keywords(response_id, k)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error computing keywords: {str(e)}")
+    if found is None:
+        raise HTTPException(status_code=404, detail="Response not indexed")
+    return {"response_id": response_id, "keywords": found}
+
+
+@router.post("/reload")
+async def reload_keywords():
+    """Rebuild the keyword matrix from the database"""
+    try:
+        with engine._lock:
+            engine._reset()
+        e = ensure_loaded()
+        return {"comments": e.size, "terms": len(e.terms)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reloading keywords: {str(e)}")
+
+
+# -----------------------------------------------------------------------------
+# CLI
+# -----------------------------------------------------------------------------
+def backfill(k: int = TOP_K) -> Tuple[int, List[Tuple[str, str]]]:
+    """Overwrite nps_ai_enrichment.keywords for every enriched comment; returns (written, failures)."""
+    from app.batch_writer import BatchUpserter
+
+    e = ensure_loaded()
+    keywords = e.all_keywords(k)
+    enriched = set(e.ids[d] for d in e.themes)
+    with BatchUpserter(service_client(), "nps_ai_enrichment", on_conflict="response_id",
+                       on_flush=response_cache.invalidate_enrichment) as writer:
+        for rid, kw in keywords.items():
+            if rid in enriched:
+                writer.add({"response_id": rid, "keywords": kw})
+    return writer.written, writer.take_failures()
+
+
+def main() -> None:
+    import time
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Corpus TF-IDF keywords for NPS comments")
+    parser.add_argument("--by", choices=GROUPINGS, default="title", help="grouping for distinctive keywords")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--min-count", type=int, default=5)
+    parser.add_argument("--backfill", action="store_true", help="rewrite keywords on existing enrichment rows")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    e = ensure_loaded()
+    print(f"Loaded {e.size} comments, {len(e.terms)} terms in {time.perf_counter() - started:.1f}s")
+    if args.backfill:
+        written, failed = backfill()
+        print(f"Keywords written: {written}, failed: {len(failed)}")
+        return
+    started = time.perf_counter()
+    result = e.distinctive(args.by, args.top, args.min_count)
+    print(f"Scored {len(result)} groups in {time.perf_counter() - started:.2f}s")
+    for name, kws in result.items():
+        print(f"{name or '(none)'}: " + ", ".join(k["keyword"] for k in kws))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+"""
+Metrics and tracing
+Dependency-free counters, gauges and histograms rendered in the Prometheus
+text format at /metrics, plus span() for timing code blocks. If
+opentelemetry-api is installed, spans are also emitted as OpenTelemetry spans.
+
+Metrics live in process memory, so with several API workers a scrape sees only
+the worker that answered it. Set METRICS_MULTIPROC_DIR (a directory local to
+the host, emptied whenever the server starts) to have every worker snapshot its
+metrics there every METRICS_SNAPSHOT_SECS; /metrics then reports the sum over
+all workers, with gauges counted only for workers that are still alive.
+"""
+
+from __future__ import annotations
+
+import bisect
+import copy
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+try:  # optional
+    from opentelemetry import trace as _otel_trace
+
+    _tracer = _otel_trace.get_tracer("nps-insights")
+except ImportError:  # pragma: no cover - depends on environment
+    _tracer = None
+
+router = APIRouter(tags=["metrics"])
+
+MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")
+SNAPSHOT_SECS = float(os.getenv("METRICS_SNAPSHOT_SECS", "5"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def _state(self) -> Dict[str, Any]:
+        """JSON-able copy of the values, for multi-process snapshots."""
+        raise NotImplementedError
+
+    def _clear(self) -> None:
+        raise NotImplementedError
+
+    def _absorb(self, state: Dict[str, Any]) -> None:
+        """Add another process's _state() to this metric's values."""
+        raise NotImplementedError
+
+    def merged(self, states: Sequence[Dict[str, Any]]) -> "_Metric":
+        """Unregistered copy holding the sum of the given snapshots."""
+        other = copy.copy(self)
+        other._lock = threading.Lock()
+        other._clear()
+        for state in states:
+            other._absorb(state)
+        return other
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        """Sum over all label sets."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_fmt_labels(self.label_names, k)} {v}" for k, v in self._values.items()]
+
+    def _state(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"values": [[list(k), v] for k, v in self._values.items()]}
+
+    def _clear(self) -> None:
+        self._values = {}
+
+    def _absorb(self, state: Dict[str, Any]) -> None:
+        for key, value in state.get("values", []):
+            self._values[tuple(key)] = self._values.get(tuple(key), 0.0) + value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[idx] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        out = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                running = 0
+                for bound, c in zip(self.buckets + (float("inf"),), counts):
+                    running += c
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                    out.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, le)} {running}")
+                out.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {self._sums[key]}")
+                out.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {running}")
+        return out
+
+    def _state(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"buckets": [[list(k), list(c), self._sums[k]] for k, c in self._counts.items()]}
+
+    def _clear(self) -> None:
+        self._counts = {}
+        self._sums = {}
+
+    def _absorb(self, state: Dict[str, Any]) -> None:
+        for key, counts, total in state.get("buckets", []):
+            key = tuple(key)
+            mine = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, c in enumerate(counts[: len(mine)]):
+                mine[i] += c
+            self._sums[key] = self._sums.get(key, 0.0) + total
+
+
+REGISTRY: List[_Metric] = []
+
+# -----------------------------------------------------------------------------
+# Metric definitions
+# -----------------------------------------------------------------------------
+HTTP_LATENCY = Histogram("nps_http_request_seconds", "API request latency", ["method", "route", "status"])
+INGEST_STAGE = Histogram("nps_ingest_stage_seconds", "Ingest pipeline stage duration", ["stage"])
+INGEST_ROWS = Counter("nps_ingest_rows_total", "Ingested rows by outcome", ["outcome"])
+SUPABASE_LATENCY = Histogram("nps_supabase_request_seconds", "Supabase/PostgREST call latency", ["table", "operation", "status"])
+OPENAI_LATENCY = Histogram("nps_openai_request_seconds", "OpenAI call latency", ["model", "endpoint", "outcome"])
+OPENAI_TOKENS = Counter("nps_openai_tokens_total", "OpenAI tokens", ["model", "direction"])
+OPENAI_RETRIES = Counter("nps_openai_retries_total", "Application-level OpenAI retries", ["model"])
+OPENAI_RATE_LIMITED = Counter("nps_openai_rate_limited_total", "OpenAI 429 responses", ["model"])
+ENRICH_QUEUE = Gauge("nps_enrichment_queue_depth", "Responses waiting for enrichment", ["source"])
+UPSERT_PENDING = Gauge("nps_upsert_buffer_pending", "Rows buffered for batched upsert", ["table"])
+CACHE_REQUESTS = Counter("nps_cache_requests_total", "Cache lookups by result", ["cache", "result"])
+SPAN_LATENCY = Histogram("nps_span_seconds", "Duration of traced code blocks", ["span"])
+
+
+def render() -> str:
+    metrics = _merged_registry() if MULTIPROC_DIR else REGISTRY
+    return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+
+# -----------------------------------------------------------------------------
+# Multi-process snapshots (METRICS_MULTIPROC_DIR)
+# -----------------------------------------------------------------------------
+_snapshot_thread: Optional[threading.Thread] = None
+
+
+def write_snapshot() -> None:
+    """Write this process's metrics to METRICS_MULTIPROC_DIR/<pid>.json."""
+    if not MULTIPROC_DIR:
+        return
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    path = os.path.join(MULTIPROC_DIR, f"{os.getpid()}.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({m.name: m._state() for m in REGISTRY}, f)
+    os.replace(tmp, path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merged_registry() -> List[_Metric]:
+    write_snapshot()
+    snapshots: List[Tuple[bool, Dict[str, Any]]] = []
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            pid = int(os.path.basename(path)[: -len(".json")])
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping metrics snapshot {path}: {e}")
+            continue
+        snapshots.append((_alive(pid), data))
+    # Counters and histograms keep exited workers' totals; gauges only count live workers
+    return [
+        m.merged([data.get(m.name, {}) for alive, data in snapshots if alive or m.kind != "gauge"])
+        for m in REGISTRY
+    ]
+
+
+def start_snapshots() -> None:
+    """Snapshot this worker's metrics every SNAPSHOT_SECS (no-op without METRICS_MULTIPROC_DIR)."""
+    global _snapshot_thread
+    if not MULTIPROC_DIR or (_snapshot_thread is not None and _snapshot_thread.is_alive()):
+        return
+
+    def loop() -> None:
+        while True:
+            time.sleep(SNAPSHOT_SECS)
+            try:
+                write_snapshot()
+            except OSError as e:
+                logging.warning(f"Could not write metrics snapshot: {e}")
+
+    _snapshot_thread = threading.Thread(target=loop, name="metrics-snapshot", daemon=True)
+    _snapshot_thread.start()
+
+
+# -----------------------------------------------------------------------------
+# Helpers
+# -----------------------------------------------------------------------------
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    """Time a block into nps_span_seconds and, if available, an OpenTelemetry span."""
+    start = time.perf_counter()
+    if _tracer is not None:
+        with _tracer.start_as_current_span(name, attributes={k: str(v) for k, v in attributes.items()}):
+            try:
+                yield
+            finally:
+                SPAN_LATENCY.observe(time.perf_counter() - start, span=name)
+    else:
+        try:
+            yield
+        finally:
+            SPAN_LATENCY.observe(time.perf_counter() - start, span=name)
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+class _OpenAICall:
+    def __init__(self, model: str) -> None:
+        self.model = model
+
+    def usage(self, response: Any) -> None:
+        """Record token usage from a chat/embedding response."""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        OPENAI_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, model=self.model, direction="in")
+        OPENAI_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, model=self.model, direction="out")
+        # Prompt tokens served from the provider's prefix cache (billed at the cached rate)
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", 0)
+        if cached:
+            OPENAI_TOKENS.inc(cached, model=self.model, direction="cached_in")
+
+
+@contextmanager
+def openai_call(model: str, endpoint: str = "chat") -> Iterator[_OpenAICall]:
+    """Time one OpenAI request; 429s are counted separately."""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield _OpenAICall(model)
+    except Exception as e:
+        status = getattr(e, "status_code", None)
+        outcome = "rate_limited" if status == 429 else "error"
+        if status == 429:
+            OPENAI_RATE_LIMITED.inc(model=model)
+        raise
+    finally:
+        OPENAI_LATENCY.observe(time.perf_counter() - start, model=model, endpoint=endpoint, outcome=outcome)
+
+
+def _postgrest_target(path: str) -> str:
+    # /rest/v1/<table> or /rest/v1/rpc/<fn>
+    parts = [p for p in path.split("/") if p]
+    if "rpc" in parts and parts.index("rpc") + 1 < len(parts):
+        return "rpc:" + parts[parts.index("rpc") + 1]
+    return parts[-1] if parts else ""
+
+
+def _postgrest_operation(method: str, prefer: str) -> str:
+    if method == "POST":
+        return "upsert" if "merge-duplicates" in prefer else "insert"
+    return {"GET": "select", "HEAD": "count", "PATCH": "update", "DELETE": "delete"}.get(method, method.lower())
+
+
+def instrument_supabase(client: Any) -> Any:
+    """Attach httpx hooks to a Supabase client's PostgREST session to time every call."""
+    session = client.postgrest.session
+    if getattr(session, "_nps_instrumented", False):
+        return client
+
+    def on_request(request: Any) -> None:
+        request.extensions["nps_start"] = time.perf_counter()
+
+    def on_response(response: Any) -> None:
+        request = response.request
+        start = request.extensions.get("nps_start")
+        if start is None:
+            return
+        operation = _postgrest_operation(request.method, request.headers.get("prefer", ""))
+        target = _postgrest_target(request.url.path)
+        if target.startswith("rpc:"):
+            operation = "rpc"
+        SUPABASE_LATENCY.observe(time.perf_counter() - start, table=target, operation=operation, status=response.status_code)
+
+    hooks = session.event_hooks
+    hooks["request"] = list(hooks.get("request", [])) + [on_request]
+    hooks["response"] = list(hooks.get("response", [])) + [on_response]
+    session.event_hooks = hooks
+    session._nps_instrumented = True
+    return client
+
+
+def serve_in_thread(port: int) -> None:
+    """Expose /metrics from a CLI process (e.g. direct_enrich_final.py)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+async def http_middleware(request: Any, call_next: Any) -> Any:
+    """Per-request latency by route template (not raw path, to keep cardinality low)."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        with span("http " + request.method):
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_LATENCY.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status,
+        )
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint() -> PlainTextResponse:
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,187 @@
+"""
+Near-duplicate comment collapsing
+Groups comments like "prima krant!", "Prima krant" and "prima krant, goede
+artikelen" before enrichment so one representative per group goes to the LLM
+and the result is fanned out to every member.
+
+Comments are normalized, cut into character k-shingles and summarized with
+MinHash signatures; LSH banding proposes candidate groups and each member is
+verified against its group representative by estimated Jaccard similarity.
+Everything runs on flat NumPy arrays (no per-comment Python loops in the
+hashing), so a million comments fit in memory.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))  # 0 disables collapsing
+NUM_PERM = 64
+SHINGLE = 4
+# Comments hashed per chunk; bounds the shingle arrays to a few hundred MB
+CHUNK_COMMENTS = 100_000
+
+_PUNCT = re.compile(r"[^\w\s]+")
+_SPACE = re.compile(r"\s+")
+
+
+@dataclass
+class CollapseResult:
+    # group[i] is the index of the representative comment for comment i
+    group: np.ndarray
+    representatives: np.ndarray
+
+    @property
+    def collapse_ratio(self) -> float:
+        """Share of comments that do not need their own LLM call."""
+        n = len(self.group)
+        return 1.0 - len(self.representatives) / n if n else 0.0
+
+    def members(self) -> List[np.ndarray]:
+        """Member indexes per representative, in `representatives` order."""
+        order = np.argsort(self.group, kind="stable")
+        keys = self.group[order]
+        starts = np.searchsorted(keys, self.representatives)
+        ends = np.searchsorted(keys, self.representatives, side="right")
+        return [order[s:e] for s, e in zip(starts, ends)]
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _SPACE.sub(" ", _PUNCT.sub(" ", text)).strip()
+
+
+# -----------------------------------------------------------------------------
+# Signatures
+# -----------------------------------------------------------------------------
+def _permutations(num_perm: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def _shingle_hashes(texts: Sequence[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    64-bit hash of every byte k-gram of every text, and the start offset of
+    each text's run in that array (texts shorter than k are padded).
+    """
+    encoded = [t.encode("utf-8").ljust(k) for t in texts]
+    lengths = np.fromiter((len(e) - k + 1 for e in encoded), dtype=np.int64, count=len(encoded))
+    buf = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+    text_starts = np.concatenate([[0], np.cumsum([len(e) for e in encoded])[:-1]]).astype(np.int64)
+    # Window start positions that stay inside their own text
+    win = np.repeat(text_starts, lengths) + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    h = np.zeros(len(win), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for j in range(k):
+            h = (h * np.uint64(1099511628211)) ^ buf[win + j]  # FNV-1a style mix
+        h ^= h >> np.uint64(29)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    return h, offsets
+
+
+def minhash(texts: Sequence[str], num_perm: int = NUM_PERM, k: int = SHINGLE, seed: int = 1) -> np.ndarray:
+    """MinHash signatures (n, num_perm) as uint32 for already-normalized texts."""
+    a, b = _permutations(num_perm, seed)
+    out = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for c in range(0, len(texts), CHUNK_COMMENTS):
+        h, offsets = _shingle_hashes(texts[c : c + CHUNK_COMMENTS], k)
+        with np.errstate(over="ignore"):
+            for p in range(num_perm):
+                v = (h * a[p] + b[p]) >> np.uint64(32)
+                out[c : c + len(offsets), p] = np.minimum.reduceat(v, offsets)
+    return out
+
+
+# -----------------------------------------------------------------------------
+# Grouping
+# -----------------------------------------------------------------------------
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """(bands, rows) whose S-curve midpoint (1/b)^(1/r) is closest to threshold."""
+    best = (num_perm, 1)
+    for r in range(1, num_perm + 1):
+        if num_perm % r == 0:
+            b = num_perm // r
+            if abs((1 / b) ** (1 / r) - threshold) < abs((1 / best[0]) ** (1 / best[1]) - threshold):
+                best = (b, r)
+    return best
+
+
+def _components(n: int, pairs_a: np.ndarray, pairs_b: np.ndarray) -> np.ndarray:
+    """Connected components by min-label propagation; label = smallest member index."""
+    label = np.arange(n, dtype=np.int64)
+    if not len(pairs_a):
+        return label
+    while True:
+        prev = label
+        low = np.minimum(label[pairs_a], label[pairs_b])
+        label = label.copy()
+        np.minimum.at(label, pairs_a, low)
+        np.minimum.at(label, pairs_b, low)
+        label = label[label]  # pointer jumping
+        if np.array_equal(label, prev):
+            return label
+
+
+def group_signatures(sig: np.ndarray, threshold: float) -> np.ndarray:
+    """Representative index per row: LSH candidates, verified against the representative."""
+    n, num_perm = sig.shape
+    bands, rows = lsh_params(threshold, num_perm)
+    pairs_a: List[np.ndarray] = []
+    pairs_b: List[np.ndarray] = []
+    for band in range(bands):
+        block = sig[:, band * rows : (band + 1) * rows].astype(np.uint64)
+        key = np.zeros(n, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for j in range(rows):
+                key = key * np.uint64(0x100000001B3) + block[:, j] + np.uint64(j)
+        order = np.argsort(key, kind="stable")
+        k = key[order]
+        same = k[1:] == k[:-1]
+        # Link each row to the first row of its bucket
+        starts = np.maximum.accumulate(np.where(np.concatenate([[True], ~same]), np.arange(n), 0))
+        linked = np.nonzero(np.concatenate([[False], same]))[0]
+        pairs_a.append(order[linked])
+        pairs_b.append(order[starts[linked]])
+    label = _components(n, np.concatenate(pairs_a), np.concatenate(pairs_b))
+
+    # Members must actually resemble their representative (LSH has false positives)
+    agree = (sig == sig[label]).mean(axis=1)
+    label = np.where(agree >= threshold, label, np.arange(n))
+    return label
+
+
+def collapse(texts: Sequence[str], threshold: Optional[float] = None, num_perm: int = NUM_PERM, k: int = SHINGLE) -> CollapseResult:
+    """Group near-duplicate texts; identical normalized texts always share a group."""
+    threshold = NEAR_DUP_THRESHOLD if threshold is None else threshold
+    n = len(texts)
+    if n == 0:
+        return CollapseResult(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    norm = [normalize(t) for t in texts]
+    # Exact duplicates first: hash only the distinct normalized strings
+    uniq, first, inverse = np.unique(np.asarray(norm, dtype=object), return_index=True, return_inverse=True)
+    if threshold <= 0 or threshold >= 1 or len(uniq) < 2:
+        group = first[inverse]
+    else:
+        sig = minhash(list(uniq), num_perm, k)
+        rep_of_uniq = group_signatures(sig, threshold)
+        group = first[rep_of_uniq][inverse]
+    group = group.astype(np.int64)
+    reps = np.unique(group)
+    return CollapseResult(group, reps)
+
+
+def log_collapse(result: CollapseResult, label: str) -> None:
+    n = len(result.group)
+    if n:
+        logging.info(f"{label}: {n} comments -> {len(result.representatives)} groups ({result.collapse_ratio:.1%} collapsed)")
@@ -0,0 +1,248 @@
+"""
+OpenAI Batch API jobs for offline backfills
+Requests are written as JSONL files (one chat completion per line, keyed by
+custom_id), uploaded with purpose "batch" and submitted as batch jobs with a
+24h completion window. Batch jobs are not subject to the per-minute rate
+limits of live calls and bill at half price; the caller polls until the jobs
+finish and streams the output files back.
+
+A run is persisted as a JSON state file in BATCH_STATE_DIR (job ids, input and
+output files, custom_id -> response ids, which jobs were already ingested), so
+an interrupted or --no-wait backfill is resumed by run id or by any of its
+batch job ids.
+
+The installed SDK predates client.batches, so jobs go through the client's
+generic get/post (same auth, base URL and retries as the typed resources).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from openai import OpenAI
+
+BATCH_STATE_DIR = os.getenv("BATCH_STATE_DIR", os.path.join(os.getcwd(), "batch_jobs"))
+# Provider limits per input file: 50k requests, 200 MB
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_MB", "190")) * 1024 * 1024
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_WINDOW = "24h"
+TERMINAL = {"completed", "failed", "expired", "cancelled"}
+JSONObject = Dict[str, Any]
+
+
+# -----------------------------------------------------------------------------
+# Request files
+# -----------------------------------------------------------------------------
+def request_line(custom_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def write_request_files(
+    lines: Iterable[Dict[str, Any]],
+    directory: str,
+    stem: str,
+    max_requests: int = BATCH_MAX_REQUESTS,
+    max_bytes: int = BATCH_MAX_BYTES,
+) -> List[str]:
+    """Write request lines as JSONL files under the per-file request and size limits."""
+    os.makedirs(directory, exist_ok=True)
+    paths: List[str] = []
+    fh = None
+    count = size = 0
+    try:
+        for line in lines:
+            data = (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+            if fh is None or count >= max_requests or size + len(data) > max_bytes:
+                if fh is not None:
+                    fh.close()
+                paths.append(os.path.join(directory, f"{stem}-{len(paths):03d}.jsonl"))
+                fh = open(paths[-1], "wb")
+                count = size = 0
+            fh.write(data)
+            count += 1
+            size += len(data)
+    finally:
+        if fh is not None:
+            fh.close()
+    return paths
+
+
+def parse_result(line: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]], Optional[str]]:
+    """(custom_id, chat completion body, error) for one output or error file line."""
+    custom_id = line.get("custom_id", "")
+    if line.get("error"):
+        error = line["error"]
+        return custom_id, None, error.get("message") if isinstance(error, dict) else str(error)
+    response = line.get("response") or {}
+    if response.get("status_code", 200) >= 400:
+        body = response.get("body") or {}
+        message = (body.get("error") or {}).get("message") if isinstance(body, dict) else None
+        return custom_id, None, f"HTTP {response.get('status_code')}: {message or body}"
+    return custom_id, response.get("body"), None
+
+
+def iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as fh:
+        for raw in fh:
+            if raw.strip():
+                yield json.loads(raw)
+
+
+# -----------------------------------------------------------------------------
+# Run state
+# -----------------------------------------------------------------------------
+@dataclass
+class BatchJob:
+    request_file: str
+    input_file_id: str = ""
+    batch_id: str = ""
+    status: str = "pending"
+    output_file_id: str = ""
+    error_file_id: str = ""
+    request_counts: Dict[str, int] = field(default_factory=dict)
+    ingested: bool = False
+
+
+@dataclass
+class BatchRun:
+    run_id: str
+    model: str
+    created_at: float
+    jobs: List[BatchJob] = field(default_factory=list)
+    # custom_id -> every response id sharing that request (near-duplicates)
+    members: Dict[str, List[str]] = field(default_factory=dict)
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def new(cls, model: str, **meta: Any) -> "BatchRun":
+        run_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        return cls(run_id=run_id, model=model, created_at=time.time(), meta=meta)
+
+    @property
+    def directory(self) -> str:
+        return os.path.join(BATCH_STATE_DIR, self.run_id)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, "state.json")
+
+    def save(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(asdict(self), fh, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    @classmethod
+    def load(cls, path: str) -> "BatchRun":
+        with open(path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        data["jobs"] = [BatchJob(**j) for j in data.get("jobs", [])]
+        return cls(**data)
+
+    @classmethod
+    def find(cls, ref: str) -> "BatchRun":
+        """Run by state file path, run id or one of its batch job ids."""
+        if os.path.isfile(ref):
+            return cls.load(ref)
+        candidate = os.path.join(BATCH_STATE_DIR, ref, "state.json")
+        if os.path.isfile(candidate):
+            return cls.load(candidate)
+        if os.path.isdir(BATCH_STATE_DIR):
+            for name in sorted(os.listdir(BATCH_STATE_DIR), reverse=True):
+                path = os.path.join(BATCH_STATE_DIR, name, "state.json")
+                if os.path.isfile(path):
+                    run = cls.load(path)
+                    if any(j.batch_id == ref for j in run.jobs):
+                        return run
+        raise FileNotFoundError(f"No batch run state for {ref!r} in {BATCH_STATE_DIR}")
+
+    def pending(self) -> List[BatchJob]:
+        return [j for j in self.jobs if not j.ingested]
+
+
+# -----------------------------------------------------------------------------
+# Client
+# -----------------------------------------------------------------------------
+class BatchClient:
+    def __init__(self, client: OpenAI) -> None:
+        self.client = client
+
+    def upload(self, path: str) -> str:
+        with open(path, "rb") as fh:
+            # "batch" is not in this SDK's purpose Literal yet; the API accepts it
+            return self.client.files.create(file=(os.path.basename(path), fh), purpose="batch").id  # type: ignore[arg-type]
+
+    def create(self, input_file_id: str, metadata: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        body: Dict[str, Any] = {"input_file_id": input_file_id, "endpoint": BATCH_ENDPOINT, "completion_window": BATCH_WINDOW}
+        if metadata:
+            body["metadata"] = metadata
+        return self.client.post("/batches", cast_to=JSONObject, body=body)
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        return self.client.get(f"/batches/{batch_id}", cast_to=JSONObject)
+
+    def cancel(self, batch_id: str) -> Dict[str, Any]:
+        return self.client.post(f"/batches/{batch_id}/cancel", cast_to=JSONObject)
+
+    def download(self, file_id: str, path: str) -> str:
+        """Save a result file to path (kept with the run, so re-ingesting needs no download)."""
+        if not os.path.isfile(path):
+            self.client.files.content(file_id).stream_to_file(path + ".part")
+            os.replace(path + ".part", path)
+        return path
+
+    def submit(self, run: BatchRun) -> None:
+        """Upload and create every job of the run that has not been submitted yet."""
+        for job in run.jobs:
+            if not job.input_file_id:
+                job.input_file_id = self.upload(job.request_file)
+                run.save()
+            if not job.batch_id:
+                batch = self.create(job.input_file_id, {"run_id": run.run_id})
+                job.batch_id, job.status = batch["id"], batch.get("status", "validating")
+                run.save()
+
+    def refresh(self, job: BatchJob) -> BatchJob:
+        batch = self.retrieve(job.batch_id)
+        job.status = batch.get("status", job.status)
+        job.output_file_id = batch.get("output_file_id") or ""
+        job.error_file_id = batch.get("error_file_id") or ""
+        job.request_counts = batch.get("request_counts") or {}
+        return job
+
+    def wait(
+        self,
+        run: BatchRun,
+        on_done: Callable[[BatchJob], None],
+        poll_secs: float = 60.0,
+        log: Callable[[str], None] = print,
+    ) -> None:
+        """Poll until every job is terminal, calling on_done once per finished job as soon as it finishes."""
+        last: Dict[str, str] = {}
+        while True:
+            waiting = 0
+            for job in run.pending():
+                if job.status not in TERMINAL:
+                    self.refresh(job)
+                    run.save()
+                if job.status in TERMINAL:
+                    on_done(job)
+                    job.ingested = True
+                    run.save()
+                else:
+                    waiting += 1
+                    counts = job.request_counts
+                    progress = f"{job.status} {counts.get('completed', 0) + counts.get('failed', 0)}/{counts.get('total') or '?'}"
+                    if last.get(job.batch_id) != progress:
+                        last[job.batch_id] = progress
+                        log(f"⏳ {job.batch_id}: {progress}")
+            if not waiting:
+                return
+            time.sleep(poll_secs)
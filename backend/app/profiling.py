@@ -0,0 +1,206 @@
+"""
+On-demand request profiling
+A low-overhead sampling profiler that snapshots a thread's stack every few
+milliseconds and writes collapsed stacks ("frame;frame;frame count" lines),
+which flamegraph.pl, speedscope and inferno render as flame graphs.
+
+Requests are profiled when an authorized caller asks for it (X-Profile header
+or ?profile= query flag plus PROFILE_TOKEN), and 1-in-N requests are
+profiled continuously when PROFILE_SAMPLE_EVERY is set. A request profile only
+keeps samples taken while one of that request's asyncio tasks was running, so
+concurrent requests on the same event loop do not leak into it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hmac
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from fastapi.responses import PlainTextResponse
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_EVERY = int(os.getenv("PROFILE_SAMPLE_EVERY", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+MAX_DEPTH = 128
+
+
+class StackSampler:
+    """
+    Sample one thread's (or every thread's) Python stack on a timer.
+
+    Sampling runs in a daemon thread via sys._current_frames(), so the
+    profiled code is not instrumented and pays only for the GIL hand-off.
+    """
+
+    def __init__(
+        self,
+        interval: float = PROFILE_INTERVAL_MS / 1000.0,
+        thread_id: Optional[int] = None,
+        all_threads: bool = False,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> None:
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.all_threads = all_threads
+        # With a loop, only samples taken while one of `tasks` runs on it are kept
+        self.loop = loop
+        self.tasks: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = 0.0
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "StackSampler":
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> "StackSampler":
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def __enter__(self) -> "StackSampler":
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            if self.loop is not None and asyncio.current_task(self.loop) not in self.tasks:
+                continue
+            frames = sys._current_frames()
+            if self.all_threads:
+                targets = [(tid, f) for tid, f in frames.items() if tid != me]
+            else:
+                frame = frames.get(self.thread_id)
+                targets = [(self.thread_id, frame)] if frame is not None else []
+            for tid, frame in targets:
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if self.all_threads:
+                    stack.append(names.get(tid, str(tid)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def write(self, name: str, directory: str = PROFILE_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.collapsed")
+        with open(path, "w") as fh:
+            fh.write(self.collapsed())
+        return path
+
+
+def _safe_name(path: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in path.strip("/"))[:80] or "root"
+
+
+def _authorized(token: str) -> bool:
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+_request_counter = itertools.count(1)
+# Sampler of the profiled request whose context a task is created in
+_owner: ContextVar[Optional[StackSampler]] = ContextVar("profile_owner", default=None)
+
+
+def _track_tasks(loop: asyncio.AbstractEventLoop) -> None:
+    """Install a task factory that adds tasks spawned by a profiled request to its sampler."""
+    previous = loop.get_task_factory()
+    if getattr(previous, "_profiling", False):
+        return
+
+    def factory(loop: asyncio.AbstractEventLoop, coro: Any, **kwargs: Any) -> asyncio.Task:
+        task = previous(loop, coro, **kwargs) if previous else asyncio.Task(coro, loop=loop, **kwargs)
+        sampler = _owner.get()
+        if sampler is not None:
+            sampler.tasks.add(task)
+        return task
+
+    factory._profiling = True  # type: ignore[attr-defined]
+    loop.set_task_factory(factory)
+
+
+async def profile_middleware(request: Any, call_next: Any) -> Any:
+    """
+    Profile the request when asked to or when it is the N-th one.
+
+    X-Profile: collapsed | store (or ?profile=collapsed|store) with
+    X-Profile-Token (or ?profile_token=). 'collapsed' returns the stacks as
+    the response body; 'store' writes them to PROFILE_DIR and names the file
+    in the X-Profile-File response header. Sampled requests are always stored.
+
+    Only on-loop time of this request's tasks (the middleware and everything
+    call_next spawns) is recorded; time spent awaiting I/O or worker threads
+    does not show up.
+    """
+    mode = request.headers.get("x-profile") or request.query_params.get("profile")
+    if mode and not _authorized(request.headers.get("x-profile-token") or request.query_params.get("profile_token", "")):
+        mode = None
+    if not mode and PROFILE_SAMPLE_EVERY and next(_request_counter) % PROFILE_SAMPLE_EVERY == 0:
+        mode = "store"
+    if not mode:
+        return await call_next(request)
+
+    # Async handlers (and the sync Supabase calls inside them) run on this thread
+    loop = asyncio.get_running_loop()
+    _track_tasks(loop)
+    sampler = StackSampler(loop=loop)
+    sampler.tasks.add(asyncio.current_task())
+    token = _owner.set(sampler)
+    sampler.start()
+    try:
+        response = await call_next(request)
+    finally:
+        sampler.stop()
+        _owner.reset(token)
+
+    if mode == "collapsed":
+        return PlainTextResponse(
+            sampler.collapsed(),
+            headers={"X-Profile-Samples": str(sampler.samples), "X-Profile-Status": str(response.status_code)},
+        )
+    try:
+        path = sampler.write(f"{request.method}-{_safe_name(request.url.path)}")
+        response.headers["X-Profile-File"] = os.path.basename(path)
+    except OSError as e:
+        logging.error(f"Could not store profile: {e}")
+    return response
+
+
+def profile_call(fn: Any, path: str, *args: Any, **kwargs: Any) -> Any:
+    """Run fn under the sampler (all threads) and write collapsed stacks to path; for CLIs."""
+    sampler = StackSampler(all_threads=True).start()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sampler.stop()
+        with open(path, "w") as fh:
+            fh.write(sampler.collapsed())
+        print(f"Profile: {sampler.samples} samples over {sampler.elapsed:.1f}s written to {path}")
+
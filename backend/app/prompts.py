@@ -0,0 +1,262 @@
+"""
+Enrichment prompt building and token budgeting
+Prompts are split into a byte-stable prefix (system instructions, taxonomy,
+the current theme list) sent as the system message, and a user message that
+only carries the comment. Providers cache prompt prefixes (OpenAI from 1024
+tokens, in 128-token steps), so keeping everything that repeats in front and
+identical byte for byte makes every call after the first bill most of the
+prefix as cached input and return faster.
+
+Themes are rendered sorted and tagged with a content version, so every
+process builds the same prefix for the same theme set, and a new theme shows
+up as a new version instead of a silently different prompt. Above
+MAX_PROMPT_THEMES the most used themes are kept (callers pass them in
+priority order, see rank_themes) before sorting.
+
+Tokens are counted locally (tiktoken if installed, otherwise a conservative
+bytes-based estimate) to truncate oversize comments before sending, route
+them to OVERSIZE_MODEL when one is configured, and estimate the tokens, cost
+and wall time of a backfill before it starts.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import math
+import os
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Comment budget per call; longer comments are truncated (or routed)
+COMMENT_TOKENS = int(os.getenv("PROMPT_COMMENT_TOKENS", "1000"))
+OVERSIZE_MODEL = os.getenv("OVERSIZE_MODEL", "")
+OVERSIZE_COMMENT_TOKENS = int(os.getenv("OVERSIZE_COMMENT_TOKENS", "8000"))
+MAX_PROMPT_THEMES = 200
+# Reply size used by estimates (JSON object with a few themes)
+EST_OUTPUT_TOKENS = int(os.getenv("EST_OUTPUT_TOKENS", "60"))
+
+# Provider prompt caching: minimum cacheable prefix and granularity
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+# Chat formatting overhead per message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# USD per 1M tokens: input, cached input, output
+PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+}
+# Batch API jobs bill every token at half price
+BATCH_DISCOUNT = 0.5
+
+
+# -----------------------------------------------------------------------------
+# Token counting
+# -----------------------------------------------------------------------------
+@lru_cache(maxsize=8)
+def _encoding(model: str) -> Any:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Token count for text; without tiktoken an upper-leaning estimate (~3.5 bytes per token for Dutch)."""
+    enc = _encoding(model)
+    if enc is not None:
+        return len(enc.encode(text))
+    return math.ceil(len(text.encode("utf-8")) / 3.5) if text else 0
+
+
+def truncate_tokens(text: str, limit: int, model: str = "gpt-4o-mini") -> str:
+    """Longest head of text within limit tokens, cut at a word boundary when estimating."""
+    enc = _encoding(model)
+    if enc is not None:
+        ids = enc.encode(text)
+        return text if len(ids) <= limit else enc.decode(ids[:limit])
+    data = text.encode("utf-8")
+    budget = int(limit * 3.5)
+    if len(data) <= budget:
+        return text
+    head = data[:budget].decode("utf-8", errors="ignore")
+    cut = head.rfind(" ")
+    return head[:cut] if cut > len(head) // 2 else head
+
+
+def cacheable_tokens(prefix_tokens: int) -> int:
+    """Prefix tokens a provider cache can serve (0 below the minimum)."""
+    if prefix_tokens < CACHE_MIN_TOKENS:
+        return 0
+    return CACHE_MIN_TOKENS + (prefix_tokens - CACHE_MIN_TOKENS) // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS
+
+
+# -----------------------------------------------------------------------------
+# Prompt builder
+# -----------------------------------------------------------------------------
+@dataclass(frozen=True)
+class PromptPrefix:
+    """The static part of a prompt: identical bytes for every comment."""
+
+    name: str
+    system: str
+    version: str
+    tokens: int
+
+    def messages(self, user: str) -> List[Dict[str, str]]:
+        return [{"role": "system", "content": self.system}, {"role": "user", "content": user}]
+
+
+@dataclass
+class FittedComment:
+    text: str
+    tokens: int
+    truncated: bool
+    model: str
+
+
+def build_prefix(name: str, system: str, model: str = "gpt-4o-mini") -> PromptPrefix:
+    version = hashlib.sha1(system.encode("utf-8")).hexdigest()[:10]
+    return PromptPrefix(name, system, version, count_tokens(system, model) + MESSAGE_OVERHEAD_TOKENS)
+
+
+def rank_themes(themes: Iterable[str], usage: Dict[str, float]) -> List[str]:
+    """Themes by usage, most used first; unused ones keep their given order after them."""
+    return sorted(themes, key=lambda t: -usage.get(t, 0))
+
+
+def theme_block(themes: Iterable[str]) -> Tuple[str, str]:
+    """
+    Sorted, de-duplicated theme list and its content version. `themes` is in
+    priority order: over MAX_PROMPT_THEMES the first ones are kept, then sorted.
+    """
+    names = list(dict.fromkeys(t.strip() for t in themes if t and t.strip()))
+    if len(names) > MAX_PROMPT_THEMES:
+        logging.warning(f"Prompt theme list capped at {MAX_PROMPT_THEMES} of {len(names)} themes")
+        names = names[:MAX_PROMPT_THEMES]
+    names.sort(key=lambda t: (t.casefold(), t))
+    body = "\n".join(f"- {t}" for t in names)
+    return body, hashlib.sha1(body.encode("utf-8")).hexdigest()[:8]
+
+
+@lru_cache(maxsize=16)
+def themed_prefix(name: str, instructions: str, themes: Tuple[str, ...], model: str = "gpt-4o-mini") -> PromptPrefix:
+    """Instructions followed by the versioned theme list, as one cacheable system message."""
+    body, version = theme_block(themes)
+    return build_prefix(name, f"{instructions.rstrip()}\n\nHuidige themas (versie {version}):\n{body}\n", model)
+
+
+def fit_comment(
+    comment: str,
+    model: str,
+    limit: int = COMMENT_TOKENS,
+    oversize_model: str = OVERSIZE_MODEL,
+    oversize_limit: int = OVERSIZE_COMMENT_TOKENS,
+) -> FittedComment:
+    """Comment within the token budget, routed to oversize_model (if set) when it does not fit."""
+    text = comment.strip()
+    tokens = count_tokens(text, model)
+    if tokens <= limit:
+        return FittedComment(text, tokens, False, model)
+    if oversize_model:
+        model, limit = oversize_model, oversize_limit
+        if tokens <= limit:
+            return FittedComment(text, tokens, False, model)
+    text = truncate_tokens(text, limit, model)
+    return FittedComment(text, count_tokens(text, model), True, model)
+
+
+# -----------------------------------------------------------------------------
+# Backfill estimates
+# -----------------------------------------------------------------------------
+@dataclass
+class Estimate:
+    model: str
+    calls: int
+    comments: int
+    prefix_tokens: int
+    cached_prefix_tokens: int
+    input_tokens: int
+    cached_input_tokens: int
+    output_tokens: int
+    truncated: int
+    cost_usd: float
+    cost_without_cache_usd: float
+    wall_secs: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        out = asdict(self)
+        out["cost_usd"] = round(self.cost_usd, 4)
+        out["cost_without_cache_usd"] = round(self.cost_without_cache_usd, 4)
+        out["wall_hours"] = round(self.wall_secs / 3600, 2)
+        return out
+
+
+def estimate(
+    prefix: PromptPrefix,
+    comments: Sequence[str],
+    model: str,
+    calls: Optional[int] = None,
+    max_rpm: Optional[int] = None,
+    concurrency: int = 1,
+    latency_secs: float = 1.5,
+    user_overhead: str = "",
+) -> Estimate:
+    """
+    Tokens, cost and wall time for sending `comments` with `prefix`. `calls`
+    is the number of LLM calls when near-duplicates share one (defaults to
+    one per comment); the token totals scale with it. Every call after the
+    first is assumed to hit the provider prefix cache.
+    """
+    n = len(comments)
+    calls = n if calls is None else calls
+    per_comment = []
+    truncated = 0
+    for c in comments:
+        fitted = fit_comment(c, model, oversize_model="")
+        truncated += fitted.truncated
+        per_comment.append(fitted.tokens)
+    overhead = count_tokens(user_overhead, model) + MESSAGE_OVERHEAD_TOKENS
+    comment_tokens = sum(per_comment) * (calls / n if n else 0)
+
+    input_tokens = int(calls * prefix.tokens + comment_tokens + calls * overhead)
+    cached_prefix = cacheable_tokens(prefix.tokens)
+    cached_input = max(calls - 1, 0) * cached_prefix
+    output_tokens = calls * EST_OUTPUT_TOKENS
+
+    price_in, price_cached, price_out = PRICES.get(model, PRICES["gpt-4o-mini"])
+    cost_without = (input_tokens * price_in + output_tokens * price_out) / 1e6
+    cost = ((input_tokens - cached_input) * price_in + cached_input * price_cached + output_tokens * price_out) / 1e6
+
+    wall = calls * latency_secs / max(concurrency, 1)
+    if max_rpm:
+        wall = max(wall, calls / max_rpm * 60)
+    return Estimate(
+        model=model,
+        calls=calls,
+        comments=n,
+        prefix_tokens=prefix.tokens,
+        cached_prefix_tokens=cached_prefix,
+        input_tokens=input_tokens,
+        cached_input_tokens=cached_input,
+        output_tokens=output_tokens,
+        truncated=truncated,
+        cost_usd=cost,
+        cost_without_cache_usd=cost_without,
+        wall_secs=wall,
+    )
+
+
+def usage_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int, batch: bool = False) -> float:
+    """USD for reported usage."""
+    price_in, price_cached, price_out = PRICES.get(model, PRICES["gpt-4o-mini"])
+    cost = ((prompt_tokens - cached_tokens) * price_in + cached_tokens * price_cached + completion_tokens * price_out) / 1e6
+    return cost * BATCH_DISCOUNT if batch else cost
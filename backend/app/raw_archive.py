@@ -0,0 +1,247 @@
+"""
+Compact raw-row archive (see sql/018_raw_archive.sql)
+With RAW_ARCHIVE=parquet an upload's original rows are written once as a
+zstd-compressed Parquet file, on local disk (RAW_ARCHIVE_DIR) or in a Supabase
+Storage bucket (RAW_ARCHIVE_BUCKET), instead of one nps_raw row per response.
+nps_response rows carry (upload_id, row_index) and raw rows are rehydrated
+lazily, reading only the Parquet row groups that hold the requested rows.
+"""
+
+from __future__ import annotations
+
+import bisect
+import io
+import logging
+import math
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+from fastapi import APIRouter, HTTPException, Query
+
+from app import clients
+
+router = APIRouter(prefix="/raw", tags=["raw-archive"])
+
+RAW_ARCHIVE = os.getenv("RAW_ARCHIVE", "table")  # table | parquet
+RAW_ARCHIVE_DIR = os.getenv("RAW_ARCHIVE_DIR", os.path.join(os.getcwd(), "raw_archive"))
+RAW_ARCHIVE_BUCKET = os.getenv("RAW_ARCHIVE_BUCKET", "")
+ROW_GROUP_SIZE = 5000
+COMPRESSION_LEVEL = 9
+# Open archives kept by the reader
+CACHE_SIZE = 32
+
+
+def enabled() -> bool:
+    return RAW_ARCHIVE == "parquet"
+
+
+def _cell(value: Any) -> Optional[str]:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return str(value)
+
+
+# -----------------------------------------------------------------------------
+# Storage
+# -----------------------------------------------------------------------------
+def _put(key: str, data: bytes) -> str:
+    if RAW_ARCHIVE_BUCKET:
+        clients.supabase().storage.from_(RAW_ARCHIVE_BUCKET).upload(key, data, {"content-type": "application/vnd.apache.parquet"})
+        return f"supabase://{RAW_ARCHIVE_BUCKET}/{key}"
+    os.makedirs(RAW_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(RAW_ARCHIVE_DIR, key)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+    return f"file://{os.path.abspath(path)}"
+
+
+def _remove(uri: str) -> None:
+    if uri.startswith("file://"):
+        try:
+            os.unlink(uri[len("file://"):])
+        except FileNotFoundError:
+            pass
+    elif uri.startswith("supabase://"):
+        bucket, key = uri[len("supabase://"):].split("/", 1)
+        clients.supabase().storage.from_(bucket).remove([key])
+    else:
+        raise ValueError(f"Unsupported archive location: {uri}")
+
+
+def _open(uri: str) -> Any:
+    """Seekable source for pyarrow; local files are memory-mapped, not read."""
+    import pyarrow as pa
+
+    if uri.startswith("file://"):
+        return pa.memory_map(uri[len("file://"):])
+    if uri.startswith("supabase://"):
+        bucket, key = uri[len("supabase://"):].split("/", 1)
+        return pa.BufferReader(clients.supabase().storage.from_(bucket).download(key))
+    raise ValueError(f"Unsupported archive location: {uri}")
+
+
+# -----------------------------------------------------------------------------
+# Writing
+# -----------------------------------------------------------------------------
+def archive_rows(rows: Sequence[Dict[str, Any]], filename: Optional[str] = None) -> str:
+    """
+    Store parsed rows as they came from the file and register the upload.
+    Returns the upload id; row i of the upload has row_index i.
+    """
+    import pyarrow as pa
+
+    # Excel headers may be non-string; everything is archived as text
+    cells = [{str(k): _cell(v) for k, v in r.items()} for r in rows]
+    columns: Dict[str, None] = {}
+    for r in cells:
+        for k in r:
+            columns.setdefault(k, None)
+    table = pa.table({col: pa.array([r.get(col) for r in cells], type=pa.string()) for col in columns})
+    return archive_table(table, filename)
+
+
+def archive_table(table: Any, filename: Optional[str] = None) -> str:
+    """archive_rows for rows already parsed into an Arrow table of strings."""
+    import pyarrow.parquet as pq
+
+    buf = io.BytesIO()
+    pq.write_table(
+        table,
+        buf,
+        compression="zstd",
+        compression_level=COMPRESSION_LEVEL,
+        row_group_size=ROW_GROUP_SIZE,
+    )
+    data = buf.getvalue()
+
+    upload_id = str(uuid.uuid4())
+    uri = _put(f"{upload_id}.parquet", data)
+    clients.supabase().table("nps_upload").insert({
+        "id": upload_id,
+        "filename": filename,
+        "storage_uri": uri,
+        "row_count": table.num_rows,
+        "byte_size": len(data),
+        "columns": table.column_names,
+    }).execute()
+    logging.info(f"Archived {table.num_rows} raw rows ({len(data)} bytes) as upload {upload_id}")
+    return upload_id
+
+
+def delete_upload(upload_id: str) -> None:
+    """Remove an archive and its nps_upload row, e.g. when none of its responses got inserted."""
+    sb = clients.supabase()
+    found = sb.table("nps_upload").select("storage_uri").eq("id", upload_id).limit(1).execute().data
+    if found:
+        _remove(found[0]["storage_uri"])
+    sb.table("nps_upload").delete().eq("id", upload_id).execute()
+    reader.forget(upload_id)
+    logging.info(f"Deleted archive of upload {upload_id}")
+
+
+# -----------------------------------------------------------------------------
+# Reading
+# -----------------------------------------------------------------------------
+class RawArchiveReader:
+    """Rehydrate raw rows by (upload_id, row_index), keeping recently used archives open."""
+
+    def __init__(self, cache_size: int = CACHE_SIZE) -> None:
+        self.cache_size = cache_size
+        self._files: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _file(self, upload_id: str) -> Any:
+        import pyarrow.parquet as pq
+
+        with self._lock:
+            pf = self._files.get(upload_id)
+            if pf is not None:
+                self._files.move_to_end(upload_id)
+                return pf
+        found = clients.supabase().table("nps_upload").select("storage_uri").eq("id", upload_id).limit(1).execute().data
+        if not found:
+            raise KeyError(upload_id)
+        pf = pq.ParquetFile(_open(found[0]["storage_uri"]))
+        with self._lock:
+            self._files[upload_id] = pf
+            while len(self._files) > self.cache_size:
+                self._files.popitem(last=False)
+        return pf
+
+    def rows(self, upload_id: str, indexes: Sequence[int]) -> Dict[int, Dict[str, Any]]:
+        """Rows by index; only the row groups containing them are decoded."""
+        pf = self._file(upload_id)
+        meta = pf.metadata
+        starts = []
+        offset = 0
+        for g in range(meta.num_row_groups):
+            starts.append(offset)
+            offset += meta.row_group(g).num_rows
+        by_group: Dict[int, List[int]] = {}
+        for idx in set(indexes):
+            if 0 <= idx < offset:
+                g = bisect.bisect_right(starts, idx) - 1
+                by_group.setdefault(g, []).append(idx)
+        out: Dict[int, Dict[str, Any]] = {}
+        for g, wanted in by_group.items():
+            group = pf.read_row_group(g).to_pylist()
+            for idx in wanted:
+                out[idx] = group[idx - starts[g]]
+        return out
+
+    def row(self, upload_id: str, row_index: int) -> Optional[Dict[str, Any]]:
+        return self.rows(upload_id, [row_index]).get(row_index)
+
+    def forget(self, upload_id: str) -> None:
+        with self._lock:
+            self._files.pop(upload_id, None)
+
+
+reader = RawArchiveReader()
+
+
+def raw_for_response(response_id: str) -> Optional[Dict[str, Any]]:
+    """Raw row behind a response, from the archive or the legacy nps_raw table."""
+    sb = clients.supabase()
+    found = sb.table("nps_response").select("raw_id, upload_id, row_index").eq("id", response_id).limit(1).execute().data
+    if not found:
+        return None
+    r = found[0]
+    if r.get("upload_id") is not None and r.get("row_index") is not None:
+        return reader.row(r["upload_id"], r["row_index"])
+    if r.get("raw_id"):
+        raw = sb.table("nps_raw").select("raw_data").eq("id", r["raw_id"]).limit(1).execute().data
+        return raw[0]["raw_data"] if raw else None
+    return None
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.get("/responses/{response_id}")
+async def get_response_raw(response_id: str):
+    """Original uploaded row for a response"""
+    try:
+        raw = raw_for_response(response_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading raw row: {str(e)}")
+    if raw is None:
+        raise HTTPException(status_code=404, detail="Raw row not found")
+    return raw
+
+
+@router.get("/uploads/{upload_id}/rows")
+async def get_upload_rows(upload_id: str, index: List[int] = Query(...)):
+    """Original rows of an archived upload by row index"""
+    try:
+        rows = reader.rows(upload_id, index)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading archive: {str(e)}")
+    return {str(i): rows.get(i) for i in index}
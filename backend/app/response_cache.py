@@ -0,0 +1,584 @@
+"""
+Shared response cache for the read endpoints
+Results are cached as JSON under keys that depend on one or more scopes: a
+survey name, ALL_SURVEYS for cross-survey results (/surveys, /enrich/stats)
+or ENRICHMENT for anything derived from nps_ai_enrichment. Every scope has a
+version counter in the shared tier; a cached entry stores the versions it was
+computed under and is only served while they are still current, so bumping a
+scope (`invalidate`) makes every worker miss on its next request.
+
+Writers publish the bump: ingest (run_ingest, upload_csv) invalidates the
+surveys it inserted into plus ALL_SURVEYS, enrichment writes invalidate
+ENRICHMENT.
+
+Backends (CACHE_BACKEND):
+- off (default): every request computes, as before this cache existed
+- local: per-process dict; only for a single worker (other workers' writes
+  are not seen until CACHE_TTL)
+- shm: one mmap'd segment per host (CACHE_SHM_PATH) shared by all workers on
+  it; versions live in the same segment, so a bump is visible immediately
+- redis: any Redis-protocol server (CACHE_REDIS_URL); versions are INCR'd
+  there and PUBLISHed on CACHE_CHANNEL, which keeps a small per-worker copy
+  (CACHE_LOCAL_ITEMS) valid without a round trip per request. That copy can
+  lag a bump by the pub/sub delivery time; set CACHE_LOCAL_ITEMS=0 for strict
+  reads (one MGET per lookup).
+
+Cache failures never fail a request: the shared tier is skipped and the
+result computed as if it had missed. CACHE_TTL bounds how long an entry can
+live if an invalidation is lost.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+from fastapi import APIRouter, HTTPException
+
+from app.metrics import cache_lookup
+
+router = APIRouter(prefix="/cache", tags=["cache"])
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "off").lower()
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+CACHE_SHM_PATH = os.getenv(
+    "CACHE_SHM_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "nps-response-cache"),
+)
+CACHE_SHM_MB = int(os.getenv("CACHE_SHM_MB", "64"))
+CACHE_SHM_SLOT_KB = int(os.getenv("CACHE_SHM_SLOT_KB", "64"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://127.0.0.1:6379/0")
+CACHE_REDIS_PREFIX = os.getenv("CACHE_REDIS_PREFIX", "nps:cache:")
+CACHE_CHANNEL = os.getenv("CACHE_CHANNEL", "nps:cache:invalidate")
+CACHE_LOCAL_ITEMS = int(os.getenv("CACHE_LOCAL_ITEMS", "1024"))
+CACHE_REDIS_TIMEOUT = float(os.getenv("CACHE_REDIS_TIMEOUT", "0.5"))
+RETRY_AFTER_SECS = 5.0
+
+# Scopes besides survey names; GLOBAL is part of every key
+GLOBAL = "~global"
+ALL_SURVEYS = "~surveys"
+ENRICHMENT = "~enrichment"
+
+Versions = Tuple[int, ...]
+
+
+def _pack(versions: Versions, expires: float, payload: bytes) -> bytes:
+    return struct.pack(f"<dB{len(versions)}Q", expires, len(versions), *versions) + payload
+
+
+def _unpack(blob: bytes) -> Tuple[float, Versions, bytes]:
+    expires, n = struct.unpack_from("<dB", blob)
+    versions = struct.unpack_from(f"<{n}Q", blob, 9)
+    return expires, versions, blob[9 + 8 * n :]
+
+
+class Backend:
+    """Version counters per scope plus a key/value store of packed entries."""
+
+    name = "base"
+
+    def fetch(self, key: str, scopes: Sequence[str]) -> Tuple[Optional[bytes], Versions]:
+        """Stored blob for key (or None) and the current versions of scopes."""
+        raise NotImplementedError
+
+    def put(self, key: str, blob: bytes, ttl: float) -> None:
+        raise NotImplementedError
+
+    def bump(self, scopes: Sequence[str]) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+    def lookup(self, key: str, scopes: Sequence[str]) -> Tuple[Optional[bytes], Versions]:
+        blob, current = self.fetch(key, scopes)
+        if blob is not None:
+            expires, versions, payload = _unpack(blob)
+            if versions == current and expires > time.time():
+                return payload, current
+        return None, current
+
+    def store(self, key: str, versions: Versions, payload: bytes, ttl: float) -> None:
+        self.put(key, _pack(versions, time.time() + ttl, payload), ttl)
+
+
+class LocalBackend(Backend):
+    """Per-process LRU; only correct with a single worker."""
+
+    name = "local"
+
+    def __init__(self, max_items: int = 4096) -> None:
+        self.max_items = max_items
+        self._versions: Dict[str, int] = {}
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fetch(self, key: str, scopes: Sequence[str]) -> Tuple[Optional[bytes], Versions]:
+        with self._lock:
+            blob = self._items.get(key)
+            if blob is not None:
+                self._items.move_to_end(key)
+            return blob, tuple(self._versions.get(s, 0) for s in scopes)
+
+    def put(self, key: str, blob: bytes, ttl: float) -> None:
+        with self._lock:
+            self._items[key] = blob
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def bump(self, scopes: Sequence[str]) -> None:
+        with self._lock:
+            for s in scopes:
+                self._versions[s] = self._versions.get(s, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._items), "max_items": self.max_items}
+
+
+# -----------------------------------------------------------------------------
+# Shared memory (one segment per host)
+# -----------------------------------------------------------------------------
+class ShmBackend(Backend):
+    """
+    Fixed-size mmap'd file: a header, a table of version counters (scopes are
+    hashed into it; a collision only causes an extra miss) and equal-sized
+    slots. Each key may live in one of two slots. Writers serialize on an
+    flock; readers are lock-free and use a per-slot sequence number (odd while
+    a write is in progress) to detect torn reads.
+    """
+
+    name = "shm"
+    MAGIC = b"NPSRC001"
+    HEADER = struct.Struct("<8sIII")  # magic, slots, slot size, version counters
+    SLOT = struct.Struct("<QQdI")  # sequence, key hash, written at, length
+    SLOT_HEADER = 32
+    VERSION_COUNTERS = 4096
+
+    def __init__(self, path: str, size_mb: int, slot_kb: int) -> None:
+        self.path = path
+        self.slot_size = slot_kb * 1024
+        self.versions_at = 64
+        self.slots_at = self.versions_at + 8 * self.VERSION_COUNTERS
+        self.slots = max(2, (size_mb * 1024 * 1024 - self.slots_at) // self.slot_size)
+        self.size = self.slots_at + self.slots * self.slot_size
+        self.too_large = 0
+        self._thread_lock = threading.Lock()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            expected = self.HEADER.pack(self.MAGIC, self.slots, self.slot_size, self.VERSION_COUNTERS)
+            if os.fstat(self._fd).st_size != self.size or header != expected:
+                # First worker on the host (or a new geometry): start empty
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, expected, 0)
+        self._mm = mmap.mmap(self._fd, self.size)
+
+    def _locked(self) -> "_FileLock":
+        return _FileLock(self._fd, self._thread_lock)
+
+    @staticmethod
+    def _hash(text: str) -> int:
+        return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+    def _candidates(self, h: int) -> Tuple[int, int]:
+        return h % self.slots, (h >> 32) % self.slots
+
+    def _slot_offset(self, slot: int) -> int:
+        return self.slots_at + slot * self.slot_size
+
+    def _version_offset(self, scope: str) -> int:
+        return self.versions_at + 8 * (self._hash(scope) % self.VERSION_COUNTERS)
+
+    def fetch(self, key: str, scopes: Sequence[str]) -> Tuple[Optional[bytes], Versions]:
+        mm = self._mm
+        current = tuple(struct.unpack_from("<Q", mm, self._version_offset(s))[0] for s in scopes)
+        h = self._hash(key)
+        for slot in self._candidates(h):
+            off = self._slot_offset(slot)
+            seq, key_hash, _, length = self.SLOT.unpack_from(mm, off)
+            if key_hash != h or seq & 1 or length > self.slot_size - self.SLOT_HEADER:
+                continue
+            blob = mm[off + self.SLOT_HEADER : off + self.SLOT_HEADER + length]
+            if struct.unpack_from("<Q", mm, off)[0] == seq:
+                return blob, current
+        return None, current
+
+    def put(self, key: str, blob: bytes, ttl: float) -> None:
+        if len(blob) > self.slot_size - self.SLOT_HEADER:
+            self.too_large += 1
+            return
+        mm = self._mm
+        h = self._hash(key)
+        with self._locked():
+            headers = [(slot, self.SLOT.unpack_from(mm, self._slot_offset(slot))) for slot in self._candidates(h)]
+            same = [slot for slot, (_, key_hash, _, _) in headers if key_hash == h]
+            slot = same[0] if same else min(headers, key=lambda item: item[1][2])[0]
+            off = self._slot_offset(slot)
+            seq = struct.unpack_from("<Q", mm, off)[0]
+            struct.pack_into("<Q", mm, off, seq + 1)
+            mm[off + self.SLOT_HEADER : off + self.SLOT_HEADER + len(blob)] = blob
+            struct.pack_into("<QdI", mm, off + 8, h, time.time(), len(blob))
+            struct.pack_into("<Q", mm, off, seq + 2)
+
+    def bump(self, scopes: Sequence[str]) -> None:
+        mm = self._mm
+        with self._locked():
+            for s in scopes:
+                off = self._version_offset(s)
+                struct.pack_into("<Q", mm, off, struct.unpack_from("<Q", mm, off)[0] + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        used = sum(
+            1 for slot in range(self.slots)
+            if struct.unpack_from("<Q", self._mm, self._slot_offset(slot) + 8)[0]
+        )
+        return {
+            "path": self.path,
+            "size_mb": round(self.size / 1024 / 1024, 1),
+            "slots": self.slots,
+            "slot_kb": self.slot_size // 1024,
+            "slots_used": used,
+            "too_large": self.too_large,
+        }
+
+
+class _FileLock:
+    """flock excludes other processes; the thread lock other threads of this one."""
+
+    def __init__(self, fd: int, thread_lock: threading.Lock) -> None:
+        self.fd = fd
+        self.thread_lock = thread_lock
+
+    def __enter__(self) -> None:
+        self.thread_lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc: Any) -> None:
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+# -----------------------------------------------------------------------------
+# Redis protocol
+# -----------------------------------------------------------------------------
+class RespError(Exception):
+    pass
+
+
+class RespConnection:
+    """Minimal blocking RESP2 client: enough for GET/SET/MGET/INCR/PUBLISH/SUBSCRIBE."""
+
+    def __init__(self, url: str, timeout: Optional[float]) -> None:
+        parsed = urlparse(url)
+        self.sock = socket.create_connection((parsed.hostname or "127.0.0.1", parsed.port or 6379), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if parsed.password:
+            self.command("AUTH", *([parsed.username] if parsed.username else []), parsed.password)
+        db = (parsed.path or "/0").strip("/")
+        if db and db != "0":
+            self.command("SELECT", db)
+
+    @staticmethod
+    def _encode(args: Sequence[Any]) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            data = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    def read(self) -> Any:
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self.reader.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self.read() for _ in range(n)]
+        raise RespError(f"unexpected reply {line!r}")
+
+    def command(self, *args: Any) -> Any:
+        self.sock.sendall(self._encode(args))
+        return self.read()
+
+    def pipeline(self, commands: Sequence[Sequence[Any]]) -> List[Any]:
+        self.sock.sendall(b"".join(self._encode(c) for c in commands))
+        return [self.read() for _ in commands]
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend(Backend):
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str, channel: str, local_items: int, timeout: float) -> None:
+        self.url = url
+        self.prefix = prefix
+        self.channel = channel
+        self.timeout = timeout
+        self.local_items = local_items
+        self.local_hits = 0
+        self._conn = threading.local()
+        # Worker-local copy, valid while pub/sub keeps `_known` versions current
+        self._local: "OrderedDict[str, bytes]" = OrderedDict()
+        self._known: Dict[str, int] = {}
+        self._subscribed = False
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+        if local_items > 0:
+            threading.Thread(target=self._listen, name="cache-invalidation", daemon=True).start()
+
+    def _connection(self) -> RespConnection:
+        conn = getattr(self._conn, "value", None)
+        if conn is None:
+            conn = self._conn.value = RespConnection(self.url, self.timeout)
+        return conn
+
+    def _call(self, fn: Callable[[RespConnection], Any]) -> Any:
+        if time.monotonic() < self._down_until:
+            raise ConnectionError("cache server unavailable, retrying later")
+        try:
+            return fn(self._connection())
+        except (OSError, RespError):
+            conn = getattr(self._conn, "value", None)
+            if conn is not None:
+                conn.close()
+            self._conn.value = None
+            # Don't pay a connect timeout on every request while the server is down
+            self._down_until = time.monotonic() + RETRY_AFTER_SECS
+            raise
+
+    def _version_key(self, scope: str) -> str:
+        return f"{self.prefix}v:{scope}"
+
+    def _learn(self, versions: Dict[str, int]) -> None:
+        with self._lock:
+            if self._subscribed:
+                for s, v in versions.items():
+                    # Versions only grow; keep the newest of reply and message
+                    self._known[s] = max(v, self._known.get(s, 0))
+
+    def fetch(self, key: str, scopes: Sequence[str]) -> Tuple[Optional[bytes], Versions]:
+        if self.local_items > 0:
+            with self._lock:
+                blob = self._local.get(key)
+                if blob is not None and self._subscribed and all(s in self._known for s in scopes):
+                    self._local.move_to_end(key)
+                    self.local_hits += 1
+                    return blob, tuple(self._known[s] for s in scopes)
+        reply = self._call(lambda c: c.command("MGET", *[self._version_key(s) for s in scopes], f"{self.prefix}d:{key}"))
+        current = tuple(int(v) if v is not None else 0 for v in reply[:-1])
+        self._learn(dict(zip(scopes, current)))
+        blob = reply[-1]
+        if blob is not None:
+            self._remember(key, blob)
+        return blob, current
+
+    def _remember(self, key: str, blob: bytes) -> None:
+        if self.local_items <= 0:
+            return
+        with self._lock:
+            self._local[key] = blob
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_items:
+                self._local.popitem(last=False)
+
+    def put(self, key: str, blob: bytes, ttl: float) -> None:
+        self._call(lambda c: c.command("SET", f"{self.prefix}d:{key}", blob, "PX", int(ttl * 1000)))
+        self._remember(key, blob)
+
+    def bump(self, scopes: Sequence[str]) -> None:
+        replies = self._call(lambda c: c.pipeline([("INCR", self._version_key(s)) for s in scopes]))
+        versions = dict(zip(scopes, (int(v) for v in replies)))
+        self._learn(versions)
+        self._call(lambda c: c.command("PUBLISH", self.channel, json.dumps({"versions": versions})))
+
+    def _listen(self) -> None:
+        """Subscriber thread: apply published versions; forget everything while disconnected."""
+        backoff = 0.5
+        while True:
+            conn = None
+            try:
+                conn = RespConnection(self.url, None)
+                conn.command("SUBSCRIBE", self.channel)
+                with self._lock:
+                    self._known.clear()
+                    self._subscribed = True
+                backoff = 0.5
+                while True:
+                    message = conn.read()
+                    if isinstance(message, list) and message[:1] == [b"message"]:
+                        versions = json.loads(message[2]).get("versions") or {}
+                        with self._lock:
+                            for s, v in versions.items():
+                                self._known[s] = max(int(v), self._known.get(s, 0))
+            except (OSError, RespError, ValueError) as e:
+                logging.warning(f"Cache invalidation subscription lost: {e}")
+            finally:
+                with self._lock:
+                    self._subscribed = False
+                    self._known.clear()
+                if conn is not None:
+                    conn.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def lookup(self, key: str, scopes: Sequence[str]) -> Tuple[Optional[bytes], Versions]:
+        payload, current = super().lookup(key, scopes)
+        if payload is None and self.local_items > 0:
+            with self._lock:
+                self._local.pop(key, None)
+        return payload, current
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "server": f"{urlparse(self.url).hostname}:{urlparse(self.url).port or 6379}",
+                "channel": self.channel,
+                "subscribed": self._subscribed,
+                "local_entries": len(self._local),
+                "local_hits": self.local_hits,
+            }
+
+
+# -----------------------------------------------------------------------------
+# Shared cache
+# -----------------------------------------------------------------------------
+_backend: Optional[Backend] = None
+_backend_lock = threading.Lock()
+
+
+def build_backend(kind: str = CACHE_BACKEND) -> Optional[Backend]:
+    if kind == "off":
+        return None
+    if kind == "local":
+        return LocalBackend(max(CACHE_LOCAL_ITEMS, 1))
+    if kind == "shm":
+        return ShmBackend(CACHE_SHM_PATH, CACHE_SHM_MB, CACHE_SHM_SLOT_KB)
+    if kind == "redis":
+        return RedisBackend(CACHE_REDIS_URL, CACHE_REDIS_PREFIX, CACHE_CHANNEL, CACHE_LOCAL_ITEMS, CACHE_REDIS_TIMEOUT)
+    raise ValueError(f"Unknown CACHE_BACKEND {kind!r} (expected off, local, shm or redis)")
+
+
+def backend() -> Optional[Backend]:
+    """The process' backend, built on first use (after uvicorn has started the worker)."""
+    global _backend
+    if _backend is None and CACHE_BACKEND != "off":
+        with _backend_lock:
+            if _backend is None:
+                _backend = build_backend()
+    return _backend
+
+
+def shared() -> bool:
+    """Whether cached results are served to other workers too."""
+    return CACHE_BACKEND in ("shm", "redis")
+
+
+def get_or_compute(
+    namespace: str,
+    scopes: Iterable[str],
+    params: Dict[str, Any],
+    compute: Callable[[], Any],
+    ttl: Optional[float] = None,
+) -> Any:
+    """Cached JSON-compatible result of compute() for (namespace, scopes, params)."""
+    b = backend()
+    if b is None:
+        return compute()
+    scopes = (GLOBAL, *scopes)
+    key = f"{namespace}:{json.dumps([scopes, params], sort_keys=True, default=str)}"
+    try:
+        payload, versions = b.lookup(key, scopes)
+    except Exception as e:
+        logging.warning(f"Response cache ({b.name}) lookup failed: {e}")
+        cache_lookup(f"response:{namespace}", False)
+        return compute()
+    cache_lookup(f"response:{namespace}", payload is not None)
+    if payload is not None:
+        return json.loads(payload)
+
+    value = compute()
+    try:
+        # Stored under the versions read before computing: a bump in between leaves it stale
+        b.store(key, versions, json.dumps(value, default=str).encode("utf-8"), ttl or CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"Response cache ({b.name}) store failed: {e}")
+    return value
+
+
+def invalidate(*scopes: str) -> None:
+    """Bump scopes (no scopes: everything) so every worker recomputes what depends on them."""
+    b = backend()
+    if b is None:
+        return
+    scopes = tuple(dict.fromkeys(scopes)) or (GLOBAL,)
+    try:
+        b.bump(scopes)
+    except Exception as e:
+        logging.error(f"Response cache ({b.name}) invalidation of {scopes} failed: {e}")
+
+
+def invalidate_surveys(rows: Iterable[Dict[str, Any]]) -> None:
+    """Ingest hook: inserted responses change their surveys and the survey list."""
+    surveys = {str(r.get("survey_name")) for r in rows if r.get("survey_name") is not None}
+    invalidate(*sorted(surveys), ALL_SURVEYS)
+
+
+def invalidate_enrichment(rows: Optional[List[Dict[str, Any]]] = None) -> None:
+    """BatchUpserter on_flush hook for nps_ai_enrichment writes."""
+    invalidate(ENRICHMENT)
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.get("/stats")
+async def get_cache_stats():
+    """Backend in use and its occupancy"""
+    try:
+        b = backend()
+        return {"backend": b.name if b else "off", "ttl_secs": CACHE_TTL, **(b.stats() if b else {})}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting cache stats: {str(e)}")
+
+
+@router.post("/invalidate")
+async def invalidate_cache(survey_name: Optional[str] = None):
+    """Drop cached results for one survey, or everything"""
+    if survey_name:
+        invalidate(survey_name, ALL_SURVEYS)
+    else:
+        invalidate()
+    return {"invalidated": survey_name or "all"}
@@ -0,0 +1,504 @@
+"""
+Columnar in-process response store
+With RESPONSE_STORE=on, every worker keeps the nps_response columns the
+metric endpoints need as NumPy arrays: the score (int8), creation_date as
+days since 1970 (int32), dictionary codes for survey, title, gender, age
+range, subscription years and category (int32 each), has_explanation (bool)
+and the id (fixed-width bytes, with a sorted index for lookups). That is ~75
+bytes per response
+instead of a dict per row, and survey metrics, filters and top-k rankings
+become masks and bincounts over the arrays instead of PostgREST round trips.
+
+The store is built once at startup, from a Parquet snapshot in
+RESPONSE_STORE_DIR when there is one, and caught up incrementally from
+nps_response by a watermark on created_at (re-reading a small overlap and
+upserting by id, so rows committed slightly out of order are not missed).
+Ingest adds inserted rows directly; other workers pick them up on their next
+refresh (RESPONSE_STORE_REFRESH_SECS), and results computed for a shared
+response cache refresh first (current()). Only refreshes move the watermark.
+Deletes are only seen by /store/reload.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+
+from app import response_cache
+from app.db import iter_pages, service_client
+from app.metrics import cache_lookup
+from app.segments import summarize
+
+router = APIRouter(prefix="/store", tags=["response-store"])
+
+RESPONSE_STORE = os.getenv("RESPONSE_STORE", "off")  # on | off
+RESPONSE_STORE_DIR = os.getenv("RESPONSE_STORE_DIR", os.path.join(os.getcwd(), "response_store"))
+REFRESH_SECS = float(os.getenv("RESPONSE_STORE_REFRESH_SECS", "30"))
+# created_at window re-read on every refresh, for inserts that commit late
+REFRESH_OVERLAP_SECS = float(os.getenv("RESPONSE_STORE_OVERLAP_SECS", "300"))
+# Rows added since the last snapshot before writing a new one
+SAVE_EVERY = int(os.getenv("RESPONSE_STORE_SAVE_EVERY", "50000"))
+SNAPSHOT = "responses.parquet"
+
+DIMENSIONS: Tuple[str, ...] = ("survey_name", "title_text", "gender", "age_range", "years_employed", "nps_category")
+LOAD_COLUMNS = "id, " + ", ".join(DIMENSIONS) + ", creation_date, nps_score, has_explanation, created_at"
+ID_WIDTH = 36
+NULL_DAY = np.iinfo(np.int32).min
+EPOCH = date(1970, 1, 1).toordinal()
+RANKINGS = ("nps", "responses", "average_score", "detractors")
+
+
+def enabled() -> bool:
+    return RESPONSE_STORE == "on"
+
+
+def _day(value: Any) -> int:
+    """Days since 1970-01-01, or NULL_DAY when missing/unparseable."""
+    if not value:
+        return NULL_DAY
+    try:
+        return date.fromisoformat(str(value)[:10]).toordinal() - EPOCH
+    except ValueError:
+        return NULL_DAY
+
+
+def _date(day: int) -> Optional[str]:
+    return None if day == NULL_DAY else date.fromordinal(int(day) + EPOCH).isoformat()
+
+
+class ResponseStore:
+    """
+    Columns are dense arrays that grow by doubling; row numbers are stable, so
+    an upsert of a known id overwrites its row in place. `order` sorts the
+    first `size` ids and is kept sorted on insert, so id lookups are a
+    searchsorted instead of a per-row dict.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.lookup: Dict[str, Dict[str, int]] = {d: {} for d in DIMENSIONS}
+        self.values: Dict[str, List[str]] = {d: [] for d in DIMENSIONS}
+        self.ids = np.zeros(1024, dtype=f"S{ID_WIDTH}")
+        self.order = np.zeros(0, dtype=np.int64)
+        self.score = np.zeros(1024, dtype=np.int8)
+        self.day = np.zeros(1024, dtype=np.int32)
+        self.commented = np.zeros(1024, dtype=bool)
+        self.codes: Dict[str, np.ndarray] = {d: np.zeros(1024, dtype=np.int32) for d in DIMENSIONS}
+        self.size = 0
+        self.watermark = ""
+        self.refreshed = 0.0
+        self.dirty = 0
+        self.loaded = False
+
+    # -------------------------------------------------------------------------
+    # Updates
+    # -------------------------------------------------------------------------
+    def _code(self, dim: str, value: Any) -> int:
+        key = "" if value is None else str(value)
+        table = self.lookup[dim]
+        code = table.get(key)
+        if code is None:
+            code = table[key] = len(self.values[dim])
+            self.values[dim].append(key)
+        return code
+
+    def _reserve(self, rows: int) -> None:
+        cap = len(self.score)
+        if self.size + rows <= cap:
+            return
+        while cap < self.size + rows:
+            cap *= 2
+
+        def grown(col: np.ndarray) -> np.ndarray:
+            out = np.zeros(cap, dtype=col.dtype)
+            out[: self.size] = col[: self.size]
+            return out
+
+        # New arrays rather than resize: readers keep valid views of the old ones
+        self.ids, self.score, self.day = grown(self.ids), grown(self.score), grown(self.day)
+        self.commented = grown(self.commented)
+        self.codes = {d: grown(c) for d, c in self.codes.items()}
+
+    def _find(self, keys: np.ndarray) -> np.ndarray:
+        """Row of each id, -1 where unknown."""
+        if not self.size or not len(keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        ids = self.ids[: self.size]
+        at = np.minimum(np.searchsorted(ids, keys, sorter=self.order), self.size - 1)
+        rows = self.order[at]
+        return np.where(ids[rows] == keys, rows, -1)
+
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Upsert nps_response rows that carry an id; returns the number of new rows."""
+        # Last version of each id wins
+        batch = {str(r["id"]): r for r in rows if r.get("id") and r.get("nps_score") is not None}
+        if not batch:
+            return 0
+        items = list(batch.values())
+        keys = np.array(list(batch), dtype=f"S{ID_WIDTH}")
+        with self._lock:
+            at = self._find(keys)
+            new = at < 0
+            added = int(new.sum())
+            self._reserve(added)
+            at[new] = np.arange(self.size, self.size + added)
+
+            self.score[at] = [int(r["nps_score"]) for r in items]
+            self.day[at] = [_day(r.get("creation_date")) for r in items]
+            self.commented[at] = [bool(r.get("has_explanation")) for r in items]
+            for d in DIMENSIONS:
+                self.codes[d][at] = [self._code(d, r.get(d)) for r in items]
+            if added:
+                fresh = at[new]
+                self.ids[fresh] = keys[new]
+                fresh = fresh[np.argsort(keys[new], kind="stable")]
+                slots = np.searchsorted(self.ids[: self.size], self.ids[fresh], sorter=self.order)
+                self.order = np.insert(self.order, slots, fresh)
+                self.size += added
+            self.dirty += added
+        return added
+
+    def refresh(self, client: Any = None) -> int:
+        """Catch up from nps_response since the watermark (minus the overlap)."""
+        client = client or service_client()
+        where = None
+        if self.watermark:
+            since = self.watermark
+            try:
+                since = (datetime.fromisoformat(since) - timedelta(seconds=REFRESH_OVERLAP_SECS)).isoformat()
+            except ValueError:
+                pass
+            where = lambda q: q.gte("created_at", since)  # noqa: E731
+        added = 0
+        latest = self.watermark
+        for page in iter_pages(client, "nps_response", LOAD_COLUMNS, where=where):
+            added += self.add_rows(page)
+            latest = max([latest, *(str(r.get("created_at") or "") for r in page)])
+        # Only a full read from the DB moves the watermark: rows this worker
+        # ingested itself say nothing about what other workers inserted before them
+        self.watermark = latest
+        self.refreshed = time.time()
+        return added
+
+    # -------------------------------------------------------------------------
+    # Persistence
+    # -------------------------------------------------------------------------
+    def save(self, directory: str = RESPONSE_STORE_DIR) -> str:
+        """Write a Parquet snapshot (dictionary-encoded columns) atomically; returns its path."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, SNAPSHOT)
+        tmp = path + ".tmp"
+        with self._lock:
+            n = self.size
+            columns = {
+                "id": pa.array(self.ids[:n]),
+                "nps_score": pa.array(self.score[:n]),
+                "creation_day": pa.array(self.day[:n]),
+                "has_explanation": pa.array(self.commented[:n]),
+            }
+            for d in DIMENSIONS:
+                columns[d] = pa.DictionaryArray.from_arrays(pa.array(self.codes[d][:n]), pa.array(self.values[d], pa.string()))
+            table = pa.table(columns).replace_schema_metadata({"watermark": self.watermark})
+            self.dirty = 0
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+        logging.info(f"Response store saved: {n} rows")
+        return path
+
+    def load(self, directory: str = RESPONSE_STORE_DIR) -> bool:
+        """Replace the store with the snapshot in `directory`; False when there is none."""
+        path = os.path.join(directory, SNAPSHOT)
+        if not os.path.exists(path):
+            return False
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path).unify_dictionaries()
+        with self._lock:
+            self._reset()
+            n = self.size = table.num_rows
+            cap = max(1024, 1 << max(n - 1, 0).bit_length())
+
+            def column(name: str, dtype: Any) -> np.ndarray:
+                out = np.zeros(cap, dtype=dtype)
+                out[:n] = table.column(name).to_numpy()
+                return out
+
+            self.ids = column("id", f"S{ID_WIDTH}")
+            self.order = np.argsort(self.ids[:n], kind="stable")
+            self.score = column("nps_score", np.int8)
+            self.day = column("creation_day", np.int32)
+            self.commented = column("has_explanation", bool)
+            for d in DIMENSIONS:
+                chunks = table.column(d).chunks
+                values = chunks[0].dictionary.to_pylist() if chunks else []
+                self.values[d] = values
+                self.lookup[d] = {v: i for i, v in enumerate(values)}
+                self.codes[d] = np.zeros(cap, dtype=np.int32)
+                if n:
+                    self.codes[d][:n] = np.concatenate([c.indices.to_numpy(zero_copy_only=False) for c in chunks])
+            self.watermark = (table.schema.metadata or {}).get(b"watermark", b"").decode()
+        return True
+
+    # -------------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------------
+    def _snapshot(self) -> Tuple[int, np.ndarray, np.ndarray, Dict[str, np.ndarray], Dict[str, List[str]], Dict[str, Dict[str, int]]]:
+        # Appends only write past `size` and growth allocates new arrays, so views are safe to read unlocked
+        with self._lock:
+            n = self.size
+            return (n, self.score[:n], self.day[:n], {d: c[:n] for d, c in self.codes.items()},
+                    {d: list(v) for d, v in self.values.items()}, {d: dict(v) for d, v in self.lookup.items()})
+
+    def select(
+        self,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+    ) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]], Optional[np.ndarray]]:
+        """Columns plus the row mask for the filters (None when nothing is filtered)."""
+        n, score, day, codes, values, lookup = self._snapshot()
+        mask: Optional[np.ndarray] = None
+        for dim, wanted in (filters or {}).items():
+            allowed = [lookup[dim][v] for v in wanted if v in lookup[dim]]
+            m = np.isin(codes[dim], allowed)
+            mask = m if mask is None else mask & m
+        if start or end:
+            lo = start.toordinal() - EPOCH if start else NULL_DAY + 1
+            hi = end.toordinal() - EPOCH if end else np.iinfo(np.int32).max
+            m = (day >= lo) & (day <= hi)
+            mask = m if mask is None else mask & m
+        return {"score": score, "day": day, **codes}, values, mask
+
+    def grouped(
+        self,
+        group_by: Optional[str] = None,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+    ) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+        """(group labels, score histograms[groups, 11], first day, last day) for the slice."""
+        cols, values, mask = self.select(filters, start, end)
+        score, day = cols["score"].astype(np.int64), cols["day"]
+        group = cols[group_by] if group_by else np.zeros(len(score), dtype=np.int32)
+        if mask is not None:
+            score, day, group = score[mask], day[mask], group[mask]
+        k = max(len(values[group_by]), 1) if group_by else 1
+        hist = np.bincount(group.astype(np.int64) * 11 + score, minlength=k * 11).reshape(k, 11)
+        first = np.full(k, np.iinfo(np.int32).max, dtype=np.int32)
+        last = np.full(k, NULL_DAY, dtype=np.int32)
+        dated = day != NULL_DAY
+        np.minimum.at(first, group[dated], day[dated])
+        np.maximum.at(last, group[dated], day[dated])
+        labels = values[group_by] if group_by else [""]
+        return labels, hist, first, last
+
+    def survey_metrics(self, survey_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Per-survey metrics in the shape of get_survey_metrics (one survey when named)."""
+        filters = {"survey_name": [survey_name]} if survey_name is not None else None
+        labels, hist, first, last = self.grouped("survey_name", filters)
+        s = summarize(hist)
+        out = []
+        for i in np.nonzero(s["n"])[0]:
+            n = int(s["n"][i])
+            out.append({
+                "survey_name": labels[i],
+                "total_responses": n,
+                "promoters": int(s["promoters"][i]),
+                "passives": int(s["passives"][i]),
+                "detractors": int(s["detractors"][i]),
+                "average_score": round(float(s["avg_score"][i]), 2),
+                "nps_score": round((int(s["promoters"][i]) - int(s["detractors"][i])) / n * 100, 2),
+                "nps_ci_low": round(float(s["ci_low"][i]), 2),
+                "nps_ci_high": round(float(s["ci_high"][i]), 2),
+                "first_response": _date(first[i]) if first[i] != np.iinfo(np.int32).max else None,
+                "last_response": _date(last[i]),
+            })
+        return out
+
+    def top(
+        self,
+        group_by: str,
+        k: int = 10,
+        by: str = "nps",
+        ascending: bool = False,
+        min_responses: int = 1,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+    ) -> List[Dict[str, Any]]:
+        """The k groups ranked by NPS, response count, average score or detractor count."""
+        labels, hist, first, last = self.grouped(group_by, filters, start, end)
+        s = summarize(hist)
+        metric = {"nps": s["nps"], "responses": s["n"], "average_score": s["avg_score"], "detractors": s["detractors"]}[by]
+        candidates = np.nonzero(s["n"] >= max(min_responses, 1))[0]
+        if not len(candidates):
+            return []
+        key = metric[candidates].astype(np.float64) * (1 if ascending else -1)
+        if k < len(candidates):
+            part = np.argpartition(key, k - 1)[:k]
+            candidates, key = candidates[part], key[part]
+        ranked = candidates[np.lexsort((s["n"][candidates] * -1, key))]
+        return [
+            {
+                group_by: labels[i],
+                "responses": int(s["n"][i]),
+                "promoters": int(s["promoters"][i]),
+                "passives": int(s["passives"][i]),
+                "detractors": int(s["detractors"][i]),
+                "average_score": round(float(s["avg_score"][i]), 2),
+                "nps_score": round(float(s["nps"][i]), 1),
+                "nps_ci_low": round(float(s["ci_low"][i]), 1),
+                "nps_ci_high": round(float(s["ci_high"][i]), 1),
+                "first_response": _date(first[i]) if first[i] != np.iinfo(np.int32).max else None,
+                "last_response": _date(last[i]),
+            }
+            for i in ranked
+        ]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            n = self.size
+            return {"responses": n, "with_explanation": int(np.count_nonzero(self.commented[:n]))}
+
+    def nbytes(self) -> Dict[str, int]:
+        n = self.size
+        out = {"id": self.ids[:n].nbytes + self.order.nbytes, "nps_score": self.score[:n].nbytes,
+               "creation_date": self.day[:n].nbytes, "has_explanation": self.commented[:n].nbytes}
+        out.update({d: c[:n].nbytes for d, c in self.codes.items()})
+        return out
+
+
+# -----------------------------------------------------------------------------
+# Shared store
+# -----------------------------------------------------------------------------
+store = ResponseStore()
+_load_lock = threading.Lock()
+
+
+def ensure_loaded(max_age: float = REFRESH_SECS) -> ResponseStore:
+    """Load the snapshot (or build from nps_response) on first use; refresh when older than max_age."""
+    cache_lookup("response_store", store.loaded)
+    if store.loaded and time.time() - store.refreshed < max_age:
+        return store
+    with _load_lock:
+        if not store.loaded:
+            restored = store.load()
+            store.refresh()
+            store.loaded = True
+            logging.info(f"Response store {'restored' if restored else 'built'}: {store.size} rows")
+            if store.dirty:
+                store.save()
+        elif time.time() - store.refreshed >= max_age:
+            store.refresh()
+            if store.dirty >= SAVE_EVERY:
+                store.save()
+    return store
+
+
+def current() -> ResponseStore:
+    """
+    The store for computing a result the response cache will keep. With a
+    shared cache tier it is caught up first: otherwise a worker that has not
+    refreshed since another worker's ingest would publish stale numbers under
+    the new scope versions, for every worker, until CACHE_TTL.
+    """
+    return ensure_loaded(max_age=0 if response_cache.shared() else REFRESH_SECS)
+
+
+def record_ingested(rows: Iterable[Dict[str, Any]]) -> None:
+    """Ingest hook: add inserted responses (as returned by the insert) if the store is live."""
+    if store.loaded:
+        store.add_rows(rows)
+
+
+def save_if_dirty() -> None:
+    if store.loaded and store.dirty:
+        store.save()
+
+
+def _filters(**dims: Optional[List[str]]) -> Dict[str, List[str]]:
+    return {dim: vals for dim, vals in dims.items() if vals}
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.get("/top")
+async def get_top_segments(
+    group_by: str = "title_text",
+    k: int = Query(10, ge=1, le=1000),
+    by: str = "nps",
+    ascending: bool = False,
+    min_responses: int = 30,
+    survey: Optional[List[str]] = Query(None),
+    title: Optional[List[str]] = Query(None),
+    gender: Optional[List[str]] = Query(None),
+    age_range: Optional[List[str]] = Query(None),
+    years_employed: Optional[List[str]] = Query(None),
+    category: Optional[List[str]] = Query(None),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+):
+    """
+    Top-k groups of one dimension (survey_name, title_text, gender,
+    age_range, years_employed, nps_category) ranked by nps, responses,
+    average_score or detractors; ascending=true gives the bottom k.
+    """
+    if group_by not in DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown dimension: {group_by}")
+    if by not in RANKINGS:
+        raise HTTPException(status_code=400, detail=f"Unknown ranking: {by}")
+    try:
+        filters = _filters(survey_name=survey, title_text=title, gender=gender, age_range=age_range,
+                           years_employed=years_employed, nps_category=category)
+        return ensure_loaded().top(group_by, k, by, ascending, min_responses, filters, start_date, end_date)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error ranking segments: {str(e)}")
+
+
+@router.get("/stats")
+async def get_store_stats():
+    """Rows, memory per column and refresh state"""
+    try:
+        s = ensure_loaded()
+        nbytes = s.nbytes()
+        return {
+            "rows": s.size,
+            "bytes": sum(nbytes.values()),
+            "bytes_per_row": round(sum(nbytes.values()) / s.size, 1) if s.size else None,
+            "columns": nbytes,
+            "dimensions": {d: len(s.values[d]) for d in DIMENSIONS},
+            "watermark": s.watermark or None,
+            "refreshed_secs_ago": round(time.time() - s.refreshed, 1),
+            "pending_snapshot": s.dirty,
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading response store stats: {str(e)}")
+
+
+@router.post("/reload")
+async def reload_response_store():
+    """Drop the store and its snapshot and rebuild from nps_response"""
+    try:
+        path = os.path.join(RESPONSE_STORE_DIR, SNAPSHOT)
+        if os.path.exists(path):
+            os.remove(path)
+        with _load_lock, store._lock:
+            store._reset()
+        s = ensure_loaded()
+        return {"rows": s.size, "dimensions": {d: len(s.values[d]) for d in DIMENSIONS}}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rebuilding response store: {str(e)}")
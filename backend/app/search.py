@@ -0,0 +1,546 @@
+"""
+Full-text search over NPS comments
+An in-memory inverted index over nps_response.nps_explanation with BM25
+ranking, fed by ingest batches like the trend counters, and snapshotted to
+disk (SEARCH_INDEX_DIR) so a restart only catches up on responses created
+since the last snapshot instead of re-tokenizing the whole table.
+
+Every worker catches up from nps_response by a created_at watermark every
+SEARCH_REFRESH_SECS, re-reading an overlap (already indexed ids are skipped),
+so responses ingested by other workers show up too. Only these DB reads move
+the watermark. Workers share one snapshot file: writes are serialized by a
+lock file and a snapshot never replaces one with a newer watermark.
+
+Tokenization is Dutch-aware: accents are folded, common Dutch stopwords are
+dropped and a light suffix stemmer maps "kranten"/"krant" and
+"bezorgingen"/"bezorging" onto the same term.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+
+from app.db import iter_pages, service_client
+from app.metrics import cache_lookup
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+LOAD_COLUMNS = "id, survey_name, title_text, creation_date, nps_score, nps_explanation, created_at"
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", os.path.join(os.getcwd(), "search_index"))
+# Newly indexed responses between snapshots
+SAVE_EVERY = int(os.getenv("SEARCH_SAVE_EVERY", "5000"))
+SNAPSHOT = "index.npz"
+REFRESH_SECS = float(os.getenv("SEARCH_REFRESH_SECS", "30"))
+# created_at window re-read on every refresh, for inserts that commit late
+REFRESH_OVERLAP_SECS = float(os.getenv("SEARCH_OVERLAP_SECS", "300"))
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+CATEGORIES = {"detractor": (0, 6), "passive": (7, 8), "promoter": (9, 10)}
+
+# -----------------------------------------------------------------------------
+# Tokenization
+# -----------------------------------------------------------------------------
+STOPWORDS = frozenset("""
+aan al alle alles als altijd ander andere anders ben bij dan dat de der deze die dit doch doen door
+dus een eens en er ge geen geweest haar had heb hebben heeft hem het hier hij hoe hun ik in is ja je
+kan kon kunnen maar me meer men met mij mijn moet na naar niet niets nog nu of om omdat ons ook op
+over reeds te tegen toch toen tot u uit uw van veel voor want waren was wat we wel werd wezen wie
+wij wil worden wordt zal ze zelf zich zij zijn zo zonder zou
+""".split())
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_VOWELS = frozenset("aeiouy")
+_DOUBLE = frozenset(("bb", "dd", "ff", "gg", "kk", "ll", "mm", "nn", "pp", "rr", "ss", "tt"))
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents ("reëel" -> "reeel")."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _undouble(word: str) -> str:
+    return word[:-1] if word[-2:] in _DOUBLE else word
+
+
+def stem(word: str) -> str:
+    """Light Dutch stemmer: plural and inflection suffixes only."""
+    if len(word) <= 3 or word.isdigit():
+        return word
+    if word.endswith("heden"):
+        return word[:-5] + "heid"
+    for suffix in ("ene", "en"):
+        if word.endswith(suffix):
+            base = word[: -len(suffix)]
+            if len(base) >= 3 and base[-1] not in _VOWELS and not base.endswith("gem"):
+                return _undouble(base)
+            return word
+    for suffix in ("se", "s"):
+        if word.endswith(suffix):
+            base = word[: -len(suffix)]
+            if len(base) >= 3 and base[-1] not in _VOWELS and base[-1] != "j":
+                return base
+            return word
+    if word.endswith("e"):
+        base = word[:-1]
+        if len(base) >= 3 and base[-1] not in _VOWELS:
+            return _undouble(base)
+    return word
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    return [stem(w) for w in _TOKEN.findall(fold(text)) if len(w) > 1 and w not in STOPWORDS]
+
+
+def _day(value: Any) -> int:
+    """Date ordinal, or -1 when missing/unparseable."""
+    if not value:
+        return -1
+    try:
+        return date.fromisoformat(str(value)[:10]).toordinal()
+    except ValueError:
+        return -1
+
+
+class SearchIndex:
+    """
+    Postings are kept per term as (doc, tf) pairs in two forms: a compacted
+    CSR block (offsets/docs/tfs as uint32/uint16 arrays) and small growable
+    typed arrays for documents added since the last compaction. Doc numbers
+    only increase, so appending keeps every posting list sorted.
+
+    Per-document filter columns (survey, title, score, day) and lengths are
+    dense NumPy arrays that grow by doubling.
+    """
+
+    def __init__(self) -> None:
+        self._reset()
+        self._lock = threading.Lock()
+
+    def _reset(self) -> None:
+        self.ids: List[str] = []
+        self.doc_of: Dict[str, int] = {}
+        self.vocab: Dict[str, int] = {}
+        self.terms: List[str] = []
+        self.surveys: Dict[str, int] = {}
+        self.titles: Dict[str, int] = {}
+        self.size = 0
+        self.doc_len = np.zeros(1024, dtype=np.uint16)
+        self.survey = np.zeros(1024, dtype=np.int32)
+        self.title = np.zeros(1024, dtype=np.int32)
+        self.score = np.zeros(1024, dtype=np.int8)
+        self.day = np.zeros(1024, dtype=np.int32)
+        self.total_len = 0
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.post_docs = np.zeros(0, dtype=np.uint32)
+        self.post_tf = np.zeros(0, dtype=np.uint16)
+        self.tails: Dict[int, Tuple[array, array]] = {}
+        self.watermark = ""
+        self.dirty = 0
+        self.loaded = False
+        self.refreshed = 0.0
+
+    # -------------------------------------------------------------------------
+    # Updates
+    # -------------------------------------------------------------------------
+    def _grow(self) -> None:
+        for name in ("doc_len", "survey", "title", "score", "day"):
+            col = getattr(self, name)
+            setattr(self, name, np.concatenate([col, np.zeros_like(col)]))
+
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Index nps_response rows that carry an id; already indexed ids are ignored."""
+        added = 0
+        with self._lock:
+            for r in rows:
+                rid = r.get("id")
+                if not rid or rid in self.doc_of:
+                    continue
+                counts = Counter(tokenize(r.get("nps_explanation")))
+                if not counts:
+                    continue
+                doc = self.size
+                if doc == len(self.doc_len):
+                    self._grow()
+                length = min(sum(counts.values()), 65535)
+                self.doc_len[doc] = length
+                self.survey[doc] = self.surveys.setdefault(r.get("survey_name") or "", len(self.surveys))
+                self.title[doc] = self.titles.setdefault(r.get("title_text") or "", len(self.titles))
+                score = r.get("nps_score")
+                self.score[doc] = -1 if score is None else int(score)
+                self.day[doc] = _day(r.get("creation_date"))
+                for term, tf in counts.items():
+                    tid = self.vocab.get(term)
+                    if tid is None:
+                        tid = self.vocab[term] = len(self.terms)
+                        self.terms.append(term)
+                    tail = self.tails.get(tid)
+                    if tail is None:
+                        tail = self.tails[tid] = (array("I"), array("H"))
+                    tail[0].append(doc)
+                    tail[1].append(min(tf, 65535))
+                self.ids.append(rid)
+                self.doc_of[rid] = doc
+                self.total_len += length
+                self.size += 1
+                added += 1
+            self.dirty += added
+        return added
+
+    def refresh(self, client: Any = None) -> int:
+        """Index commented responses created since the watermark (minus the overlap)."""
+        client = client or service_client()
+        since = self.watermark
+        if since:
+            try:
+                since = (datetime.fromisoformat(since) - timedelta(seconds=REFRESH_OVERLAP_SECS)).isoformat()
+            except ValueError:
+                pass
+
+        def where(q: Any) -> Any:
+            q = q.filter("nps_explanation", "not.is", "null")
+            return q.gte("created_at", since) if since else q
+
+        added = 0
+        latest = self.watermark
+        for page in iter_pages(client, "nps_response", LOAD_COLUMNS, where=where):
+            added += self.add_rows(page)
+            latest = max([latest, *(str(r.get("created_at") or "") for r in page)])
+        self.watermark = latest
+        self.refreshed = time.time()
+        return added
+
+    def _postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(docs, tfs) for a term; call with the lock held."""
+        docs = tfs = None
+        if tid + 1 < len(self.offsets):
+            lo, hi = self.offsets[tid], self.offsets[tid + 1]
+            docs, tfs = self.post_docs[lo:hi], self.post_tf[lo:hi]
+        tail = self.tails.get(tid)
+        if tail is not None:
+            # Copies, so later appends can't be blocked by exported buffers
+            t_docs, t_tfs = np.array(tail[0], dtype=np.uint32), np.array(tail[1], dtype=np.uint16)
+            if docs is None:
+                return t_docs, t_tfs
+            return np.concatenate([docs, t_docs]), np.concatenate([tfs, t_tfs])
+        if docs is None:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint16)
+        return docs, tfs
+
+    def compact(self) -> None:
+        """Merge the per-term tails into the CSR postings."""
+        with self._lock:
+            if not self.tails:
+                return
+            n_terms = len(self.terms)
+            base = np.zeros(n_terms, dtype=np.int64)
+            base[: len(self.offsets) - 1] = np.diff(self.offsets)
+            extra = np.zeros(n_terms, dtype=np.int64)
+            for tid, (docs, _) in self.tails.items():
+                extra[tid] = len(docs)
+            offsets = np.zeros(n_terms + 1, dtype=np.int64)
+            np.cumsum(base + extra, out=offsets[1:])
+            docs = np.empty(offsets[-1], dtype=np.uint32)
+            tfs = np.empty(offsets[-1], dtype=np.uint16)
+
+            # Existing postings shift right by the tail sizes of earlier terms
+            owner = np.repeat(np.arange(n_terms), base)
+            pos = offsets[owner] + (np.arange(len(owner)) - self.offsets[owner])
+            docs[pos] = self.post_docs
+            tfs[pos] = self.post_tf
+            for tid, (t_docs, t_tfs) in self.tails.items():
+                start = offsets[tid] + base[tid]
+                docs[start : start + len(t_docs)] = t_docs
+                tfs[start : start + len(t_tfs)] = t_tfs
+
+            self.offsets, self.post_docs, self.post_tf = offsets, docs, tfs
+            self.tails = {}
+
+    # -------------------------------------------------------------------------
+    # Persistence
+    # -------------------------------------------------------------------------
+    def save(self, directory: str = SEARCH_INDEX_DIR) -> Optional[str]:
+        """
+        Compact and write a snapshot atomically; returns its path, or None when
+        another worker already saved one with a newer watermark.
+        """
+        self.compact()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, SNAPSHOT)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(path + ".lock", "w") as lock_fh:
+            # One writer at a time across the workers sharing the directory
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            if _snapshot_watermark(path) > self.watermark:
+                return None
+            with self._lock:
+                n = self.size
+                arrays = {
+                    "ids": np.array(self.ids, dtype="S"),
+                    "terms": np.array(self.terms, dtype="S"),
+                    "surveys": np.array(sorted(self.surveys, key=self.surveys.get), dtype=str),
+                    "titles": np.array(sorted(self.titles, key=self.titles.get), dtype=str),
+                    "doc_len": self.doc_len[:n],
+                    "survey": self.survey[:n],
+                    "title": self.title[:n],
+                    "score": self.score[:n],
+                    "day": self.day[:n],
+                    "offsets": self.offsets,
+                    "post_docs": self.post_docs,
+                    "post_tf": self.post_tf,
+                    "watermark": np.array(self.watermark),
+                }
+                with open(tmp, "wb") as fh:
+                    np.savez(fh, **arrays)
+                self.dirty = 0
+            os.replace(tmp, path)
+        logging.info(f"Search index saved: {n} documents, {len(self.terms)} terms, {len(self.post_docs)} postings")
+        return path
+
+    def load(self, directory: str = SEARCH_INDEX_DIR) -> bool:
+        """Replace the index with the snapshot in `directory`; False when there is none."""
+        path = os.path.join(directory, SNAPSHOT)
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as z:
+            data = {k: z[k] for k in z.files}
+        with self._lock:
+            self._reset()
+            self.ids = data["ids"].astype(str).tolist()
+            self.doc_of = {rid: i for i, rid in enumerate(self.ids)}
+            self.terms = data["terms"].astype(str).tolist()
+            self.vocab = {t: i for i, t in enumerate(self.terms)}
+            self.surveys = {s: i for i, s in enumerate(data["surveys"].tolist())}
+            self.titles = {t: i for i, t in enumerate(data["titles"].tolist())}
+            self.size = len(self.ids)
+            cap = max(1024, 1 << max(self.size - 1, 0).bit_length())
+            for name in ("doc_len", "survey", "title", "score", "day"):
+                col = np.zeros(cap, dtype=data[name].dtype)
+                col[: self.size] = data[name]
+                setattr(self, name, col)
+            self.total_len = int(data["doc_len"].sum())
+            self.offsets = data["offsets"]
+            self.post_docs = data["post_docs"]
+            self.post_tf = data["post_tf"]
+            self.watermark = str(data["watermark"])
+        return True
+
+    # -------------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------------
+    def search(
+        self,
+        query: str,
+        surveys: Optional[Sequence[str]] = None,
+        titles: Optional[Sequence[str]] = None,
+        categories: Optional[Sequence[str]] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        limit: int = 20,
+        offset: int = 0,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """BM25-ranked matches for any query term; returns (total matches, page of hits)."""
+        tids = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        with self._lock:
+            n = self.size
+            if not tids or not n:
+                return 0, []
+            avgdl = self.total_len / n
+            scores = np.zeros(n, dtype=np.float32)
+            matched = []
+            for tid in tids:
+                docs, tfs = self._postings(tid)
+                df = len(docs)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                tf = tfs.astype(np.float32)
+                norm = K1 * (1 - B + B * self.doc_len[docs] / avgdl)
+                scores[docs] += idf * tf * (K1 + 1) / (tf + norm)
+                matched.append(docs)
+            cand = np.unique(np.concatenate(matched)) if len(matched) > 1 else matched[0]
+
+            mask = np.ones(len(cand), dtype=bool)
+            if surveys:
+                mask &= np.isin(self.survey[cand], [self.surveys[s] for s in surveys if s in self.surveys])
+            if titles:
+                mask &= np.isin(self.title[cand], [self.titles[t] for t in titles if t in self.titles])
+            if categories:
+                nps = self.score[cand]
+                in_cat = np.zeros(len(cand), dtype=bool)
+                for c in categories:
+                    lo, hi = CATEGORIES[c]
+                    in_cat |= (nps >= lo) & (nps <= hi)
+                mask &= in_cat
+            if start is not None:
+                mask &= self.day[cand] >= start.toordinal()
+            if end is not None:
+                mask &= (self.day[cand] >= 0) & (self.day[cand] <= end.toordinal())
+            cand = cand[mask]
+
+            total = len(cand)
+            want = min(offset + limit, total)
+            if want <= offset:
+                return total, []
+            cand_scores = scores[cand]
+            top = np.argpartition(-cand_scores, want - 1)[:want] if want < total else np.arange(total)
+            top = top[np.argsort(-cand_scores[top], kind="stable")][offset:want]
+
+            survey_names = sorted(self.surveys, key=self.surveys.get)
+            title_names = sorted(self.titles, key=self.titles.get)
+            hits = []
+            for i in top:
+                doc = int(cand[i])
+                day = int(self.day[doc])
+                score = int(self.score[doc])
+                hits.append({
+                    "response_id": self.ids[doc],
+                    "score": round(float(cand_scores[i]), 4),
+                    "survey_name": survey_names[self.survey[doc]],
+                    "title_text": title_names[self.title[doc]],
+                    "creation_date": date.fromordinal(day).isoformat() if day > 0 else None,
+                    "nps_score": None if score < 0 else score,
+                })
+        return total, hits
+
+
+def _snapshot_watermark(path: str) -> str:
+    """Watermark of the snapshot at path ("" when there is none)."""
+    if not os.path.exists(path):
+        return ""
+    try:
+        with np.load(path) as z:
+            return str(z["watermark"])
+    except Exception:
+        return ""
+
+
+# -----------------------------------------------------------------------------
+# Shared index
+# -----------------------------------------------------------------------------
+index = SearchIndex()
+_load_lock = threading.Lock()
+
+
+def ensure_loaded() -> SearchIndex:
+    """Load the snapshot (or build from nps_response) on first use, then catch up when stale."""
+    cache_lookup("search_index", index.loaded)
+    if index.loaded and time.time() - index.refreshed < REFRESH_SECS:
+        return index
+    with _load_lock:
+        if not index.loaded:
+            restored = index.load()
+            index.refresh()
+            index.loaded = True
+            if restored:
+                logging.info(f"Search index restored: {index.size} documents ({index.dirty} caught up)")
+            else:
+                logging.info(f"Search index built: {index.size} documents, {len(index.terms)} terms")
+            if index.dirty:
+                index.save()
+        elif time.time() - index.refreshed >= REFRESH_SECS:
+            index.refresh()
+            if index.dirty >= SAVE_EVERY:
+                index.save()
+    return index
+
+
+def record_ingested(rows: Iterable[Dict[str, Any]]) -> None:
+    """Ingest hook: index inserted responses (as returned by the insert) if the index is live."""
+    if index.loaded:
+        index.add_rows(rows)
+
+
+def save_if_dirty() -> None:
+    if index.loaded and index.dirty:
+        index.save()
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.get("")
+async def search_comments(
+    q: str = Query(..., min_length=1),
+    survey: Optional[List[str]] = Query(None),
+    title: Optional[List[str]] = Query(None),
+    category: Optional[List[str]] = Query(None),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    limit: int = Query(20, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    with_text: bool = True,
+):
+    """
+    BM25-ranked comment search. Filters accept repeated values; category is
+    promoter, passive or detractor.
+    """
+    unknown = [c for c in category or [] if c not in CATEGORIES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown categories: {unknown}")
+    try:
+        idx = ensure_loaded()
+        started = time.perf_counter()
+        total, hits = idx.search(q, survey, title, category, start_date, end_date, limit, offset)
+        took_ms = (time.perf_counter() - started) * 1000
+        if with_text and hits:
+            found = (
+                service_client().table("nps_response")
+                .select("id, nps_explanation")
+                .in_("id", [h["response_id"] for h in hits])
+                .execute().data or []
+            )
+            text = {r["id"]: r["nps_explanation"] for r in found}
+            for h in hits:
+                h["nps_explanation"] = text.get(h["response_id"])
+        return {"query": q, "terms": tokenize(q), "total": total, "took_ms": round(took_ms, 2), "results": hits}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching comments: {str(e)}")
+
+
+@router.get("/stats")
+async def get_search_stats():
+    """Index size and snapshot state"""
+    try:
+        idx = ensure_loaded()
+        return {
+            "documents": idx.size,
+            "terms": len(idx.terms),
+            "postings": int(len(idx.post_docs) + sum(len(d) for d, _ in idx.tails.values())),
+            "pending_snapshot": idx.dirty,
+            "watermark": idx.watermark or None,
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading search stats: {str(e)}")
+
+
+@router.post("/reload")
+async def reload_search_index():
+    """Drop the index and its snapshot and rebuild from nps_response"""
+    try:
+        path = os.path.join(SEARCH_INDEX_DIR, SNAPSHOT)
+        if os.path.exists(path):
+            os.remove(path)
+        with index._lock:
+            index._reset()
+        idx = ensure_loaded()
+        return {"documents": idx.size, "terms": len(idx.terms)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rebuilding search index: {str(e)}")
@@ -0,0 +1,335 @@
+"""
+Segment cube over response demographics
+Pre-aggregated 0-10 score histograms per combination of survey, title, gender,
+age range, subscription years and month, kept in memory and updated from
+ingest. Any group-by/filter over those dimensions is answered from the
+histograms without touching the database.
+
+Other workers' ingests are picked up by a created_at watermark catch-up
+every SEGMENTS_REFRESH_SECS, as in app.trends (see app.db.CreatedWatermark).
+Loading and catching up run in a worker thread, off the event loop.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+
+from app.db import CreatedWatermark, iter_pages, service_client
+from app.metrics import cache_lookup
+from app.stats import nps_interval
+
+router = APIRouter(prefix="/segments", tags=["segments"])
+
+DIMENSIONS: Tuple[str, ...] = ("survey_name", "title_text", "gender", "age_range", "years_employed", "month")
+LOAD_COLUMNS = "id, survey_name, title_text, gender, age_range, years_employed, creation_date, nps_score, created_at"
+REFRESH_SECS = float(os.getenv("SEGMENTS_REFRESH_SECS", "30"))
+# created_at window re-read on every refresh, for inserts that commit late
+REFRESH_OVERLAP_SECS = float(os.getenv("SEGMENTS_OVERLAP_SECS", "300"))
+SCORES = np.arange(11)
+# Group-bys with at most this many possible keys use a dense bincount
+DENSE_GROUPS = 1 << 18
+
+
+class SegmentCube:
+    """
+    Cells are the distinct dimension combinations seen so far.
+
+    `codes` holds one row of dictionary codes per cell (int32) and `hist` the
+    matching 11-bucket score histogram (int32). Both grow by doubling, so
+    incremental updates are amortized O(1) per row.
+    """
+
+    def __init__(self) -> None:
+        self.lookup: Dict[str, Dict[str, int]] = {d: {} for d in DIMENSIONS}
+        self.values: Dict[str, List[str]] = {d: [] for d in DIMENSIONS}
+        self.cells: Dict[Tuple[int, ...], int] = {}
+        self.codes = np.zeros((1024, len(DIMENSIONS)), dtype=np.int32)
+        self.hist = np.zeros((1024, 11), dtype=np.int32)
+        self.size = 0
+        self.loaded = False
+        self.refreshed = 0.0
+        self.since = CreatedWatermark(REFRESH_OVERLAP_SECS)
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    # Updates
+    # -------------------------------------------------------------------------
+    def _code(self, dim: str, value: Any) -> int:
+        key = "" if value is None else str(value)
+        table = self.lookup[dim]
+        code = table.get(key)
+        if code is None:
+            code = table[key] = len(self.values[dim])
+            self.values[dim].append(key)
+        return code
+
+    def _cell(self, combo: Tuple[int, ...]) -> int:
+        idx = self.cells.get(combo)
+        if idx is None:
+            if self.size == len(self.codes):
+                self.codes = np.concatenate([self.codes, np.zeros_like(self.codes)])
+                self.hist = np.concatenate([self.hist, np.zeros_like(self.hist)])
+            idx = self.cells[combo] = self.size
+            self.codes[idx] = combo
+            self.size += 1
+        return idx
+
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Count nps_response rows; rows already counted by id are skipped."""
+        cells: List[int] = []
+        scores: List[int] = []
+        with self._lock:
+            horizon = self.since.horizon()
+            for r in rows:
+                score = r.get("nps_score")
+                created = r.get("creation_date")
+                if score is None or not created or not self.since.first_time(r, horizon):
+                    continue
+                month = str(created)[:7] + "-01"
+                combo = tuple(
+                    self._code(d, month if d == "month" else r.get(d)) for d in DIMENSIONS
+                )
+                cells.append(self._cell(combo))
+                scores.append(int(score))
+            if cells:
+                np.add.at(self.hist, (np.asarray(cells), np.asarray(scores)), 1)
+        return len(cells)
+
+    def refresh(self, client: Any = None) -> int:
+        """Count nps_response rows created since the watermark (minus the overlap)."""
+        client = client or service_client()
+        added = 0
+        for page in iter_pages(client, "nps_response", LOAD_COLUMNS, where=self.since.where()):
+            added += self.add_rows(page)
+            with self._lock:
+                self.since.advance(page)
+        self.refreshed = time.time()
+        return added
+
+    def reset(self) -> None:
+        with self._lock:
+            self.lookup = {d: {} for d in DIMENSIONS}
+            self.values = {d: [] for d in DIMENSIONS}
+            self.cells = {}
+            self.codes = np.zeros((1024, len(DIMENSIONS)), dtype=np.int32)
+            self.hist = np.zeros((1024, 11), dtype=np.int32)
+            self.size = 0
+            self.loaded = False
+            self.refreshed = 0.0
+            self.since.reset()
+
+    # -------------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------------
+    def query(
+        self,
+        group_by: Sequence[str] = (),
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        start_month: Optional[str] = None,
+        end_month: Optional[str] = None,
+    ) -> Tuple[List[Tuple[str, ...]], np.ndarray]:
+        """Return (group keys, histograms[groups, 11]) for the slice."""
+        with self._lock:
+            codes = self.codes[: self.size]
+            # Copy so concurrent ingest updates can't tear a read
+            hist = self.hist[: self.size].copy()
+            values = {d: list(v) for d, v in self.values.items()}
+            lookup = {d: dict(v) for d, v in self.lookup.items()}
+
+        mask = None
+        for dim, wanted in (filters or {}).items():
+            allowed = [lookup[dim][v] for v in wanted if v in lookup[dim]]
+            m = np.isin(codes[:, DIMENSIONS.index(dim)], allowed)
+            mask = m if mask is None else mask & m
+        if start_month or end_month:
+            months = values["month"]
+            allowed = [
+                c for c, m in enumerate(months)
+                if (not start_month or m >= start_month) and (not end_month or m <= end_month)
+            ]
+            m = np.isin(codes[:, DIMENSIONS.index("month")], allowed)
+            mask = m if mask is None else mask & m
+        if mask is not None:
+            codes = codes[mask]
+            hist = hist[mask]
+
+        if not group_by:
+            return [()], hist.sum(axis=0, dtype=np.int64, keepdims=True)
+        if not len(codes):
+            return [], np.zeros((0, 11), dtype=np.int64)
+
+        cols = [DIMENSIONS.index(d) for d in group_by]
+        radix = [max(len(values[d]), 1) for d in group_by]
+        # Mixed-radix key turns any group-by into a 1-D grouping
+        key = np.zeros(len(codes), dtype=np.int64)
+        for c, r in zip(cols, radix):
+            key = key * r + codes[:, c]
+
+        if int(np.prod(radix, dtype=np.float64)) <= DENSE_GROUPS:
+            # Small key space: dense bincount per score bucket, no sort
+            dense = np.stack(
+                [np.bincount(key, weights=hist[:, s], minlength=int(np.prod(radix))) for s in SCORES], axis=1
+            )
+            present = np.nonzero(dense.sum(axis=1))[0]
+            grouped = dense[present].astype(np.int64)
+            parts = []
+            for r in reversed(radix):
+                parts.append(present % r)
+                present = present // r
+            group_codes = list(reversed(parts))
+        else:
+            # High-cardinality group-by: sort + segmented sum
+            order = np.argsort(key, kind="stable")
+            key = key[order]
+            starts = np.concatenate([[0], np.nonzero(key[1:] != key[:-1])[0] + 1])
+            grouped = np.add.reduceat(hist[order].astype(np.int64), starts, axis=0)
+            first = order[starts]
+            group_codes = [codes[first, c] for c in cols]
+
+        labels = list(zip(*(np.asarray(values[d], dtype=object)[gc] for gc, d in zip(group_codes, group_by))))
+        return labels, grouped
+
+
+def summarize(hist: np.ndarray) -> Dict[str, np.ndarray]:
+    """NPS, CI and average score per histogram row."""
+    promoters = hist[:, 9:].sum(axis=1)
+    passives = hist[:, 7:9].sum(axis=1)
+    detractors = hist[:, :7].sum(axis=1)
+    s = nps_interval(promoters, passives, detractors)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s["avg_score"] = (hist * SCORES).sum(axis=1) / s["n"]
+    s.update(promoters=promoters, passives=passives, detractors=detractors)
+    return s
+
+
+# -----------------------------------------------------------------------------
+# Shared cube
+# -----------------------------------------------------------------------------
+cube = SegmentCube()
+_load_lock = threading.Lock()
+
+
+def ensure_loaded(max_age: float = REFRESH_SECS) -> SegmentCube:
+    """Load the cube from nps_response on first use; catch up when older than max_age. Blocking."""
+    cache_lookup("segment_cube", cube.loaded)
+    if cube.loaded and time.time() - cube.refreshed < max_age:
+        return cube
+    with _load_lock:
+        if not cube.loaded:
+            cube.refresh()
+            cube.loaded = True
+            logging.info(f"Segment cube loaded: {cube.size} cells")
+        elif time.time() - cube.refreshed >= max_age:
+            cube.refresh()
+    return cube
+
+
+async def loaded_cube() -> SegmentCube:
+    """ensure_loaded for endpoints: the scan runs in a worker thread, not on the event loop."""
+    if cube.loaded and time.time() - cube.refreshed < REFRESH_SECS:
+        return cube
+    return await asyncio.to_thread(ensure_loaded)
+
+
+def record_ingested(rows: Iterable[Dict[str, Any]]) -> None:
+    """Ingest hook: count inserted responses (as returned by the insert, with ids) if the cube is live."""
+    if cube.loaded:
+        cube.add_rows(rows)
+
+
+def _round(value: float, digits: int) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.get("")
+async def get_segments(
+    group_by: str = "",
+    survey: Optional[List[str]] = Query(None),
+    title: Optional[List[str]] = Query(None),
+    gender: Optional[List[str]] = Query(None),
+    age_range: Optional[List[str]] = Query(None),
+    years_employed: Optional[List[str]] = Query(None),
+    start_month: Optional[date] = None,
+    end_month: Optional[date] = None,
+    min_responses: int = 0,
+):
+    """
+    NPS per segment. group_by is a comma-separated list of dimensions
+    (survey_name, title_text, gender, age_range, years_employed, month);
+    filters accept repeated values.
+    """
+    dims = [d.strip() for d in group_by.split(",") if d.strip()]
+    unknown = [d for d in dims if d not in DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown dimensions: {unknown}")
+    filters = {
+        dim: vals
+        for dim, vals in (
+            ("survey_name", survey),
+            ("title_text", title),
+            ("gender", gender),
+            ("age_range", age_range),
+            ("years_employed", years_employed),
+        )
+        if vals
+    }
+    try:
+        labels, hist = (await loaded_cube()).query(
+            dims,
+            filters,
+            start_month.replace(day=1).isoformat() if start_month else None,
+            end_month.replace(day=1).isoformat() if end_month else None,
+        )
+        s = summarize(hist)
+        out = []
+        for i in np.nonzero(s["n"] >= max(min_responses, 1))[0]:
+            row: Dict[str, Any] = dict(zip(dims, labels[i]))
+            row.update({
+                "responses": int(s["n"][i]),
+                "promoters": int(s["promoters"][i]),
+                "passives": int(s["passives"][i]),
+                "detractors": int(s["detractors"][i]),
+                "average_score": _round(s["avg_score"][i], 2),
+                "nps_score": _round(s["nps"][i], 1),
+                "nps_ci_low": _round(s["ci_low"][i], 1),
+                "nps_ci_high": _round(s["ci_high"][i], 1),
+                "score_histogram": [int(x) for x in hist[i]],
+            })
+            out.append(row)
+        out.sort(key=lambda r: -r["responses"])
+        return out
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error slicing segments: {str(e)}")
+
+
+@router.get("/dimensions")
+async def get_segment_dimensions():
+    """Distinct values per dimension, for building filters"""
+    try:
+        c = await loaded_cube()
+        return {d: sorted(c.values[d]) for d in DIMENSIONS}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error listing dimensions: {str(e)}")
+
+
+@router.post("/reload")
+async def reload_segments():
+    """Drop the in-memory cube and rebuild it from nps_response"""
+    try:
+        cube.reset()
+        c = await loaded_cube()
+        return {"cells": c.size, "dimensions": {d: len(c.values[d]) for d in DIMENSIONS}}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reloading segments: {str(e)}")
@@ -0,0 +1,484 @@
+"""
+Local Dutch sentiment scorer
+A fast path next to the LLM: a linear model over folded, stemmed Dutch tokens
+with negation scope ("niet goed" flips "goed"), intensifiers ("erg duur") and
+"maar" contrast (the clause after "maar" carries the weight). Scores are in
+[-1, 1] like nps_ai_enrichment.sentiment_score.
+
+Out of the box the weights are a hand-written lexicon. `train` refits them
+as ridge regression on our own labeled enrichment rows, with the lexicon as
+prior, and the result is saved to SENTIMENT_MODEL and picked up on the next
+start. Batches are scored with one bincount over (comment, feature) pairs.
+
+Run from backend/:
+    python -m app.sentiment                      # agreement with existing LLM labels
+    python -m app.sentiment --train              # fit on labeled rows, save the model
+    python -m app.sentiment --rescore --dry-run  # score rows the LLM left without sentiment
+    python -m app.sentiment --rescore --all      # ... and overwrite the LLM's scores too
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from app import response_cache
+from app.db import iter_pages, service_client
+from app.search import fold, stem
+
+router = APIRouter(prefix="/sentiment", tags=["sentiment"])
+
+SENTIMENT_MODEL = os.getenv("SENTIMENT_MODEL", os.path.join(os.getcwd(), "sentiment_model.npz"))
+# |score| above this is positive/negative, matching the labels written by enrich.process_batch
+LABEL_THRESHOLD = 0.1
+LABELS = ("negative", "neutral", "positive")
+# Negated words get this fraction of their weight, with the sign flipped
+NEGATION_FACTOR = 0.6
+NEGATION_SCOPE = 3
+# Weight of words before a "maar"
+BEFORE_MAAR = 0.5
+# Ridge strength pulling trained weights towards the lexicon, and minimum comments per feature
+RIDGE = 5.0
+MIN_DF = 3
+# nps_ai_enrichment.sentiment_source (sql/020): who produced the score; only 'llm' rows are labels
+SOURCE_LLM = "llm"
+SOURCE_LOCAL = "local"
+# Response ids per UPDATE / lookup
+UPDATE_CHUNK = 200
+
+LEXICON: Dict[str, float] = {
+    # positive
+    "goed": 1.0, "prima": 0.8, "uitstekend": 1.5, "geweldig": 1.5, "top": 1.2, "tevreden": 1.0,
+    "blij": 1.0, "fijn": 0.9, "prettig": 0.8, "leuk": 0.8, "mooi": 0.8, "handig": 0.6, "snel": 0.5,
+    "vriendelijk": 0.9, "behulpzaam": 0.9, "betrouwbaar": 0.8, "duidelijk": 0.5, "interessant": 0.8,
+    "informatief": 0.7, "compleet": 0.5, "fantastisch": 1.5, "perfect": 1.4, "super": 1.2,
+    "heerlijk": 1.2, "aanrader": 1.3, "aanbevelen": 0.6, "genieten": 1.0, "gevarieerd": 0.6,
+    "degelijk": 0.6, "lekker": 0.7, "correct": 0.5, "makkelijk": 0.6, "gemakkelijk": 0.6,
+    "waardevol": 0.8, "uitgebreid": 0.5, "tof": 1.0, "bedankt": 0.6, "prachtig": 1.3,
+    "onafhankelijk": 0.5, "objectief": 0.6, "kwaliteit": 0.4, "plezier": 0.9, "graag": 0.6,
+    # negative
+    "slecht": -1.2, "slechter": -1.1, "matig": -0.7, "teleurgesteld": -1.2, "teleurstellend": -1.2,
+    "ontevreden": -1.2, "duur": -0.8, "duurder": -0.8, "prijzig": -0.7, "laat": -0.4, "traag": -0.7,
+    "probleem": -0.7, "problemen": -0.7, "storing": -0.8, "fout": -0.7, "fouten": -0.7,
+    "klacht": -0.8, "klachten": -0.8, "irritant": -1.0, "vervelend": -0.9, "jammer": -0.6,
+    "helaas": -0.6, "waardeloos": -1.5, "belachelijk": -1.3, "slordig": -0.8, "rommel": -1.0,
+    "onzin": -1.0, "saai": -0.8, "achteruit": -0.8, "verslechterd": -1.0, "opzeggen": -0.8,
+    "opgezegd": -0.6, "reclame": -0.4, "eenzijdig": -0.7, "onduidelijk": -0.6, "moeilijk": -0.5,
+    "lastig": -0.5, "onvriendelijk": -1.0, "ergernis": -1.0, "ergerlijk": -1.0, "verschrikkelijk": -1.5,
+    "vreselijk": -1.4, "onbetrouwbaar": -1.0, "oppervlakkig": -0.7, "weinig": -0.4, "minder": -0.4,
+    "gemist": -0.5, "kwijt": -0.4, "nergens": -0.5, "negatief": -0.8, "gekleurd": -0.6,
+}
+NEGATORS = frozenset(("niet", "geen", "nooit", "niks", "niets", "nauwelijks", "zonder"))
+INTENSIFIERS: Dict[str, float] = {
+    "zeer": 1.5, "erg": 1.5, "heel": 1.4, "echt": 1.3, "ontzettend": 1.6, "enorm": 1.5,
+    "hartstikke": 1.6, "te": 1.3, "veel": 1.2, "best": 1.1, "extreem": 1.6,
+}
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+@lru_cache(maxsize=1 << 17)
+def _stem(word: str) -> str:
+    return stem(word)
+
+
+def label(score: Optional[float]) -> str:
+    if score is None or abs(score) <= LABEL_THRESHOLD:
+        return "neutral"
+    return "positive" if score > 0 else "negative"
+
+
+def label_from_llm(row: Dict[str, Any]) -> Optional[str]:
+    """Sentiment label of an enrichment row, whichever pipeline wrote it."""
+    if row.get("sentiment_label") in LABELS:
+        return row["sentiment_label"]
+    if row.get("sentiment_score") is not None:
+        return label(float(row["sentiment_score"]))
+    s = row.get("sentiment")
+    return {"promoter": "positive", "detractor": "negative", "passive": "neutral", "neutral": "neutral",
+            "positive": "positive", "negative": "negative"}.get(str(s).lower()) if s else None
+
+
+def tokens(text: Optional[str]) -> List[Tuple[str, float, bool]]:
+    """(stem, multiplier, negated) per content token of a comment."""
+    if not text:
+        return []
+    words = _TOKEN.findall(fold(text))
+    out: List[Tuple[str, float, bool]] = []
+    negate = 0
+    boost = 1.0
+    for w in words:
+        if w in NEGATORS:
+            negate = NEGATION_SCOPE
+            continue
+        if w in INTENSIFIERS:
+            boost = INTENSIFIERS[w]
+            continue
+        if w == "maar":
+            out = [(t, m * BEFORE_MAAR, n) for t, m, n in out]
+            negate = 0
+            continue
+        out.append((_stem(w), boost, negate > 0))
+        boost = 1.0
+        if negate:
+            negate -= 1
+    return out
+
+
+class SentimentModel:
+    """
+    score = tanh(scale * (bias + sum_t w[feature_t] * multiplier_t / sqrt(n_tokens)))
+
+    Features are stems and their negated variants: stem i maps to feature i,
+    "niet <stem i>" to feature V + i.
+    """
+
+    def __init__(self, vocab: Dict[str, int], weights: np.ndarray, bias: float = 0.0, scale: float = 1.2) -> None:
+        self.vocab = vocab
+        self.weights = weights
+        self.bias = bias
+        self.scale = scale
+
+    @classmethod
+    def from_lexicon(cls) -> "SentimentModel":
+        vocab: Dict[str, int] = {}
+        base: List[float] = []
+        for word, w in LEXICON.items():
+            s = _stem(word)
+            if s not in vocab:
+                vocab[s] = len(base)
+                base.append(w)
+        w = np.asarray(base, dtype=np.float64)
+        return cls(vocab, np.concatenate([w, -NEGATION_FACTOR * w]))
+
+    # -------------------------------------------------------------------------
+    # Features
+    # -------------------------------------------------------------------------
+    def encode(
+        self, texts: Sequence[Optional[str]], vocab: Optional[Dict[str, int]] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(doc, feature, value) triplets of the sparse design matrix."""
+        vocab = self.vocab if vocab is None else vocab
+        V = len(vocab)
+        docs: List[int] = []
+        feats: List[int] = []
+        vals: List[float] = []
+        for d, text in enumerate(texts):
+            toks = tokens(text)
+            if not toks:
+                continue
+            norm = len(toks) ** -0.5
+            for t, mult, neg in toks:
+                f = vocab.get(t)
+                if f is not None:
+                    docs.append(d)
+                    feats.append(f + V if neg else f)
+                    vals.append(mult * norm)
+        return (
+            np.asarray(docs, dtype=np.int64),
+            np.asarray(feats, dtype=np.int64),
+            np.asarray(vals, dtype=np.float64),
+        )
+
+    def raw(self, texts: Sequence[Optional[str]]) -> np.ndarray:
+        docs, feats, vals = self.encode(texts)
+        return self.bias + np.bincount(docs, weights=self.weights[feats] * vals, minlength=len(texts))
+
+    def score(self, texts: Sequence[Optional[str]]) -> np.ndarray:
+        """Sentiment in [-1, 1] per comment."""
+        return np.tanh(self.scale * self.raw(texts))
+
+    # -------------------------------------------------------------------------
+    # Persistence
+    # -------------------------------------------------------------------------
+    def save(self, path: str = SENTIMENT_MODEL) -> None:
+        terms = sorted(self.vocab, key=self.vocab.get)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            np.savez(fh, terms=np.array(terms, dtype="S"), weights=self.weights,
+                     bias=np.array(self.bias), scale=np.array(self.scale))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str = SENTIMENT_MODEL) -> "SentimentModel":
+        with np.load(path) as z:
+            terms = z["terms"].astype(str).tolist()
+            return cls({t: i for i, t in enumerate(terms)}, z["weights"], float(z["bias"]), float(z["scale"]))
+
+
+_model: Optional[SentimentModel] = None
+_model_lock = threading.Lock()
+
+
+def model() -> SentimentModel:
+    """Trained model from SENTIMENT_MODEL if present, otherwise the lexicon."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                if os.path.exists(SENTIMENT_MODEL):
+                    _model = SentimentModel.load(SENTIMENT_MODEL)
+                    logging.info(f"Sentiment model loaded from {SENTIMENT_MODEL} ({len(_model.vocab)} terms)")
+                else:
+                    _model = SentimentModel.from_lexicon()
+    return _model
+
+
+def score(texts: Sequence[Optional[str]]) -> np.ndarray:
+    return model().score(texts)
+
+
+# -----------------------------------------------------------------------------
+# Training and evaluation
+# -----------------------------------------------------------------------------
+@dataclass
+class Labeled:
+    response_ids: List[str] = field(default_factory=list)
+    texts: List[str] = field(default_factory=list)
+    # LLM sentiment in [-1, 1] (label mapped to -1/0/1 when only a label exists)
+    targets: List[float] = field(default_factory=list)
+    labels: List[str] = field(default_factory=list)
+    nps: List[float] = field(default_factory=list)
+
+    def subset(self, mask: np.ndarray) -> "Labeled":
+        keep = np.nonzero(mask)[0]
+        return Labeled(*[[col[i] for i in keep] for col in (self.response_ids, self.texts, self.targets, self.labels, self.nps)])
+
+
+def load_labeled(client: Any) -> Labeled:
+    """
+    Enrichment rows with an LLM sentiment, joined to their comment and NPS
+    score. Locally scored rows are skipped, so the model is never trained or
+    evaluated on its own output.
+    """
+    by_response: Dict[str, Tuple[float, str]] = {}
+    for page in iter_pages(client, "nps_ai_enrichment", "*", key="response_id"):
+        for r in page:
+            if r.get("sentiment_source") == SOURCE_LOCAL:
+                continue
+            lab = label_from_llm(r)
+            if lab is None or not r.get("response_id"):
+                continue
+            s = r.get("sentiment_score")
+            target = float(s) if s is not None else {"negative": -1.0, "neutral": 0.0, "positive": 1.0}[lab]
+            by_response[r["response_id"]] = (target, lab)
+
+    out = Labeled()
+    ids = list(by_response)
+    for i in range(0, len(ids), 200):
+        res = client.table("nps_response").select("id, nps_explanation, nps_score").in_("id", ids[i : i + 200]).execute()
+        for r in res.data or []:
+            if not (r.get("nps_explanation") or "").strip():
+                continue
+            target, lab = by_response[r["id"]]
+            out.response_ids.append(r["id"])
+            out.texts.append(r["nps_explanation"])
+            out.targets.append(target)
+            out.labels.append(lab)
+            out.nps.append(float(r["nps_score"]) if r.get("nps_score") is not None else np.nan)
+    return out
+
+
+def holdout_mask(response_ids: Sequence[str], share: float = 0.2) -> np.ndarray:
+    """Deterministic evaluation split by response id."""
+    return np.array([zlib.crc32(rid.encode()) % 1000 < share * 1000 for rid in response_ids], dtype=bool)
+
+
+def train(data: Labeled, prior: Optional[SentimentModel] = None, ridge: float = RIDGE, iters: int = 200) -> SentimentModel:
+    """
+    Ridge regression of atanh(target) on the token features, shrunk towards
+    the prior (lexicon) weights, solved with conjugate gradients on the
+    sparse normal equations.
+    """
+    prior = prior or SentimentModel.from_lexicon()
+    counts: Dict[str, int] = {}
+    for text in data.texts:
+        for t in {t for t, _, _ in tokens(text)}:
+            counts[t] = counts.get(t, 0) + 1
+    vocab = dict(prior.vocab)
+    for t, c in counts.items():
+        if c >= MIN_DF and t not in vocab:
+            vocab[t] = len(vocab)
+    V = len(vocab)
+    # Prior weights laid out on the new vocabulary (+ bias as the last feature)
+    w0 = np.zeros(2 * V + 1)
+    pv = len(prior.vocab)
+    for t, i in prior.vocab.items():
+        w0[vocab[t]] = prior.weights[i]
+        w0[V + vocab[t]] = prior.weights[pv + i]
+
+    docs, feats, vals = prior.encode(data.texts, vocab)
+    n = len(data.texts)
+    docs = np.concatenate([docs, np.arange(n)])
+    feats = np.concatenate([feats, np.full(n, 2 * V)])
+    vals = np.concatenate([vals, np.ones(n)])
+    D = 2 * V + 1
+
+    def matvec(w: np.ndarray) -> np.ndarray:
+        return np.bincount(docs, weights=w[feats] * vals, minlength=n)
+
+    def rmatvec(r: np.ndarray) -> np.ndarray:
+        return np.bincount(feats, weights=r[docs] * vals, minlength=D)
+
+    y = np.arctanh(np.clip(np.asarray(data.targets, dtype=np.float64), -0.95, 0.95)) / prior.scale
+    # Solve (X'X + ridge I) d = X'(y - X w0) for d = w - w0
+    b = rmatvec(y - matvec(w0))
+    d = np.zeros(D)
+    r = b.copy()
+    p = r.copy()
+    rs = r @ r
+    for _ in range(iters):
+        Ap = rmatvec(matvec(p)) + ridge * p
+        alpha = rs / (p @ Ap)
+        d += alpha * p
+        r -= alpha * Ap
+        rs_new = r @ r
+        if rs_new < 1e-10 * max(b @ b, 1e-12):
+            break
+        p = r + (rs_new / rs) * p
+        rs = rs_new
+    w = w0 + d
+    return SentimentModel(vocab, w[:-1], float(w[-1]), prior.scale)
+
+
+def agreement(scores: np.ndarray, data: Labeled) -> Dict[str, Any]:
+    """Label agreement, confusion matrix and correlations against the LLM labels and NPS."""
+    predicted = [label(s) for s in scores]
+    idx = {l: i for i, l in enumerate(LABELS)}
+    confusion = np.zeros((3, 3), dtype=np.int64)
+    for p, t in zip(predicted, data.labels):
+        confusion[idx[t], idx[p]] += 1
+    targets = np.asarray(data.targets, dtype=np.float64)
+    nps = np.asarray(data.nps, dtype=np.float64)
+    has_nps = ~np.isnan(nps)
+
+    def corr(a: np.ndarray, b: np.ndarray) -> Optional[float]:
+        if len(a) < 2 or a.std() == 0 or b.std() == 0:
+            return None
+        return round(float(np.corrcoef(a, b)[0, 1]), 3)
+
+    n = len(predicted)
+    return {
+        "comments": n,
+        "label_agreement": round(float(np.trace(confusion) / n), 3) if n else None,
+        "confusion": {t: dict(zip(LABELS, confusion[i].tolist())) for i, t in enumerate(LABELS)},
+        "corr_llm_score": corr(scores, targets),
+        "corr_nps": corr(scores[has_nps], nps[has_nps]),
+    }
+
+
+def rescore(client: Any, dry_run: bool = False, only_missing: bool = True) -> Dict[str, Any]:
+    """
+    Write local sentiment onto existing enrichment rows instead of asking the
+    LLM, marked sentiment_source 'local'. By default only rows without a score
+    are filled in; only_missing=False overwrites the LLM's scores as well.
+    Rows are UPDATEd per distinct (score, label), so the NOT NULL columns of
+    the enrichment row never come into play.
+    """
+    from app.theme_aggregates import refresh_for_responses
+
+    rows = [r for page in iter_pages(client, "nps_ai_enrichment", "response_id, sentiment_score", key="response_id") for r in page]
+    if only_missing:
+        rows = [r for r in rows if r.get("sentiment_score") is None]
+    comments: Dict[str, str] = {}
+    ids = [r["response_id"] for r in rows if r.get("response_id")]
+    for i in range(0, len(ids), UPDATE_CHUNK):
+        res = client.table("nps_response").select("id, nps_explanation").in_("id", ids[i : i + UPDATE_CHUNK]).execute()
+        comments.update({r["id"]: r.get("nps_explanation") or "" for r in res.data or []})
+    ids = [rid for rid in ids if comments.get(rid, "").strip()]
+    scores = score([comments[rid] for rid in ids])
+    result: Dict[str, Any] = {"rows": len(ids), "written": 0, "failed": []}
+    if dry_run:
+        return result
+
+    groups: Dict[float, List[str]] = {}
+    for rid, s in zip(ids, scores):
+        groups.setdefault(round(float(s), 2), []).append(rid)
+    updated: List[str] = []
+    for s, group in groups.items():
+        for i in range(0, len(group), UPDATE_CHUNK):
+            chunk = group[i : i + UPDATE_CHUNK]
+            try:
+                client.table("nps_ai_enrichment").update(
+                    {"sentiment_score": s, "sentiment_label": label(s), "sentiment_source": SOURCE_LOCAL}
+                ).in_("response_id", chunk).execute()
+            except Exception as e:
+                logging.error(f"Sentiment update failed for {len(chunk)} rows: {e}")
+                result["failed"].extend((rid, str(e)) for rid in chunk)
+                continue
+            updated.extend(chunk)
+    result["written"] = len(updated)
+    if updated:
+        refresh_for_responses(client, updated)
+        response_cache.invalidate_enrichment()
+    return result
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+class ScoreRequest(BaseModel):
+    texts: List[str]
+
+
+@router.post("/score")
+async def score_texts(request: ScoreRequest):
+    """Local sentiment for a batch of comments (no LLM call)"""
+    try:
+        scores = score(request.texts)
+        return [{"sentiment_score": round(float(s), 3), "sentiment_label": label(float(s))} for s in scores]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error scoring sentiment: {str(e)}")
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Local Dutch sentiment: evaluate, train or re-score")
+    parser.add_argument("--train", action="store_true", help="fit on labeled enrichment rows and save to SENTIMENT_MODEL")
+    parser.add_argument("--rescore", action="store_true", help="write local sentiment onto enrichment rows")
+    parser.add_argument("--all", action="store_true", help="with --rescore, also overwrite existing (LLM) sentiment scores")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--ridge", type=float, default=RIDGE)
+    args = parser.parse_args()
+
+    client = service_client()
+    if args.rescore:
+        r = rescore(client, args.dry_run, only_missing=not args.all)
+        written = r["written"]
+        print(f"Rows: {r['rows']}{' (dry run)' if args.dry_run else f', written: {written}'}")
+        for response_id, err in r["failed"]:
+            print(f"Update failed for {response_id}: {err}")
+        return
+
+    data = load_labeled(client)
+    print(f"Labeled comments: {len(data.texts)}")
+    held = holdout_mask(data.response_ids)
+    lexicon = SentimentModel.from_lexicon()
+    test = data.subset(held)
+    print("Lexicon on holdout:", json.dumps(agreement(lexicon.score(test.texts), test)))
+    if args.train:
+        fit = data.subset(~held)
+        trained = train(fit, lexicon, args.ridge)
+        print("Trained on holdout:", json.dumps(agreement(trained.score(test.texts), test)))
+        if not args.dry_run:
+            train(data, lexicon, args.ridge).save(SENTIMENT_MODEL)
+            print(f"Saved {SENTIMENT_MODEL}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Vectorized NPS statistics
+Standard errors, confidence intervals and significance tests for NPS and NPS
+deltas, computed for every title/theme/segment in one NumPy pass.
+
+All functions take arrays of promoter/passive/detractor counts of any (equal)
+shape and return arrays of that shape. NPS is on the -100..100 scale.
+"""
+
+from __future__ import annotations
+
+from statistics import NormalDist
+from typing import Dict
+
+import numpy as np
+
+Z_95 = 1.959964
+
+
+def _z_for(alpha: float) -> float:
+    """Two-sided critical value of the standard normal for significance level alpha."""
+    if not 0.0 < alpha < 1.0:
+        raise ValueError(f"alpha must be in (0, 1), got {alpha}")
+    return NormalDist().inv_cdf(1.0 - alpha / 2.0)
+
+
+def erfc(x: np.ndarray) -> np.ndarray:
+    """Complementary error function (Abramowitz & Stegun 7.1.26, |err| < 1.5e-7)."""
+    x = np.asarray(x, dtype=np.float64)
+    z = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    r = poly * np.exp(-z * z)
+    return np.where(x >= 0, r, 2.0 - r)
+
+
+def two_sided_p(z: np.ndarray) -> np.ndarray:
+    """Two-sided p-value for standard normal z scores."""
+    return erfc(np.abs(z) / np.sqrt(2.0))
+
+
+def nps_with_se(promoters: np.ndarray, passives: np.ndarray, detractors: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    NPS and its standard error per segment.
+
+    Var(NPS) = (p + d - (p - d)^2) / n for promoter share p and detractor
+    share d; empty segments yield NaN.
+    """
+    pr = np.asarray(promoters, dtype=np.float64)
+    de = np.asarray(detractors, dtype=np.float64)
+    n = pr + np.asarray(passives, dtype=np.float64) + de
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = pr / n
+        d = de / n
+        nps = 100.0 * (p - d)
+        se = 100.0 * np.sqrt((p + d - (p - d) ** 2) / n)
+    empty = n == 0
+    nps = np.where(empty, np.nan, nps)
+    se = np.where(empty, np.nan, se)
+    return {"n": n, "nps": nps, "se": se}
+
+
+def nps_interval(
+    promoters: np.ndarray,
+    passives: np.ndarray,
+    detractors: np.ndarray,
+    alpha: float = 0.05,
+) -> Dict[str, np.ndarray]:
+    """NPS with analytic (1 - alpha) confidence bounds, clipped to [-100, 100]."""
+    s = nps_with_se(promoters, passives, detractors)
+    z = _z_for(alpha)
+    s["ci_low"] = np.clip(s["nps"] - z * s["se"], -100.0, 100.0)
+    s["ci_high"] = np.clip(s["nps"] + z * s["se"], -100.0, 100.0)
+    return s
+
+
+def delta_significance(
+    current: Dict[str, np.ndarray],
+    previous: Dict[str, np.ndarray],
+    alpha: float = 0.05,
+) -> Dict[str, np.ndarray]:
+    """
+    Compare two independent NPS estimates (outputs of nps_with_se).
+
+    Returns delta, its standard error, CI bounds, z score, two-sided p-value
+    and a significance flag at level alpha.
+    """
+    z_crit = _z_for(alpha)
+    delta = current["nps"] - previous["nps"]
+    se = np.sqrt(current["se"] ** 2 + previous["se"] ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = delta / se
+        # A zero SE (e.g. 100% promoters both months) gives an infinite/undefined z
+        z = np.where(se > 0, z, np.where(delta == 0, 0.0, np.sign(delta) * np.inf))
+    p = two_sided_p(z)
+    return {
+        "delta": delta,
+        "se": se,
+        "ci_low": delta - z_crit * se,
+        "ci_high": delta + z_crit * se,
+        "z": z,
+        "p_value": p,
+        "significant": p < alpha,
+    }
+
+
+def benjamini_hochberg(p_values: np.ndarray, alpha: float = 0.05) -> np.ndarray:
+    """
+    False-discovery-rate control across many segments tested at once.
+    Returns a boolean mask of discoveries; NaN p-values are never significant.
+    """
+    p = np.asarray(p_values, dtype=np.float64).ravel()
+    valid = ~np.isnan(p)
+    out = np.zeros(p.shape, dtype=bool)
+    m = int(valid.sum())
+    if m:
+        idx = np.nonzero(valid)[0]
+        order = idx[np.argsort(p[idx])]
+        passed = p[order] <= alpha * np.arange(1, m + 1) / m
+        if passed.any():
+            out[order[: np.nonzero(passed)[0].max() + 1]] = True
+    return out.reshape(np.shape(p_values))
@@ -0,0 +1,528 @@
+"""
+Survey-analysis processing engine
+Processes survey_analyses (sql/009, sql/010) in per-question chunks on a worker
+pool. Each finished chunk is checkpointed to survey_responses.ai_analysis, so a
+crashed or timed-out run resumes where it stopped instead of sitting in
+'processing' until sql/015_reset_stuck_surveys.sql is run by hand.
+
+Resume command (run from backend/):
+    python -m app.survey_processing resume
+    python -m app.survey_processing process <survey_id>
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException
+
+from app import clients
+from app.batch_writer import BatchUpserter
+from app.db import iter_pages, service_client
+from app.metrics import ENRICH_QUEUE, OPENAI_RETRIES, openai_call, span
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+router = APIRouter(prefix="/survey-analysis", tags=["survey-analysis"])
+
+MODEL = os.getenv("SURVEY_ANALYSIS_MODEL", "gpt-4o-mini")
+CHUNK_SIZE = int(os.getenv("SURVEY_CHUNK_SIZE", "25"))
+WORKERS = int(os.getenv("SURVEY_WORKERS", "4"))
+MAX_RETRIES = 3
+# A 'processing' survey not updated for this long is considered crashed
+STALE_MINUTES = int(os.getenv("SURVEY_STALE_MINUTES", "10"))
+RESPONSE_COLUMNS = "id, survey_id, response_id, row_number, response_text, metadata, question_text, question_order, ai_analysis"
+
+THEME_RULES = """2. Main themes: Extract 2-3 meaningful themes that represent CONCRETE TOPICS, ISSUES, or CONCEPTS.
+   - GOOD themes: "product quality", "customer service", "pricing", "delivery issues", "user experience", "feature requests"
+   - BAD themes: "good", "bad", "like", "think", "would", "more", "better", "team", "work", "time", "help", "need", "want"
+   - Focus on WHAT is being discussed, not HOW it's described
+   - Avoid generic words, pronouns, or filler words
+   - Use descriptive noun phrases that capture the actual subject matter"""
+
+SENTIMENT_RULES = """1. Sentiment: Be decisive - if the response expresses satisfaction, praise, or positive emotions, classify as "positive". If it expresses dissatisfaction, complaints, or negative emotions, classify as "negative". Only use "neutral" for truly neutral statements."""
+
+# Surveys being processed by this worker process. Other processes are kept
+# out by claim_survey, which takes the survey in the database.
+_running: Dict[str, asyncio.Task] = {}
+
+
+class SurveyBusy(RuntimeError):
+    """Another worker holds a fresh 'processing' claim on the survey"""
+
+
+def system_prompt(question_text: Optional[str]) -> str:
+    """Same instructions as the original request-scoped handler."""
+    if question_text:
+        return f"""Analyze this survey response and extract meaningful insights:
+
+{SENTIMENT_RULES}
+
+{THEME_RULES}
+
+3. Question context: This response is for the question "{question_text}". Consider this context when analyzing themes.
+
+Return JSON format:
+{{
+  "sentiment": "positive|negative|neutral",
+  "sentiment_score": 0.8,
+  "themes": ["concrete_theme1", "concrete_theme2"],
+  "question_context": "{question_text}"
+}}"""
+    return f"""Analyze this survey response and extract meaningful insights:
+
+{SENTIMENT_RULES}
+
+{THEME_RULES}
+
+Return JSON format:
+{{
+  "sentiment": "positive|negative|neutral",
+  "sentiment_score": 0.8,
+  "themes": ["concrete_theme1", "concrete_theme2"]
+}}"""
+
+
+def clean_theme_name(theme: str) -> str:
+    name = re.sub(r"^(question_\d+_|response_text_)", "", str(theme)).replace("_", " ")
+    return re.sub(r"\b\w", lambda m: m.group(0).upper(), name).strip()
+
+
+# -----------------------------------------------------------------------------
+# Incremental aggregation
+# -----------------------------------------------------------------------------
+class ThemeAccumulator:
+    """Running theme/sentiment totals, fed one analysed response at a time."""
+
+    def __init__(self) -> None:
+        self.total = 0
+        self.failed = 0
+        self.sentiments: Dict[str, int] = defaultdict(int)
+        self.themes: Dict[str, Dict[str, Any]] = {}
+        self.questions: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, row: Dict[str, Any]) -> None:
+        analysis = row.get("ai_analysis") or {}
+        self.total += 1
+        if analysis.get("failed"):
+            self.failed += 1
+        label = analysis.get("sentiment") or "neutral"
+        score = float(analysis.get("sentiment_score") or 0)
+        self.sentiments[label] += 1
+
+        question = row.get("question_text") or "Unknown"
+        q = self.questions.setdefault(question, {"count": 0, "positive": 0, "themes": defaultdict(int)})
+        q["count"] += 1
+        q["positive"] += label == "positive"
+
+        for theme in dict.fromkeys(clean_theme_name(t) for t in analysis.get("themes") or []):
+            if not theme:
+                continue
+            t = self.themes.setdefault(theme, {
+                "count": 0, "negative": 0, "positive": 0, "sentiment_sum": 0.0, "samples": [],
+            })
+            t["count"] += 1
+            t["negative"] += label == "negative"
+            t["positive"] += label == "positive"
+            t["sentiment_sum"] += score
+            if len(t["samples"]) < 3 and row.get("response_text"):
+                t["samples"].append(row["response_text"])
+            q["themes"][theme] += 1
+
+    def theme_rows(self, survey_id: str) -> List[Dict[str, Any]]:
+        return [{
+            "survey_id": survey_id,
+            "theme_name": name,
+            "mention_count": t["count"],
+            "sentiment_score": round(t["sentiment_sum"] / t["count"], 2),
+            "sample_responses": t["samples"],
+        } for name, t in self.themes.items()]
+
+    def severity(self, t: Dict[str, Any]) -> float:
+        # Adaptive volume weight and sentiment impact, as in the original handler
+        n = self.total
+        volume = t["count"] ** 0.5 if n <= 30 else t["count"] ** 0.75 if n <= 200 else t["count"]
+        negative_share = t["negative"] / t["count"]
+        avg = t["sentiment_sum"] / t["count"]
+        impact = negative_share if negative_share > 0.5 else 1 - negative_share
+        return volume * (0.7 * impact + 0.3 * (1 + abs(0.5 - avg)))
+
+    def insight_rows(self, survey_id: str, is_multi_question: bool) -> List[Dict[str, Any]]:
+        def row(kind: str, title: str, description: str, themes: List[str], impact: float) -> Dict[str, Any]:
+            return {
+                "survey_id": survey_id,
+                "insight_type": kind,
+                "title": title,
+                "description": description,
+                "priority": round(impact * 10),
+                "supporting_data": {"related_themes": themes, "impact_score": impact},
+            }
+
+        out: List[Dict[str, Any]] = []
+        positive = self.sentiments.get("positive", 0)
+        negative = self.sentiments.get("negative", 0)
+
+        if is_multi_question:
+            for question, q in self.questions.items():
+                top = [t for t, _ in sorted(q["themes"].items(), key=lambda kv: -kv[1])[:3]]
+                if not top:
+                    continue
+                rate = round(q["positive"] * 100 / q["count"])
+                verdict = (
+                    "Overall positive feedback" if rate >= 70
+                    else "Significant concerns identified" if rate <= 30
+                    else "Mixed feedback with both positive and negative aspects"
+                )
+                out.append(row(
+                    "summary",
+                    f"Question Analysis: {question}",
+                    f"**Question:** {question}\n\n**Response Summary:** {q['count']} responses ({rate}% positive sentiment)"
+                    f"\n\n**Key Themes:** {', '.join(top)}\n\n**Analysis:** {verdict}",
+                    top,
+                    0.7,
+                ))
+            out.append(row(
+                "summary",
+                "Overall Survey Analysis",
+                f"**Multi-Question Survey Analysis**\n\n**Total Responses:** {self.total} across {len(self.questions)} questions"
+                f"\n**Sentiment:** {positive} positive, {negative} negative\n\n**Cross-Question Themes:** {', '.join(list(self.themes)[:5])}",
+                list(self.themes),
+                0.8,
+            ))
+
+        if self.total:
+            out.append(row(
+                "summary",
+                "Customer Satisfaction Overview",
+                f"{round(positive * 100 / self.total)}% of customers are satisfied ({positive}/{self.total} positive responses). "
+                f"{negative} customers reported issues that need attention.",
+                [],
+                0.8,
+            ))
+
+        ranked = sorted(self.themes.items(), key=lambda kv: -self.severity(kv[1]))
+        for name, t in ranked[:5]:
+            negative_share = t["negative"] / t["count"]
+            why = (
+                f"High negative share ({round(negative_share * 100)}%) despite {t['count']} mentions."
+                if negative_share > 0.5
+                else f"Moderate volume ({t['count']} mentions) with {round(negative_share * 100)}% negative sentiment."
+            )
+            evidence = "\n".join(f'{i + 1}. "{s[:150]}..."' for i, s in enumerate(t["samples"]))
+            out.append(row(
+                "theme",
+                f"{name[:1].upper() + name[1:]} Analysis",
+                f"**Metrics:** {t['count']} mentions, {round(negative_share * 100)}% negative, "
+                f"{round(t['sentiment_sum'] / t['count'] * 100)}% sentiment\n\n**Evidence:**\n{evidence}\n\n**Why it matters:** {why}",
+                [name],
+                min(self.severity(t) / 10, 1.0),
+            ))
+
+        if ranked:
+            plan = f"**Based on {self.total} customer responses, focus on these themes first:**\n\n"
+            for i, (name, t) in enumerate(ranked[:3], start=1):
+                plan += (
+                    f"**{i}. {name}**\n• Mentioned by {t['count']} customers ({t['positive']} positive, {t['negative']} negative)\n"
+                    f"• Severity score: {self.severity(t):.2f} ({round(t['negative'] * 100 / t['count'])}% negative)\n\n"
+                )
+            out.append(row("recommendation", "Team Action Plan", plan, [n for n, _ in ranked[:3]], 0.9))
+        return out
+
+
+# -----------------------------------------------------------------------------
+# Engine
+# -----------------------------------------------------------------------------
+async def analyze_response(row: Dict[str, Any], is_multi_question: bool) -> Dict[str, Any]:
+    """LLM analysis of one response, with retries; failures become a marked neutral result."""
+    prompt = system_prompt(row.get("question_text") if is_multi_question else None)
+    last_error = ""
+    for attempt in range(MAX_RETRIES):
+        try:
+            with openai_call(MODEL) as call:
+                completion = await clients.openai_async().chat.completions.create(
+                    model=MODEL,
+                    messages=[
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": row["response_text"]},
+                    ],
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                )
+                call.usage(completion)
+            analysis = json.loads(completion.choices[0].message.content or "{}")
+            if not analysis.get("sentiment") or not isinstance(analysis.get("themes"), list):
+                raise ValueError("Invalid AI analysis structure")
+            return analysis
+        except Exception as e:
+            last_error = str(e)
+            if attempt + 1 < MAX_RETRIES:
+                OPENAI_RETRIES.inc(model=MODEL)
+            await asyncio.sleep(2 ** attempt)
+    logging.error(f"Survey response {row.get('id')} failed after {MAX_RETRIES} attempts: {last_error}")
+    return {"sentiment": "neutral", "sentiment_score": 0, "themes": [], "failed": True, "error": last_error}
+
+
+def plan_chunks(rows: List[Dict[str, Any]], size: int = CHUNK_SIZE) -> List[List[Dict[str, Any]]]:
+    """Split pending rows per question, then into fixed-size chunks."""
+    by_question: Dict[Tuple[int, str], List[Dict[str, Any]]] = defaultdict(list)
+    for r in rows:
+        by_question[(r.get("question_order") or 0, r.get("question_text") or "")].append(r)
+    chunks: List[List[Dict[str, Any]]] = []
+    for key in sorted(by_question):
+        group = sorted(by_question[key], key=lambda r: r.get("row_number") or 0)
+        chunks.extend(group[i : i + size] for i in range(0, len(group), size))
+    return chunks
+
+
+def set_progress(sb: Client, survey_id: str, processed: int, total: int, **extra: Any) -> None:
+    sb.table("survey_analyses").update({
+        "analysis_results": {
+            "progress": {
+                "processed": processed,
+                "total": total,
+                "percentage": round(processed * 100 / total) if total else 100,
+            },
+            **extra,
+        },
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }).eq("id", survey_id).execute()
+
+
+def _utc_iso(dt: datetime) -> str:
+    # No '+' offset: the value goes inside a PostgREST or= filter
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def claim_survey(sb: Client, survey_id: str) -> bool:
+    """
+    Set the survey to 'processing' unless another run holds it.
+
+    Conditional UPDATE, so two API workers (or the CLI) racing on one survey
+    cannot both win: a 'processing' row updated within STALE_MINUTES belongs
+    to a live run; anything older is treated as crashed and taken over.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = _utc_iso(now - timedelta(minutes=STALE_MINUTES))
+    res = (
+        sb.table("survey_analyses")
+        .update({"status": "processing", "updated_at": now.isoformat()})
+        .eq("id", survey_id)
+        .or_(f"status.neq.processing,updated_at.lt.{cutoff}")
+        .execute()
+    )
+    return bool(res.data)
+
+
+def load_survey(sb: Client, survey_id: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Claim the survey and read its responses (blocking)"""
+    found = sb.table("survey_analyses").select("*").eq("id", survey_id).limit(1).execute().data
+    if not found:
+        raise LookupError(f"Survey {survey_id} not found")
+    if not claim_survey(sb, survey_id):
+        raise SurveyBusy(f"Survey {survey_id} is being processed by another worker")
+    rows = [
+        r
+        for page in iter_pages(sb, "survey_responses", RESPONSE_COLUMNS, where=lambda q: q.eq("survey_id", survey_id))
+        for r in page
+    ]
+    return found[0], rows
+
+
+def set_status(sb: Client, survey_id: str, status: str) -> None:
+    sb.table("survey_analyses").update({"status": status}).eq("id", survey_id).execute()
+
+
+def save_results(sb: Client, survey_id: str, acc: ThemeAccumulator, is_multi: bool, total: int) -> Tuple[int, int]:
+    """Replace theme and insight records (idempotent reruns) and write the final status"""
+    sb.table("survey_themes").delete().eq("survey_id", survey_id).execute()
+    sb.table("survey_insights").delete().eq("survey_id", survey_id).execute()
+    themes = acc.theme_rows(survey_id)
+    insights = acc.insight_rows(survey_id, is_multi)
+    if themes:
+        sb.table("survey_themes").insert(themes).execute()
+    if insights:
+        sb.table("survey_insights").insert(insights).execute()
+
+    complete = acc.total == total and not acc.failed
+    sb.table("survey_analyses").update({
+        "status": "completed" if complete else "failed",
+        "total_responses": total,
+        "analysis_results": {
+            "progress": {"processed": acc.total, "total": total, "percentage": round(acc.total * 100 / total) if total else 100},
+            "failed_responses": acc.failed,
+        },
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }).eq("id", survey_id).execute()
+    return len(themes), len(insights)
+
+
+async def process_survey(survey_id: str, sb: Optional[Client] = None) -> Dict[str, Any]:
+    """
+    Process (or resume) one survey.
+
+    Rows that already carry ai_analysis are checkpoints from an earlier run:
+    they are folded into the aggregates without calling the LLM again. Rows
+    whose analysis failed (retries exhausted) are pending again, and the
+    survey is only marked completed once no row failed. Database calls run
+    in worker threads so the event loop keeps serving requests.
+    """
+    sb = sb or service_client()
+    survey, rows = await asyncio.to_thread(load_survey, sb, survey_id)
+    is_multi = bool(survey.get("is_multi_question"))
+
+    acc = ThemeAccumulator()
+    pending = []
+    for r in rows:
+        if r.get("ai_analysis") and not r["ai_analysis"].get("failed"):
+            acc.add(r)
+        else:
+            pending.append(r)
+    total = len(rows)
+    logging.info(f"Survey {survey_id}: {total - len(pending)} checkpointed, {len(pending)} pending")
+    await asyncio.to_thread(set_progress, sb, survey_id, acc.total, total)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for chunk in plan_chunks(pending):
+        queue.put_nowait(chunk)
+    writer = BatchUpserter(sb, "survey_responses", on_conflict="id", max_rows=CHUNK_SIZE, max_age_secs=float("inf"))
+    lock = asyncio.Lock()
+
+    async def worker() -> None:
+        while True:
+            try:
+                chunk = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            with span("survey_analysis.chunk", survey_id=survey_id, size=len(chunk)):
+                results = await asyncio.gather(*(analyze_response(r, is_multi) for r in chunk))
+            async with lock:
+                for r, analysis in zip(chunk, results):
+                    r["ai_analysis"] = analysis
+                    writer.add(dict(r))
+                # Checkpoint: the chunk is durable before it counts as processed
+                await asyncio.to_thread(writer.flush)
+                failed_ids = {rid for rid, _ in writer.take_failures()}
+                for r in chunk:
+                    if r["id"] not in failed_ids:
+                        acc.add(r)
+                await asyncio.to_thread(set_progress, sb, survey_id, acc.total, total)
+                ENRICH_QUEUE.set(total - acc.total, source="survey_analysis")
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, WORKERS))))
+    except Exception as e:
+        logging.error(f"Survey {survey_id} processing aborted: {e}")
+        await asyncio.to_thread(set_status, sb, survey_id, "failed")
+        raise
+    finally:
+        writer.close()
+
+    themes, insights = await asyncio.to_thread(save_results, sb, survey_id, acc, is_multi, total)
+    return {"processed": acc.total, "total": total, "failed": acc.failed, "themes": themes, "insights": insights}
+
+
+def stuck_surveys(sb: Client) -> List[str]:
+    cutoff = (datetime.now(timezone.utc) - timedelta(minutes=STALE_MINUTES)).isoformat()
+    res = sb.table("survey_analyses").select("id").eq("status", "processing").lt("updated_at", cutoff).execute()
+    return [r["id"] for r in res.data or []]
+
+
+def _start(survey_id: str) -> bool:
+    """
+    Run a survey in this process unless it is already running here.
+
+    This check only covers the current process; a run that another worker
+    already holds is refused by claim_survey and logged when the task starts.
+    """
+    task = _running.get(survey_id)
+    if task and not task.done():
+        return False
+
+    async def run() -> None:
+        try:
+            await process_survey(survey_id)
+        except SurveyBusy as e:
+            logging.info(str(e))
+        except Exception as e:
+            logging.error(f"Survey {survey_id} failed: {e}")
+        finally:
+            _running.pop(survey_id, None)
+
+    _running[survey_id] = asyncio.get_running_loop().create_task(run())
+    return True
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.post("/{survey_id}/process")
+async def start_processing(survey_id: str):
+    """Start or resume processing in the background; poll /progress for status"""
+    try:
+        started = _start(survey_id)
+        return {"survey_id": survey_id, "started": started, "already_running": not started}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error starting survey processing: {str(e)}")
+
+
+@router.get("/{survey_id}/progress")
+async def get_processing_progress(survey_id: str):
+    try:
+        res = service_client().table("survey_analyses").select("id, status, analysis_results, updated_at").eq("id", survey_id).limit(1).execute()
+        if not res.data:
+            raise HTTPException(status_code=404, detail="Survey not found")
+        survey = res.data[0]
+        return {
+            "survey_id": survey_id,
+            "status": survey["status"],
+            "running_here": survey_id in _running,
+            "progress": (survey.get("analysis_results") or {}).get("progress"),
+            "updated_at": survey.get("updated_at"),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching progress: {str(e)}")
+
+
+@router.post("/resume")
+async def resume_stuck():
+    """Resume every survey left in 'processing' by a crashed or timed-out run"""
+    try:
+        ids = stuck_surveys(service_client())
+        return {"resumed": [sid for sid in ids if _start(sid)]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error resuming surveys: {str(e)}")
+
+
+async def _cli(args: argparse.Namespace) -> None:
+    sb = service_client()
+    ids = [args.survey_id] if args.command == "process" else stuck_surveys(sb)
+    for sid in ids:
+        logging.info(f"Survey {sid}: {await process_survey(sid, sb)}")
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Process survey analyses with checkpoints")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("resume", help="resume surveys stuck in 'processing'")
+    proc = sub.add_parser("process", help="process or resume one survey")
+    proc.add_argument("survey_id")
+    asyncio.run(_cli(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
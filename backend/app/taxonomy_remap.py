@@ -0,0 +1,404 @@
+"""
+Bulk taxonomy remap (see sql/019_theme_alias.sql)
+Maps the themes on existing nps_ai_enrichment rows onto the current taxonomy
+without re-enriching every comment:
+
+1. alias/slug lookup per distinct source theme (theme_alias table, --taxonomy file)
+2. nearest centroid per remaining source theme: the mean embedding of its rows
+   against the mean embedding of each target theme's rows
+3. nearest centroid per remaining row, using the row's own embedding
+4. rows that are still ambiguous go to the LLM (bounded by --max-llm)
+
+All steps are vectorized over the dictionary-encoded (row, theme) pairs; only
+rows whose themes change are written, as UPDATEs grouped by the new value
+(themes and primary_theme, which follows its source theme's mapping).
+
+Run from backend/:
+    python -m app.taxonomy_remap --dry-run
+    python -m app.taxonomy_remap --taxonomy taxonomy.json --save-aliases --max-llm 500
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app import clients, response_cache
+from app.db import iter_pages, service_client
+from app.metrics import openai_call
+from app.theme_aggregates import refresh_for_responses
+from app.theme_discovery import Projector, fetch_comments, normalize_rows, parse_vector
+
+MODEL = os.getenv("TAXONOMY_REMAP_MODEL", "gpt-4o-mini")
+# A source theme needs this many embedded rows before its centroid is trusted
+MIN_THEME_SUPPORT = 5
+THEME_MIN_SIMILARITY = 0.80
+ROW_MIN_SIMILARITY = 0.40
+# Required lead of the best target over the runner-up
+MIN_MARGIN = 0.05
+LLM_CONCURRENCY = 4
+# Response ids per UPDATE ... WHERE response_id IN (...) (URL length)
+UPDATE_CHUNK = 200
+
+
+def slugify(name: str) -> str:
+    s = re.sub(r"[^a-z0-9]+", "-", (name or "").lower().strip())
+    return re.sub(r"-+", "-", s).strip("-")
+
+
+@dataclass
+class RemapResult:
+    rows: int = 0
+    changed: int = 0
+    by_alias: int = 0
+    by_theme_centroid: int = 0
+    by_row_centroid: int = 0
+    by_llm: int = 0
+    unresolved: int = 0
+    learned_aliases: Dict[str, str] = field(default_factory=dict)
+    written: int = 0
+    failed: List[Tuple[Any, str]] = field(default_factory=list)
+
+
+# -----------------------------------------------------------------------------
+# Inputs
+# -----------------------------------------------------------------------------
+def load_taxonomy(client: Any, path: Optional[str] = None) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Target themes and alias slug -> theme. A taxonomy file is either a list of
+    theme names or {"theme": ["alias", ...]}; otherwise the themes table is used.
+    theme_alias rows are always added.
+    """
+    aliases: Dict[str, str] = {}
+    if path:
+        with open(path) as fh:
+            spec = json.load(fh)
+        if isinstance(spec, dict):
+            targets = list(spec)
+            for theme, names in spec.items():
+                for a in names or []:
+                    aliases[slugify(a)] = theme
+        else:
+            targets = list(spec)
+    else:
+        targets = [r["name"] for r in client.table("themes").select("name").order("name").execute().data or []]
+    try:
+        for r in client.table("theme_alias").select("alias, theme").execute().data or []:
+            if r["theme"] in targets:
+                aliases.setdefault(slugify(r["alias"]), r["theme"])
+    except Exception as e:
+        logging.warning(f"theme_alias not available: {e}")
+    for t in targets:
+        aliases[slugify(t)] = t
+    return targets, aliases
+
+
+def load_enrichments(
+    client: Any, projector: Projector
+) -> Tuple[List[str], List[List[str]], List[Optional[str]], np.ndarray, np.ndarray]:
+    """(response ids, theme lists, primary themes, projected unit embeddings, has-embedding mask)."""
+    ids: List[str] = []
+    themes: List[List[str]] = []
+    primary: List[Optional[str]] = []
+    blocks: List[np.ndarray] = []
+    has: List[bool] = []
+    columns = "response_id, themes, primary_theme, embedded_vector"
+    for page in iter_pages(client, "nps_ai_enrichment", columns, key="response_id"):
+        vecs = []
+        for r in page:
+            ids.append(r["response_id"])
+            primary.append(r.get("primary_theme"))
+            t = r.get("themes") or []
+            themes.append([str(x) for x in (json.loads(t) if isinstance(t, str) else t)])
+            v = parse_vector(r.get("embedded_vector"))
+            has.append(v is not None and v.size > 0)
+            vecs.append(v if has[-1] else None)
+        width = next((v.shape[0] for v in vecs if v is not None), None)
+        if width is None:
+            blocks.append(np.zeros((len(vecs), projector.dims), dtype=np.float32))
+            continue
+        dense = np.stack([v if v is not None else np.zeros(width, dtype=np.float32) for v in vecs])
+        blocks.append(projector(dense).astype(np.float32))
+    x = np.concatenate(blocks) if blocks else np.zeros((0, projector.dims), dtype=np.float32)
+    return ids, themes, primary, x, np.asarray(has, dtype=bool)
+
+
+# -----------------------------------------------------------------------------
+# Mapping
+# -----------------------------------------------------------------------------
+def group_means(x: np.ndarray, groups: np.ndarray, n_groups: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Unit-normalized mean vector per group id and member counts."""
+    counts = np.bincount(groups, minlength=n_groups)
+    sums = np.stack([np.bincount(groups, weights=x[:, j], minlength=n_groups) for j in range(x.shape[1])], axis=1)
+    return normalize_rows(sums).astype(np.float32), counts
+
+
+def best_two(sims: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Best column, its score and the lead over the runner-up, per row."""
+    if sims.shape[1] == 1:
+        return np.zeros(len(sims), dtype=np.int64), sims[:, 0], np.full(len(sims), np.inf)
+    top2 = np.argpartition(-sims, 1, axis=1)[:, :2]
+    s = np.take_along_axis(sims, top2, axis=1)
+    first = s.argmax(axis=1)
+    best = top2[np.arange(len(sims)), first]
+    return best, s.max(axis=1), np.abs(s[:, 0] - s[:, 1])
+
+
+def plan_remap(
+    themes: Sequence[Sequence[str]],
+    x: np.ndarray,
+    has_vec: np.ndarray,
+    targets: Sequence[str],
+    aliases: Dict[str, str],
+    theme_min_similarity: float = THEME_MIN_SIMILARITY,
+    row_min_similarity: float = ROW_MIN_SIMILARITY,
+    min_margin: float = MIN_MARGIN,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str], Dict[str, Any]]:
+    """
+    Returns the flattened (row, source theme) pairs with their target index
+    (-1 where unresolved), the source theme names and counters.
+    """
+    target_index = {t: i for i, t in enumerate(targets)}
+    names: List[str] = []
+    code: Dict[str, int] = {}
+    pair_row: List[int] = []
+    pair_src: List[int] = []
+    for r, ts in enumerate(themes):
+        for t in ts:
+            c = code.get(t)
+            if c is None:
+                c = code[t] = len(names)
+                names.append(t)
+            pair_row.append(r)
+            pair_src.append(c)
+    rows = np.asarray(pair_row, dtype=np.int64)
+    src = np.asarray(pair_src, dtype=np.int64)
+
+    # 1. alias / slug lookup, once per distinct source theme
+    src_map = np.array([target_index.get(aliases.get(slugify(n), ""), -1) for n in names] or [], dtype=np.int64)
+    mapped = src_map[src] if len(src) else np.zeros(0, dtype=np.int64)
+    stats: Dict[str, Any] = {"by_alias": int((mapped >= 0).sum()), "by_theme_centroid": 0, "by_row_centroid": 0, "learned": {}}
+    if not len(targets) or not has_vec.any():
+        return rows, src, mapped, names, stats
+
+    # Target centroids from rows already mapped by alias
+    known = (mapped >= 0) & has_vec[rows]
+    centroids, support = group_means(x[rows[known]], mapped[known], len(targets))
+    usable = support > 0
+    if not usable.any():
+        return rows, src, mapped, names, stats
+    cols = np.nonzero(usable)[0]
+
+    # 2. nearest centroid per unresolved source theme
+    unresolved_src = np.nonzero(src_map < 0)[0]
+    if len(unresolved_src):
+        pick = (src_map[src] < 0) & has_vec[rows]
+        src_centroids, src_support = group_means(x[rows[pick]], src[pick], len(names))
+        cand = unresolved_src[src_support[unresolved_src] >= MIN_THEME_SUPPORT]
+        if len(cand):
+            best, score, lead = best_two(src_centroids[cand] @ centroids[cols].T)
+            ok = (score >= theme_min_similarity) & (lead >= min_margin)
+            for s, t in zip(cand[ok], cols[best[ok]]):
+                src_map[s] = t
+                stats["learned"][names[s]] = targets[t]
+            newly = (mapped < 0) & (src_map[src] >= 0)
+            mapped = np.where(newly, src_map[src], mapped)
+            stats["by_theme_centroid"] = int(newly.sum())
+
+    # 3. nearest centroid per remaining (row, theme) pair from the row's own embedding
+    todo = np.nonzero((mapped < 0) & has_vec[rows])[0]
+    if len(todo):
+        best, score, lead = best_two(x[rows[todo]] @ centroids[cols].T)
+        ok = (score >= row_min_similarity) & (lead >= min_margin)
+        mapped[todo[ok]] = cols[best[ok]]
+        stats["by_row_centroid"] = int(ok.sum())
+    return rows, src, mapped, names, stats
+
+
+# -----------------------------------------------------------------------------
+# LLM escalation
+# -----------------------------------------------------------------------------
+ESCALATE_PROMPT = """Je bent een NPS-analist. Kies 1 tot 3 themas voor de reactie, UITSLUITEND uit deze lijst:
+{targets}
+Antwoord ALLEEN als JSON: {{"themes": [string]}}"""
+
+
+async def classify_with_llm(comments: Dict[str, str], targets: Sequence[str]) -> Dict[str, List[str]]:
+    allowed = set(targets)
+    prompt = ESCALATE_PROMPT.format(targets="\n".join(f"- {t}" for t in targets))
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+    async def one(rid: str, text: str) -> Tuple[str, List[str]]:
+        async with semaphore:
+            try:
+                with openai_call(MODEL) as call:
+                    completion = await clients.openai_async().chat.completions.create(
+                        model=MODEL,
+                        messages=[{"role": "system", "content": prompt}, {"role": "user", "content": text[:4000]}],
+                        temperature=0.1,
+                        response_format={"type": "json_object"},
+                    )
+                    call.usage(completion)
+                picked = json.loads(completion.choices[0].message.content or "{}").get("themes") or []
+                return rid, [t for t in picked if t in allowed]
+            except Exception as e:
+                logging.error(f"LLM remap failed for {rid}: {e}")
+                return rid, []
+
+    results = await asyncio.gather(*(one(rid, text) for rid, text in comments.items() if text))
+    return {rid: themes for rid, themes in results if themes}
+
+
+# -----------------------------------------------------------------------------
+# Run
+# -----------------------------------------------------------------------------
+def remap(
+    client: Any,
+    taxonomy_path: Optional[str] = None,
+    max_llm: int = 0,
+    dry_run: bool = False,
+    save_aliases: bool = False,
+    theme_min_similarity: float = THEME_MIN_SIMILARITY,
+    row_min_similarity: float = ROW_MIN_SIMILARITY,
+) -> RemapResult:
+    targets, aliases = load_taxonomy(client, taxonomy_path)
+    if not targets:
+        raise RuntimeError("Target taxonomy is empty")
+    ids, themes, primary, x, has_vec = load_enrichments(client, Projector())
+    rows, src, mapped, names, stats = plan_remap(themes, x, has_vec, targets, aliases, theme_min_similarity, row_min_similarity)
+    result = RemapResult(
+        rows=len(ids),
+        by_alias=stats["by_alias"],
+        by_theme_centroid=stats["by_theme_centroid"],
+        by_row_centroid=stats["by_row_centroid"],
+        learned_aliases=stats["learned"],
+    )
+
+    # New theme list per row, keeping the source order and dropping duplicates
+    new_themes: List[List[str]] = [[] for _ in ids]
+    # Per row: source theme -> target it was mapped to
+    row_map: List[Dict[str, str]] = [{} for _ in ids]
+    unresolved_rows = set()
+    for r, s, t in zip(rows.tolist(), src.tolist(), mapped.tolist()):
+        if t < 0:
+            unresolved_rows.add(r)
+            continue
+        row_map[r][names[s]] = targets[t]
+        if targets[t] not in new_themes[r]:
+            new_themes[r].append(targets[t])
+
+    # 4. escalate rows with an unresolved theme
+    escalate = sorted(unresolved_rows)[:max_llm]
+    if escalate:
+        comments = fetch_comments(client, [ids[r] for r in escalate])
+        picked = asyncio.run(classify_with_llm(comments, targets))
+        index = {ids[r]: r for r in escalate}
+        for rid, ts in picked.items():
+            new_themes[index[rid]] = ts
+            unresolved_rows.discard(index[rid])
+        result.by_llm = len(picked)
+    result.unresolved = len(unresolved_rows)
+
+    changes = []
+    for r in range(len(ids)):
+        # Rows still holding unmapped themes are left untouched
+        if r in unresolved_rows or not new_themes[r]:
+            continue
+        new_primary = remap_primary(primary[r], row_map[r], new_themes[r], aliases)
+        if new_themes[r] != themes[r] or new_primary != primary[r]:
+            changes.append({"response_id": ids[r], "themes": new_themes[r], "primary_theme": new_primary})
+    result.changed = len(changes)
+    if dry_run:
+        return result
+
+    result.written, result.failed = write_changes(client, changes)
+    if save_aliases and result.learned_aliases:
+        client.table("theme_alias").upsert(
+            [{"alias": a, "theme": t, "source": "centroid"} for a, t in result.learned_aliases.items()],
+            on_conflict="alias",
+        ).execute()
+    return result
+
+
+def remap_primary(old: Optional[str], row_map: Dict[str, str], new_themes: List[str], aliases: Dict[str, str]) -> str:
+    """primary_theme through the same mapping as the row's themes; the first new theme otherwise."""
+    if old:
+        mapped = row_map.get(old) or aliases.get(slugify(old))
+        if mapped in new_themes:
+            return mapped
+    return new_themes[0]
+
+
+def write_changes(client: Any, changes: List[Dict[str, Any]]) -> Tuple[int, List[Tuple[Any, str]]]:
+    """
+    UPDATE the changed rows, one statement per distinct (themes, primary_theme)
+    and id chunk. An UPDATE only touches these columns, so the NOT NULL
+    columns of the enrichment row never come into play. Returns (written, failures).
+    """
+    groups: Dict[Tuple[Tuple[str, ...], str], List[str]] = {}
+    for c in changes:
+        groups.setdefault((tuple(c["themes"]), c["primary_theme"]), []).append(c["response_id"])
+    written = 0
+    updated: List[str] = []
+    failed: List[Tuple[Any, str]] = []
+    for (themes, primary), ids in groups.items():
+        for i in range(0, len(ids), UPDATE_CHUNK):
+            chunk = ids[i : i + UPDATE_CHUNK]
+            try:
+                client.table("nps_ai_enrichment").update(
+                    {"themes": list(themes), "primary_theme": primary}
+                ).in_("response_id", chunk).execute()
+            except Exception as e:
+                logging.error(f"Remap update failed for {len(chunk)} rows: {e}")
+                failed.extend((rid, str(e)) for rid in chunk)
+                continue
+            written += len(chunk)
+            updated.extend(chunk)
+    if updated:
+        refresh_for_responses(client, updated)
+        response_cache.invalidate_enrichment()
+    return written, failed
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Remap existing enrichments onto the current theme taxonomy")
+    parser.add_argument("--taxonomy", help="JSON list of themes or {theme: [aliases]}; default: the themes table")
+    parser.add_argument("--max-llm", type=int, default=0, help="escalate at most this many ambiguous rows to the LLM")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    parser.add_argument("--save-aliases", action="store_true", help="store learned theme-level mappings in theme_alias")
+    parser.add_argument("--theme-min-similarity", type=float, default=THEME_MIN_SIMILARITY)
+    parser.add_argument("--row-min-similarity", type=float, default=ROW_MIN_SIMILARITY)
+    args = parser.parse_args()
+
+    r = remap(
+        service_client(),
+        args.taxonomy,
+        args.max_llm,
+        args.dry_run,
+        args.save_aliases,
+        args.theme_min_similarity,
+        args.row_min_similarity,
+    )
+    print(f"Rows: {r.rows}, changed: {r.changed}{' (dry run)' if args.dry_run else f', written: {r.written}'}")
+    print(f"Theme mentions mapped by alias: {r.by_alias}, theme centroid: {r.by_theme_centroid}, row centroid: {r.by_row_centroid}")
+    print(f"Rows resolved by LLM: {r.by_llm}, left unresolved: {r.unresolved}")
+    for alias, theme in sorted(r.learned_aliases.items()):
+        print(f"  learned alias: {alias} -> {theme}")
+    for response_id, err in r.failed:
+        print(f"Update failed for {response_id}: {err}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Precomputed theme aggregates (nps_theme_aggregate, see sql/017_theme_aggregate.sql)
+Serves /themes/{survey_name} from per-(survey, title, month, theme) counters
+instead of unnesting every enrichment on each request.
+
+Refresh command (run from backend/):
+    python -m app.theme_aggregates refresh
+    python -m app.theme_aggregates refresh --responses <id> <id> ...
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from app.db import iter_pages, service_client
+from app.stats import nps_interval
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+AGGREGATE_TABLE = "nps_theme_aggregate"
+COUNTER_COLUMNS = (
+    "mention_count",
+    "nps_sum",
+    "sentiment_sum",
+    "sentiment_n",
+    "promoters",
+    "passives",
+    "detractors",
+    "positive_count",
+    "negative_count",
+    "neutral_count",
+)
+# PostgREST URLs get long with big id lists; refresh in slices
+REFRESH_CHUNK = 500
+
+
+def refresh_for_responses(client: Client, response_ids: Iterable[str]) -> int:
+    """Recompute the aggregate groups touched by these responses."""
+    ids = [rid for rid in dict.fromkeys(response_ids) if rid]
+    affected = 0
+    for i in range(0, len(ids), REFRESH_CHUNK):
+        res = client.rpc("refresh_theme_aggregate_for", {"p_response_ids": ids[i : i + REFRESH_CHUNK]}).execute()
+        affected += int(res.data or 0)
+    return affected
+
+
+def refresh_all(client: Client) -> int:
+    """Rebuild the whole aggregate table."""
+    res = client.rpc("refresh_theme_aggregate", {}).execute()
+    return int(res.data or 0)
+
+
+def refresh_hook(client: Client):
+    """BatchUpserter on_flush callback keeping the aggregate in step with enrichment writes."""
+    def _hook(rows: List[Dict[str, Any]]) -> None:
+        refresh_for_responses(client, (r.get("response_id") for r in rows))
+    return _hook
+
+
+def rollup_by_theme(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Sum aggregate rows per theme and derive averages and NPS."""
+    totals: Dict[str, Dict[str, float]] = {}
+    survey_name = None
+    for row in rows:
+        survey_name = survey_name or row.get("survey_name")
+        acc = totals.setdefault(row["theme"], {c: 0 for c in COUNTER_COLUMNS})
+        for c in COUNTER_COLUMNS:
+            acc[c] += float(row.get(c) or 0)
+
+    themes = list(totals)
+    ci = nps_interval(
+        np.array([totals[t]["promoters"] for t in themes]),
+        np.array([totals[t]["passives"] for t in themes]),
+        np.array([totals[t]["detractors"] for t in themes]),
+    )
+
+    out = []
+    for i, theme in enumerate(themes):
+        acc = totals[theme]
+        n = int(acc["mention_count"])
+        out.append({
+            "survey_name": survey_name,
+            "theme": theme,
+            "theme_count": n,
+            "avg_nps": round(acc["nps_sum"] / n, 2) if n else None,
+            "avg_sentiment": round(acc["sentiment_sum"] / acc["sentiment_n"], 3) if acc["sentiment_n"] else None,
+            "promoters": int(acc["promoters"]),
+            "passives": int(acc["passives"]),
+            "detractors": int(acc["detractors"]),
+            "nps": None if np.isnan(ci["nps"][i]) else round(float(ci["nps"][i]), 1),
+            "nps_ci_low": None if np.isnan(ci["ci_low"][i]) else round(float(ci["ci_low"][i]), 1),
+            "nps_ci_high": None if np.isnan(ci["ci_high"][i]) else round(float(ci["ci_high"][i]), 1),
+            "positive_count": int(acc["positive_count"]),
+            "negative_count": int(acc["negative_count"]),
+            "neutral_count": int(acc["neutral_count"]),
+        })
+    out.sort(key=lambda r: (-r["theme_count"], r["theme"]))
+    return out
+
+
+def survey_themes(
+    client: Client,
+    survey_name: str,
+    title: Optional[str] = None,
+    start_month: Optional[str] = None,
+    end_month: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Theme breakdown for a survey, optionally filtered by title and month range
+    (YYYY-MM-01). A survey has a row per (title, month, theme), far more than
+    one PostgREST response returns, so the rows are paged.
+    """
+
+    def where(query: Any) -> Any:
+        query = query.eq("survey_name", survey_name)
+        if title is not None:
+            query = query.eq("title_text", title)
+        if start_month:
+            query = query.gte("month", start_month)
+        if end_month:
+            query = query.lte("month", end_month)
+        return query
+
+    columns = "survey_name, theme, " + ", ".join(COUNTER_COLUMNS)
+    return rollup_by_theme([r for page in iter_pages(client, AGGREGATE_TABLE, columns, where=where) for r in page])
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Refresh nps_theme_aggregate")
+    sub = parser.add_subparsers(dest="command", required=True)
+    refresh = sub.add_parser("refresh", help="rebuild all groups, or only those touched by --responses")
+    refresh.add_argument("--responses", nargs="*", help="response ids whose groups should be recomputed")
+    args = parser.parse_args()
+
+    client = service_client()
+    if args.responses:
+        affected = refresh_for_responses(client, args.responses)
+    else:
+        affected = refresh_all(client)
+    logging.info(f"nps_theme_aggregate refreshed: {affected} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Theme discovery for the "overige" bucket
+Clusters the stored embeddings of comments tagged "overige" and asks the LLM
+for one theme label per cluster (from a handful of representative comments)
+instead of inventing themes one comment at a time.
+
+Embeddings are streamed from nps_ai_enrichment page by page, random-projected
+to PROJECTION_DIMS and L2-normalized, so several hundred thousand vectors fit
+comfortably in memory. Clustering is spherical mini-batch k-means; points far
+from every centroid are left as noise and small clusters are dropped, in the
+spirit of HDBSCAN's "not everything belongs to a cluster".
+
+Run from backend/:
+    python -m app.theme_discovery --out proposals.json
+    python -m app.theme_discovery --theme overige --k 40 --min-cluster-size 25
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app import clients
+from app.db import iter_pages, service_client
+from app.metrics import openai_call
+
+MODEL = os.getenv("THEME_DISCOVERY_MODEL", "gpt-4o-mini")
+PROJECTION_DIMS = 128
+BATCH_SIZE = 2048
+MAX_ITER = 200
+SAMPLES_PER_CLUSTER = 8
+LLM_CONCURRENCY = 4
+ASSIGN_CHUNK = 65536
+# Full-data Lloyd passes after the mini-batch phase to polish the centroids
+REFINE_PASSES = 3
+
+
+@dataclass
+class ThemeProposal:
+    cluster: int
+    theme: str
+    description: str
+    size: int
+    cohesion: float  # mean cosine similarity of members to the centroid
+    existing: bool  # label matches a theme that already exists
+    examples: List[str] = field(default_factory=list)
+    response_ids: List[str] = field(default_factory=list)
+
+
+# -----------------------------------------------------------------------------
+# Vectors
+# -----------------------------------------------------------------------------
+def parse_vector(value: Any) -> Optional[np.ndarray]:
+    """pgvector values arrive as '[0.1,0.2,...]' strings through PostgREST."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return np.array(value.strip("[]").split(","), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+class Projector:
+    """Seeded Gaussian random projection (Johnson-Lindenstrauss), created for the first vector's width."""
+
+    def __init__(self, dims: int = PROJECTION_DIMS, seed: int = 0) -> None:
+        self.dims = dims
+        self.seed = seed
+        self.matrix: Optional[np.ndarray] = None
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        if x.shape[1] <= self.dims:
+            return normalize_rows(x)
+        if self.matrix is None:
+            rng = np.random.default_rng(self.seed)
+            self.matrix = (rng.standard_normal((x.shape[1], self.dims)) / np.sqrt(self.dims)).astype(np.float32)
+        return normalize_rows(x @ self.matrix)
+
+
+def load_vectors(client: Any, theme: str = "overige", projector: Optional[Projector] = None) -> Tuple[List[str], np.ndarray]:
+    """Response ids and projected unit vectors of enrichments tagged `theme`."""
+    projector = projector or Projector()
+    ids: List[str] = []
+    blocks: List[np.ndarray] = []
+    pages = iter_pages(
+        client,
+        "nps_ai_enrichment",
+        "response_id, embedded_vector",
+        where=lambda q: q.contains("themes", [theme]).filter("embedded_vector", "not.is", "null"),
+        key="response_id",
+    )
+    for page in pages:
+        vecs = []
+        for r in page:
+            v = parse_vector(r.get("embedded_vector"))
+            if v is not None and v.size:
+                ids.append(r["response_id"])
+                vecs.append(v)
+        if vecs:
+            blocks.append(projector(np.stack(vecs)))
+    if not blocks:
+        return [], np.zeros((0, projector.dims), dtype=np.float32)
+    return ids, np.concatenate(blocks)
+
+
+# -----------------------------------------------------------------------------
+# Clustering
+# -----------------------------------------------------------------------------
+def kmeans_pp(x: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Greedy k-means++ seeding on unit vectors with cosine distance: candidates
+    are drawn with probability proportional to the squared distance to the
+    nearest chosen center, and of 2 + log(k) candidates per step the one that
+    lowers the total squared distance most is kept.
+    """
+    trials = 2 + int(np.log(k))
+    centers = [x[rng.integers(len(x))]]
+    dist = np.maximum(1.0 - x @ centers[0], 0)
+    for _ in range(1, k):
+        p = dist**2
+        total = p.sum()
+        if total <= 0:
+            idx = int(rng.integers(len(x)))
+        else:
+            cand = rng.choice(len(x), size=trials, p=p / total)
+            # Distance of every row to each candidate, capped by the current nearest center
+            cand_dist = np.minimum(dist[None, :], np.maximum(1.0 - x[cand] @ x.T, 0))
+            best = int(np.argmin((cand_dist**2).sum(axis=1)))
+            idx = int(cand[best])
+        centers.append(x[idx])
+        dist = np.minimum(dist, np.maximum(1.0 - x @ x[idx], 0))
+    return np.stack(centers)
+
+
+def assign(x: np.ndarray, centers: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Nearest centroid and its cosine similarity per row, in bounded-memory chunks."""
+    labels = np.empty(len(x), dtype=np.int32)
+    sims = np.empty(len(x), dtype=np.float32)
+    for i in range(0, len(x), ASSIGN_CHUNK):
+        s = x[i : i + ASSIGN_CHUNK] @ centers.T
+        labels[i : i + ASSIGN_CHUNK] = s.argmax(axis=1)
+        sims[i : i + ASSIGN_CHUNK] = s.max(axis=1)
+    return labels, sims
+
+
+def minibatch_kmeans(
+    x: np.ndarray,
+    k: int,
+    batch_size: int = BATCH_SIZE,
+    max_iter: int = MAX_ITER,
+    tol: float = 1e-4,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Spherical mini-batch k-means (Sculley 2010) on unit vectors.
+
+    Each step moves every centroid toward the mean of its batch members with
+    a per-centroid learning rate of batch_count / total_count, then projects
+    it back onto the unit sphere. Returns the centroids.
+    """
+    rng = np.random.default_rng(seed)
+    k = max(1, min(k, len(x)))
+    seed_rows = x[rng.choice(len(x), size=min(len(x), max(20 * k, 10000)), replace=False)]
+    centers = kmeans_pp(seed_rows, k, rng)
+    counts = np.zeros(k, dtype=np.float64)
+    for _ in range(max_iter):
+        batch = x[rng.integers(0, len(x), size=min(batch_size, len(x)))]
+        labels = (batch @ centers.T).argmax(axis=1)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, batch)
+        batch_counts = np.bincount(labels, minlength=k).astype(np.float64)
+        hit = batch_counts > 0
+        counts[hit] += batch_counts[hit]
+        eta = (batch_counts[hit] / counts[hit])[:, None]
+        updated = normalize_rows((1.0 - eta) * centers[hit] + eta * (sums[hit] / batch_counts[hit][:, None]))
+        shift = float(np.abs(updated - centers[hit]).max()) if hit.any() else 0.0
+        centers[hit] = updated
+        if shift < tol:
+            break
+    return centers
+
+
+def cluster(
+    x: np.ndarray,
+    k: Optional[int] = None,
+    min_cluster_size: int = 20,
+    min_similarity: float = 0.5,
+    seed: int = 0,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (labels, similarities, centroids); label -1 marks noise (too far
+    from its centroid, or in a cluster smaller than min_cluster_size).
+    """
+    if k is None:
+        k = int(np.clip(np.sqrt(len(x) / 2), 2, 100))
+    centers = minibatch_kmeans(x, k, seed=seed)
+    for _ in range(REFINE_PASSES):
+        labels, _ = assign(x, centers)
+        sums = np.stack([np.bincount(labels, weights=x[:, j], minlength=len(centers)) for j in range(x.shape[1])], axis=1)
+        filled = np.bincount(labels, minlength=len(centers)) > 0
+        centers[filled] = normalize_rows(sums[filled]).astype(centers.dtype)
+    labels, sims = assign(x, centers)
+    labels[sims < min_similarity] = -1
+    sizes = np.bincount(labels[labels >= 0], minlength=len(centers))
+    labels[(labels >= 0) & (sizes[np.maximum(labels, 0)] < min_cluster_size)] = -1
+    return labels, sims, centers
+
+
+def representatives(labels: np.ndarray, sims: np.ndarray, n: int = SAMPLES_PER_CLUSTER) -> Dict[int, np.ndarray]:
+    """Row indexes of the n members closest to each cluster's centroid."""
+    out: Dict[int, np.ndarray] = {}
+    for c in np.unique(labels[labels >= 0]):
+        members = np.nonzero(labels == c)[0]
+        out[int(c)] = members[np.argsort(-sims[members])[:n]]
+    return out
+
+
+# -----------------------------------------------------------------------------
+# Labelling
+# -----------------------------------------------------------------------------
+LABEL_PROMPT = """Je bent een NPS-analist. Hieronder staan reacties die samen een groep vormen.
+Geef één kort, concreet Nederlands thema (2-4 woorden) dat de groep beschrijft en een korte omschrijving.
+Gebruik een bestaand thema als dat duidelijk past.
+Bestaande themas: {existing}
+Antwoord ALLEEN als JSON: {{"theme": string, "description": string}}"""
+
+
+async def label_cluster(examples: Sequence[str], existing: Sequence[str]) -> Dict[str, str]:
+    prompt = LABEL_PROMPT.format(existing=", ".join(existing[:200]) or "-")
+    with openai_call(MODEL) as call:
+        completion = await clients.openai_async().chat.completions.create(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": "\n".join(f"- {e[:500]}" for e in examples)},
+            ],
+            temperature=0.2,
+            response_format={"type": "json_object"},
+        )
+        call.usage(completion)
+    data = json.loads(completion.choices[0].message.content or "{}")
+    return {"theme": str(data.get("theme") or "").strip(), "description": str(data.get("description") or "").strip()}
+
+
+def fetch_comments(client: Any, response_ids: Iterable[str]) -> Dict[str, str]:
+    ids = list(response_ids)
+    out: Dict[str, str] = {}
+    for i in range(0, len(ids), 200):
+        res = client.table("nps_response").select("id, nps_explanation").in_("id", ids[i : i + 200]).execute()
+        out.update({r["id"]: r.get("nps_explanation") or "" for r in res.data or []})
+    return out
+
+
+def existing_themes(client: Any) -> List[str]:
+    try:
+        return [r["name"] for r in client.table("themes").select("name").order("name").execute().data or []]
+    except Exception:
+        return []
+
+
+async def discover(
+    client: Any,
+    theme: str = "overige",
+    k: Optional[int] = None,
+    min_cluster_size: int = 20,
+    min_similarity: float = 0.5,
+    seed: int = 0,
+) -> List[ThemeProposal]:
+    """Cluster `theme` comments and return one labelled proposal per cluster, largest first."""
+    ids, x = load_vectors(client, theme)
+    if not len(ids):
+        return []
+    labels, sims, _ = cluster(x, k, min_cluster_size, min_similarity, seed)
+    reps = representatives(labels, sims)
+    comments = fetch_comments(client, (ids[i] for rows in reps.values() for i in rows))
+    known = existing_themes(client)
+    known_lower = {t.lower() for t in known}
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+    async def propose(c: int, rows: np.ndarray) -> ThemeProposal:
+        examples = [comments[ids[i]] for i in rows if comments.get(ids[i])]
+        async with semaphore:
+            label = await label_cluster(examples, known)
+        members = np.nonzero(labels == c)[0]
+        return ThemeProposal(
+            cluster=c,
+            theme=label["theme"] or theme,
+            description=label["description"],
+            size=len(members),
+            cohesion=round(float(sims[members].mean()), 4),
+            existing=label["theme"].lower() in known_lower,
+            examples=examples,
+            response_ids=[ids[i] for i in members],
+        )
+
+    proposals = await asyncio.gather(*(propose(c, rows) for c, rows in reps.items()))
+    noise = int((labels < 0).sum())
+    logging.info(f"Theme discovery: {len(ids)} '{theme}' vectors, {len(proposals)} clusters, {noise} unclustered")
+    return sorted(proposals, key=lambda p: -p.size)
+
+
+# -----------------------------------------------------------------------------
+# CLI
+# -----------------------------------------------------------------------------
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Propose new themes by clustering 'overige' comments")
+    parser.add_argument("--theme", default="overige", help="bucket to mine (default: overige)")
+    parser.add_argument("--k", type=int, default=None, help="number of clusters (default: sqrt(n/2), 2..100)")
+    parser.add_argument("--min-cluster-size", type=int, default=20)
+    parser.add_argument("--min-similarity", type=float, default=0.5, help="cosine similarity below which a comment is noise")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write proposals (with member response ids) to this JSON file")
+    args = parser.parse_args()
+
+    proposals = asyncio.run(discover(service_client(), args.theme, args.k, args.min_cluster_size, args.min_similarity, args.seed))
+    for p in proposals:
+        tag = "existing" if p.existing else "new"
+        print(f"{p.size:6d}  {p.cohesion:.2f}  [{tag}] {p.theme} - {p.description}")
+    if args.out:
+        with open(args.out, "w") as fh:
+            json.dump([asdict(p) for p in proposals], fh, ensure_ascii=False, indent=2)
+        print(f"Wrote {len(proposals)} proposals to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
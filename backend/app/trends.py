@@ -0,0 +1,387 @@
+"""
+Incremental MoM trends and winners/losers
+Keeps per-(title, survey, month) promoter/passive/detractor counters in memory,
+fed by ingest batches, so trend queries work on a titles x months array instead
+of rescanning nps_response through v_nps_monthly (sql/005_trends.sql,
+sql/006_winners_losers.sql). NULL titles and surveys are their own group,
+as in the SQL.
+
+Like the response store, the counters catch up from nps_response by a
+watermark on created_at every TRENDS_REFRESH_SECS, re-reading an overlap
+window, so other workers' ingests are counted too. Counters cannot be
+upserted, so the ids counted inside the overlap window are remembered and a
+re-read row is never counted twice.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from fastapi import APIRouter, HTTPException
+
+from app.db import CreatedWatermark, iter_pages, service_client
+from app.metrics import cache_lookup
+from app.stats import benjamini_hochberg, delta_significance, nps_with_se
+
+router = APIRouter(prefix="/trends", tags=["trends"])
+
+LOAD_COLUMNS = "id, title_text, survey_name, creation_date, nps_score, created_at"
+REFRESH_SECS = float(os.getenv("TRENDS_REFRESH_SECS", "30"))
+# created_at window re-read on every refresh, for inserts that commit late
+REFRESH_OVERLAP_SECS = float(os.getenv("TRENDS_OVERLAP_SECS", "300"))
+
+# Counter slots on the last axis
+PROMOTERS, PASSIVES, DETRACTORS = 0, 1, 2
+
+
+def month_key(value: Any) -> Optional[int]:
+    """Encode an ISO date/datetime as year * 12 + month - 1."""
+    if value is None:
+        return None
+    if isinstance(value, date):
+        return value.year * 12 + value.month - 1
+    s = str(value)
+    if len(s) < 7:
+        return None
+    try:
+        return int(s[0:4]) * 12 + int(s[5:7]) - 1
+    except ValueError:
+        return None
+
+
+def month_label(key: int) -> str:
+    return f"{key // 12:04d}-{key % 12 + 1:02d}-01"
+
+
+def score_slot(score: int) -> int:
+    if score >= 9:
+        return PROMOTERS
+    if score >= 7:
+        return PASSIVES
+    return DETRACTORS
+
+
+class TrendCounters:
+    """
+    Dense int32 counters of shape (titles, surveys, months, 3).
+
+    Titles and surveys are dictionary-encoded in arrival order (None is a
+    key of its own); the month axis covers a contiguous range that grows as
+    older/newer months arrive.
+    """
+
+    def __init__(self) -> None:
+        self.titles: Dict[Optional[str], int] = {}
+        self.surveys: Dict[Optional[str], int] = {}
+        self.first_month: Optional[int] = None
+        self.counts = np.zeros((0, 0, 0, 3), dtype=np.int32)
+        self.loaded = False
+        self.refreshed = 0.0
+        self.since = CreatedWatermark(REFRESH_OVERLAP_SECS)
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    # Updates
+    # -------------------------------------------------------------------------
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Count nps_response rows (id, title_text, survey_name, creation_date,
+        nps_score, created_at). Rows already counted by id are skipped.
+        """
+        t_idx: List[int] = []
+        s_idx: List[int] = []
+        months: List[int] = []
+        slots: List[int] = []
+        with self._lock:
+            horizon = self.since.horizon()
+            for r in rows:
+                m = month_key(r.get("creation_date"))
+                score = r.get("nps_score")
+                if m is None or score is None or not self.since.first_time(r, horizon):
+                    continue
+                t_idx.append(self.titles.setdefault(r.get("title_text"), len(self.titles)))
+                s_idx.append(self.surveys.setdefault(r.get("survey_name"), len(self.surveys)))
+                months.append(m)
+                slots.append(score_slot(int(score)))
+            if not months:
+                return 0
+            m_arr = np.asarray(months, dtype=np.int64)
+            self._grow(int(m_arr.min()), int(m_arr.max()))
+            np.add.at(
+                self.counts,
+                (np.asarray(t_idx), np.asarray(s_idx), m_arr - self.first_month, np.asarray(slots)),
+                1,
+            )
+        return len(months)
+
+    def refresh(self, client: Any = None) -> int:
+        """Count nps_response rows created since the watermark (minus the overlap)."""
+        client = client or service_client()
+        added = 0
+        for page in iter_pages(client, "nps_response", LOAD_COLUMNS, where=self.since.where()):
+            added += self.add_rows(page)
+            # Only rows read from the DB move the watermark (see response_store.refresh)
+            with self._lock:
+                self.since.advance(page)
+        self.refreshed = time.time()
+        return added
+
+    def _grow(self, lo: int, hi: int) -> None:
+        T, S, M, _ = self.counts.shape
+        first = lo if self.first_month is None else min(self.first_month, lo)
+        last = hi if self.first_month is None else max(self.first_month + M - 1, hi)
+        before = 0 if self.first_month is None else self.first_month - first
+        after = (last - first + 1) - M - before
+        pad = ((0, len(self.titles) - T), (0, len(self.surveys) - S), (before, after), (0, 0))
+        if any(p != (0, 0) for p in pad):
+            self.counts = np.pad(self.counts, pad)
+        self.first_month = first
+
+    def reset(self) -> None:
+        with self._lock:
+            self.titles.clear()
+            self.surveys.clear()
+            self.first_month = None
+            self.counts = np.zeros((0, 0, 0, 3), dtype=np.int32)
+            self.loaded = False
+            self.refreshed = 0.0
+            self.since.reset()
+
+    # -------------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------------
+    def matrix(
+        self,
+        survey: Optional[str] = None,
+        title: Optional[str] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+    ) -> Tuple[List[Optional[str]], List[int], np.ndarray]:
+        """Return (titles, month keys, counts[titles, months, 3]) for the filter window."""
+        with self._lock:
+            if self.first_month is None:
+                return [], [], np.zeros((0, 0, 3), dtype=np.int64)
+            counts = self.counts
+            if survey is not None:
+                if survey not in self.surveys:
+                    return [], [], np.zeros((0, 0, 3), dtype=np.int64)
+                counts = counts[:, self.surveys[survey] : self.surveys[survey] + 1]
+            by_title = counts.sum(axis=1, dtype=np.int64)
+            names = sorted(self.titles, key=self.titles.get)
+            first = self.first_month
+
+        lo = 0 if start is None else max(0, month_key(start) - first)
+        hi = by_title.shape[1] if end is None else min(by_title.shape[1], month_key(end) - first + 1)
+        by_title = by_title[:, lo:hi]
+        months = list(range(first + lo, first + max(lo, hi)))
+
+        keep = np.arange(len(names))
+        if title is not None:
+            keep = keep[[n == title for n in names]]
+        names = [names[i] for i in keep]
+        return names, months, by_title[keep]
+
+
+def mom_table(counts: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Vectorized NPS and MoM deltas for a (titles, months, 3) counter array.
+
+    The previous month is the last earlier month with responses for that
+    title, matching the lag() in nps_trend_by_title_with_mom.
+    """
+    cur = nps_with_se(counts[..., PROMOTERS], counts[..., PASSIVES], counts[..., DETRACTORS])
+    n = cur["n"]
+
+    T, M = n.shape
+    cols = np.where(n > 0, np.arange(M)[None, :], -1)
+    last_seen = np.maximum.accumulate(cols, axis=1)
+    prev = np.full((T, M), -1)
+    prev[:, 1:] = last_seen[:, :-1]
+    has_prev = (prev >= 0) & (n > 0)
+    rows = np.arange(T)[:, None]
+    prev_safe = np.where(has_prev, prev, 0)
+
+    before = {
+        "nps": np.where(has_prev, cur["nps"][rows, prev_safe], np.nan),
+        "se": np.where(has_prev, cur["se"][rows, prev_safe], np.nan),
+    }
+    sig = delta_significance(cur, before)
+    fdr = np.zeros_like(has_prev)
+    fdr[has_prev] = benjamini_hochberg(sig["p_value"][has_prev])
+    return {
+        "responses": n.astype(np.int64),
+        "nps": cur["nps"],
+        "prev_nps": before["nps"],
+        "mom_delta": sig["delta"],
+        "delta_se": sig["se"],
+        "ci_low": sig["ci_low"],
+        "ci_high": sig["ci_high"],
+        "p_value": sig["p_value"],
+        "significant": sig["significant"],
+        # Same test, controlled for false discoveries across every title-month in the table
+        "significant_fdr": fdr,
+    }
+
+
+def _num(value: float, digits: int = 1) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+# -----------------------------------------------------------------------------
+# Shared store
+# -----------------------------------------------------------------------------
+store = TrendCounters()
+_load_lock = threading.Lock()
+
+
+def ensure_loaded(max_age: float = REFRESH_SECS) -> TrendCounters:
+    """Load counters from nps_response on first use; catch up when older than max_age. Blocking."""
+    cache_lookup("trend_counters", store.loaded)
+    if store.loaded and time.time() - store.refreshed < max_age:
+        return store
+    with _load_lock:
+        if not store.loaded:
+            store.refresh()
+            store.loaded = True
+            logging.info(f"Trend counters loaded: {len(store.titles)} titles, {store.counts.shape[2]} months")
+        elif time.time() - store.refreshed >= max_age:
+            store.refresh()
+    return store
+
+
+async def loaded_store() -> TrendCounters:
+    """ensure_loaded for endpoints: scans and catch-ups run in a worker thread, not on the event loop."""
+    if store.loaded and time.time() - store.refreshed < REFRESH_SECS:
+        return store
+    return await asyncio.to_thread(ensure_loaded)
+
+
+def record_ingested(rows: Iterable[Dict[str, Any]]) -> None:
+    """Ingest hook: count inserted responses (as returned by the insert, with ids) if the counters are live."""
+    if store.loaded:
+        store.add_rows(rows)
+
+
+# -----------------------------------------------------------------------------
+# Endpoints
+# -----------------------------------------------------------------------------
+@router.get("")
+async def get_trends(
+    survey: Optional[str] = None,
+    title: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+):
+    """Monthly NPS per title with MoM delta and its 95% confidence interval"""
+    try:
+        names, months, counts = (await loaded_store()).matrix(survey, title, start_date, end_date)
+        if not names or not months:
+            return []
+        t = mom_table(counts)
+        out = []
+        for ti, mi in zip(*np.nonzero(t["responses"])):
+            out.append({
+                "month": month_label(months[mi]),
+                "title": names[ti],
+                "responses": int(t["responses"][ti, mi]),
+                "promoters": int(counts[ti, mi, PROMOTERS]),
+                "passives": int(counts[ti, mi, PASSIVES]),
+                "detractors": int(counts[ti, mi, DETRACTORS]),
+                "nps": _num(t["nps"][ti, mi]),
+                "mom_delta": _num(t["mom_delta"][ti, mi]),
+                "mom_ci_low": _num(t["ci_low"][ti, mi]),
+                "mom_ci_high": _num(t["ci_high"][ti, mi]),
+                "mom_p_value": _num(t["p_value"][ti, mi], 4),
+                "mom_significant": bool(t["significant"][ti, mi]),
+                "mom_significant_fdr": bool(t["significant_fdr"][ti, mi]),
+            })
+        # NULL titles last, as ORDER BY does
+        out.sort(key=lambda r: (r["month"], r["title"] is None, r["title"] or ""))
+        return out
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error computing trends: {str(e)}")
+
+
+@router.get("/movers")
+async def get_top_movers(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    survey: Optional[str] = None,
+    min_responses: int = 30,
+    top_k: int = 5,
+    rank_by: str = "ci",
+    significant_only: bool = False,
+):
+    """
+    Top K up/down titles in the latest month of the window (same shape as top_title_mom_moves).
+
+    rank_by="ci" ranks winners by the lower and losers by the upper bound of
+    the delta's 95% CI, so small, noisy titles don't crowd out real moves;
+    rank_by="delta" reproduces the raw mom_delta ranking of the RPC.
+    significant_only keeps titles that stay significant after Benjamini-Hochberg
+    across all titles compared this month, since dozens are tested at once.
+    """
+    if rank_by not in {"ci", "delta"}:
+        raise HTTPException(status_code=400, detail="rank_by must be 'ci' or 'delta'")
+    try:
+        names, months, counts = (await loaded_store()).matrix(survey, None, start_date, end_date)
+        if not names or not months:
+            return []
+        t = mom_table(counts)
+        # Latest month with any responses in the window
+        active = np.nonzero(t["responses"].sum(axis=0))[0]
+        if not len(active):
+            return []
+        mi = int(active[-1])
+        delta = t["mom_delta"][:, mi]
+        mask = (t["responses"][:, mi] >= min_responses) & ~np.isnan(delta)
+        fdr = np.zeros(len(names), dtype=bool)
+        fdr[mask] = benjamini_hochberg(t["p_value"][mask, mi])
+        if significant_only:
+            mask &= fdr
+        eligible = np.nonzero(mask)[0]
+
+        def rows(order: np.ndarray, move: str) -> List[Dict[str, Any]]:
+            return [{
+                "month": month_label(months[mi]),
+                "title": names[ti],
+                "responses": int(t["responses"][ti, mi]),
+                "nps": _num(t["nps"][ti, mi]),
+                "mom_delta": _num(delta[ti]),
+                "mom_ci_low": _num(t["ci_low"][ti, mi]),
+                "mom_ci_high": _num(t["ci_high"][ti, mi]),
+                "mom_p_value": _num(t["p_value"][ti, mi], 4),
+                "mom_significant": bool(t["significant"][ti, mi]),
+                "mom_significant_fdr": bool(fdr[ti]),
+                "move": move,
+            } for ti in order]
+
+        resp = t["responses"][eligible, mi]
+        up_key = t["ci_low"][eligible, mi] if rank_by == "ci" else delta[eligible]
+        down_key = t["ci_high"][eligible, mi] if rank_by == "ci" else delta[eligible]
+        up = eligible[np.lexsort((-resp, -up_key))][:top_k]
+        down = eligible[np.lexsort((-resp, down_key))][:top_k]
+        # Same ordering as the RPC: move asc, then mom_delta desc
+        down = down[np.argsort(-delta[down], kind="stable")]
+        up = up[np.argsort(-delta[up], kind="stable")]
+        return rows(down, "down") + rows(up, "up")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error computing movers: {str(e)}")
+
+
+@router.post("/reload")
+async def reload_trends():
+    """Drop the in-memory counters and rebuild them from nps_response"""
+    try:
+        store.reset()
+        s = await loaded_store()
+        return {"titles": len(s.titles), "surveys": len(s.surveys), "months": int(s.counts.shape[2])}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reloading trends: {str(e)}")
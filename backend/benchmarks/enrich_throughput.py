@@ -0,0 +1,333 @@
+"""
+Enrichment throughput benchmark
+Runs the real enrichment code against the local fake OpenAI server
+(benchmarks/fake_openai.py) and reports comments/sec, retries and tail
+latency, so throughput and retry behavior can be compared across commits.
+
+- api: app.enrich.process_batch (the /enrich endpoint path), `--concurrency`
+  batches in flight at once
+- cli: direct_enrich_final.run, `--concurrency` worker threads sharing one
+  queue of comments
+- batch: direct_enrich_final --batch (submit_batch + ingest_batch) through the
+  fake server's Batch API; elapsed time includes --batch-delay and polling
+
+Database reads and writes are replaced by an in-memory source and sink; only
+the OpenAI side is exercised. With --baseline the run fails (exit 1) when
+comments/sec drops more than --tolerance below the stored result.
+
+Run from backend/:
+    python benchmarks/enrich_throughput.py --path api --comments 500 --concurrency 8
+    python benchmarks/enrich_throughput.py --path cli --comments 300 --error-429 0.05 --out cli.json
+    python benchmarks/enrich_throughput.py --path cli --comments 300 --baseline cli.json
+    python benchmarks/enrich_throughput.py --path batch --comments 2000 --poll-secs 0.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(BACKEND_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_openai import FakeOpenAIServer, add_config_args, config_from_args  # noqa: E402
+
+SAMPLE_CSV = os.path.join(REPO_DIR, "CX%20tracker%202025_TOTAAL_BEWERKT.xlsx - CX tracker 2025_LLT_Magazines_N.csv")
+# Placeholder credentials: the clients are constructed but never reach Supabase
+PLACEHOLDER_ENV = {
+    "NEXT_PUBLIC_SUPABASE_URL": "http://127.0.0.1:9",
+    "SUPABASE_SERVICE_ROLE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYmVuY2htYXJrIn0.bench",
+    "OPENAI_API_KEY": "sk-fake-benchmark",
+}
+
+
+def load_comments(n: int, path: str = SAMPLE_CSV, seed: int = 0) -> List[str]:
+    """n comments from the sample export (cycled), or synthetic ones if it is missing."""
+    texts: List[str] = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8", errors="replace") as fh:
+            texts = [r["NPS_TOELICHTING"].strip() for r in csv.DictReader(fh) if (r.get("NPS_TOELICHTING") or "").strip()]
+    if not texts:
+        rng = random.Random(seed)
+        words = "krant bezorging prijs artikelen puzzels te duur slecht goed prima laat nieuws sport abonnement".split()
+        texts = [" ".join(rng.choices(words, k=rng.randint(3, 15))) for _ in range(1000)]
+    rng = random.Random(seed)
+    rng.shuffle(texts)
+    return [texts[i % len(texts)] for i in range(n)]
+
+
+class MemorySink:
+    """Stands in for the Supabase client as the BatchUpserter target."""
+
+    def __init__(self) -> None:
+        self.rows: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def table(self, name: str) -> "MemorySink":
+        return self
+
+    def upsert(self, payload: List[Dict[str, Any]], on_conflict: str = "") -> "MemorySink":
+        with self._lock:
+            self.rows.extend(payload)
+        return self
+
+    def execute(self) -> Any:
+        return None
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    v = sorted(values)
+
+    def q(p: float) -> float:
+        return round(v[min(len(v) - 1, int(p * len(v)))] * 1000, 1)
+
+    return {"p50": q(0.50), "p95": q(0.95), "p99": q(0.99), "max": round(v[-1] * 1000, 1)}
+
+
+def timed(fn: Callable, latencies: List[float], is_async: bool) -> Callable:
+    if is_async:
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - started)
+    else:
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - started)
+    return wrapper
+
+
+# -----------------------------------------------------------------------------
+# Paths
+# -----------------------------------------------------------------------------
+def bench_api(comments: List[str], concurrency: int, batch_size: int) -> Dict[str, Any]:
+    from app import enrich, keywords
+    from app.batch_writer import BatchUpserter
+
+    responses = [{"id": f"bench-{i}", "nps_explanation": c} for i, c in enumerate(comments)]
+    # Keyword idf from the benchmark corpus instead of a database load
+    keywords.engine.add_rows(responses)
+    keywords.engine.loaded = True
+    calls: List[float] = []
+    embedding_calls: List[float] = []
+    enrich.analyze_comment_with_ai = timed(enrich.analyze_comment_with_ai, calls, is_async=True)
+    enrich.create_embedding = timed(enrich.create_embedding, embedding_calls, is_async=True)
+
+    sink = MemorySink()
+    writer = BatchUpserter(sink, "nps_ai_enrichment", on_conflict="response_id")
+    totals = {"processed": 0, "failed": 0, "skipped": 0, "collapsed": 0}
+
+    async def drive() -> None:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(batch_id: int, batch: List[Dict[str, Any]]) -> None:
+            async with sem:
+                result = await enrich.process_batch(batch, batch_id, writer)
+            for k in totals:
+                totals[k] += result[k]
+
+        await asyncio.gather(*(
+            one(i // batch_size + 1, responses[i : i + batch_size]) for i in range(0, len(responses), batch_size)
+        ))
+
+    started = time.perf_counter()
+    asyncio.run(drive())
+    writer.close()
+    elapsed = time.perf_counter() - started
+    return {
+        **totals,
+        "elapsed_secs": elapsed,
+        "llm_calls": len(calls),
+        "embedding_calls": len(embedding_calls),
+        "call_latency_ms": percentiles(calls),
+        "rows_written": len(sink.rows),
+    }
+
+
+def synthetic_themes(n: int) -> List[str]:
+    base = ["content_kwaliteit", "pricing", "merkvertrouwen", "bezorging", "overige"]
+    return base[:n] + [f"thema_{i:03d}_{random.Random(i).choice(['klant', 'product', 'digitaal', 'levering'])}" for i in range(max(0, n - len(base)))]
+
+
+def bench_cli(comments: List[str], concurrency: int, batch_size: int, themes: int = 5) -> Dict[str, Any]:
+    import direct_enrich_final as d
+    from app.batch_writer import BatchUpserter
+
+    queue = [{"id": f"bench-{i}", "nps_explanation": c} for i, c in enumerate(comments)]
+    lock = threading.Lock()
+
+    def fetch_unenriched_batch(limit: int) -> List[Dict[str, Any]]:
+        with lock:
+            batch = queue[:limit]
+            del queue[:limit]
+        return batch
+
+    d.fetch_unenriched_batch = fetch_unenriched_batch
+    current = synthetic_themes(themes)
+    d.fetch_current_themes = lambda: current
+    d.ensure_theme = lambda name: (name or "").strip() or "overige"
+    d.BATCH_SIZE = batch_size
+    calls: List[float] = []
+    d.classify_comment = timed(d.classify_comment, calls, is_async=False)
+
+    sink = MemorySink()
+    totals: List[int] = []
+
+    def worker() -> None:
+        with BatchUpserter(sink, "nps_ai_enrichment", on_conflict="response_id", max_rows=d.UPSERT_ROWS) as writer:
+            totals.append(d.run(writer))
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "processed": sum(totals),
+        "failed": len(comments) - sum(totals),
+        "elapsed_secs": elapsed,
+        "llm_calls": len(calls),
+        "embedding_calls": 0,
+        "call_latency_ms": percentiles(calls),
+        "rows_written": len(sink.rows),
+    }
+
+
+def bench_batch(comments: List[str], themes: int = 5, poll_secs: float = 1.0) -> Dict[str, Any]:
+    import tempfile
+
+    import direct_enrich_final as d
+    from app import openai_batch
+    from app.batch_writer import BatchUpserter
+
+    rows = [{"id": f"bench-{i}", "nps_explanation": c} for i, c in enumerate(comments)]
+    d.fetch_all_unenriched = lambda limit=0: rows[:limit] if limit else rows
+    current = synthetic_themes(themes)
+    d.fetch_current_themes = lambda: current
+    d.ensure_theme = lambda name: (name or "").strip() or "overige"
+
+    sink = MemorySink()
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as state_dir, contextlib.redirect_stdout(io.StringIO()):
+        openai_batch.BATCH_STATE_DIR = state_dir
+        batch_run = d.submit_batch()
+        with BatchUpserter(sink, "nps_ai_enrichment", on_conflict="response_id", max_rows=d.UPSERT_ROWS) as writer:
+            processed = d.ingest_batch(batch_run, writer, poll_secs)
+    elapsed = time.perf_counter() - started
+    return {
+        "processed": processed,
+        "failed": len(comments) - processed,
+        "elapsed_secs": elapsed,
+        "llm_calls": len(batch_run.members),
+        "embedding_calls": 0,
+        "batch_jobs": len(batch_run.jobs),
+        "rows_written": len(sink.rows),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Enrichment throughput against a local fake OpenAI server")
+    parser.add_argument("--path", choices=["api", "cli", "batch"], default="api")
+    parser.add_argument("--comments", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--max-rpm", type=int, default=100000, help="MAX_RPM for direct_enrich_final (its own pacing)")
+    parser.add_argument("--csv", default=SAMPLE_CSV, help="export to take comments from")
+    parser.add_argument("--themes", type=int, default=5, help="size of the theme list (cli path; sets the prompt prefix length)")
+    parser.add_argument("--poll-secs", type=float, default=1.0, help="batch status polling interval (batch path)")
+    parser.add_argument("--out", help="write the result as JSON")
+    parser.add_argument("--baseline", help="earlier --out file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed comments/sec drop vs baseline")
+    add_config_args(parser)
+    args = parser.parse_args()
+
+    for k, v in PLACEHOLDER_ENV.items():
+        os.environ.setdefault(k, v)
+    os.environ["MAX_RPM"] = str(args.max_rpm)
+    config = config_from_args(args)
+    comments = load_comments(args.comments, args.csv, args.seed)
+
+    from app.metrics import OPENAI_RATE_LIMITED, OPENAI_RETRIES
+    from app.prompts import usage_cost
+
+    with FakeOpenAIServer(config) as server:
+        os.environ["OPENAI_BASE_URL"] = server.url
+        if args.path == "api":
+            result = bench_api(comments, args.concurrency, args.batch_size)
+        elif args.path == "cli":
+            result = bench_cli(comments, args.concurrency, args.batch_size, args.themes)
+        else:
+            result = bench_batch(comments, args.themes, args.poll_secs)
+        stats = server.stats
+
+    logical_calls = result["llm_calls"] + result["embedding_calls"]
+    result.update({
+        "path": args.path,
+        "revision": git_revision(),
+        "comments": len(comments),
+        "concurrency": args.concurrency,
+        "comments_per_sec": round(result["processed"] / result["elapsed_secs"], 2) if result["elapsed_secs"] else None,
+        "server_requests": {"chat": stats.chat, "embeddings": stats.embeddings},
+        "prompt_tokens": stats.prompt_tokens,
+        "cached_tokens": stats.cached_tokens,
+        "cached_share": round(stats.cached_tokens / stats.prompt_tokens, 3) if stats.prompt_tokens else 0.0,
+        "cost_usd_per_1k_comments": round(
+            usage_cost("gpt-4o-mini", stats.prompt_tokens, stats.cached_tokens, stats.completion_tokens,
+                       batch=args.path == "batch") / max(len(comments), 1) * 1000, 4
+        ),
+        "injected": {"429": stats.rate_limited, "500": stats.server_errors, "malformed": stats.malformed},
+        "app_retries": OPENAI_RETRIES.total(),
+        "rate_limited_seen": OPENAI_RATE_LIMITED.total(),
+        # Requests the SDK re-sent on its own (429/5xx with backoff)
+        "sdk_retries": stats.chat + stats.embeddings - logical_calls,
+        "fake_server": vars(config),
+    })
+    result["elapsed_secs"] = round(result["elapsed_secs"], 2)
+    print(json.dumps(result, indent=2))
+
+    if args.out:
+        with open(args.out, "w") as fh:
+            json.dump(result, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            base = json.load(fh)
+        floor = base["comments_per_sec"] * (1 - args.tolerance)
+        if result["comments_per_sec"] < floor:
+            print(f"REGRESSION: {result['comments_per_sec']} comments/sec < {floor:.2f} (baseline {base['comments_per_sec']} @ {base.get('revision')})")
+            sys.exit(1)
+        print(f"OK vs baseline {base['comments_per_sec']} comments/sec @ {base.get('revision')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+"""
+Local OpenAI-compatible stand-in
+Serves /v1/chat/completions and /v1/embeddings well enough for the AsyncOpenAI
+and OpenAI clients used by enrichment, with configurable latency, injected
+429s (with Retry-After) and 500s, malformed JSON replies and deterministic
+fake embeddings. Nothing leaves the machine and nothing is billed.
+
+Chat replies are JSON objects whose shape follows the prompt: the
+direct_enrich_final.py schema (primary_theme/themes/sentiment/confidence),
+the app.enrich schema (themes/theme_scores/sentiment) or the survey/main.py
+schema (sentiment label + sentiment_score). Content is derived from a hash of
+the prompt, so the same comment always gets the same answer.
+
+Prompt caching is modelled on OpenAI's: once a prompt prefix (everything
+before the last message) of at least 1024 tokens has been seen, later
+requests starting with it report the cacheable part as
+prompt_tokens_details.cached_tokens and answer faster (--cached-speedup).
+
+/v1/files and /v1/batches implement the Batch API flow used by
+direct_enrich_final.py --batch: uploaded JSONL request files are validated,
+answered line by line in the background (same replies, injected errors and
+malformed share as live calls, without their latency) after --batch-delay
+seconds, and written to output / error files that can be downloaded.
+
+Run from backend/ (point clients at it with OPENAI_BASE_URL=http://127.0.0.1:8099/v1):
+    python benchmarks/fake_openai.py --port 8099 --latency-ms 400 --error-429 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, Response
+
+EMBEDDING_DIMS = {"text-embedding-3-large": 3072, "text-embedding-3-small": 1536, "text-embedding-ada-002": 1536}
+THEMES = ["Klantenservice", "Productkwaliteit", "Prijs/Value", "Levering", "Communicatie", "Algemene tevredenheid"]
+
+
+@dataclass
+class FakeConfig:
+    latency_ms: float = 300.0
+    # fixed | uniform | exp | lognormal (median latency_ms, shape jitter)
+    latency_dist: str = "lognormal"
+    jitter: float = 0.5
+    embedding_latency_ms: float = 80.0
+    error_429: float = 0.0
+    error_500: float = 0.0
+    malformed: float = 0.0
+    retry_after: float = 1.0
+    prefix_cache: bool = True
+    # share of latency saved on a fully cached prompt
+    cached_speedup: float = 0.5
+    # seconds before a submitted batch starts; per-request time inside a batch
+    batch_delay: float = 1.0
+    batch_request_ms: float = 1.0
+    seed: int = 0
+
+
+@dataclass
+class FakeStats:
+    chat: int = 0
+    embeddings: int = 0
+    rate_limited: int = 0
+    server_errors: int = 0
+    malformed: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    batches: int = 0
+    batch_requests: int = 0
+    started: float = field(default_factory=time.time)
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _cacheable(tokens: int) -> int:
+    return 0 if tokens < 1024 else 1024 + (tokens - 1024) // 128 * 128
+
+
+def _digest(text: str) -> int:
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def chat_content(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Deterministic reply in the schema the prompt asks for."""
+    text = "\n".join(str(m.get("content") or "") for m in messages)
+    rng = random.Random(_digest(text))
+    # direct_enrich_final.py lists the current themes as "- name" lines; answer from those
+    offered = re.findall(r"^- (.+)$", text, flags=re.MULTILINE)
+    pool = offered or THEMES
+    themes = rng.sample(pool, k=min(len(pool), rng.randint(1, 3)))
+    score = round(rng.uniform(-1, 1), 2)
+    label = "positive" if score > 0.1 else "negative" if score < -0.1 else "neutral"
+
+    if "primary_theme" in text:
+        return {
+            "primary_theme": themes[0],
+            "themes": themes,
+            "sentiment": {"positive": "promoter", "negative": "detractor"}.get(label, "passive"),
+            "confidence": round(rng.uniform(0.5, 0.95), 2),
+        }
+    if "sentiment_score" in text:
+        return {
+            "themes": themes,
+            "sentiment": label,
+            "sentiment_score": score,
+            "sentiment_label": label,
+            "summary": "Samenvatting van de reactie",
+        }
+    return {
+        "themes": themes,
+        "theme_scores": {t: round(rng.uniform(0.4, 1.0), 2) for t in themes},
+        "sentiment": score,
+        "language": "nl",
+    }
+
+
+def fake_embedding(text: str, dims: int) -> np.ndarray:
+    v = np.random.default_rng(_digest(text)).standard_normal(dims).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def create_app(config: Optional[FakeConfig] = None) -> FastAPI:
+    config = config or FakeConfig()
+    stats = FakeStats()
+    rng = random.Random(config.seed)
+    lock = threading.Lock()
+    seen_prefixes: set = set()
+    app = FastAPI(title="Fake OpenAI")
+    app.state.config = config
+    app.state.stats = stats
+
+    def latency(median_ms: float) -> float:
+        with lock:
+            if config.latency_dist == "fixed":
+                ms = median_ms
+            elif config.latency_dist == "uniform":
+                ms = rng.uniform(median_ms * (1 - config.jitter), median_ms * (1 + config.jitter))
+            elif config.latency_dist == "exp":
+                ms = rng.expovariate(1 / median_ms) if median_ms > 0 else 0.0
+            else:
+                ms = median_ms * rng.lognormvariate(0, config.jitter)
+        return max(ms, 0.0) / 1000
+
+    def injected_error() -> Optional[JSONResponse]:
+        with lock:
+            roll = rng.random()
+        if roll < config.error_429:
+            stats.rate_limited += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": f"{config.retry_after:g}", "retry-after-ms": f"{config.retry_after * 1000:g}"},
+            )
+        if roll < config.error_429 + config.error_500:
+            stats.server_errors += 1
+            return JSONResponse({"error": {"message": "Internal error (fake)", "type": "server_error"}}, status_code=500)
+        return None
+
+    def cached_prefix(messages: List[Dict[str, Any]]) -> int:
+        """Cacheable prefix tokens already seen (messages before the last one)."""
+        if not config.prefix_cache or len(messages) < 2:
+            return 0
+        prefix = json.dumps(messages[:-1], sort_keys=True)
+        cacheable = _cacheable(sum(_tokens(str(m.get("content") or "")) for m in messages[:-1]))
+        with lock:
+            hit = prefix in seen_prefixes
+            seen_prefixes.add(prefix)
+        return cacheable if hit else 0
+
+    def completion(body: Dict[str, Any]):
+        """(prompt tokens, cached tokens, latency) for a chat request."""
+        stats.chat += 1
+        messages = body.get("messages") or []
+        prompt_tokens = sum(_tokens(str(m.get("content") or "")) for m in messages)
+        cached_tokens = cached_prefix(messages)
+        speedup = config.cached_speedup * cached_tokens / prompt_tokens if prompt_tokens else 0.0
+        return prompt_tokens, cached_tokens, latency(config.latency_ms) * (1 - speedup)
+
+    def completion_body(body: Dict[str, Any], prompt_tokens: int, cached_tokens: int) -> Dict[str, Any]:
+        content = json.dumps(chat_content(body.get("messages") or []), ensure_ascii=False)
+        with lock:
+            broken = rng.random() < config.malformed
+        if broken:
+            stats.malformed += 1
+            content = content[: len(content) // 2]
+        completion_tokens = _tokens(content)
+        stats.prompt_tokens += prompt_tokens
+        stats.cached_tokens += cached_tokens
+        stats.completion_tokens += completion_tokens
+        return {
+            "id": f"chatcmpl-fake-{stats.chat}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt_tokens, cached_tokens, delay = completion(body)
+        await asyncio.sleep(delay)
+        error = injected_error()
+        if error is not None:
+            return error
+        return completion_body(body, prompt_tokens, cached_tokens)
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        stats.embeddings += 1
+        await asyncio.sleep(latency(config.embedding_latency_ms))
+        error = injected_error()
+        if error is not None:
+            return error
+        inputs = body.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs or [])
+        model = body.get("model", "text-embedding-3-large")
+        dims = int(body.get("dimensions") or EMBEDDING_DIMS.get(model, 1536))
+        data = []
+        for i, text in enumerate(inputs):
+            v = fake_embedding(str(text), dims)
+            emb: Any = base64.b64encode(v.tobytes()).decode() if body.get("encoding_format") == "base64" else v.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": emb})
+        tokens = sum(_tokens(str(t)) for t in inputs)
+        stats.prompt_tokens += tokens
+        return {"object": "list", "data": data, "model": model, "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    # -- Batch API ----------------------------------------------------------------
+    files: Dict[str, Dict[str, Any]] = {}
+    contents: Dict[str, bytes] = {}
+    batches: Dict[str, Dict[str, Any]] = {}
+
+    def store_file(filename: str, purpose: str, data: bytes) -> Dict[str, Any]:
+        file_id = f"file-fake-{uuid.uuid4().hex[:12]}"
+        files[file_id] = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                          "filename": filename, "purpose": purpose, "status": "processed"}
+        contents[file_id] = data
+        return files[file_id]
+
+    def public(batch: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+    def not_found(kind: str, key: str) -> HTTPException:
+        return HTTPException(404, detail={"error": {"message": f"No such {kind}: {key}", "type": "invalid_request_error"}})
+
+    async def process_batch(batch: Dict[str, Any]) -> None:
+        await asyncio.sleep(config.batch_delay)
+        if batch["status"] == "cancelling":
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+            return
+        try:
+            lines = [json.loads(raw) for raw in contents[batch["input_file_id"]].decode("utf-8").splitlines() if raw.strip()]
+            if any(line.get("url") != batch["endpoint"] for line in lines):
+                raise ValueError("every line must use the batch endpoint")
+        except ValueError as e:
+            batch.update(status="failed", failed_at=int(time.time()),
+                         errors={"object": "list", "data": [{"code": "invalid_request", "message": str(e)}]})
+            return
+        batch.update(status="in_progress", in_progress_at=int(time.time()))
+        batch["request_counts"]["total"] = len(lines)
+        output: List[str] = []
+        errors: List[str] = []
+        for line in lines:
+            if batch["status"] == "cancelling":
+                break
+            await asyncio.sleep(config.batch_request_ms / 1000)
+            stats.batch_requests += 1
+            body = line.get("body") or {}
+            prompt_tokens, cached_tokens, _ = completion(body)
+            # No rate limits inside a batch; only server errors end up in the error file
+            with lock:
+                failed = rng.random() < config.error_500
+            result: Dict[str, Any] = {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": line.get("custom_id")}
+            if not failed:
+                result.update(response={"status_code": 200, "request_id": uuid.uuid4().hex,
+                                        "body": completion_body(body, prompt_tokens, cached_tokens)}, error=None)
+                output.append(json.dumps(result, ensure_ascii=False))
+                batch["request_counts"]["completed"] += 1
+            else:
+                stats.server_errors += 1
+                result.update(response={"status_code": 500, "request_id": uuid.uuid4().hex,
+                                        "body": {"error": {"message": "Internal error (fake)", "type": "server_error"}}},
+                              error=None)
+                errors.append(json.dumps(result, ensure_ascii=False))
+                batch["request_counts"]["failed"] += 1
+        if output:
+            batch["output_file_id"] = store_file(f"{batch['id']}_output.jsonl", "batch_output",
+                                                 "\n".join(output).encode("utf-8") + b"\n")["id"]
+        if errors:
+            batch["error_file_id"] = store_file(f"{batch['id']}_error.jsonl", "batch_output",
+                                                "\n".join(errors).encode("utf-8") + b"\n")["id"]
+        if batch["status"] == "cancelling":
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+        else:
+            batch.update(status="completed", completed_at=int(time.time()))
+
+    @app.post("/v1/files")
+    async def upload_file(file: UploadFile = File(...), purpose: str = Form(...)):
+        return store_file(file.filename or "upload.jsonl", purpose, await file.read())
+
+    @app.get("/v1/files/{file_id}")
+    async def get_file(file_id: str):
+        if file_id not in files:
+            raise not_found("file", file_id)
+        return files[file_id]
+
+    @app.get("/v1/files/{file_id}/content")
+    async def get_file_content(file_id: str):
+        if file_id not in contents:
+            raise not_found("file", file_id)
+        return Response(contents[file_id], media_type="application/octet-stream")
+
+    @app.post("/v1/batches")
+    async def create_batch(request: Request):
+        body = await request.json()
+        if body.get("input_file_id") not in files:
+            raise not_found("file", str(body.get("input_file_id")))
+        stats.batches += 1
+        batch = {
+            "id": f"batch_fake_{uuid.uuid4().hex[:12]}", "object": "batch", "endpoint": body.get("endpoint"),
+            "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window", "24h"),
+            "status": "validating", "output_file_id": None, "error_file_id": None, "errors": None,
+            "created_at": int(time.time()), "metadata": body.get("metadata"),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        batches[batch["id"]] = batch
+        batch["_task"] = asyncio.create_task(process_batch(batch))
+        return public(batch)
+
+    @app.get("/v1/batches/{batch_id}")
+    async def get_batch(batch_id: str):
+        if batch_id not in batches:
+            raise not_found("batch", batch_id)
+        return public(batches[batch_id])
+
+    @app.post("/v1/batches/{batch_id}/cancel")
+    async def cancel_batch(batch_id: str):
+        if batch_id not in batches:
+            raise not_found("batch", batch_id)
+        batch = batches[batch_id]
+        if batch["status"] in ("validating", "in_progress"):
+            batch["status"] = "cancelling"
+        return public(batch)
+
+    @app.get("/stats")
+    async def get_stats():
+        return {**asdict(stats), "config": asdict(config)}
+
+    return app
+
+
+class FakeOpenAIServer:
+    """Run the fake server in a background thread (for benchmark drivers)."""
+
+    def __init__(self, config: Optional[FakeConfig] = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        import socket
+
+        import uvicorn
+
+        if port == 0:
+            with socket.socket() as s:
+                s.bind((host, 0))
+                port = s.getsockname()[1]
+        self.app = create_app(config)
+        self.url = f"http://{host}:{port}/v1"
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, name="fake-openai", daemon=True)
+
+    @property
+    def stats(self) -> FakeStats:
+        return self.app.state.stats
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+
+
+def add_config_args(parser: argparse.ArgumentParser) -> None:
+    d = FakeConfig()
+    parser.add_argument("--latency-ms", type=float, default=d.latency_ms, help="median chat latency")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exp", "lognormal"], default=d.latency_dist)
+    parser.add_argument("--jitter", type=float, default=d.jitter, help="lognormal sigma / uniform half-width")
+    parser.add_argument("--embedding-latency-ms", type=float, default=d.embedding_latency_ms)
+    parser.add_argument("--error-429", type=float, default=d.error_429, help="share of requests answered with 429")
+    parser.add_argument("--error-500", type=float, default=d.error_500, help="share of requests answered with 500")
+    parser.add_argument("--malformed", type=float, default=d.malformed, help="share of chat replies with truncated JSON")
+    parser.add_argument("--retry-after", type=float, default=d.retry_after, help="Retry-After seconds on 429s")
+    parser.add_argument("--no-prefix-cache", dest="prefix_cache", action="store_false", help="never report cached prompt tokens")
+    parser.add_argument("--cached-speedup", type=float, default=d.cached_speedup, help="latency saved on a fully cached prompt")
+    parser.add_argument("--batch-delay", type=float, default=d.batch_delay, help="seconds before a submitted batch starts")
+    parser.add_argument("--batch-request-ms", type=float, default=d.batch_request_ms, help="time per request inside a batch")
+    parser.add_argument("--seed", type=int, default=d.seed)
+
+
+def config_from_args(args: argparse.Namespace) -> FakeConfig:
+    return FakeConfig(**{k: getattr(args, k) for k in asdict(FakeConfig())})
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in for enrichment load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    add_config_args(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+"""
+Local PostgREST stand-in with synthetic survey data
+Seeds nps_response, nps_ai_enrichment and nps_theme_aggregate in memory
+(numpy columns) at a configurable scale and answers the subset of the
+PostgREST protocol the read API uses: column selection, eq/neq/gt/gte/lt/lte/
+in/is filters (and their not. forms), order, limit/offset, the Range header
+and the get_survey_metrics RPC. Rows are capped at --max-rows per request
+like db-max-rows on Supabase (1000 by default there; 0 = no cap).
+
+Per-table query counts and time spent are kept at /stats so a load test can
+tell API time from database time.
+
+Run from backend/ (point the API at it with SUPABASE_URL=http://127.0.0.1:54321):
+    python benchmarks/postgrest_standin.py --port 54321 --titles 50 --months 24 --responses 1000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+
+
+class QueryError(ValueError):
+    pass
+
+
+ID_PREFIX = "00000000-0000-4000-8000-"
+THEMES = [
+    "Klantenservice",
+    "Productkwaliteit",
+    "Prijs/Value",
+    "Gebruiksvriendelijkheid",
+    "Betrouwbaarheid",
+    "Communicatie",
+    "Levering",
+    "Technische problemen",
+    "Algemene tevredenheid",
+]
+CATEGORIES = ["promoter", "passive", "detractor"]
+SENTIMENT_LABELS = ["positive", "neutral", "negative"]
+# Rough NPS_SCORE distribution of the sample export (0..10)
+SCORE_WEIGHTS = np.array([3, 1, 1, 2, 2, 5, 6, 11, 20, 21, 28], dtype=float)
+COMMENT_WORDS = (
+    "krant bezorging prijs artikelen puzzels te duur slecht goed prima laat nieuws sport abonnement "
+    "interessant verhalen opzeggen papier app digitale editie bezorger brievenbus te vaak reclame "
+    "leuk blad fijne rubrieken kwaliteit minder dunner klantenservice bereikbaar wachttijd"
+).split()
+
+
+@dataclass
+class Scale:
+    surveys: int = 4
+    titles: int = 50
+    months: int = 24
+    responses: int = 1_000_000
+    comment_share: float = 0.45
+    enriched_share: float = 0.8
+    end_month: str = "2025-09"
+    seed: int = 0
+
+
+def survey_names(scale: Scale) -> List[str]:
+    return [f"CX tracker {2025 - i}" if i < 3 else f"Survey {i}" for i in range(scale.surveys)]
+
+
+def title_names(scale: Scale) -> List[str]:
+    return [f"Titel {i:02d}" for i in range(scale.titles)]
+
+
+def title_survey(scale: Scale) -> np.ndarray:
+    """Survey index per title (each title is asked in exactly one survey)."""
+    return np.arange(scale.titles) % max(scale.surveys, 1)
+
+
+# -----------------------------------------------------------------------------
+# Columns and tables
+# -----------------------------------------------------------------------------
+@dataclass
+class Column:
+    # int | float | bool | cat | list | date | ts | text | id
+    kind: str
+    values: np.ndarray
+    categories: List[str] = field(default_factory=list)
+
+    def decode(self, idx: np.ndarray) -> List[Any]:
+        v = self.values[idx]
+        if self.kind in ("int", "bool"):
+            return v.tolist()
+        if self.kind == "float":
+            return [None if x != x else round(x, 4) for x in v.tolist()]
+        if self.kind == "cat":
+            cats = self.categories
+            return [cats[c] if c >= 0 else None for c in v.tolist()]
+        if self.kind == "list":
+            cats = self.categories
+            return [[cats[c] for c in row if c >= 0] for row in v.tolist()]
+        if self.kind in ("date", "ts"):
+            out = np.datetime_as_string(v, unit="D" if self.kind == "date" else "s").tolist()
+            suffix = "+00:00" if self.kind == "ts" else ""
+            return [None if s == "NaT" else s + suffix for s in out]
+        if self.kind == "id":
+            return [f"{ID_PREFIX}{i:012d}" for i in v.tolist()]
+        return v.tolist()
+
+    def parse(self, raw: str) -> Any:
+        if self.kind in ("int", "float"):
+            return float(raw)
+        if self.kind == "bool":
+            return raw.lower() == "true"
+        if self.kind == "cat":
+            return self.categories.index(raw) if raw in self.categories else -2
+        if self.kind == "date":
+            return np.datetime64(raw[:10], "D")
+        if self.kind == "ts":
+            return np.datetime64(raw[:19].replace(" ", "T"), "s")
+        if self.kind == "id":
+            return int(raw[len(ID_PREFIX):]) if raw.startswith(ID_PREFIX) else -1
+        return raw
+
+    def null_mask(self, idx: np.ndarray) -> np.ndarray:
+        v = self.values[idx]
+        if self.kind == "float":
+            return np.isnan(v)
+        if self.kind == "cat":
+            return v < 0
+        if self.kind == "list":
+            return (v < 0).all(axis=1)
+        if self.kind in ("date", "ts"):
+            return np.isnat(v)
+        if self.kind == "text":
+            return np.equal(v, None)
+        return np.zeros(len(idx), dtype=bool)
+
+    def sort_key(self, idx: np.ndarray) -> np.ndarray:
+        v = self.values[idx]
+        if self.kind == "cat":
+            # alphabetical rank per code; the trailing entry puts NULL (-1) last
+            rank = np.append(np.argsort(np.argsort(self.categories)), len(self.categories))
+            return rank[v].astype(np.float64)
+        if self.kind in ("list", "text"):
+            raise QueryError(f"ordering by a {self.kind} column is not supported")
+        if self.kind in ("date", "ts"):
+            return v.view(np.int64).astype(np.float64)
+        return v.astype(np.float64)
+
+
+@dataclass
+class Table:
+    name: str
+    columns: Dict[str, Column]
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values())).values)
+
+    def column(self, name: str) -> Column:
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise QueryError(f"column {self.name}.{name} does not exist") from None
+
+    def match(self, idx: np.ndarray, name: str, expr: str) -> np.ndarray:
+        """Rows of idx passing one PostgREST filter (`col=op.value`)."""
+        negate = expr.startswith("not.")
+        if negate:
+            expr = expr[4:]
+        op, _, raw = expr.partition(".")
+        col = self.column(name)
+        if op == "is":
+            if raw == "null":
+                mask = col.null_mask(idx)
+            elif raw in ("true", "false"):
+                mask = col.values[idx] == (raw == "true")
+            else:
+                raise QueryError(f"unsupported is.{raw}")
+        elif op == "in":
+            items = [s.strip().strip('"') for s in raw.strip("()").split(",") if s.strip()]
+            mask = np.isin(col.values[idx], [col.parse(s) for s in items])
+        elif op in ("eq", "neq", "gt", "gte", "lt", "lte"):
+            v = col.values[idx]
+            target = col.parse(raw)
+            mask = {
+                "eq": lambda: v == target,
+                "neq": lambda: v != target,
+                "gt": lambda: v > target,
+                "gte": lambda: v >= target,
+                "lt": lambda: v < target,
+                "lte": lambda: v <= target,
+            }[op]()
+            if op == "neq":
+                # SQL: NULL <> x is not true
+                mask &= ~col.null_mask(idx)
+        else:
+            raise QueryError(f"unsupported operator {op}")
+        return idx[~mask if negate else mask]
+
+    def query(
+        self,
+        select: str,
+        filters: List[Tuple[str, str]],
+        order: Optional[str],
+        offset: int,
+        limit: Optional[int],
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """Rows for one request and the number of rows matching before paging."""
+        idx = np.arange(len(self))
+        for name, expr in filters:
+            idx = self.match(idx, name, expr)
+        total = len(idx)
+
+        end = total if limit is None else min(total, offset + limit)
+        if order:
+            keys = []
+            for term in order.split(","):
+                name, *mods = term.strip().split(".")
+                key = self.column(name).sort_key(idx)
+                keys.append(-key if "desc" in mods else key)
+            if len(keys) == 1 and end < total // 4:
+                # index-scan stand-in for ORDER BY ... LIMIT: only sort the head
+                head = np.argpartition(keys[0], end)[:end]
+                idx = idx[head[np.argsort(keys[0][head], kind="stable")]]
+            else:
+                idx = idx[np.lexsort(keys[::-1])]
+
+        idx = idx[offset:end]
+
+        names = list(self.columns) if select.strip() in ("", "*") else [c.strip() for c in select.split(",") if c.strip()]
+        decoded = [self.column(n).decode(idx) for n in names]
+        return [dict(zip(names, row)) for row in zip(*decoded)], total
+
+
+# -----------------------------------------------------------------------------
+# Seeding
+# -----------------------------------------------------------------------------
+def _comment_pool(rng: np.random.Generator, size: int = 4000) -> Tuple[np.ndarray, np.ndarray]:
+    lengths = rng.integers(2, 30, size)
+    pool = np.empty(size, dtype=object)
+    for i, n in enumerate(lengths):
+        pool[i] = " ".join(rng.choice(COMMENT_WORDS, n)).capitalize()
+    return pool, lengths
+
+
+def seed(scale: Scale) -> Dict[str, Table]:
+    """Synthetic tables: responses skewed towards a few big titles, spread over `months` months."""
+    rng = np.random.default_rng(scale.seed)
+    n = scale.responses
+
+    weights = 1.0 / np.arange(1, scale.titles + 1) ** 0.8
+    title = rng.choice(scale.titles, n, p=weights / weights.sum()).astype(np.int16)
+    survey = title_survey(scale)[title].astype(np.int16)
+    month = np.datetime64(scale.end_month, "M") - rng.integers(0, scale.months, n)
+    creation_date = month.astype("datetime64[D]") + rng.integers(0, 28, n)
+    created_at = creation_date.astype("datetime64[s]") + rng.integers(86_400, 3 * 86_400, n)
+
+    score = rng.choice(11, n, p=SCORE_WEIGHTS / SCORE_WEIGHTS.sum()).astype(np.int16)
+    category = np.where(score >= 9, 0, np.where(score >= 7, 1, 2)).astype(np.int8)
+
+    pool, pool_words = _comment_pool(rng)
+    has_comment = rng.random(n) < scale.comment_share
+    pick = rng.integers(0, len(pool), n)
+    explanation = np.where(has_comment, pool[pick], "")
+    word_count = np.where(has_comment, pool_words[pick], 0).astype(np.int16)
+
+    nps_response = Table("nps_response", {
+        "id": Column("id", np.arange(n)),
+        "survey_name": Column("cat", survey, survey_names(scale)),
+        "nps_score": Column("int", score),
+        "nps_explanation": Column("text", explanation),
+        "gender": Column("cat", rng.integers(-1, 2, n).astype(np.int8), ["M", "V"]),
+        "age_range": Column("cat", rng.integers(0, 4, n).astype(np.int8), ["18-34", "35-54", "55-64", "65+"]),
+        "years_employed": Column("cat", rng.integers(0, 4, n).astype(np.int8), ["<1", "1-3", "3-5", "5+"]),
+        "creation_date": Column("date", creation_date),
+        "title_text": Column("cat", title, title_names(scale)),
+        "nps_category": Column("cat", category, CATEGORIES),
+        "word_count": Column("int", word_count),
+        "has_explanation": Column("bool", has_comment),
+        "created_at": Column("ts", created_at),
+    })
+
+    # Enrichment for a share of the commented responses, 1-3 themes each
+    enriched = np.flatnonzero(has_comment & (rng.random(n) < scale.enriched_share))
+    m = len(enriched)
+    themes = np.full((m, 3), -1, dtype=np.int8)
+    themes[:, 0] = rng.integers(0, len(THEMES), m)
+    for j, p in ((1, 0.45), (2, 0.15)):
+        extra = rng.random(m) < p
+        themes[extra, j] = (themes[extra, 0] + rng.integers(1, len(THEMES), extra.sum())) % len(THEMES)
+    # Sentiment loosely follows the score
+    sentiment = np.clip((score[enriched] - 7) / 4 + rng.normal(0, 0.3, m), -1, 1).round(3)
+    sentiment_label = np.where(sentiment > 0.1, 0, np.where(sentiment < -0.1, 2, 1)).astype(np.int8)
+    nps_ai_enrichment = Table("nps_ai_enrichment", {
+        "response_id": Column("id", enriched),
+        "themes": Column("list", themes, THEMES),
+        "sentiment_score": Column("float", sentiment),
+        "sentiment_label": Column("cat", sentiment_label, SENTIMENT_LABELS),
+        "processing_status": Column("cat", np.zeros(m, dtype=np.int8), ["completed"]),
+        "created_at": Column("ts", created_at[enriched] + rng.integers(60, 86_400, m)),
+    })
+
+    return {
+        "nps_response": nps_response,
+        "nps_ai_enrichment": nps_ai_enrichment,
+        "nps_theme_aggregate": theme_aggregate(scale, nps_response, nps_ai_enrichment),
+    }
+
+
+def theme_aggregate(scale: Scale, responses: Table, enrichment: Table) -> Table:
+    """nps_theme_aggregate as sql/017_theme_aggregate.sql would build it."""
+    themes = enrichment.columns["themes"].values
+    row, slot = np.nonzero(themes >= 0)
+    theme = themes[row, slot].astype(np.int64)
+    rid = enrichment.columns["response_id"].values[row]
+    title = responses.columns["title_text"].values[rid].astype(np.int64)
+    month_start = responses.columns["creation_date"].values[rid].astype("datetime64[M]")
+    month = (np.datetime64(scale.end_month, "M") - month_start).astype(np.int64)
+
+    key = (title * scale.months + month) * len(THEMES) + theme
+    groups, inv = np.unique(key, return_inverse=True)
+    g = len(groups)
+
+    def count(mask: np.ndarray) -> np.ndarray:
+        return np.bincount(inv, weights=mask, minlength=g).astype(np.int64)
+
+    score = responses.columns["nps_score"].values[rid].astype(float)
+    category = responses.columns["nps_category"].values[rid]
+    sentiment = enrichment.columns["sentiment_score"].values[row]
+    label = enrichment.columns["sentiment_label"].values[row]
+
+    g_theme = groups % len(THEMES)
+    g_month = (groups // len(THEMES)) % scale.months
+    g_title = groups // (len(THEMES) * scale.months)
+    return Table("nps_theme_aggregate", {
+        "survey_name": Column("cat", title_survey(scale)[g_title].astype(np.int16), survey_names(scale)),
+        "title_text": Column("cat", g_title.astype(np.int16), title_names(scale)),
+        "month": Column("date", (np.datetime64(scale.end_month, "M") - g_month).astype("datetime64[D]")),
+        "theme": Column("cat", g_theme.astype(np.int8), THEMES),
+        "mention_count": Column("int", np.bincount(inv, minlength=g)),
+        "nps_sum": Column("int", np.bincount(inv, weights=score, minlength=g).astype(np.int64)),
+        "sentiment_sum": Column("float", np.bincount(inv, weights=np.nan_to_num(sentiment), minlength=g)),
+        "sentiment_n": Column("int", count(~np.isnan(sentiment))),
+        "promoters": Column("int", count(category == 0)),
+        "passives": Column("int", count(category == 1)),
+        "detractors": Column("int", count(category == 2)),
+        "positive_count": Column("int", count(label == 0)),
+        "negative_count": Column("int", count(label == 2)),
+        "neutral_count": Column("int", count(label == 1)),
+    })
+
+
+def survey_metrics(tables: Dict[str, Table]) -> List[Dict[str, Any]]:
+    """get_survey_metrics(): per-survey counts, average score, NPS and date range."""
+    t = tables["nps_response"]
+    survey = t.columns["survey_name"].values.astype(np.int64)
+    names = t.columns["survey_name"].categories
+    k = len(names)
+    category = t.columns["nps_category"].values
+    days = t.columns["creation_date"].values.astype(np.int64)
+    total = np.bincount(survey, minlength=k)
+    score_sum = np.bincount(survey, weights=t.columns["nps_score"].values, minlength=k)
+    per_cat = [np.bincount(survey, weights=category == c, minlength=k).astype(int) for c in range(3)]
+    first = np.full(k, np.iinfo(np.int64).max)
+    last = np.full(k, np.iinfo(np.int64).min)
+    np.minimum.at(first, survey, days)
+    np.maximum.at(last, survey, days)
+
+    out = []
+    for i, name in enumerate(names):
+        n = int(total[i])
+        if not n:
+            continue
+        out.append({
+            "survey_name": name,
+            "total_responses": n,
+            "promoters": int(per_cat[0][i]),
+            "passives": int(per_cat[1][i]),
+            "detractors": int(per_cat[2][i]),
+            "average_score": round(float(score_sum[i]) / n, 2),
+            "nps_score": round((per_cat[0][i] - per_cat[2][i]) / n * 100, 2),
+            "first_response": str(np.datetime64(int(first[i]), "D")),
+            "last_response": str(np.datetime64(int(last[i]), "D")),
+        })
+    return out
+
+
+RPCS = {"get_survey_metrics": survey_metrics}
+
+
+# -----------------------------------------------------------------------------
+# Server
+# -----------------------------------------------------------------------------
+@dataclass
+class StandinConfig:
+    max_rows: int = 1000
+    latency_ms: float = 1.0
+
+
+@dataclass
+class TableStats:
+    queries: int = 0
+    rows_returned: int = 0
+    secs: float = 0.0
+
+
+def _range_header(value: Optional[str]) -> Optional[Tuple[int, Optional[int]]]:
+    if not value or "-" not in value:
+        return None
+    start, _, end = value.partition("-")
+    return int(start), (int(end) if end else None)
+
+
+def create_app(tables: Dict[str, Table], config: Optional[StandinConfig] = None, scale: Optional[Scale] = None) -> FastAPI:
+    config = config or StandinConfig()
+    stats: Dict[str, TableStats] = {}
+    lock = threading.Lock()
+    app = FastAPI(title="PostgREST stand-in")
+    app.state.tables = tables
+
+    def record(target: str, rows: int, secs: float) -> None:
+        with lock:
+            s = stats.setdefault(target, TableStats())
+            s.queries += 1
+            s.rows_returned += rows
+            s.secs += secs
+
+    @app.get("/rest/v1/{table}")
+    async def read_table(table: str, request: Request):
+        if table not in tables:
+            return JSONResponse({"code": "42P01", "message": f'relation "public.{table}" does not exist'}, status_code=404)
+        await asyncio.sleep(config.latency_ms / 1000)
+
+        select, order, offset, limit = "*", None, 0, None
+        filters: List[Tuple[str, str]] = []
+        for key, value in request.query_params.multi_items():
+            if key == "select":
+                select = value
+            elif key == "order":
+                order = value
+            elif key == "offset":
+                offset = int(value)
+            elif key == "limit":
+                limit = int(value)
+            else:
+                filters.append((key, value))
+        span = _range_header(request.headers.get("range"))
+        if span is not None:
+            offset = span[0]
+            limit = None if span[1] is None else span[1] - span[0] + 1
+        if config.max_rows:
+            limit = config.max_rows if limit is None else min(limit, config.max_rows)
+
+        started = time.perf_counter()
+        try:
+            rows, total = await run_in_threadpool(tables[table].query, select, filters, order, offset, limit)
+        except ValueError as e:
+            return JSONResponse({"code": "PGRST100", "message": str(e)}, status_code=400)
+        record(table, len(rows), time.perf_counter() - started)
+
+        last = offset + len(rows) - 1
+        content_range = f"{offset}-{last}/{total}" if rows else f"*/{total}"
+        return Response(json.dumps(rows), media_type="application/json", headers={"Content-Range": content_range})
+
+    @app.post("/rest/v1/rpc/{fn}")
+    async def call_rpc(fn: str):
+        if fn not in RPCS:
+            return JSONResponse({"code": "PGRST202", "message": f"function public.{fn} not found"}, status_code=404)
+        await asyncio.sleep(config.latency_ms / 1000)
+        started = time.perf_counter()
+        rows = await run_in_threadpool(RPCS[fn], tables)
+        record(f"rpc/{fn}", len(rows), time.perf_counter() - started)
+        return Response(json.dumps(rows), media_type="application/json")
+
+    @app.get("/health")
+    async def health():
+        return {
+            "tables": {name: len(t) for name, t in tables.items()},
+            "scale": asdict(scale) if scale else None,
+            "config": asdict(config),
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        with lock:
+            return {k: {**asdict(v), "ms_per_query": round(v.secs * 1000 / v.queries, 2)} for k, v in stats.items()}
+
+    return app
+
+
+def add_scale_args(parser: argparse.ArgumentParser) -> None:
+    d = Scale()
+    parser.add_argument("--surveys", type=int, default=d.surveys)
+    parser.add_argument("--titles", type=int, default=d.titles)
+    parser.add_argument("--months", type=int, default=d.months)
+    parser.add_argument("--responses", type=int, default=d.responses)
+    parser.add_argument("--comment-share", type=float, default=d.comment_share, help="share of responses with a comment")
+    parser.add_argument("--enriched-share", type=float, default=d.enriched_share, help="share of comments already enriched")
+    parser.add_argument("--end-month", default=d.end_month, help="latest month (YYYY-MM)")
+    parser.add_argument("--seed", type=int, default=d.seed)
+
+
+def scale_from_args(args: argparse.Namespace) -> Scale:
+    return Scale(**{k: getattr(args, k) for k in asdict(Scale())})
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="PostgREST stand-in with synthetic NPS data for read API load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--max-rows", type=int, default=StandinConfig.max_rows, help="rows per request cap (0 = none)")
+    parser.add_argument("--latency-ms", type=float, default=StandinConfig.latency_ms, help="added per request (network)")
+    add_scale_args(parser)
+    args = parser.parse_args()
+
+    scale = scale_from_args(args)
+    started = time.perf_counter()
+    tables = seed(scale)
+    print(f"seeded {', '.join(f'{k}={len(t)}' for k, t in tables.items())} in {time.perf_counter() - started:.1f}s", flush=True)
+    app = create_app(tables, StandinConfig(max_rows=args.max_rows, latency_ms=args.latency_ms), scale)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
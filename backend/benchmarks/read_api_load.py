@@ -0,0 +1,416 @@
+"""
+Read API load test
+Seeds the PostgREST stand-in (benchmarks/postgrest_standin.py) with synthetic
+data, starts the API against it and drives mixed dashboard traffic with
+asyncio at fixed concurrency levels:
+
+- GET /surveys
+- GET /surveys/{survey_name}/metrics
+- GET /surveys/{survey_name}/responses (paged)
+- GET /themes/{survey_name} (whole survey, per title, or a month range)
+- GET /enrich/stats
+
+Each level runs closed-loop for --duration seconds after --warmup; throughput,
+error counts and p50/p95/p99 are reported per endpoint, together with the
+time the stand-in spent answering each table. Every run is appended to
+--history (JSON lines, keyed by git revision) and compared with the newest
+earlier run at the same scale, or with --baseline <revision>. With --tolerance
+the run fails (exit 1) when an endpoint's p95 grows or its throughput drops by
+more than that fraction. --cache selects the API's response cache backend
+(CACHE_BACKEND); with redis a local Redis-protocol stand-in is started.
+--store serves survey metrics from the in-process columnar response store
+(RESPONSE_STORE=on).
+
+Run from backend/:
+    python benchmarks/read_api_load.py
+    python benchmarks/read_api_load.py --titles 50 --months 24 --responses 1000000 --concurrency 1,8,32 --duration 20
+    python benchmarks/read_api_load.py --workers 4 --baseline 1631fe9 --tolerance 0.2
+    python benchmarks/read_api_load.py --workers 4 --cache shm
+    python benchmarks/read_api_load.py --workers 4 --store
+    python benchmarks/read_api_load.py --api-url http://127.0.0.1:8000 --db-url http://127.0.0.1:54321
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from enrich_throughput import BACKEND_DIR, PLACEHOLDER_ENV, git_revision, percentiles  # noqa: E402
+from postgrest_standin import Scale, add_scale_args, scale_from_args, survey_names, title_names  # noqa: E402
+
+HISTORY_FILE = os.path.join(BACKEND_DIR, "benchmarks", "results", "read_api_load.jsonl")
+DEFAULT_MIX = "surveys=10,metrics=25,responses=30,themes=25,stats=10"
+ENDPOINTS = ("surveys", "metrics", "responses", "themes", "stats")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, proc: Optional[subprocess.Popen], timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"{proc.args[1:3]} exited with {proc.returncode}")
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise SystemExit(f"unknown endpoint in --mix: {name!r} (expected {', '.join(ENDPOINTS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+# -----------------------------------------------------------------------------
+# Traffic
+# -----------------------------------------------------------------------------
+class Traffic:
+    """Dashboard-shaped requests over the seeded surveys, titles and months."""
+
+    def __init__(self, scale: Scale, mix: Dict[str, float], page_size: int, seed: int) -> None:
+        self.rng = random.Random(seed)
+        self.surveys = survey_names(scale)
+        self.titles = title_names(scale)
+        self.title_survey = {t: self.surveys[i % len(self.surveys)] for i, t in enumerate(self.titles)}
+        # Month starts, newest first
+        end = datetime.strptime(scale.end_month, "%Y-%m")
+        last = end.year * 12 + end.month - 1
+        self.months = [date((last - i) // 12, (last - i) % 12 + 1, 1) for i in range(scale.months)]
+        self.page_size = page_size
+        self.names = list(mix)
+        self.weights = list(mix.values())
+
+    def next(self) -> Tuple[str, str, Dict[str, Any]]:
+        rng = self.rng
+        endpoint = rng.choices(self.names, self.weights)[0]
+        survey = rng.choice(self.surveys)
+        if endpoint == "surveys":
+            return endpoint, "/surveys", {}
+        if endpoint == "metrics":
+            return endpoint, f"/surveys/{survey}/metrics", {}
+        if endpoint == "responses":
+            # Most people look at the first pages
+            page = min(int(rng.expovariate(0.5)), 50)
+            return endpoint, f"/surveys/{survey}/responses", {"limit": self.page_size, "offset": page * self.page_size}
+        if endpoint == "themes":
+            roll = rng.random()
+            if roll < 0.3:
+                title = rng.choice(self.titles)
+                return endpoint, f"/themes/{self.title_survey[title]}", {"title": title}
+            if roll < 0.6:
+                span = rng.choice([3, 6, 12])
+                start = rng.randrange(0, max(1, len(self.months) - span + 1))
+                window = self.months[start : start + span]
+                return endpoint, f"/themes/{survey}", {"start_month": window[-1].isoformat(), "end_month": window[0].isoformat()}
+            return endpoint, f"/themes/{survey}", {}
+        return endpoint, "/enrich/stats", {}
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {e: [] for e in ENDPOINTS}
+        self.errors: Dict[str, Dict[str, int]] = {e: {} for e in ENDPOINTS}
+        self.bytes: Dict[str, int] = {e: 0 for e in ENDPOINTS}
+
+    def add(self, endpoint: str, secs: float, status: str, size: int) -> None:
+        self.latencies[endpoint].append(secs)
+        self.bytes[endpoint] += size
+        if status != "200":
+            self.errors[endpoint][status] = self.errors[endpoint].get(status, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        out = {}
+        for e in ENDPOINTS:
+            n = len(self.latencies[e])
+            if not n:
+                continue
+            out[e] = {
+                "requests": n,
+                "errors": self.errors[e],
+                "req_per_sec": round(n / elapsed, 2),
+                "latency_ms": percentiles(self.latencies[e]),
+                "avg_kb": round(self.bytes[e] / n / 1024, 1),
+            }
+        return out
+
+
+async def run_level(api_url: str, traffic: Traffic, concurrency: int, warmup: float, duration: float, timeout: float) -> Dict[str, Any]:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=api_url, timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+
+        async def worker() -> None:
+            while True:
+                endpoint, path, params = traffic.next()
+                t0 = time.perf_counter()
+                if t0 >= stop_at:
+                    return
+                try:
+                    resp = await client.get(path, params=params)
+                    status, size = str(resp.status_code), len(resp.content)
+                except httpx.TimeoutException:
+                    status, size = "timeout", 0
+                except httpx.HTTPError as e:
+                    status, size = type(e).__name__, 0
+                t1 = time.perf_counter()
+                if t0 >= measure_from and t1 <= stop_at:
+                    recorder.add(endpoint, t1 - t0, status, size)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    endpoints = recorder.summary(duration)
+    total = sum(e["requests"] for e in endpoints.values())
+    errors = sum(sum(e["errors"].values()) for e in endpoints.values())
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "req_per_sec": round(total / duration, 2),
+        "endpoints": endpoints,
+    }
+
+
+def db_stats_delta(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    out = {}
+    for target, s in after.items():
+        b = before.get(target, {})
+        queries = s["queries"] - b.get("queries", 0)
+        if queries:
+            secs = s["secs"] - b.get("secs", 0.0)
+            out[target] = {
+                "queries": queries,
+                "rows_per_query": round((s["rows_returned"] - b.get("rows_returned", 0)) / queries, 1),
+                "ms_per_query": round(secs * 1000 / queries, 2),
+            }
+    return out
+
+
+# -----------------------------------------------------------------------------
+# History
+# -----------------------------------------------------------------------------
+def load_history(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def find_baseline(history: List[Dict[str, Any]], result: Dict[str, Any], revision: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Newest comparable run: same scale, mix and API workers (and `revision` if given)."""
+    keys = ("scale", "mix", "workers", "max_rows", "cache", "response_store")
+    for run in reversed(history):
+        if any(run.get(k) != result.get(k) for k in keys):
+            continue
+        if revision is None or (run.get("revision") or "").startswith(revision):
+            return run
+    return None
+
+
+def compare(result: Dict[str, Any], base: Dict[str, Any], tolerance: Optional[float]) -> List[str]:
+    """Print per-endpoint deltas; returns the regressions beyond tolerance."""
+    regressions = []
+    base_levels = {lvl["concurrency"]: lvl for lvl in base["levels"]}
+    print(f"\nvs {base.get('revision')} ({base.get('timestamp')}):")
+    for lvl in result["levels"]:
+        old_lvl = base_levels.get(lvl["concurrency"])
+        if old_lvl is None:
+            continue
+        for name, cur in lvl["endpoints"].items():
+            old = old_lvl["endpoints"].get(name)
+            if not old or not old["latency_ms"]["p95"] or not old["req_per_sec"]:
+                continue
+            p95 = cur["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1
+            rps = cur["req_per_sec"] / old["req_per_sec"] - 1
+            print(f"  c={lvl['concurrency']:<4} {name:<10} p95 {p95:+7.1%}  req/s {rps:+7.1%}")
+            if tolerance is not None and (p95 > tolerance or rps < -tolerance):
+                regressions.append(f"c={lvl['concurrency']} {name}: p95 {p95:+.1%}, req/s {rps:+.1%}")
+    return regressions
+
+
+def print_level(level: Dict[str, Any]) -> None:
+    print(f"\nconcurrency {level['concurrency']}: {level['req_per_sec']} req/s, {level['errors']} errors")
+    print(f"  {'endpoint':<10} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'kb':>7}  errors")
+    for name, e in level["endpoints"].items():
+        lat = e["latency_ms"]
+        print(f"  {name:<10} {e['req_per_sec']:>8} {lat['p50']:>8} {lat['p95']:>8} {lat['p99']:>8} {lat['max']:>8} {e['avg_kb']:>7}  {e['errors'] or ''}")
+    for target, s in level.get("db", {}).items():
+        print(f"  db {target:<22} {s['queries']:>7} queries  {s['ms_per_query']:>7} ms/query  {s['rows_per_query']:>7} rows/query")
+
+
+# -----------------------------------------------------------------------------
+# Processes
+# -----------------------------------------------------------------------------
+def start_standin(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    cmd = [
+        sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "postgrest_standin.py"),
+        "--port", str(port),
+        "--max-rows", str(args.max_rows),
+        "--latency-ms", str(args.db_latency_ms),
+    ]
+    for k, v in vars(scale_from_args(args)).items():
+        cmd += [f"--{k.replace('_', '-')}", str(v)]
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR)
+
+
+def start_api(db_url: str, port: int, workers: int, cache_env: Dict[str, str]) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        **PLACEHOLDER_ENV,
+        "SUPABASE_URL": db_url,
+        "SUPABASE_ANON_KEY": PLACEHOLDER_ENV["SUPABASE_SERVICE_ROLE_KEY"],
+        "SUPABASE_SERVICE_ROLE_KEY": PLACEHOLDER_ENV["SUPABASE_SERVICE_ROLE_KEY"],
+        **cache_env,
+    }
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent load test of the read API against a seeded PostgREST stand-in")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=15.0, help="measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=3.0, help="unmeasured seconds before each level")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint weights")
+    parser.add_argument("--page-size", type=int, default=100, help="limit for /responses pages")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per request seconds")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the API")
+    parser.add_argument("--cache", choices=["off", "local", "shm", "redis"], default="off", help="API response cache backend")
+    parser.add_argument("--store", action="store_true", help="enable the API's columnar response store")
+    parser.add_argument("--max-rows", type=int, default=1000, help="stand-in rows per request cap (0 = none)")
+    parser.add_argument("--db-latency-ms", type=float, default=1.0, help="stand-in latency per query")
+    parser.add_argument("--api-url", help="use a running API instead of starting one")
+    parser.add_argument("--db-url", help="use a running stand-in instead of starting one (its scale must match)")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--history", default=HISTORY_FILE, help="JSON lines file runs are appended to")
+    parser.add_argument("--baseline", help="revision to compare against (default: newest comparable run)")
+    parser.add_argument("--tolerance", type=float, help="fail on p95 growth or req/s drop beyond this fraction")
+    parser.add_argument("--no-save", action="store_true", help="do not append this run to --history")
+    add_scale_args(parser)
+    args = parser.parse_args()
+
+    scale = scale_from_args(args)
+    mix = parse_mix(args.mix)
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    procs: List[subprocess.Popen] = []
+    shm_path = None
+    store_dir = tempfile.mkdtemp(prefix="nps-response-store-bench-") if args.store else None
+    try:
+        db_url = args.db_url
+        if not db_url:
+            port = free_port()
+            db_url = f"http://127.0.0.1:{port}"
+            procs.append(start_standin(args, port))
+        seed_started = time.perf_counter()
+        wait_ready(f"{db_url}/health", procs[-1] if procs else None, args.startup_timeout)
+        seed_secs = time.perf_counter() - seed_started
+        tables = httpx.get(f"{db_url}/health").json()["tables"]
+
+        api_url = args.api_url
+        if not api_url:
+            cache_env = {"CACHE_BACKEND": args.cache}
+            if args.cache == "shm":
+                shm_path = cache_env["CACHE_SHM_PATH"] = os.path.join(tempfile.gettempdir(), f"nps-response-cache-bench-{os.getpid()}")
+            elif args.cache == "redis":
+                redis_port = free_port()
+                procs.append(subprocess.Popen(
+                    [sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "redis_standin.py"), "--port", str(redis_port)],
+                    cwd=BACKEND_DIR,
+                ))
+                cache_env["CACHE_REDIS_URL"] = f"redis://127.0.0.1:{redis_port}/0"
+            if store_dir:
+                cache_env.update(RESPONSE_STORE="on", RESPONSE_STORE_DIR=store_dir)
+            port = free_port()
+            api_url = f"http://127.0.0.1:{port}"
+            procs.append(start_api(db_url, port, args.workers, cache_env))
+            wait_ready(f"{api_url}/openapi.json", procs[-1], args.startup_timeout)
+        print(f"stand-in {db_url} ({', '.join(f'{k}={v}' for k, v in tables.items())}), API {api_url}", flush=True)
+
+        results = []
+        for concurrency in levels:
+            traffic = Traffic(scale, mix, args.page_size, seed=args.seed + concurrency)
+            before = httpx.get(f"{db_url}/stats").json()
+            level = asyncio.run(run_level(api_url, traffic, concurrency, args.warmup, args.duration, args.timeout))
+            level["db"] = db_stats_delta(before, httpx.get(f"{db_url}/stats").json())
+            print_level(level)
+            results.append(level)
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if shm_path and os.path.exists(shm_path):
+            os.remove(shm_path)
+        if store_dir:
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    result = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "scale": vars(scale),
+        "tables": tables,
+        "mix": mix,
+        "workers": args.workers,
+        "cache": args.cache,
+        # Only recorded when on, so earlier runs stay comparable
+        **({"response_store": "on"} if args.store else {}),
+        "max_rows": args.max_rows,
+        "db_latency_ms": args.db_latency_ms,
+        "duration": args.duration,
+        "seed_secs": round(seed_secs, 1),
+        "levels": results,
+    }
+
+    regressions: List[str] = []
+    history = load_history(args.history)
+    base = find_baseline(history, result, args.baseline)
+    if base is not None:
+        regressions = compare(result, base, args.tolerance)
+    elif args.baseline:
+        print(f"\nno comparable run for revision {args.baseline} in {args.history}")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, "a") as fh:
+            fh.write(json.dumps(result) + "\n")
+        print(f"\nappended to {args.history}")
+
+    if regressions:
+        print("REGRESSION: " + "; ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
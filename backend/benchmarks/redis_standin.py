@@ -0,0 +1,185 @@
+"""
+Local Redis-protocol stand-in
+A small asyncio RESP2 server with the commands the shared response cache
+(app/response_cache.py) uses: PING, AUTH, SELECT, GET, SET (EX/PX), MGET,
+DEL, INCR, FLUSHALL, PUBLISH and SUBSCRIBE. Keys live in one dict with lazy
+expiry. Lets CACHE_BACKEND=redis be exercised (load tests, multi-worker
+invalidation checks) without installing Redis.
+
+Run from backend/ (point the API at it with CACHE_BACKEND=redis CACHE_REDIS_URL=redis://127.0.0.1:6399/0):
+    python benchmarks/redis_standin.py --port 6399
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+class RedisStandin:
+    def __init__(self) -> None:
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.commands = 0
+
+    # -- protocol --------------------------------------------------------------
+    @staticmethod
+    def encode(value: Any) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, bool):
+            return b":%d\r\n" % int(value)
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        if isinstance(value, Exception):
+            return b"-ERR %s\r\n" % str(value).encode()
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(RedisStandin.encode(v) for v in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    @staticmethod
+    async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # inline command (redis-cli / telnet)
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    # -- commands --------------------------------------------------------------
+    def _get(self, key: bytes) -> Optional[bytes]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, args: List[bytes]) -> Any:
+        self.commands += 1
+        cmd = args[0].upper()
+        if cmd == b"PING":
+            return "PONG"
+        if cmd in (b"AUTH", b"SELECT"):
+            return "OK"
+        if cmd == b"GET":
+            return self._get(args[1])
+        if cmd == b"MGET":
+            return [self._get(k) for k in args[1:]]
+        if cmd == b"SET":
+            expires = None
+            opts = [a.upper() for a in args[3:]]
+            if b"EX" in opts:
+                expires = time.monotonic() + float(args[3 + opts.index(b"EX") + 1])
+            elif b"PX" in opts:
+                expires = time.monotonic() + float(args[3 + opts.index(b"PX") + 1]) / 1000
+            self.data[args[1]] = (args[2], expires)
+            return "OK"
+        if cmd == b"DEL":
+            return sum(self.data.pop(k, None) is not None for k in args[1:])
+        if cmd == b"INCR":
+            value = int(self._get(args[1]) or 0) + 1
+            self.data[args[1]] = (str(value).encode(), None)
+            return value
+        if cmd == b"FLUSHALL":
+            self.data.clear()
+            return "OK"
+        if cmd == b"PUBLISH":
+            message = self.encode([b"message", args[1], args[2]])
+            subscribers = self.channels.get(args[1], set())
+            for w in subscribers:
+                w.write(message)
+            return len(subscribers)
+        return ValueError(f"unknown command '{args[0].decode(errors='replace')}'")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if not args:
+                    break
+                if args[0].upper() == b"SUBSCRIBE":
+                    for i, channel in enumerate(args[1:], 1):
+                        self.channels.setdefault(channel, set()).add(writer)
+                        subscribed.add(channel)
+                        writer.write(self.encode([b"subscribe", channel, i]))
+                else:
+                    writer.write(self.encode(self.execute(args)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError: stand-in shutting down with clients still connected
+            pass
+        finally:
+            for channel in subscribed:
+                self.channels.get(channel, set()).discard(writer)
+            writer.close()
+
+
+class RedisStandinServer:
+    """Run the stand-in in a background thread (for benchmark drivers)."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.state = RedisStandin()
+        self._ready = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread = threading.Thread(target=self._run, name="redis-standin", daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}/0"
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(asyncio.start_server(self.state.handle, self.host, self.port))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        server.close()
+        pending = asyncio.all_tasks(self._loop)
+        for task in pending:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self._loop.close()
+
+    def __enter__(self) -> "RedisStandinServer":
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+async def serve(host: str, port: int) -> None:
+    server = await asyncio.start_server(RedisStandin().handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local Redis-protocol stand-in for the shared response cache")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6399)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Worker cold-start benchmark
+Imports `main` in fresh interpreters and reports wall time, which heavy
+modules got pulled in, and (with --clients) how long the first client
+construction takes. Run from backend/:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20 --clients --importtime 15
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("pandas", "openai", "supabase", "numpy", "httpx")
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import main
+imported = time.perf_counter() - t
+out = {"import_secs": imported, "heavy": [m for m in %r if m in sys.modules]}
+if %r:
+    from app import clients
+    t = time.perf_counter()
+    clients.supabase("service")
+    out["supabase_client_secs"] = time.perf_counter() - t
+    t = time.perf_counter()
+    clients.openai_async()
+    out["openai_client_secs"] = time.perf_counter() - t
+print(json.dumps(out))
+"""
+
+
+def run_once(with_clients: bool) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE % (HEAVY_MODULES, with_clients)],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def import_profile(top: int) -> list:
+    """Slowest modules by cumulative import time (python -X importtime)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def summarize(values: list) -> str:
+    values = sorted(values)
+    p90 = values[min(len(values) - 1, int(0.9 * len(values)))]
+    return f"median {statistics.median(values) * 1000:.0f} ms, p90 {p90 * 1000:.0f} ms, min {values[0] * 1000:.0f} ms"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure backend cold-start time")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--clients", action="store_true", help="also time first Supabase/OpenAI client construction")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="list the N slowest imports")
+    args = parser.parse_args()
+
+    results = [run_once(args.clients) for _ in range(args.runs)]
+    print(f"import main ({args.runs} runs): {summarize([r['import_secs'] for r in results])}")
+    print(f"heavy modules loaded at import: {', '.join(results[0]['heavy']) or 'none'}")
+    if args.clients:
+        print(f"first Supabase client: {summarize([r['supabase_client_secs'] for r in results])}")
+        print(f"first OpenAI client:   {summarize([r['openai_client_secs'] for r in results])}")
+    if args.importtime:
+        print("slowest imports (cumulative):")
+        for us, name in import_profile(args.importtime):
+            print(f"  {us / 1000:8.1f} ms {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,21 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-import pandas as pd
 import io
 import json
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel
 import os
 from dotenv import load_dotenv
-from supabase import create_client, Client
-import openai
 from datetime import datetime, date
 
 # Import new modules
 from app.ingest import router as ingest_router
 from app.enrich import router as enrich_router
+from app.batch_writer import flush_all as flush_pending_upserts
+from app.theme_aggregates import survey_themes
+from app import clients, ingest_jobs, keywords, metrics, profiling, raw_archive, response_cache, response_store, search, segments, sentiment, survey_processing, trends
+from app.stats import nps_interval
 
 # Load environment variables
 load_dotenv()
@@ -35,17 +36,49 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request latency per route, exported at /metrics
+app.middleware("http")(metrics.http_middleware)
+# Opt-in sampling profiler (X-Profile + PROFILE_TOKEN, or 1-in-PROFILE_SAMPLE_EVERY)
+app.middleware("http")(profiling.profile_middleware)
+
 # Include routers
 app.include_router(ingest_router)
+app.include_router(ingest_jobs.router)
 app.include_router(enrich_router)
+app.include_router(trends.router)
+app.include_router(segments.router)
+app.include_router(search.router)
+app.include_router(keywords.router)
+app.include_router(sentiment.router)
+app.include_router(survey_processing.router)
+app.include_router(raw_archive.router)
+app.include_router(response_cache.router)
+app.include_router(response_store.router)
+app.include_router(metrics.router)
+
+@app.on_event("startup")
+async def preload_clients():
+    """Optionally build API clients before taking traffic instead of on the first request"""
+    if os.getenv("PRELOAD_CLIENTS", "").lower() in {"1", "true", "yes"}:
+        clients.preload()
+    if response_store.enabled():
+        response_store.ensure_loaded()
+    # Per-comment keywords need the corpus matrix; build it off the event loop
+    keywords.warm()
+    metrics.start_snapshots()
 
-# Initialize Supabase client
-supabase_url = os.getenv("SUPABASE_URL")
-supabase_key = os.getenv("SUPABASE_ANON_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
+@app.on_event("shutdown")
+async def flush_buffers():
+    """Write any enrichment rows still buffered before the worker exits"""
+    flush_pending_upserts()
+    search.save_if_dirty()
+    response_store.save_if_dirty()
+    await clients.close_all()
+    metrics.write_snapshot()
 
-# Initialize OpenAI client
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Supabase (anon key) and OpenAI clients are shared and created on first use
+def supabase():
+    return clients.supabase("anon")
 
 # Pydantic models
 class NPSResponse(BaseModel):
@@ -97,7 +130,7 @@ def calculate_nps_score(promoters: int, detractors: int, total: int) -> float:
     return round(((promoters / total) - (detractors / total)) * 100, 2)
 
 async def enrich_with_ai(explanation: str) -> AIEnrichment:
-    """Use OpenAI to enrich NPS explanation with themes, sentiment, and keywords"""
+    """Use OpenAI to enrich NPS explanation with themes and sentiment; keywords are TF-IDF"""
     if not explanation or len(explanation.strip()) < 10:
         return AIEnrichment(
             themes=[],
@@ -117,13 +150,12 @@ async def enrich_with_ai(explanation: str) -> AIEnrichment:
         1. themes: Array of main themes/topics mentioned (max 5)
         2. sentiment_score: Sentiment score from -1.0 (very negative) to 1.0 (very positive)
         3. sentiment_label: "positive", "negative", or "neutral"
-        4. keywords: Array of key words/phrases (max 10)
-        5. summary: Brief summary of the response (max 100 characters)
+        4. summary: Brief summary of the response (max 100 characters)
         
         Respond with valid JSON only.
         """
         
-        response = await openai.ChatCompletion.acreate(
+        response = await clients.openai_async().chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=300,
@@ -131,6 +163,8 @@ async def enrich_with_ai(explanation: str) -> AIEnrichment:
         )
         
         result = json.loads(response.choices[0].message.content)
+        # Keywords come from the corpus TF-IDF engine rather than the model
+        result["keywords"] = keywords.extract(explanation)
         return AIEnrichment(**result)
         
     except Exception as e:
@@ -153,9 +187,21 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 @app.post("/upload-csv")
-async def upload_csv(file: UploadFile = File(...)):
-    """Upload and process CSV file with NPS data"""
+async def upload_csv(file: UploadFile = File(...), background: bool = False):
+    """Upload and process CSV file with NPS data
+    
+    With background=true the file is spooled and ingested as an ingest job
+    (batched, no inline AI enrichment); poll /ingest/jobs/{job_id} for progress.
+    """
+    if background:
+        status = await ingest_jobs.start_job(file)
+        return JSONResponse(status_code=202, content=status.model_dump())
+    touched_surveys = set()
+    upload_id = None
+    inserted_count = 0
     try:
+        import pandas as pd  # heavy; only this legacy inline path needs it
+
         # Read CSV file
         contents = await file.read()
         df = pd.read_csv(io.StringIO(contents.decode('utf-8')))
@@ -168,9 +214,12 @@ async def upload_csv(file: UploadFile = File(...)):
                 detail=f"CSV must contain columns: {required_columns}"
             )
         
+        # With RAW_ARCHIVE=parquet the original rows are archived once instead of per-row nps_raw inserts
+        upload_id = raw_archive.archive_rows(df.to_dict(orient="records"), file.filename) if raw_archive.enabled() else None
+        
         # Process each row
         processed_count = 0
-        for _, row in df.iterrows():
+        for row_index, (_, row) in enumerate(df.iterrows()):
             # Map CSV columns to our schema
             nps_data = {
                 "survey_name": row.get('SURVEY', ''),
@@ -184,15 +233,17 @@ async def upload_csv(file: UploadFile = File(...)):
                 "raw_data": row.to_dict()
             }
             
-            # Insert into nps_raw table
-            result = supabase.table("nps_raw").insert(nps_data).execute()
+            if upload_id:
+                raw_ref = {"upload_id": upload_id, "row_index": row_index}
+            else:
+                # Insert into nps_raw table
+                result = supabase().table("nps_raw").insert(nps_data).execute()
+                raw_ref = {"raw_id": result.data[0]['id']} if result.data else None
             
-            if result.data:
-                raw_id = result.data[0]['id']
-                
+            if raw_ref:
                 # Process and insert into nps_response table
                 response_data = {
-                    "raw_id": raw_id,
+                    **raw_ref,
                     "survey_name": nps_data["survey_name"],
                     "nps_score": nps_data["nps_score"],
                     "nps_explanation": nps_data["nps_explanation"],
@@ -206,10 +257,17 @@ async def upload_csv(file: UploadFile = File(...)):
                     "has_explanation": bool(nps_data["nps_explanation"] and nps_data["nps_explanation"].strip())
                 }
                 
-                response_result = supabase.table("nps_response").insert(response_data).execute()
+                response_result = supabase().table("nps_response").insert(response_data).execute()
                 
                 if response_result.data:
                     response_id = response_result.data[0]['id']
+                    inserted_count += 1
+                    touched_surveys.add(response_data["survey_name"])
+                    trends.record_ingested(response_result.data)
+                    segments.record_ingested(response_result.data)
+                    search.record_ingested(response_result.data)
+                    response_store.record_ingested(response_result.data)
+                    keywords.record_ingested(response_result.data)
                     
                     # AI enrichment (async)
                     if response_data["has_explanation"]:
@@ -226,7 +284,7 @@ async def upload_csv(file: UploadFile = File(...)):
                             "processing_status": "completed"
                         }
                         
-                        supabase.table("nps_ai_enrichment").insert(enrichment_data).execute()
+                        supabase().table("nps_ai_enrichment").insert(enrichment_data).execute()
                 
                 processed_count += 1
         
@@ -238,13 +296,26 @@ async def upload_csv(file: UploadFile = File(...)):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing CSV: {str(e)}")
+    finally:
+        # Also after a partial failure: rows inserted so far are visible to every worker
+        if touched_surveys:
+            response_cache.invalidate(*touched_surveys, response_cache.ALL_SURVEYS, response_cache.ENRICHMENT)
+        if upload_id is not None and not inserted_count:
+            # No response points into the archive; don't leave it orphaned
+            try:
+                raw_archive.delete_upload(upload_id)
+            except Exception as e:
+                print(f"Could not delete unused archive {upload_id}: {e}")
 
 @app.get("/surveys", response_model=List[NPSSurveyMetrics])
 async def get_surveys():
     """Get all surveys with their metrics"""
     try:
-        result = supabase.rpc('get_survey_metrics').execute()
-        return result.data
+        return response_cache.get_or_compute(
+            "surveys", [response_cache.ALL_SURVEYS], {},
+            lambda: (response_store.current().survey_metrics() if response_store.enabled()
+                     else supabase().rpc("get_survey_metrics", {}).execute().data),
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching surveys: {str(e)}")
 
@@ -252,50 +323,73 @@ async def get_surveys():
 async def get_survey_responses(survey_name: str, limit: int = 100, offset: int = 0):
     """Get responses for a specific survey"""
     try:
-        result = supabase.table("nps_response").select("*").eq("survey_name", survey_name).range(offset, offset + limit - 1).execute()
-        return result.data
+        return response_cache.get_or_compute(
+            "survey_responses", [survey_name], {"limit": limit, "offset": offset},
+            lambda: supabase().table("nps_response").select("*").eq("survey_name", survey_name).range(offset, offset + limit - 1).execute().data,
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching responses: {str(e)}")
 
+def load_survey_metrics(survey_name: str) -> Dict[str, Any]:
+    """Detailed metrics for a survey, computed from its responses"""
+    if response_store.enabled():
+        found = response_store.current().survey_metrics(survey_name)
+        if not found:
+            raise HTTPException(status_code=404, detail="Survey not found")
+        return found[0]
+
+    result = supabase().table("nps_response").select("nps_score, nps_category, creation_date").eq("survey_name", survey_name).execute()
+    
+    if not result.data:
+        raise HTTPException(status_code=404, detail="Survey not found")
+    
+    responses = result.data
+    total = len(responses)
+    promoters = len([r for r in responses if r['nps_category'] == 'promoter'])
+    passives = len([r for r in responses if r['nps_category'] == 'passive'])
+    detractors = len([r for r in responses if r['nps_category'] == 'detractor'])
+    
+    ci = nps_interval(promoters, passives, detractors)
+    
+    return {
+        "survey_name": survey_name,
+        "total_responses": total,
+        "promoters": promoters,
+        "passives": passives,
+        "detractors": detractors,
+        "average_score": round(sum(r['nps_score'] for r in responses) / total, 2) if total > 0 else 0,
+        "nps_score": calculate_nps_score(promoters, detractors, total),
+        "nps_ci_low": round(float(ci["ci_low"]), 2),
+        "nps_ci_high": round(float(ci["ci_high"]), 2),
+        "first_response": min(r['creation_date'] for r in responses) if responses else None,
+        "last_response": max(r['creation_date'] for r in responses) if responses else None
+    }
+
 @app.get("/surveys/{survey_name}/metrics")
 async def get_survey_metrics(survey_name: str):
     """Get detailed metrics for a specific survey"""
     try:
-        # Get basic metrics
-        result = supabase.table("nps_response").select("nps_score, nps_category, creation_date").eq("survey_name", survey_name).execute()
-        
-        if not result.data:
-            raise HTTPException(status_code=404, detail="Survey not found")
-        
-        responses = result.data
-        total = len(responses)
-        promoters = len([r for r in responses if r['nps_category'] == 'promoter'])
-        passives = len([r for r in responses if r['nps_category'] == 'passive'])
-        detractors = len([r for r in responses if r['nps_category'] == 'detractor'])
-        
-        metrics = {
-            "survey_name": survey_name,
-            "total_responses": total,
-            "promoters": promoters,
-            "passives": passives,
-            "detractors": detractors,
-            "average_score": round(sum(r['nps_score'] for r in responses) / total, 2) if total > 0 else 0,
-            "nps_score": calculate_nps_score(promoters, detractors, total),
-            "first_response": min(r['creation_date'] for r in responses) if responses else None,
-            "last_response": max(r['creation_date'] for r in responses) if responses else None
-        }
-        
-        return metrics
-        
+        return response_cache.get_or_compute("survey_metrics", [survey_name], {}, lambda: load_survey_metrics(survey_name))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calculating metrics: {str(e)}")
 
 @app.get("/themes/{survey_name}")
-async def get_survey_themes(survey_name: str):
-    """Get theme analysis for a specific survey"""
+async def get_survey_themes(
+    survey_name: str,
+    title: Optional[str] = None,
+    start_month: Optional[date] = None,
+    end_month: Optional[date] = None,
+):
+    """Get theme analysis for a specific survey from the precomputed theme aggregate"""
     try:
-        result = supabase.table("nps_theme_analysis").select("*").eq("survey_name", survey_name).execute()
-        return result.data
+        start = start_month.replace(day=1).isoformat() if start_month else None
+        end = end_month.replace(day=1).isoformat() if end_month else None
+        return response_cache.get_or_compute(
+            "survey_themes",
+            [survey_name, response_cache.ENRICHMENT],
+            {"title": title, "start_month": start, "end_month": end},
+            lambda: survey_themes(supabase(), survey_name, title=title, start_month=start, end_month=end),
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching themes: {str(e)}")
 
@@ -0,0 +1,99 @@
+"""
+In-memory stand-in for the Supabase query builder
+Just enough of select/filters/order/limit for app.db.iter_pages catch-ups,
+including PostgREST's max-rows cap, plus filtered UPDATEs and recorded RPC
+calls, so refresh and write paths run without a database.
+"""
+
+from __future__ import annotations
+
+import random
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+MAX_ROWS = 1000
+
+
+class FakeQuery:
+    def __init__(self, rows: List[Dict[str, Any]]) -> None:
+        self.rows = rows
+        self.filters: List[Callable[[Dict[str, Any]], bool]] = []
+        self.key: Optional[str] = None
+        self.count = MAX_ROWS
+        self.values: Optional[Dict[str, Any]] = None
+
+    def select(self, columns: str) -> "FakeQuery":
+        return self
+
+    def update(self, values: Dict[str, Any]) -> "FakeQuery":
+        self.values = values
+        return self
+
+    def in_(self, column: str, values: List[Any]) -> "FakeQuery":
+        wanted = set(values)
+        self.filters.append(lambda r: r.get(column) in wanted)
+        return self
+
+    def eq(self, column: str, value: Any) -> "FakeQuery":
+        self.filters.append(lambda r: r.get(column) == value)
+        return self
+
+    def gte(self, column: str, value: Any) -> "FakeQuery":
+        self.filters.append(lambda r: r.get(column) is not None and r[column] >= value)
+        return self
+
+    def gt(self, column: str, value: Any) -> "FakeQuery":
+        self.filters.append(lambda r: r.get(column) is not None and r[column] > value)
+        return self
+
+    def order(self, column: str) -> "FakeQuery":
+        self.key = column
+        return self
+
+    def limit(self, n: int) -> "FakeQuery":
+        self.count = min(n, MAX_ROWS)
+        return self
+
+    def execute(self) -> SimpleNamespace:
+        found = [r for r in self.rows if all(f(r) for f in self.filters)]
+        if self.values is not None:
+            for r in found:
+                r.update(self.values)
+            return SimpleNamespace(data=[dict(r) for r in found])
+        if self.key is not None:
+            found.sort(key=lambda r: r[self.key])
+        return SimpleNamespace(data=[dict(r) for r in found[: self.count]])
+
+
+class FakeClient:
+    def __init__(self, tables: Dict[str, List[Dict[str, Any]]]) -> None:
+        self.tables = tables
+        self.rpc_calls: List[Tuple[str, Dict[str, Any]]] = []
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self.tables.setdefault(name, []))
+
+    def rpc(self, name: str, params: Dict[str, Any]) -> SimpleNamespace:
+        self.rpc_calls.append((name, params))
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=0))
+
+
+def response_rows(n: int, seed: int = 0, start: int = 0) -> List[Dict[str, Any]]:
+    """nps_response rows with NULL titles/surveys and missing dates mixed in."""
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    rows = []
+    for i in range(start, start + n):
+        rows.append({
+            "id": f"{i:08d}",
+            "survey_name": rnd.choice(["Krant", "Magazine", None]),
+            "title_text": rnd.choice(["Dagblad", "Weekblad", "Maandblad", None]),
+            "gender": rnd.choice(["man", "vrouw", None]),
+            "age_range": rnd.choice(["18-34", "35-54", "55+"]),
+            "years_employed": rnd.choice(["<1", "1-5", ">5"]),
+            "creation_date": None if i % 40 == 0 else f"2026-{rnd.randint(1, 9):02d}-{rnd.randint(1, 28):02d}",
+            "nps_score": rnd.randint(0, 10),
+            "created_at": (now - timedelta(seconds=rnd.randint(0, 3600))).isoformat(),
+        })
+    return rows
@@ -0,0 +1,76 @@
+import math
+from collections import Counter
+
+from app.keywords import BIGRAM_MIN_DF, KeywordEngine, analyze, pick_distinct
+
+CORPUS = [
+    ("a", "Dagblad", "De krant komt elke dag te laat, echt elke dag"),
+    ("b", "Dagblad", "Bezorging van de krant is slecht"),
+    ("c", "Dagblad", "Krant te laat en de bezorger is onvriendelijk"),
+    ("d", "Maandblad", "Abonnement is veel te duur"),
+    ("e", "Maandblad", "De prijs van het abonnement stijgt elk jaar"),
+    ("f", "Maandblad", "Mooie puzzels maar duur abonnement"),
+]
+
+
+def engine(corpus=CORPUS):
+    e = KeywordEngine()
+    e.add_rows({"id": rid, "title_text": title, "nps_explanation": text, "nps_score": 5} for rid, title, text in corpus)
+    return e
+
+
+def brute_force(e, text):
+    """Unigram TF-IDF ranking of one comment: (1 + ln tf) * (ln((1 + N) / (1 + df)) + 1)."""
+    n = len(CORPUS)
+    docs = [Counter(t for t, _ in analyze(body)) for _, _, body in CORPUS]
+    tf = Counter(t for t, _ in analyze(text))
+    weight = {}
+    for term, count in tf.items():
+        df = sum(1 for d in docs if term in d)
+        if " " in term and df < BIGRAM_MIN_DF:
+            continue
+        weight[term] = (1 + math.log(count)) * (math.log((1 + n) / (1 + df)) + 1)
+    # Ties in column order, as in the index
+    ranked = sorted(weight, key=lambda t: (-weight[t], e.vocab[t]))
+    return [e.display(e.vocab[t]) for t in ranked]
+
+
+def test_analyze_bigrams_only_for_adjacent_words():
+    assert analyze("De kranten kwamen te laat") == [
+        ("krant", "kranten"),
+        ("kwam", "kwamen"),
+        ("krant kwam", "kranten kwamen"),
+        ("laat", "laat"),
+    ]
+    assert analyze(None) == []
+
+
+def test_doc_keywords_match_brute_force_tfidf():
+    e = engine()
+    for rid, _, text in CORPUS:
+        assert e.doc_keywords(rid, k=20) == brute_force(e, text)
+    assert e.doc_keywords("unknown") is None
+
+
+def test_all_keywords_match_per_document_keywords():
+    e = engine()
+    everything = e.all_keywords(k=3)
+    assert everything == {rid: e.doc_keywords(rid, k=3) for rid, _, _ in CORPUS}
+
+
+def test_extract_ranks_unseen_words_as_rare():
+    e = engine()
+    # "krant" is in half the corpus, "kartonnen" nowhere
+    assert e.extract("krant kartonnen", k=2) == ["kartonnen", "krant"]
+
+
+def test_pick_distinct_skips_overlapping_terms():
+    ranked = [("krant bezorg", "krant bezorging"), ("krant", "krant"), ("laat", "laat"), ("bezorg laat", "bezorging laat")]
+    assert pick_distinct(((t, lambda s=s: s) for t, s in ranked), 3) == ["krant bezorging", "laat"]
+
+
+def test_distinctive_keywords_per_title():
+    out = engine().distinctive("title", top=2, min_count=2)
+    assert out["Dagblad"][0]["keyword"] == "krant"
+    assert out["Dagblad"][0]["count"] == 3
+    assert {k["keyword"] for k in out["Maandblad"]} == {"abonnement", "duur"}
@@ -0,0 +1,47 @@
+from app.near_dupes import collapse, lsh_params, normalize
+
+TEXTS = [
+    "De krant kwam te laat!",
+    "de krant kwam   te laat",
+    "De bezorger kwam de krant vandaag weer te laat brengen",
+    "De bezorger kwam de krant vandaag weer te laat bezorgen",
+    "Prijs is veel te hoog voor wat je krijgt",
+]
+
+
+def test_normalize():
+    assert normalize("  De KRANT, kwam...te laat! ") == "de krant kwam te laat"
+    assert normalize(None) == ""
+
+
+def test_collapse_groups_near_duplicates():
+    result = collapse(TEXTS, threshold=0.8)
+    g = result.group
+    assert g[0] == g[1]
+    assert g[2] == g[3]
+    assert len({g[0], g[2], g[4]}) == 3
+    assert result.representatives.tolist() == sorted(set(g.tolist()))
+    # Every comment's representative is a member of its own group
+    assert all(g[r] == r for r in result.representatives)
+    assert result.collapse_ratio == 1 - 3 / 5
+    members = {int(r): m.tolist() for r, m in zip(result.representatives, result.members())}
+    assert sorted(members[g[2]]) == [2, 3]
+
+
+def test_exact_mode_only_merges_identical_normalized_text():
+    g = collapse(TEXTS, threshold=0).group
+    assert g[0] == g[1]
+    assert len(set(g.tolist())) == 4
+
+
+def test_collapse_is_deterministic_and_handles_empty_input():
+    assert collapse(TEXTS, threshold=0.8).group.tolist() == collapse(list(TEXTS), threshold=0.8).group.tolist()
+    empty = collapse([], threshold=0.8)
+    assert len(empty.group) == 0 and empty.collapse_ratio == 0.0
+    assert collapse(["a"], threshold=0.8).group.tolist() == [0]
+
+
+def test_lsh_params_midpoint_near_threshold():
+    bands, rows = lsh_params(0.8, 64)
+    assert bands * rows == 64
+    assert abs((1 / bands) ** (1 / rows) - 0.8) < 0.1
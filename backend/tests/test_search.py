@@ -0,0 +1,84 @@
+import math
+from collections import Counter
+from datetime import date
+
+import pytest
+
+from app.search import B, K1, SearchIndex, stem, tokenize
+
+DOCS = [
+    {"id": "a", "nps_explanation": "De krant wordt te laat bezorgd, elke dag weer een late krant", "survey_name": "Krant", "title_text": "Dagblad", "nps_score": 3, "creation_date": "2026-01-10"},
+    {"id": "b", "nps_explanation": "Bezorging prima, de krant is goed", "survey_name": "Krant", "title_text": "Dagblad", "nps_score": 9, "creation_date": "2026-02-10"},
+    {"id": "c", "nps_explanation": "Te duur voor wat je krijgt", "survey_name": "Magazine", "title_text": "Maandblad", "nps_score": 5, "creation_date": "2026-03-10"},
+    {"id": "d", "nps_explanation": "Krant", "survey_name": "Krant", "title_text": "Weekblad", "nps_score": 8, "creation_date": None},
+    {"id": "e", "nps_explanation": "De puzzels zijn leuk en de bezorger is altijd op tijd", "survey_name": "Magazine", "title_text": "Maandblad", "nps_score": 10, "creation_date": "2026-04-10"},
+]
+
+
+def brute_force(query, docs=DOCS):
+    """Textbook BM25 over the same tokenizer."""
+    toks = {d["id"]: Counter(tokenize(d["nps_explanation"])) for d in docs}
+    toks = {k: v for k, v in toks.items() if v}
+    n = len(toks)
+    avgdl = sum(sum(c.values()) for c in toks.values()) / n
+    scores = {}
+    for term in set(tokenize(query)):
+        df = sum(1 for c in toks.values() if term in c)
+        if not df:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for rid, c in toks.items():
+            if term in c:
+                dl = sum(c.values())
+                tf = c[term]
+                scores[rid] = scores.get(rid, 0.0) + idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * dl / avgdl))
+    return sorted(scores.items(), key=lambda kv: -kv[1])
+
+
+def index(docs=DOCS):
+    idx = SearchIndex()
+    idx.add_rows(docs)
+    return idx
+
+
+def test_tokenize_and_stem():
+    assert tokenize("De kranten werden te laat bezorgd!") == ["krant", "werd", "laat", "bezorgd"]
+    assert stem("mogelijkheden") == "mogelijkheid"
+    assert stem("puzzels") == "puzzel"
+
+
+@pytest.mark.parametrize("query", ["krant", "krant bezorging", "late bezorger", "duur"])
+def test_ranking_matches_brute_force_bm25(query):
+    total, hits = index().search(query)
+    expected = brute_force(query)
+    assert total == len(expected)
+    assert [h["response_id"] for h in hits] == [rid for rid, _ in expected]
+    for h, (_, score) in zip(hits, expected):
+        assert h["score"] == pytest.approx(score, abs=1e-3)
+
+
+def test_filters_and_paging():
+    idx = index()
+    total, hits = idx.search("krant", categories=["promoter", "passive"])
+    assert total == 2 and {h["response_id"] for h in hits} == {"b", "d"}
+    total, hits = idx.search("krant", surveys=["Krant"], start=date(2026, 2, 1))
+    # Undated comments drop out as soon as a date bound is given
+    assert [h["response_id"] for h in hits] == ["b"]
+    total, page = idx.search("krant", limit=1, offset=1)
+    assert total == 3 and page[0]["response_id"] == brute_force("krant")[1][0]
+    assert idx.search("onbekendwoord") == (0, [])
+
+
+def test_compaction_and_snapshot_keep_results(tmp_path):
+    idx = index(DOCS[:3])
+    idx.compact()
+    idx.add_rows(DOCS[3:])
+    # Re-adding known ids is a no-op
+    assert idx.add_rows(DOCS) == 0
+    before = idx.search("krant bezorging")
+    assert before == index().search("krant bezorging")
+
+    idx.save(str(tmp_path))
+    loaded = SearchIndex()
+    assert loaded.load(str(tmp_path))
+    assert loaded.search("krant bezorging") == before
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from app import segments
+from app.segments import SegmentCube, summarize
+from tests.fakes import FakeClient, response_rows
+
+
+def brute_force(rows, group_by, filters=None, start_month=None, end_month=None):
+    hist = defaultdict(lambda: [0] * 11)
+    for r in rows:
+        if r["nps_score"] is None or not r["creation_date"]:
+            continue
+        values = {d: "" if r.get(d) is None else str(r[d]) for d in segments.DIMENSIONS if d != "month"}
+        values["month"] = r["creation_date"][:7] + "-01"
+        if any(values[d] not in wanted for d, wanted in (filters or {}).items()):
+            continue
+        if (start_month and values["month"] < start_month) or (end_month and values["month"] > end_month):
+            continue
+        hist[tuple(values[d] for d in group_by)][r["nps_score"]] += 1
+    return dict(hist)
+
+
+def as_dict(labels, hist):
+    return {tuple(label): row.tolist() for label, row in zip(labels, hist)}
+
+
+@pytest.mark.parametrize("group_by", [(), ("gender",), ("title_text", "month"), ("survey_name", "age_range", "years_employed")])
+def test_query_matches_groupby(group_by):
+    rows = response_rows(4000)
+    cube = SegmentCube()
+    cube.add_rows(rows)
+    assert as_dict(*cube.query(group_by)) == brute_force(rows, group_by)
+
+
+def test_filters_and_month_window():
+    rows = response_rows(4000, seed=1)
+    cube = SegmentCube()
+    cube.add_rows(rows)
+    filters = {"survey_name": ["Krant"], "gender": ["vrouw", ""]}
+    got = cube.query(("title_text",), filters, "2026-03-01", "2026-06-01")
+    assert as_dict(*got) == brute_force(rows, ("title_text",), filters, "2026-03-01", "2026-06-01")
+
+
+def test_sparse_group_by_path(monkeypatch):
+    rows = response_rows(2000, seed=2)
+    cube = SegmentCube()
+    cube.add_rows(rows)
+    group_by = ("title_text", "gender", "month")
+    monkeypatch.setattr(segments, "DENSE_GROUPS", 1)
+    assert as_dict(*cube.query(group_by)) == brute_force(rows, group_by)
+
+
+def test_refresh_does_not_count_ingested_rows_twice():
+    rows = response_rows(2500, seed=3)
+    client = FakeClient({"nps_response": rows})
+    cube = SegmentCube()
+    cube.add_rows(rows[:500])
+    cube.refresh(client)
+    more = response_rows(200, seed=4, start=len(rows))
+    for r in more:
+        r["created_at"] = datetime.now(timezone.utc).isoformat()
+    rows.extend(more)
+    cube.add_rows(more[:50])
+    cube.refresh(client)
+    assert as_dict(*cube.query(("gender",))) == brute_force(rows, ("gender",))
+
+
+def test_summarize():
+    hist = np.zeros((1, 11), dtype=np.int64)
+    hist[0, [0, 8, 10]] = [1, 1, 2]
+    s = summarize(hist)
+    assert s["nps"][0] == pytest.approx(25.0)
+    assert s["avg_score"][0] == pytest.approx(28 / 4)
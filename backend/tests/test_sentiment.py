@@ -0,0 +1,75 @@
+import math
+
+import pytest
+
+from app import sentiment
+from app.sentiment import BEFORE_MAAR, NEGATION_FACTOR, SOURCE_LOCAL, SentimentModel, label, label_from_llm
+from tests.fakes import FakeClient
+
+
+@pytest.fixture
+def lexicon(monkeypatch):
+    model = SentimentModel.from_lexicon()
+    monkeypatch.setattr(sentiment, "_model", model)
+    return model
+
+
+@pytest.mark.parametrize(
+    "text, raw",
+    [
+        ("goed", 1.0),
+        ("niet goed", -NEGATION_FACTOR * 1.0),
+        ("zeer slecht", 1.5 * -1.2),
+        # "maar" damps what came before it; two content tokens share a 1/sqrt(2) norm
+        ("goed maar duur", (BEFORE_MAAR * 1.0 - 0.8) / math.sqrt(2)),
+        ("de krant", 0.0),
+        (None, 0.0),
+    ],
+)
+def test_lexicon_scores_match_hand_computation(lexicon, text, raw):
+    assert lexicon.score([text])[0] == pytest.approx(math.tanh(lexicon.scale * raw))
+
+
+def test_labels():
+    assert label(None) == "neutral"
+    assert label(0.05) == "neutral"
+    assert label(0.3) == "positive"
+    assert label(-0.3) == "negative"
+    assert label_from_llm({"sentiment_label": "negative", "sentiment_score": 0.9}) == "negative"
+    assert label_from_llm({"sentiment_score": 0.8}) == "positive"
+    assert label_from_llm({"sentiment": "Detractor"}) == "negative"
+    assert label_from_llm({}) is None
+
+
+def test_model_round_trip(lexicon, tmp_path):
+    path = str(tmp_path / "model.npz")
+    lexicon.save(path)
+    loaded = SentimentModel.load(path)
+    texts = ["echt geweldig", "niet tevreden", "te duur"]
+    assert loaded.score(texts) == pytest.approx(lexicon.score(texts))
+
+
+def test_rescore_fills_missing_scores_only(lexicon):
+    client = FakeClient({
+        "nps_response": [
+            {"id": "r1", "nps_explanation": "Geweldig blad"},
+            {"id": "r2", "nps_explanation": "Veel te duur"},
+            {"id": "r3", "nps_explanation": "Prima"},
+            {"id": "r4", "nps_explanation": "   "},
+        ],
+        "nps_ai_enrichment": [
+            {"response_id": "r1", "sentiment_score": None},
+            {"response_id": "r2", "sentiment_score": None},
+            {"response_id": "r3", "sentiment_score": 0.5, "sentiment_source": "llm"},
+            {"response_id": "r4", "sentiment_score": None},
+        ],
+    })
+    result = sentiment.rescore(client)
+    assert result == {"rows": 2, "written": 2, "failed": []}
+    rows = {r["response_id"]: r for r in client.tables["nps_ai_enrichment"]}
+    assert rows["r1"]["sentiment_label"] == "positive" and rows["r1"]["sentiment_source"] == SOURCE_LOCAL
+    assert rows["r2"]["sentiment_label"] == "negative"
+    assert rows["r1"]["sentiment_score"] == round(float(lexicon.score(["Geweldig blad"])[0]), 2)
+    assert rows["r3"] == {"response_id": "r3", "sentiment_score": 0.5, "sentiment_source": "llm"}
+    assert rows["r4"]["sentiment_score"] is None
+    assert sorted(client.rpc_calls[0][1]["p_response_ids"]) == ["r1", "r2"]
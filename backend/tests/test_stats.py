@@ -0,0 +1,63 @@
+from statistics import NormalDist
+
+import numpy as np
+import pytest
+
+from app.stats import benjamini_hochberg, delta_significance, nps_interval, nps_with_se
+from app.trends import mom_table
+
+
+def test_nps_interval_matches_hand_computation():
+    # p = 0.5, d = 0.2: NPS 30, Var = (0.7 - 0.09) / 100
+    s = nps_interval(np.array([50]), np.array([30]), np.array([20]))
+    se = 100 * np.sqrt(0.0061)
+    assert s["nps"][0] == pytest.approx(30.0)
+    assert s["se"][0] == pytest.approx(se)
+    assert s["ci_low"][0] == pytest.approx(30.0 - 1.959964 * se, abs=1e-4)
+    assert s["ci_high"][0] == pytest.approx(30.0 + 1.959964 * se, abs=1e-4)
+
+
+def test_nps_interval_alpha_and_empty_segments():
+    s = nps_interval(np.array([50, 0]), np.array([30, 0]), np.array([20, 0]), alpha=0.1)
+    z = NormalDist().inv_cdf(0.95)
+    assert s["ci_high"][0] - s["nps"][0] == pytest.approx(z * s["se"][0])
+    assert np.isnan(s["nps"][1]) and np.isnan(s["ci_low"][1])
+    with pytest.raises(ValueError):
+        nps_interval(np.array([1]), np.array([1]), np.array([1]), alpha=1.5)
+
+
+def test_delta_significance_matches_hand_computation():
+    # NPS 40 (SE 8) against NPS 0 (SE sqrt(80)): delta 40, SE 12
+    cur = nps_with_se(np.array([60]), np.array([20]), np.array([20]))
+    prev = nps_with_se(np.array([40]), np.array([20]), np.array([40]))
+    sig = delta_significance(cur, prev)
+    assert sig["delta"][0] == pytest.approx(40.0)
+    assert sig["se"][0] == pytest.approx(12.0)
+    assert sig["z"][0] == pytest.approx(40 / 12)
+    assert sig["p_value"][0] == pytest.approx(2 * (1 - NormalDist().cdf(40 / 12)), abs=1e-6)
+    assert bool(sig["significant"][0])
+
+
+def test_benjamini_hochberg_known_vector():
+    # Sorted: .001 <= .01, .012 <= .02, .031 > .03, .039 <= .04, .2 > .05.
+    # Step-up: everything up to rank 4 is a discovery, .031 included.
+    p = np.array([0.039, 0.001, 0.031, 0.2, 0.012])
+    assert benjamini_hochberg(p).tolist() == [True, True, True, False, True]
+    assert not benjamini_hochberg(np.array([0.02, 0.03]), alpha=0.01).any()
+
+
+def test_benjamini_hochberg_ignores_nan_and_keeps_shape():
+    p = np.array([[0.001, np.nan], [0.04, 0.5]])
+    out = benjamini_hochberg(p)
+    assert out.shape == (2, 2)
+    # m counts the three real tests only: .04 > 2/3 * .05
+    assert out.tolist() == [[True, False], [False, False]]
+
+
+def test_trend_fdr_flags_are_a_subset_of_raw_flags():
+    rng = np.random.default_rng(0)
+    counts = rng.integers(0, 40, size=(30, 6, 3))
+    counts[:3, 3:, 0] += 200  # a few titles with real jumps
+    t = mom_table(counts)
+    assert t["significant_fdr"][:3, 3].all()
+    assert not (t["significant_fdr"] & ~t["significant"]).any()
@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+
+from app.taxonomy_remap import plan_remap, remap, remap_primary, slugify
+from app.theme_discovery import normalize_rows
+from tests.fakes import FakeClient
+
+TARGETS = ["prijs", "bezorging"]
+ALIASES = {"prijs": "prijs", "bezorging": "bezorging", "kosten": "prijs"}
+
+
+def corpus(seed=0):
+    """(themes, vectors) per row; None vectors are rows without an embedding."""
+    rng = np.random.default_rng(seed)
+    price, delivery = np.eye(8)[0], np.eye(8)[1]
+
+    def near(direction, n):
+        return list(direction + 0.05 * rng.standard_normal((n, 8)))
+
+    rows = (
+        [(["Prijs"], v) for v in near(price, 10)]
+        + [(["Bezorging"], v) for v in near(delivery, 10)]
+        + [(["Kosten"], v) for v in near(price, 2)]
+        # Enough rows for a theme centroid
+        + [(["tarieven"], v) for v in near(price, 6)]
+        # Too few for a theme centroid: matched row by row
+        + [(["laat"], v) for v in near(delivery, 2)]
+        # Equally close to both targets
+        + [(["raar"], (price + delivery) / np.sqrt(2))]
+        + [(["iets"], None)]
+    )
+    return [t for t, _ in rows], [v for _, v in rows]
+
+
+def test_plan_remap_steps():
+    themes, vectors = corpus()
+    has_vec = np.array([v is not None for v in vectors])
+    x = normalize_rows(np.stack([v if v is not None else np.zeros(8) for v in vectors])).astype(np.float32)
+    rows, src, mapped, names, stats = plan_remap(themes, x, has_vec, TARGETS, ALIASES)
+
+    by_theme = {}
+    for s, t in zip(src.tolist(), mapped.tolist()):
+        by_theme.setdefault(names[s], set()).add(TARGETS[t] if t >= 0 else None)
+    assert by_theme == {
+        "Prijs": {"prijs"},
+        "Bezorging": {"bezorging"},
+        "Kosten": {"prijs"},
+        "tarieven": {"prijs"},
+        "laat": {"bezorging"},
+        "raar": {None},
+        "iets": {None},
+    }
+    assert stats["by_alias"] == 22
+    assert stats["by_theme_centroid"] == 6
+    assert stats["by_row_centroid"] == 2
+    assert stats["learned"] == {"tarieven": "prijs"}
+
+
+def test_remap_primary():
+    assert remap_primary("Kosten", {"Kosten": "prijs"}, ["bezorging", "prijs"], ALIASES) == "prijs"
+    assert remap_primary("Kosten", {}, ["bezorging", "prijs"], ALIASES) == "prijs"
+    assert remap_primary("onbekend", {}, ["bezorging"], ALIASES) == "bezorging"
+    assert remap_primary(None, {}, ["prijs"], ALIASES) == "prijs"
+    assert slugify("  Prijs / Kosten ") == "prijs-kosten"
+
+
+def test_remap_writes_changed_rows_only(tmp_path):
+    themes, vectors = corpus()
+    enrichments = [
+        {
+            "response_id": f"r{i:03d}",
+            "themes": json.dumps(t),
+            "primary_theme": t[0],
+            "embedded_vector": None if v is None else "[" + ",".join(f"{c:.6f}" for c in v) + "]",
+        }
+        for i, (t, v) in enumerate(zip(themes, vectors))
+    ]
+    # Already on the target taxonomy: must not be rewritten
+    enrichments.append({"response_id": "r999", "themes": ["prijs"], "primary_theme": "prijs", "embedded_vector": None})
+    client = FakeClient({"nps_ai_enrichment": enrichments})
+    taxonomy = tmp_path / "taxonomy.json"
+    taxonomy.write_text(json.dumps({"prijs": ["Kosten"], "bezorging": []}))
+
+    result = remap(client, taxonomy_path=str(taxonomy))
+    # 30 remapped rows; "raar" and "iets" stay unresolved
+    assert result.changed == result.written == 30
+    assert result.unresolved == 2
+    rows = {r["response_id"]: r for r in client.tables["nps_ai_enrichment"]}
+    assert rows["r000"]["themes"] == ["prijs"] and rows["r000"]["primary_theme"] == "prijs"
+    assert rows["r028"]["themes"] == ["bezorging"]
+    assert rows["r030"]["themes"] == json.dumps(["raar"])
+    assert [name for name, _ in client.rpc_calls] == ["refresh_theme_aggregate_for"]
+    assert "r999" not in client.rpc_calls[0][1]["p_response_ids"]
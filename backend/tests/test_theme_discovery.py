@@ -0,0 +1,55 @@
+import numpy as np
+
+from app.theme_discovery import Projector, cluster, normalize_rows, parse_vector, representatives
+
+
+def blobs(sizes, dims=32, spread=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((len(sizes), dims)))
+    x = np.concatenate([c + spread * rng.standard_normal((n, dims)) for c, n in zip(centers, sizes)])
+    truth = np.repeat(np.arange(len(sizes)), sizes)
+    return normalize_rows(x).astype(np.float32), truth
+
+
+def test_cluster_recovers_blobs():
+    x, truth = blobs([80, 60, 70])
+    labels, sims, centers = cluster(x, k=3, min_cluster_size=10, min_similarity=0.5)
+    assert centers.shape == (3, x.shape[1])
+    found = set()
+    for blob in range(3):
+        got = np.unique(labels[truth == blob])
+        assert len(got) == 1 and got[0] >= 0
+        found.add(int(got[0]))
+    assert len(found) == 3
+
+
+def test_cluster_marks_outliers_and_small_clusters_as_noise():
+    x, truth = blobs([80, 60, 70])
+    # Random directions in 32 dimensions are far from every centroid
+    outliers = normalize_rows(np.random.default_rng(1).standard_normal((3, x.shape[1]))).astype(np.float32)
+    labels, _, _ = cluster(np.concatenate([x, outliers]), k=3, min_cluster_size=10, min_similarity=0.5)
+    assert (labels[len(x) :] == -1).all()
+    assert (labels[: len(x)] >= 0).all()
+
+    x, truth = blobs([80, 60, 8], seed=1)
+    labels, _, _ = cluster(x, k=3, min_cluster_size=10, min_similarity=0.5)
+    assert (labels[truth == 2] == -1).all()
+    assert len(np.unique(labels[truth == 0])) == 1 and labels[truth == 0][0] >= 0
+
+
+def test_representatives_are_closest_members():
+    labels = np.array([0, 0, 0, 1, 1, -1])
+    sims = np.array([0.7, 0.9, 0.8, 0.6, 0.95, 0.99])
+    reps = representatives(labels, sims, n=2)
+    assert reps[0].tolist() == [1, 2]
+    assert reps[1].tolist() == [4, 3]
+    assert -1 not in reps
+
+
+def test_parse_vector_and_projection():
+    assert parse_vector("[1,2.5,-3]").tolist() == [1.0, 2.5, -3.0]
+    assert parse_vector(None) is None
+    x = np.random.default_rng(2).standard_normal((5, 300)).astype(np.float32)
+    projected = Projector(dims=16)(x)
+    assert projected.shape == (5, 16)
+    assert np.allclose(np.linalg.norm(projected, axis=1), 1.0, atol=1e-5)
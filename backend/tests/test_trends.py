@@ -0,0 +1,77 @@
+from collections import defaultdict
+from datetime import date, datetime, timezone
+
+import numpy as np
+
+from app.trends import DETRACTORS, PASSIVES, PROMOTERS, TrendCounters, mom_table, month_key, score_slot
+from tests.fakes import FakeClient, response_rows
+
+
+def brute_force(rows, survey=None, start=None, end=None):
+    counts = defaultdict(lambda: [0, 0, 0])
+    for r in rows:
+        m = month_key(r["creation_date"])
+        if m is None or r["nps_score"] is None:
+            continue
+        if survey is not None and r["survey_name"] != survey:
+            continue
+        if (start is not None and m < month_key(start)) or (end is not None and m > month_key(end)):
+            continue
+        counts[(r["title_text"], m)][score_slot(r["nps_score"])] += 1
+    return dict(counts)
+
+
+def as_dict(names, months, counts):
+    return {
+        (names[t], months[m]): counts[t, m].tolist()
+        for t, m in zip(*np.nonzero(counts.sum(axis=2)))
+    }
+
+
+def test_matrix_matches_groupby():
+    rows = response_rows(3000)
+    store = TrendCounters()
+    store.add_rows(rows)
+    assert as_dict(*store.matrix()) == brute_force(rows)
+
+
+def test_survey_filter_and_month_window():
+    rows = response_rows(3000, seed=1)
+    store = TrendCounters()
+    store.add_rows(rows)
+    start, end = date(2026, 3, 1), date(2026, 5, 31)
+    got = as_dict(*store.matrix(survey="Krant", start=start, end=end))
+    assert got == brute_force(rows, survey="Krant", start=start, end=end)
+    # NULL surveys are a group of their own, not part of every survey
+    assert as_dict(*store.matrix(survey=None)) != got
+
+
+def test_refresh_does_not_count_ingested_rows_twice():
+    rows = response_rows(2500, seed=2)
+    client = FakeClient({"nps_response": rows})
+    store = TrendCounters()
+    # Rows this worker ingested itself, then a catch-up that reads them again
+    store.add_rows(rows[:400])
+    store.refresh(client)
+    store.refresh(client)
+    assert as_dict(*store.matrix()) == brute_force(rows)
+
+    # Rows another worker inserts later
+    more = response_rows(300, seed=3, start=len(rows))
+    for r in more:
+        r["created_at"] = datetime.now(timezone.utc).isoformat()
+    rows.extend(more)
+    store.refresh(client)
+    assert as_dict(*store.matrix()) == brute_force(rows)
+
+
+def test_mom_delta_against_last_month_with_responses():
+    counts = np.zeros((1, 3, 3), dtype=np.int64)
+    counts[0, 0, PROMOTERS] = 10
+    counts[0, 2, DETRACTORS] = 4
+    counts[0, 2, PASSIVES] = 4
+    t = mom_table(counts)
+    assert np.isnan(t["mom_delta"][0, 0])
+    assert t["prev_nps"][0, 2] == 100.0
+    assert t["nps"][0, 2] == -50.0
+    assert t["mom_delta"][0, 2] == -150.0
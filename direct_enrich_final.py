@@ -1,15 +1,27 @@
-import os, time, json, re, random
-from typing import Dict, Any, List
+import argparse, os, sys, time, json, re, random
+from typing import Dict, Any, List, Optional
 from openai import OpenAI
 from supabase import create_client, Client
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from app.batch_writer import BatchUpserter
+from app import near_dupes, openai_batch, prompts, response_cache
+from app.metrics import ENRICH_QUEUE, OPENAI_RETRIES, instrument_supabase, openai_call, serve_in_thread
+from app.profiling import profile_call
+from app.theme_aggregates import refresh_hook
+
 # ---- Config ----
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 BATCH_SIZE   = int(os.getenv("BATCH_SIZE", "250"))
 MAX_RPM      = int(os.getenv("MAX_RPM", "180"))
+UPSERT_ROWS  = int(os.getenv("UPSERT_ROWS", "250"))
+UPSERT_SECS  = float(os.getenv("UPSERT_SECS", "30"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # serve Prometheus metrics while running
+NEAR_DUP     = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))  # 0 sends every comment to the LLM
+POLL_SECS    = float(os.getenv("BATCH_POLL_SECS", "60"))  # --batch: status polling interval
 PAUSE_SECS   = 60.0 / MAX_RPM
 
-SB: Client = create_client(os.environ["NEXT_PUBLIC_SUPABASE_URL"], os.environ["SUPABASE_SERVICE_ROLE_KEY"])
+SB: Client = instrument_supabase(create_client(os.environ["NEXT_PUBLIC_SUPABASE_URL"], os.environ["SUPABASE_SERVICE_ROLE_KEY"]))
 client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
 
 # ---- Helpers ----
@@ -17,11 +29,20 @@ def slugify(name: str) -> str:
     s = re.sub(r"[^a-z0-9]+", "-", name.lower().strip())
     return re.sub(r"-+", "-", s).strip("-")
 
+def fetch_theme_usage() -> Dict[str, float]:
+    # Mentions per theme (sql/022_theme_usage.sql); empty before the aggregate exists
+    try:
+        res = SB.table("v_theme_usage").select("theme,mentions").execute()
+        return {r["theme"]: float(r["mentions"] or 0) for r in res.data or []}
+    except Exception:
+        return {}
+
 def fetch_current_themes() -> List[str]:
+    # Most used first, then newest, so a capped prompt list keeps the themes that matter
     try:
-        res = SB.table("themes").select("name").order("name").execute()
+        res = SB.table("themes").select("name").order("created_at", desc=True).execute()
         rows = res.data or []
-        return [r["name"] for r in rows]
+        return prompts.rank_themes([r["name"] for r in rows], fetch_theme_usage())
     except Exception:
         # If themes table doesn't exist or no permission, use default themes
         return ["content_kwaliteit", "pricing", "merkvertrouwen", "overige"]
@@ -61,29 +82,35 @@ confidence (number 0..1),
 new_theme (string, optioneel).
 """
 
-def classify_comment(comment: str, existing_themes: List[str]) -> Dict[str, Any]:
-    user_msg = (
-        "Huidige themas:\n- " + "\n- ".join(existing_themes[:200]) +
-        "\n\nReactie:\n" + comment
-    )
+USER_PREFIX = "Reactie:\n"
+
+def classify_prefix(existing_themes: List[str], model: str = OPENAI_MODEL) -> prompts.PromptPrefix:
+    # System + versioned theme list form one byte-stable, provider-cacheable prefix
+    return prompts.themed_prefix("classify", SYSTEM, tuple(existing_themes), model)
 
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role":"system","content": SYSTEM},
-            {"role":"user","content": user_msg}
-        ],
+def classify_request(comment: str, existing_themes: List[str], model: str = OPENAI_MODEL) -> Dict[str, Any]:
+    prefix = classify_prefix(existing_themes, model)
+    return dict(
+        model=model,
+        # Only the comment varies, at the very end
+        messages=prefix.messages(USER_PREFIX + comment),
         # Ask for plain JSON object (no schema). This avoids cache/name issues.
         response_format={"type": "json_object"},
         temperature=0.1
     )
 
+def classify_comment(comment: str, existing_themes: List[str], model: str = OPENAI_MODEL) -> Dict[str, Any]:
+    with openai_call(model) as call:
+        rsp = client.chat.completions.create(**classify_request(comment, existing_themes, model))
+        call.usage(rsp)
+    return parse_classification(rsp.choices[0].message.content)
+
+def parse_classification(txt: str) -> Dict[str, Any]:
     # Robust parse
     try:
-        data = json.loads(rsp.choices[0].message.content)
+        data = json.loads(txt)
     except Exception:
         # Fallback: attempt to extract JSON substring if model added prose (rare)
-        txt = rsp.choices[0].message.content
         start = txt.find("{")
         end   = txt.rfind("}")
         data = json.loads(txt[start:end+1]) if start != -1 and end != -1 else {}
@@ -105,8 +132,8 @@ def classify_comment(comment: str, existing_themes: List[str]) -> Dict[str, Any]
 
     return data
 
-def upsert_enrichment(response_id, model, payload, raw):
-    SB.table("nps_ai_enrichment").upsert({
+def enrichment_row(response_id, model, payload, raw) -> Dict[str, Any]:
+    return {
         "response_id": response_id,
         "model": model,
         "themes": payload["themes"],
@@ -114,7 +141,7 @@ def upsert_enrichment(response_id, model, payload, raw):
         "sentiment": payload["sentiment"],
         "confidence": float(payload["confidence"]),
         "raw": raw
-    }).execute()
+    }
 
 def fetch_unenriched_batch(limit: int) -> List[Dict[str, Any]]:
     # Pull a candidate page (cheap) and filter out already enriched locally (idempotent)
@@ -162,39 +189,216 @@ def reconcile_themes(model_out: Dict[str, Any], current_themes: List[str]) -> Di
         "confidence": float(model_out["confidence"]),
     }
 
-def main():
+def main(batch: bool = False, resume: str = "", limit: int = 0, wait: bool = True, poll_secs: float = POLL_SECS):
+    total = 0
+    if batch and not resume:
+        batch_run = submit_batch(limit)
+        if batch_run is None:
+            return
+        if not wait:
+            print(f"🕒 Submitted; resume later with --batch-resume {batch_run.run_id}")
+            return
+        resume = batch_run.run_id
+    if METRICS_PORT:
+        serve_in_thread(METRICS_PORT)
+    refresh = refresh_hook(SB)
+
+    def on_flush(rows):
+        refresh(rows)
+        # Same host / Redis as the API: its cached theme and stats results go stale
+        response_cache.invalidate_enrichment(rows)
+
+    writer = BatchUpserter(SB, "nps_ai_enrichment", on_conflict="response_id",
+                           max_rows=UPSERT_ROWS, max_age_secs=UPSERT_SECS,
+                           on_flush=on_flush)
+    try:
+        total = ingest_batch(openai_batch.BatchRun.find(resume), writer, poll_secs) if resume else run(writer)
+    finally:
+        writer.close()
+        failures = writer.take_failures()
+        for response_id, err in failures:
+            print(f"❌ Upsert failed for {response_id}: {err}")
+        total -= len(failures)
+        print(f"🎉 Done. Upserts: {total} in {writer.round_trips} round trips")
+
+def run(writer: BatchUpserter) -> int:
     total = 0
+    calls = 0
+    failed_ids = set()
     while True:
-        batch = fetch_unenriched_batch(BATCH_SIZE)
+        # Rows queued in the writer are not visible to the next fetch yet
+        writer.flush()
+        failed_ids.update(rid for rid, _ in writer.failures)
+        batch = [r for r in fetch_unenriched_batch(BATCH_SIZE) if r["id"] not in failed_ids]
         if not batch:
             print("✅ Klaar: geen unenriched rows meer.")
             break
 
         current = fetch_current_themes()
 
-        for row in batch:
+        # One LLM call per group of near-duplicate comments; members share the result
+        rows = [r for r in batch if (r["nps_explanation"] or "").strip()]
+        groups = near_dupes.collapse([r["nps_explanation"].strip() for r in rows], threshold=NEAR_DUP)
+        calls += len(groups.representatives)
+        print(f"Batch: {len(rows)} comments -> {len(groups.representatives)} LLM calls "
+              f"({groups.collapse_ratio:.1%} near-duplicates collapsed)")
+
+        for i, (rep, members) in enumerate(zip(groups.representatives, groups.members())):
+            row = rows[rep]
+            ENRICH_QUEUE.set(len(groups.representatives) - i, source="cli")
             time.sleep(PAUSE_SECS)
-            txt = (row["nps_explanation"] or "").strip()
-            if not txt:
-                continue
+            fitted = prompts.fit_comment(row["nps_explanation"], OPENAI_MODEL)
+            if fitted.truncated:
+                print(f"✂️  {row['id']}: comment truncated to {fitted.tokens} tokens")
 
             for attempt in range(5):
                 try:
-                    out = classify_comment(txt[:4000], current)
+                    out = classify_comment(fitted.text, current, fitted.model)
                     merged = reconcile_themes(out, current)
-                    upsert_enrichment(row["id"], OPENAI_MODEL, merged, out)
-                    total += 1
-                    if total % 100 == 0:
-                        print(f"Progress: {total} upserts")
+                    for m in members:
+                        writer.add(enrichment_row(rows[m]["id"], fitted.model, merged, out))
+                        total += 1
+                        if total % 100 == 0:
+                            print(f"Progress: {total} queued, {writer.written} written")
                     break
                 except Exception as e:
+                    OPENAI_RETRIES.inc(model=OPENAI_MODEL)
                     wait = 2 ** attempt + random.random()
                     print(f"Warn {attempt+1}/5 on {row['id']}: {e} — sleep {wait:.1f}s")
                     time.sleep(wait)
             else:
-                print(f"❌ Skipped {row['id']} after retries.")
+                print(f"❌ Skipped {row['id']} ({len(members)} comments) after retries.")
+                failed_ids.update(rows[m]["id"] for m in members)
+
+    if total:
+        print(f"Near-duplicates: {total} rows from {calls} LLM calls ({1 - calls / total:.1%} collapsed)")
+    return total
+
+# ---- Batch API mode ----
+def submit_batch(limit: int = 0) -> Optional[openai_batch.BatchRun]:
+    """Write the backlog as Batch API request files and submit them; returns the persisted run."""
+    rows = fetch_all_unenriched(limit)
+    if not rows:
+        print("✅ Klaar: geen unenriched rows meer.")
+        return None
+    current = fetch_current_themes()
+    groups = near_dupes.collapse([r["nps_explanation"].strip() for r in rows], threshold=NEAR_DUP)
+    batch_run = openai_batch.BatchRun.new(OPENAI_MODEL, themes=len(current), comments=len(rows))
+
+    def lines():
+        for rep, members in zip(groups.representatives, groups.members()):
+            row = rows[rep]
+            fitted = prompts.fit_comment(row["nps_explanation"], OPENAI_MODEL)
+            custom_id = str(row["id"])
+            batch_run.members[custom_id] = [rows[m]["id"] for m in members]
+            yield openai_batch.request_line(custom_id, classify_request(fitted.text, current, fitted.model))
+
+    paths = openai_batch.write_request_files(lines(), batch_run.directory, "requests")
+    batch_run.jobs = [openai_batch.BatchJob(request_file=p) for p in paths]
+    batch_run.save()
+    print(f"Batch run {batch_run.run_id}: {len(rows)} comments -> {len(groups.representatives)} requests "
+          f"in {len(paths)} file(s) ({groups.collapse_ratio:.1%} near-duplicates collapsed)")
+    openai_batch.BatchClient(client).submit(batch_run)
+    for job in batch_run.jobs:
+        print(f"📤 {job.batch_id} <- {os.path.basename(job.request_file)}")
+    return batch_run
+
+def enriched_ids(ids: List[str], chunk: int = 200) -> set:
+    """Which of these responses already have an enrichment row."""
+    found = set()
+    for i in range(0, len(ids), chunk):
+        res = SB.table("nps_ai_enrichment").select("response_id").in_("response_id", ids[i:i + chunk]).execute()
+        found.update(r["response_id"] for r in res.data or [])
+    return found
+
+def ingest_batch(batch_run: openai_batch.BatchRun, writer: BatchUpserter, poll_secs: float = POLL_SECS) -> int:
+    """
+    Poll the run's jobs and upsert each job's results as soon as it finishes.
+    Jobs take hours; responses enriched meanwhile (a live run, another batch,
+    an earlier ingest of this run) are re-checked here and left alone.
+    """
+    batches = openai_batch.BatchClient(client)
+    batches.submit(batch_run)  # a run interrupted mid-submit picks up where it stopped
+    totals = {"rows": 0, "failed": 0, "existing": 0}
+
+    def on_done(job: openai_batch.BatchJob) -> None:
+        if job.status != "completed":
+            print(f"❌ {job.batch_id} ended {job.status}; its comments stay unenriched for the next run")
+        current = fetch_current_themes()
+        results = []
+        for file_id, name in ((job.output_file_id, "output"), (job.error_file_id, "errors")):
+            if not file_id:
+                continue
+            path = batches.download(file_id, os.path.join(batch_run.directory, f"{job.batch_id}-{name}.jsonl"))
+            for line in openai_batch.iter_jsonl(path):
+                custom_id, body, error = openai_batch.parse_result(line)
+                results.append((custom_id, body, error, batch_run.members.get(custom_id, [custom_id])))
+        existing = enriched_ids([m for _, _, _, members in results for m in members])
+        for custom_id, body, error, members in results:
+            todo = [m for m in members if m not in existing]
+            totals["existing"] += len(members) - len(todo)
+            if not todo:
+                continue
+            try:
+                if error:
+                    raise RuntimeError(error)
+                out = parse_classification(body["choices"][0]["message"]["content"])
+                merged = reconcile_themes(out, current)
+            except Exception as e:
+                totals["failed"] += len(todo)
+                print(f"❌ Skipped {custom_id} ({len(todo)} comments): {e}")
+                continue
+            for m in todo:
+                writer.add(enrichment_row(m, body.get("model", batch_run.model), merged, out))
+                totals["rows"] += 1
+        writer.flush()
+        print(f"📥 {job.batch_id}: {job.request_counts} -> {totals['rows']} queued, {writer.written} written, "
+              f"{totals['existing']} already enriched")
+
+    batches.wait(batch_run, on_done, poll_secs)
+    if totals["failed"]:
+        print(f"{totals['failed']} comments failed; a live run (without --batch) picks them up")
+    return totals["rows"]
+
+def fetch_all_unenriched(limit: int = 0) -> List[Dict[str, Any]]:
+    """Every unenriched row with a comment (first `limit` when set), paged."""
+    from app.db import iter_pages
+
+    enriched = {r["response_id"] for page in iter_pages(SB, "nps_ai_enrichment", "response_id", key="response_id") for r in page}
+    rows: List[Dict[str, Any]] = []
+    for page in iter_pages(SB, "nps_response", "id, nps_explanation",
+                           where=lambda q: q.filter("nps_explanation", "not.is", "null")):
+        rows.extend(r for r in page if r["id"] not in enriched and (r["nps_explanation"] or "").strip())
+        if limit and len(rows) >= limit:
+            return rows[:limit]
+    return rows
 
-    print(f"🎉 Done. Upserts: {total}")
+def estimate_backfill(latency_secs: float) -> prompts.Estimate:
+    """Tokens, cost and wall time for everything still unenriched, without calling the LLM."""
+    comments = [r["nps_explanation"].strip() for r in fetch_all_unenriched()]
+    calls = len(near_dupes.collapse(comments, threshold=NEAR_DUP).representatives) if comments else 0
+    prefix = classify_prefix(fetch_current_themes())
+    return prompts.estimate(prefix, comments, OPENAI_MODEL, calls=calls, latency_secs=latency_secs + PAUSE_SECS,
+                            user_overhead=USER_PREFIX)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Enrich unenriched NPS responses")
+    parser.add_argument("--profile", metavar="FILE", help="sample stacks while running and write collapsed stacks to FILE")
+    parser.add_argument("--estimate", action="store_true", help="print tokens, cost and wall time for the backlog and exit")
+    parser.add_argument("--latency", type=float, default=1.5, help="seconds per LLM call assumed by --estimate")
+    parser.add_argument("--batch", action="store_true", help="submit the backlog as Batch API jobs (no MAX_RPM) and ingest the results")
+    parser.add_argument("--batch-resume", metavar="ID", default="", help="resume polling/ingesting a batch run (run id, batch job id or state file)")
+    parser.add_argument("--batch-limit", type=int, default=0, help="--batch: submit at most this many comments")
+    parser.add_argument("--no-wait", dest="wait", action="store_false", help="--batch: submit and exit; ingest later with --batch-resume")
+    parser.add_argument("--poll-secs", type=float, default=POLL_SECS, help="--batch: seconds between status polls")
+    args = parser.parse_args()
+    mode = dict(batch=args.batch, resume=args.batch_resume, limit=args.batch_limit, wait=args.wait, poll_secs=args.poll_secs)
+    if args.estimate:
+        est = estimate_backfill(args.latency)
+        print(json.dumps(est.to_dict(), indent=2))
+        if est.prefix_tokens < prompts.CACHE_MIN_TOKENS:
+            print(f"ℹ️  Prompt prefix is {est.prefix_tokens} tokens; provider caching starts at {prompts.CACHE_MIN_TOKENS}")
+    elif args.profile:
+        profile_call(main, args.profile, **mode)
+    else:
+        main(**mode)
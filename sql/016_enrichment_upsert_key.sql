@@ -0,0 +1,20 @@
+-- Unique key for batched enrichment upserts
+-- Multi-row upserts use on_conflict=response_id, which needs a unique index
+
+-- Keep exactly one enrichment per response before adding the constraint: the
+-- most recent by created_at (NULLs last), with ctid breaking ties and NULLs
+DELETE FROM nps_ai_enrichment e
+USING (
+    SELECT ctid,
+           row_number() OVER (
+               PARTITION BY response_id
+               ORDER BY created_at DESC NULLS LAST, ctid DESC
+           ) AS rn
+    FROM nps_ai_enrichment
+    WHERE response_id IS NOT NULL
+) ranked
+WHERE e.ctid = ranked.ctid
+  AND ranked.rn > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_nps_ai_enrichment_response_id
+ON nps_ai_enrichment(response_id);
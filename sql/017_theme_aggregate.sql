@@ -0,0 +1,178 @@
+-- Precomputed theme aggregates
+-- One row per (survey, title, month, theme), maintained incrementally as
+-- enrichment batches land. Replaces the unnest + group by that
+-- nps_theme_analysis runs over every enrichment on each read. Like that view
+-- it counts every response: undated responses land in the NULL month and
+-- NULL titles are a group of their own (not merged with '').
+
+CREATE TABLE IF NOT EXISTS nps_theme_aggregate (
+    -- Surrogate key for keyset paging (app.db.iter_pages); regenerated on refresh
+    id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    survey_name TEXT NOT NULL,
+    title_text TEXT,
+    month DATE,
+    theme TEXT NOT NULL,
+    mention_count INTEGER NOT NULL DEFAULT 0,
+    nps_sum INTEGER NOT NULL DEFAULT 0,
+    sentiment_sum NUMERIC NOT NULL DEFAULT 0,
+    sentiment_n INTEGER NOT NULL DEFAULT 0,
+    promoters INTEGER NOT NULL DEFAULT 0,
+    passives INTEGER NOT NULL DEFAULT 0,
+    detractors INTEGER NOT NULL DEFAULT 0,
+    positive_count INTEGER NOT NULL DEFAULT 0,
+    negative_count INTEGER NOT NULL DEFAULT 0,
+    neutral_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    UNIQUE NULLS NOT DISTINCT (survey_name, title_text, month, theme)
+);
+
+CREATE INDEX IF NOT EXISTS idx_nps_theme_aggregate_survey_month
+ON nps_theme_aggregate(survey_name, month);
+
+-- Rows feeding the aggregate. Enrichment columns are read from to_jsonb(ai),
+-- so the view works on both enrichment schemas: themes as JSONB or text[],
+-- sentiment_score/sentiment_label/processing_status (sql/001_init.sql) or
+-- only a sentiment class (create_tables.sql), which maps like
+-- app.sentiment.label_from_llm.
+CREATE OR REPLACE VIEW v_theme_aggregate_source AS
+SELECT
+    r.id AS response_id,
+    r.survey_name,
+    r.title_text,
+    date_trunc('month', r.creation_date)::date AS month,
+    theme,
+    r.nps_score,
+    (j ->> 'sentiment_score')::numeric AS sentiment_score,
+    COALESCE(
+        j ->> 'sentiment_label',
+        CASE lower(j ->> 'sentiment')
+            WHEN 'promoter' THEN 'positive'
+            WHEN 'positive' THEN 'positive'
+            WHEN 'detractor' THEN 'negative'
+            WHEN 'negative' THEN 'negative'
+            WHEN 'passive' THEN 'neutral'
+            WHEN 'neutral' THEN 'neutral'
+        END
+    ) AS sentiment_label
+FROM nps_response r
+JOIN nps_ai_enrichment ai ON ai.response_id = r.id,
+LATERAL to_jsonb(ai) AS j,
+LATERAL jsonb_array_elements_text(j -> 'themes') AS theme
+WHERE COALESCE(j ->> 'processing_status', 'completed') = 'completed';
+
+-- Recompute only the (survey, title, month) groups touched by the given responses.
+-- Concurrent flushes touching the same group are serialized with a
+-- transaction-scoped advisory lock per group, taken in key order so two
+-- flushes cannot deadlock; the later one recomputes after the earlier commits.
+CREATE OR REPLACE FUNCTION refresh_theme_aggregate_for(p_response_ids UUID[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public, pg_temp
+AS $$
+DECLARE
+    affected INTEGER;
+    k RECORD;
+BEGIN
+    CREATE TEMP TABLE IF NOT EXISTS pg_temp._theme_agg_keys (
+        survey_name TEXT, title_text TEXT, month DATE
+    ) ON COMMIT DROP;
+    TRUNCATE pg_temp._theme_agg_keys;
+
+    INSERT INTO pg_temp._theme_agg_keys
+    SELECT DISTINCT r.survey_name, r.title_text, date_trunc('month', r.creation_date)::date
+    FROM nps_response r
+    WHERE r.id = ANY(p_response_ids);
+
+    -- %L renders NULL unquoted, so a NULL title/month hashes apart from 'NULL' or ''
+    FOR k IN SELECT * FROM pg_temp._theme_agg_keys ORDER BY survey_name, title_text NULLS FIRST, month NULLS FIRST LOOP
+        PERFORM pg_advisory_xact_lock(
+            hashtext(format('nps_theme_aggregate|%L|%L|%L', k.survey_name, k.title_text, k.month))
+        );
+    END LOOP;
+
+    DELETE FROM nps_theme_aggregate a
+    USING pg_temp._theme_agg_keys k
+    WHERE a.survey_name = k.survey_name
+      AND a.title_text IS NOT DISTINCT FROM k.title_text
+      AND a.month IS NOT DISTINCT FROM k.month;
+
+    INSERT INTO nps_theme_aggregate (
+        survey_name, title_text, month, theme, mention_count, nps_sum,
+        sentiment_sum, sentiment_n, promoters, passives, detractors,
+        positive_count, negative_count, neutral_count, updated_at
+    )
+    SELECT
+        s.survey_name, s.title_text, s.month, s.theme,
+        COUNT(*),
+        SUM(s.nps_score),
+        COALESCE(SUM(s.sentiment_score), 0),
+        COUNT(s.sentiment_score),
+        COUNT(*) FILTER (WHERE s.nps_score >= 9),
+        COUNT(*) FILTER (WHERE s.nps_score BETWEEN 7 AND 8),
+        COUNT(*) FILTER (WHERE s.nps_score <= 6),
+        COUNT(*) FILTER (WHERE s.sentiment_label = 'positive'),
+        COUNT(*) FILTER (WHERE s.sentiment_label = 'negative'),
+        COUNT(*) FILTER (WHERE s.sentiment_label = 'neutral'),
+        NOW()
+    FROM v_theme_aggregate_source s
+    JOIN pg_temp._theme_agg_keys k
+      ON s.survey_name = k.survey_name
+     AND s.title_text IS NOT DISTINCT FROM k.title_text
+     AND s.month IS NOT DISTINCT FROM k.month
+    GROUP BY s.survey_name, s.title_text, s.month, s.theme;
+
+    GET DIAGNOSTICS affected = ROW_COUNT;
+    RETURN affected;
+END;
+$$;
+
+-- Full rebuild, e.g. after a taxonomy change or bulk SQL reclassification
+CREATE OR REPLACE FUNCTION refresh_theme_aggregate()
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public, pg_temp
+AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    TRUNCATE nps_theme_aggregate;
+
+    INSERT INTO nps_theme_aggregate (
+        survey_name, title_text, month, theme, mention_count, nps_sum,
+        sentiment_sum, sentiment_n, promoters, passives, detractors,
+        positive_count, negative_count, neutral_count, updated_at
+    )
+    SELECT
+        survey_name, title_text, month, theme,
+        COUNT(*),
+        SUM(nps_score),
+        COALESCE(SUM(sentiment_score), 0),
+        COUNT(sentiment_score),
+        COUNT(*) FILTER (WHERE nps_score >= 9),
+        COUNT(*) FILTER (WHERE nps_score BETWEEN 7 AND 8),
+        COUNT(*) FILTER (WHERE nps_score <= 6),
+        COUNT(*) FILTER (WHERE sentiment_label = 'positive'),
+        COUNT(*) FILTER (WHERE sentiment_label = 'negative'),
+        COUNT(*) FILTER (WHERE sentiment_label = 'neutral'),
+        NOW()
+    FROM v_theme_aggregate_source
+    GROUP BY survey_name, title_text, month, theme;
+
+    GET DIAGNOSTICS affected = ROW_COUNT;
+    RETURN affected;
+END;
+$$;
+
+GRANT SELECT ON nps_theme_aggregate TO anon, authenticated;
+
+-- The refresh functions run as their owner: only the backend (service role)
+-- may call them, not every holder of the anon key
+REVOKE EXECUTE ON FUNCTION refresh_theme_aggregate_for(UUID[]) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION refresh_theme_aggregate() FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION refresh_theme_aggregate_for(UUID[]) TO service_role;
+GRANT EXECUTE ON FUNCTION refresh_theme_aggregate() TO service_role;
+
+-- Initial fill
+SELECT refresh_theme_aggregate();
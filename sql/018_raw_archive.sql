@@ -0,0 +1,21 @@
+-- Compact raw-row archive
+-- With RAW_ARCHIVE=parquet each upload's original rows are stored once as a
+-- zstd-compressed Parquet file (local disk or a Supabase Storage bucket) instead
+-- of one nps_raw row per response. nps_response points at (upload_id, row_index).
+
+CREATE TABLE IF NOT EXISTS nps_upload (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    filename TEXT,
+    storage_uri TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    byte_size BIGINT,
+    columns TEXT[],
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE nps_response ADD COLUMN IF NOT EXISTS upload_id UUID REFERENCES nps_upload(id) ON DELETE SET NULL;
+ALTER TABLE nps_response ADD COLUMN IF NOT EXISTS row_index INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_nps_response_upload ON nps_response(upload_id, row_index);
+
+GRANT SELECT ON nps_upload TO anon, authenticated;
@@ -0,0 +1,14 @@
+-- Theme aliases for bulk taxonomy remaps (python -m app.taxonomy_remap)
+-- Maps an old or variant theme name to its canonical theme in the current taxonomy.
+-- Matching is on the slug (lowercase, non-alphanumerics collapsed to '-').
+
+CREATE TABLE IF NOT EXISTS theme_alias (
+    alias TEXT PRIMARY KEY,
+    theme TEXT NOT NULL,
+    source TEXT DEFAULT 'manual', -- manual | centroid (learned by a remap run)
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_theme_alias_theme ON theme_alias(theme);
+
+GRANT SELECT ON theme_alias TO anon, authenticated;
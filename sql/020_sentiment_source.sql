@@ -0,0 +1,11 @@
+-- Provenance of nps_ai_enrichment.sentiment_score (python -m app.sentiment)
+-- 'llm' when the analysis model gave the score, 'local' when the local scorer
+-- filled it in (enrich fallback or --rescore). Only 'llm' rows are used as
+-- training and evaluation labels. Existing rows predate the local scorer's
+-- writes unless a rescore ran; NULL is read as 'llm'.
+
+ALTER TABLE nps_ai_enrichment ADD COLUMN IF NOT EXISTS sentiment_source TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_nps_ai_enrichment_sentiment_source
+    ON nps_ai_enrichment(sentiment_source)
+    WHERE sentiment_source = 'local';
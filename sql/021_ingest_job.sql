@@ -0,0 +1,20 @@
+-- Ingest job status (POST /ingest/jobs)
+-- Written by the worker running the job on every state change and while rows
+-- go in, so every API worker can report a job and finished jobs survive a
+-- restart. Rows older than INGEST_JOB_RETENTION_DAYS are pruned by the app.
+
+CREATE TABLE IF NOT EXISTS nps_ingest_job (
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    status TEXT NOT NULL, -- queued | parsing | inserting | completed | failed
+    bytes BIGINT DEFAULT 0,
+    counts JSONB DEFAULT '{}'::jsonb,
+    errors JSONB DEFAULT '[]'::jsonb,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_nps_ingest_job_created_at ON nps_ingest_job(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_nps_ingest_job_updated_at ON nps_ingest_job(updated_at);
@@ -0,0 +1,13 @@
+-- Theme usage for the prompt theme list (direct_enrich_final.fetch_current_themes)
+-- Mentions per theme from the precomputed aggregate (sql/017), so the most
+-- used themes are the ones kept when the list is capped.
+
+CREATE OR REPLACE VIEW v_theme_usage AS
+SELECT
+    theme,
+    SUM(mention_count) AS mentions,
+    MAX(month) AS last_month
+FROM nps_theme_aggregate
+GROUP BY theme;
+
+GRANT SELECT ON v_theme_usage TO anon, authenticated;